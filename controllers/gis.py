@@ -866,6 +866,24 @@ def hdata():
 
     return json.dumps(hdict, separators=SEPARATORS)
 
+# -----------------------------------------------------------------------------
+def tiles():
+    """
+        Return a Mapbox Vector Tile of a Feature or Theme Layer:
+            GET '/eden/gis/tiles/' + layer_id + '/' + z + '/' + x + '/' + y + '.mvt'
+    """
+
+    try:
+        layer_id, z, x, y = [int(arg.split(".", 1)[0]) for arg in request.args[:4]]
+    except (ValueError, TypeError):
+        raise HTTP(400)
+
+    from core import VectorTiles
+    data = VectorTiles(layer_id).tile(z, x, y)
+
+    response.headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+    return data
+
 # -----------------------------------------------------------------------------
 def s3_gis_location_parents(r, **attr):
     """
@@ -128,6 +128,193 @@ def gis_update_location_tree(feature, user_id=None):
     db.commit()
     return path
 
+# -----------------------------------------------------------------------------
+def gis_update_location_tree_batch(features, user_id=None):
+    """
+        Update the Location Tree for multiple features
+            - batch variant of gis_update_location_tree, used by
+              s3task.queue_batch to coalesce updates
+
+        @param features: list of features (in JSON format)
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = gis.update_location_tree_batch(features)
+    db.commit()
+    return result
+
+# -----------------------------------------------------------------------------
+def gis_location_simplify(location_id, user_id=None):
+    """
+        Update the pre-computed simplified geometries for a location
+
+        @param location_id: the gis_location record ID
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = gis.update_simplified([location_id])
+    db.commit()
+    return result
+
+# -----------------------------------------------------------------------------
+def gis_location_simplify_batch(location_ids=None, user_id=None):
+    """
+        Update the pre-computed simplified geometries for multiple locations
+            - batch variant of gis_location_simplify, used by
+              s3task.queue_batch to coalesce updates
+            - can also be scheduled without location_ids to rebuild
+              the simplified geometries of all locations (e.g. after
+              changing settings.gis.simplify_tolerances)
+
+        @param location_ids: list of gis_location record IDs, or None for all
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    if location_ids is not None:
+        location_ids = list(set(location_ids))
+    result = gis.update_simplified(location_ids)
+    db.commit()
+    return result
+
+# -----------------------------------------------------------------------------
+def gis_spatial_index_update(location_id, user_id=None):
+    """
+        Update the in-process spatial index for a location
+
+        @param location_id: the gis_location record ID
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    index = gis.get_spatial_index()
+    if index:
+        index.update([location_id])
+
+# -----------------------------------------------------------------------------
+def gis_spatial_index_update_batch(location_ids=None, user_id=None):
+    """
+        Update the in-process spatial index for multiple locations
+            - batch variant of gis_spatial_index_update, used by
+              s3task.queue_batch to coalesce updates
+            - can also be scheduled without location_ids to rebuild
+              the index (e.g. after bulk imports of locations)
+
+        @param location_ids: list of gis_location record IDs, or None for all
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    index = gis.get_spatial_index()
+    if not index:
+        return None
+    if location_ids is None:
+        return index.build()
+    index.update(list(set(location_ids)))
+
+# -----------------------------------------------------------------------------
+def gis_geocode_location(location_id, user_id=None):
+    """
+        Geocode the street address of an imported location
+
+        @param location_id: the gis_location record ID
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    return gis.geocode_batch([location_id])
+
+# -----------------------------------------------------------------------------
+def gis_geocode_location_batch(location_ids=None, user_id=None):
+    """
+        Geocode the street addresses of multiple locations
+            - batch variant of gis_geocode_location, used by
+              s3task.queue_batch to coalesce requests
+            - each distinct address is geocoded only once, and
+              requests to the geocoder service are rate-limited
+            - can also be scheduled without location_ids to geocode
+              all locations with street address but without (or only
+              with inherited) Lat/Lon
+
+        @param location_ids: list of gis_location record IDs, or None for all
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    if location_ids is not None:
+        location_ids = list(set(location_ids))
+        if not location_ids:
+            return 0
+    return gis.geocode_batch(location_ids)
+
+# -----------------------------------------------------------------------------
+def gis_config_screenshot(config_id, user_id=None):
+    """
+        Save a screenshot of a saved map as its image
+            - see settings.gis.config_screenshot
+
+        @param config_id: the gis_config record ID
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    screenshot = settings.get_gis_config_screenshot()
+    if not screenshot:
+        return None
+    width, height = screenshot[:2]
+    filename = gis.get_screenshot(config_id, False, height, width)
+    if filename:
+        table = s3db.gis_config
+        db(table.id == config_id).update(image = filename)
+    return filename
+
+# -----------------------------------------------------------------------------
+def gis_screenshot_seed(config_ids=None, user_id=None):
+    """
+        Pre-render screenshots of saved maps
+            - see settings.gis.screenshot_seed
+            - to be scheduled periodically, so that PDF exports
+              with maps can reuse the pre-rendered images
+
+        @param config_ids: list of gis_config record IDs, or None for all
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    return gis.seed_screenshots(config_ids)
+
+# -----------------------------------------------------------------------------
+def gis_map_config_invalidate(user_id=None):
+    """
+        Invalidate all cached map configurations
+            - deferred by MapConfigCache.invalidate to run after commit
+
+        @param user_id: calling request's auth.user.id or None
+    """
+    from core import MapConfigCache
+    # Run the Task & return the result
+    MapConfigCache.touch()
+
 # -----------------------------------------------------------------------------
 # Org: always-enabled
 # -----------------------------------------------------------------------------
@@ -144,6 +331,122 @@ def org_site_check(site_id, user_id=None):
         customise(site_id)
         db.commit()
 
+# -----------------------------------------------------------------------------
+def org_site_check_batch(site_ids, user_id=None):
+    """
+        Check the Status for multiple Sites
+            - batch variant of org_site_check, uses the bulk-method
+              of the template-specific site check if available
+    """
+
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+
+    # Check for Template-specific processing
+    customise = settings.get_org_site_check()
+    if customise:
+        site_ids = list(dict.fromkeys(site_ids))
+        bulk = getattr(customise, "bulk", None)
+        if callable(bulk):
+            bulk(site_ids)
+        else:
+            for site_id in site_ids:
+                customise(site_id)
+        db.commit()
+
+# -----------------------------------------------------------------------------
+def s3_hierarchy_index(tablename, user_id=None):
+    """
+        Rebuild the subtree index of a hierarchy
+
+        @param tablename: the hierarchical table
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = s3base.S3Hierarchy(tablename).build_index()
+    db.commit()
+    return result
+
+# -----------------------------------------------------------------------------
+def s3_summary_refresh(tablename, name=None, periods=None, user_id=None):
+    """
+        Refresh the materialized summaries of a table
+            - deferred by SummaryTable.schedule to run after writes in
+              web requests, or scheduled periodically to catch up with all
+              modified records (and to rebuild summaries left pending by
+              writes outside of web requests)
+
+        @param tablename: the summarized table
+        @param name: the summary name (None for all summaries of the table)
+        @param periods: additional periods to recompute, list of ISO-format
+                        period starts (all modified periods are recomputed
+                        in any case)
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    for summary in s3base.SummaryTable.configured(tablename):
+        if name is None or summary.name == name:
+            summary.refresh(periods)
+    db.commit()
+
+# -----------------------------------------------------------------------------
+def report_cache_invalidate(tablename, user_id=None):
+    """
+        Invalidate all cached pivot table reports involving a table
+            - deferred by S3PivotTableCache.invalidate to run after commit
+
+        @param tablename: the table name
+        @param user_id: calling request's auth.user.id or None
+    """
+    from core import S3PivotTableCache
+    # Run the Task & return the result
+    S3PivotTableCache.touch(tablename)
+
+# -----------------------------------------------------------------------------
+def auth_set_realm_entity(tablename,
+                          force_update=False,
+                          start=None,
+                          limit=None,
+                          user_id=None):
+    """
+        Bulk-update the realm entity of records in a table
+            - commits after each chunk, and logs the progress
+            - to resume after interruption, re-run with start=<last ID>
+
+        @param tablename: the table name
+        @param force_update: update the realm entity even if already set
+        @param start: process only records with IDs greater than this
+        @param limit: the maximum number of records to process
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+
+    def progress(processed, last_id):
+        db.commit()
+        current.log.info("%s: %s records processed, last ID %s" % (tablename,
+                                                                    processed,
+                                                                    last_id,
+                                                                    ))
+
+    # Run the Task & return the result
+    processed, last_id = auth.set_realm_entity_bulk(tablename,
+                                                    force_update = force_update,
+                                                    start = start,
+                                                    limit = limit,
+                                                    progress = progress,
+                                                    )
+    db.commit()
+    return {"processed": processed, "last_id": last_id}
+
 # -----------------------------------------------------------------------------
 tasks = {"dummy": dummy,
          "s3db_task": s3db_task,
@@ -151,7 +454,22 @@ tasks = {"dummy": dummy,
          "maintenance": maintenance,
          "gis_download_kml": gis_download_kml,
          "gis_update_location_tree": gis_update_location_tree,
+         "gis_update_location_tree_batch": gis_update_location_tree_batch,
+         "gis_location_simplify": gis_location_simplify,
+         "gis_location_simplify_batch": gis_location_simplify_batch,
+         "gis_spatial_index_update": gis_spatial_index_update,
+         "gis_spatial_index_update_batch": gis_spatial_index_update_batch,
+         "gis_geocode_location": gis_geocode_location,
+         "gis_geocode_location_batch": gis_geocode_location_batch,
+         "gis_config_screenshot": gis_config_screenshot,
+         "gis_screenshot_seed": gis_screenshot_seed,
+         "gis_map_config_invalidate": gis_map_config_invalidate,
          "org_site_check": org_site_check,
+         "org_site_check_batch": org_site_check_batch,
+         "s3_hierarchy_index": s3_hierarchy_index,
+         "s3_summary_refresh": s3_summary_refresh,
+         "auth_set_realm_entity": auth_set_realm_entity,
+         "report_cache_invalidate": report_cache_invalidate,
          }
 
 # -----------------------------------------------------------------------------
@@ -326,22 +644,38 @@ if has_module("stats"):
     tasks["stats_demographic_update_aggregates"] = stats_demographic_update_aggregates
 
     # -------------------------------------------------------------------------
-    def stats_demographic_update_location_aggregate(location_level,
-                                                    root_location_id,
-                                                    parameter_id,
-                                                    start_date,
-                                                    end_date,
-                                                    user_id = None,
-                                                    ):
+    def stats_rollup_update(tablename,
+                            records = None,
+                            user_id = None,
+                            ):
+        """
+            Update the rollup aggregates for changed stats data records
+            - deferred from the onaccept/ondelete of the data table
+
+            @param tablename: the stats data table name
+            @param records: list of [parameter_id, location_id, date] of
+                            the changed records
+            @param user_id: calling request's auth.user.id or None
+        """
+        if user_id:
+            # Authenticate
+            auth.s3_impersonate(user_id)
+
+        # Run the Task & return the result
+        result = s3db.stats_Rollup(tablename).update(records or [])
+        db.commit()
+        return result
+
+    tasks["stats_rollup_update"] = stats_rollup_update
+
+    # -------------------------------------------------------------------------
+    def stats_rollup_rebuild(tablename,
+                             user_id = None,
+                             ):
         """
-            Update the stats_demographic_aggregate table for the given location and parameter
-            - called from within stats_demographic_update_aggregates
-
-            @param location_level: gis level at which the data needs to be accumulated
-            @param root_location_id: id of the location
-            @param parameter_id: parameter for which the stats are being updated
-            @param start_date: start date of the period in question
-            @param end_date: end date of the period in question
+            Rebuild all rollup aggregates for a stats data table
+
+            @param tablename: the stats data table name
             @param user_id: calling request's auth.user.id or None
         """
         if user_id:
@@ -349,16 +683,11 @@ if has_module("stats"):
             auth.s3_impersonate(user_id)
 
         # Run the Task & return the result
-        result = s3db.stats_demographic_update_location_aggregate(location_level,
-                                                                  root_location_id,
-                                                                  parameter_id,
-                                                                  start_date,
-                                                                  end_date,
-                                                                  )
+        result = s3db.stats_Rollup(tablename).rebuild()
         db.commit()
         return result
 
-    tasks["stats_demographic_update_location_aggregate"] = stats_demographic_update_location_aggregate
+    tasks["stats_rollup_rebuild"] = stats_rollup_rebuild
 
     # --------------------e----------------------------------------------------
     # Disease: Depends on Stats
@@ -388,38 +717,6 @@ if has_module("stats"):
 
         tasks["disease_stats_update_aggregates"] = disease_stats_update_aggregates
 
-        # ---------------------------------------------------------------------
-        def disease_stats_update_location_aggregates(location_id,
-                                                     children,
-                                                     parameter_id,
-                                                     dates,
-                                                     user_id = None,
-                                                     ):
-            """
-                Update the disease_stats_aggregate table for the given location and parameter
-                - called from within disease_stats_update_aggregates
-
-                @param location_id: location to aggregate at
-                @param children: locations to aggregate from
-                @param parameter_id: parameter to aggregate
-                @param dates: dates to aggregate for
-                @param user_id: calling request's auth.user.id or None
-            """
-            if user_id:
-                # Authenticate
-                auth.s3_impersonate(user_id)
-
-            # Run the Task & return the result
-            result = s3db.disease_stats_update_location_aggregates(location_id,
-                                                                   children,
-                                                                   parameter_id,
-                                                                   dates,
-                                                                   )
-            db.commit()
-            return result
-
-        tasks["disease_stats_update_location_aggregates"] = disease_stats_update_location_aggregates
-
 # -----------------------------------------------------------------------------
 if has_module("sync"):
 
@@ -26,6 +26,7 @@
 """
 
 __all__ = ("AuthS3",
+           "UserRealms",
            )
 
 import binascii
@@ -1164,25 +1165,23 @@ Thank you"""
             userlon = float(position[1])
             accuracy = float(position[2]) / 1000 # Ensures accuracy is in km
             closestpoint = 0
-            closestdistance = 0
-            gis = current.gis
             # @ToDo: Filter to just Sites & Home Addresses?
-            locations = gis.get_features_in_radius(userlat, userlon, accuracy)
+            locations = current.gis.get_features_in_radius(userlat, userlon, accuracy)
 
+            # Find the location closest to the user
             ignore_levels_for_presence = deployment_settings.get_auth_ignore_levels_for_presence()
-            greatCircleDistance = gis.greatCircleDistance
-            for location in locations:
-                if location.level not in ignore_levels_for_presence:
-                    if closestpoint != 0:
-                        currentdistance = greatCircleDistance(closestpoint.lat,
-                                                              closestpoint.lon,
-                                                              location.lat,
-                                                              location.lon)
-                        if currentdistance < closestdistance:
-                            closestpoint = location
-                            closestdistance = currentdistance
-                    else:
-                        closestpoint = location
+            locations = [location for location in locations
+                         if location.level not in ignore_levels_for_presence]
+            if locations:
+                from ..gis import Geodesy
+                nearest = Geodesy.nearest(userlat,
+                                          userlon,
+                                          [location.lat for location in locations],
+                                          [location.lon for location in locations],
+                                          limit = 1,
+                                          )
+                if nearest:
+                    closestpoint = locations[nearest[0][0]]
 
             s3tracker = S3Tracker()
             person_id = self.s3_logged_in_person()
@@ -3985,14 +3984,14 @@ Please go to %(url)s to approve this user."""
             # Permissions of a group apply only for records owned by any of
             # the entities which belong to the realm of the group membership
 
-            # These realms apply for every authenticated user:
+            start = time.time()
 
             if not permission.entity_realm:
                 # All roles apply site-wide (i.e. no realms, policy 5 and below)
                 realms = {row.group_id: None for row in rows}
             else:
                 # Roles are limited to realms (policy 6 and above)
-                default_realm = s3db.pr_default_realms(self.user["pe_id"])
+                default_realm = DEFAULT
 
                 # Store the realms:
                 realms = {}
@@ -4011,6 +4010,8 @@ Please go to %(url)s to approve this user."""
 
                     pe_id = row.pe_id
                     if pe_id is None:
+                        if default_realm is DEFAULT:
+                            default_realm = s3db.pr_default_realms(self.user["pe_id"])
                         if default_realm:
                             realm.extend([e for e in default_realm if e not in realm])
                         if not realm:
@@ -4020,41 +4021,40 @@ Please go to %(url)s to approve this user."""
                     elif pe_id not in realm:
                         realm.append(pe_id)
 
-                if permission.entity_hierarchy:
-                    # Realms include subsidiaries of the realm entities
-
-                    # Get all entities in realms
-                    entities = []
-                    append = entities.append
-                    for realm in realms.values():
-                        if realm is not None:
-                            for entity in realm:
-                                if entity not in entities:
-                                    append(entity)
-
-                    # Lookup the subsidiaries of all realms and extensions
-                    descendants = s3db.pr_descendants(entities)
-
-                    # Add the subsidiaries to the realms
-                    for group_id in realms:
-                        realm = realms[group_id]
-                        if realm is None:
-                            continue
-                        append = realm.append
-                        for entity in list(realm):
-                            if entity in descendants:
-                                for subsidiary in descendants[entity]:
-                                    if subsidiary not in realm:
-                                        append(subsidiary)
-
             # These realms apply for every authenticated user:
             for role in (ANONYMOUS, AUTHENTICATED):
                 if role:
                     realms[role] = None
-            self.user["realms"] = Storage(realms)
+
+            # Realms include subsidiaries of the realm entities, which
+            # are looked up lazily on first access (once per request)
+            expand = permission.entity_realm and permission.entity_hierarchy
+            self.user["realms"] = UserRealms(realms, expand=expand)
+
+            self.realm_timing("set_roles", time.time() - start)
 
         session.s3.roles = list(session_roles)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def realm_timing(key, duration):
+        """
+            Instrumentation: record the time spent in role/realm
+            computation for the current request (in response.s3.realm_timings)
+
+            Args:
+                key: the computation step
+                duration: the time spent (seconds)
+        """
+
+        s3 = current.response.s3
+        timings = s3.realm_timings
+        if timings is None:
+            timings = s3.realm_timings = {}
+        timings[key] = timings.get(key, 0.0) + duration
+
+        current.log.debug("Auth: %s took %.2fms" % (key, duration * 1000))
+
     # -------------------------------------------------------------------------
     def s3_create_role(self, role, description=None, *acls, **args):
         """
@@ -5294,6 +5294,326 @@ Please go to %(url)s to approve this user."""
 
         return
 
+    # -------------------------------------------------------------------------
+    def set_realm_entity_bulk(self,
+                              table,
+                              query = None,
+                              entity = 0,
+                              force_update = False,
+                              start = None,
+                              limit = None,
+                              chunk_size = 1000,
+                              progress = None,
+                              ):
+        """
+            Update the realm entity for large numbers of records, using
+            set-based updates rather than updating record by record
+                - records are processed in chunks ordered by record ID, and
+                  grouped by their computed realm entity for the update
+                - can be resumed from the last processed record ID
+
+            Args:
+                table: the Table (or tablename)
+                query: a query to select the records (default all records)
+                entity: the realm entity
+                            - an person entity ID
+                            - a tuple (table, instance_id)
+                            - 0 for default lookup
+                force_update: update the realm entity even if already set
+                start: process only records with IDs greater than this
+                limit: the maximum number of records to process
+                chunk_size: the number of records to process per chunk
+                progress: a callback function(processed, last_id), called
+                          after each chunk
+
+            Returns:
+                tuple (processed, last_id), where last_id is the ID of the
+                last processed record (None if there were no records)
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        REALM = "realm_entity"
+
+        EID = "pe_id"
+        OID = "organisation_id"
+        SID = "site_id"
+        GID = "group_id"
+        entity_fields = (EID, OID, SID, GID)
+
+        # Find the table
+        if hasattr(table, "_tablename"):
+            tablename = original_tablename(table)
+        else:
+            tablename = table
+            table = s3db.table(tablename)
+        if not table or REALM not in table.fields:
+            return 0, None
+
+        # Realm entity specified by call?
+        realm_entity = entity
+        if isinstance(realm_entity, tuple):
+            realm_entity = s3db.pr_get_pe_id(realm_entity)
+            if not realm_entity:
+                return 0, None
+
+        # Find the available fields
+        fields_in_table = [table._id.name, REALM] + \
+                          [f for f in entity_fields if f in table.fields]
+        fields_to_load = [table[f] for f in fields_in_table]
+
+        if query is None:
+            query = (table._id > 0)
+        if not force_update:
+            query &= (table[REALM] == None)
+
+        processed = 0
+        last_id = start
+
+        get_realm_entities = self.get_realm_entities
+        while True:
+
+            # Select the next chunk
+            q = query
+            if last_id is not None:
+                q &= (table._id > last_id)
+            size = chunk_size
+            if limit is not None:
+                size = min(size, limit - processed)
+                if size <= 0:
+                    break
+            rows = db(q).select(orderby = table._id,
+                                limitby = (0, size),
+                                *fields_to_load)
+            if not rows:
+                break
+
+            # Group the records by realm entity
+            realms = get_realm_entities(table, rows, entity=realm_entity)
+            groups = {}
+            for record_id, realm in realms.items():
+                if realm in groups:
+                    groups[realm].append(record_id)
+                else:
+                    groups[realm] = [record_id]
+
+            # Update records group by group
+            for realm, record_ids in groups.items():
+                self.s3_update_records_owner(table, record_ids,
+                                             update = force_update,
+                                             realm_entity = realm,
+                                             )
+
+            processed += len(rows)
+            last_id = rows.last()[table._id]
+
+            if progress:
+                progress(processed, last_id)
+            if len(rows) < size:
+                break
+
+        return processed, last_id
+
+    # -------------------------------------------------------------------------
+    def s3_update_records_owner(self, table, record_ids, update=False, **fields):
+        """
+            Set-based variant of s3_update_record_owner, updating the
+            same ownership field values in multiple records at once
+
+            Args:
+                table: the table
+                record_ids: the record IDs
+                update: True to update realm_entity in all realm-components
+                fields: dict of {ownership_field:value}
+        """
+
+        # Ownership fields
+        OUSR = "owned_by_user"
+        OGRP = "owned_by_group"
+        REALM = "realm_entity"
+
+        ownership_fields = (OUSR, OGRP, REALM)
+
+        data = dict((key, fields[key]) for key in fields
+                                       if key in ownership_fields)
+        if not data or not record_ids:
+            return
+
+        db = current.db
+
+        # Update records
+        q = (table._id.belongs(record_ids))
+        success = db(q).update(**data)
+
+        if success and update and REALM in data:
+
+            # Update realm-components
+            s3db = current.s3db
+            realm_components = s3db.get_config(table, "realm_components")
+
+            if realm_components:
+                resource = s3db.resource(table,
+                                         components = realm_components,
+                                         )
+                components = resource.components
+                realm = {REALM: data[REALM]}
+                for alias in realm_components:
+                    component = components.get(alias)
+                    if not component:
+                        continue
+                    ctable = component.table
+                    if REALM not in ctable.fields:
+                        continue
+                    # Look up the component record IDs first, as some
+                    # backends (MySQL) reject UPDATEs with a subselect
+                    # from the target table
+                    query = component.get_join() & q
+                    rows = db(query).select(ctable._id)
+                    component_ids = [row[ctable._id] for row in rows]
+                    if not component_ids:
+                        continue
+                    ctablename = component.tablename
+                    if ctable._tablename != ctablename:
+                        # Component with table alias => switch to
+                        # original table for update:
+                        ctable = db[ctablename]
+                    chunk = 1000
+                    for i in range(0, len(component_ids), chunk):
+                        cquery = ctable._id.belongs(component_ids[i:i+chunk])
+                        db(cquery).update(**realm)
+
+        # Update super-entities
+        self.update_shared_fields(table, q, **data)
+
+    # -------------------------------------------------------------------------
+    def get_realm_entities(self, table, rows, entity=0):
+        """
+            Lookup the realm entities for multiple records, bulk variant
+            of get_realm_entity
+
+            Args:
+                table: the Table
+                rows: the records (Rows, or list of Rows/dicts)
+                entity: the entity (pe_id)
+
+            Returns:
+                a dict {record_id: realm_entity}
+
+            Note:
+                realm_entity callbacks (deployment setting or table config)
+                can provide a bulk-method, which is called with the table
+                and the rows, and must return a dict {record_id: realm_entity},
+                where 0 means to fall back to the default lookup cascade
+        """
+
+        if "realm_entity" not in table:
+            return {}
+
+        s3db = current.s3db
+
+        pkey = table._id.name
+
+        # Entity specified by call?
+        if isinstance(entity, tuple):
+            entity = s3db.pr_get_pe_id(entity)
+        if entity != 0:
+            return {row[pkey]: entity for row in rows}
+
+        result = {}
+        pending = {row[pkey]: row for row in rows}
+
+        # Deployment-global method, then table-specific method
+        handlers = (current.deployment_settings.get_auth_realm_entity(),
+                    s3db.get_config(table, "realm_entity"),
+                    )
+        for handler in handlers:
+            if not pending or not callable(handler):
+                continue
+            bulk = getattr(handler, "bulk", None)
+            if callable(bulk):
+                realms = bulk(table, list(pending.values()))
+            else:
+                realms = {record_id: handler(table, row)
+                          for record_id, row in pending.items()}
+            for record_id, realm_entity in realms.items():
+                if realm_entity != 0 and record_id in pending:
+                    result[record_id] = realm_entity
+                    del pending[record_id]
+
+        # Fall back to standard lookup cascade
+        if pending:
+            tablename = original_tablename(table)
+            fields = next(iter(pending.values()))
+            if "pe_id" in fields and \
+               tablename not in ("pr_person", "dvi_body"):
+                for record_id, row in pending.items():
+                    result[record_id] = row["pe_id"]
+            else:
+                for fn, ktablename in (("organisation_id", "org_organisation"),
+                                       ("site_id", "org_site"),
+                                       ("group_id", "pr_group"),
+                                       ):
+                    if fn in fields:
+                        keys = {row[fn] for row in pending.values()}
+                        pe_ids = self.get_pe_ids(ktablename, keys)
+                        for record_id, row in pending.items():
+                            result[record_id] = pe_ids.get(row[fn])
+                        break
+                else:
+                    for record_id in pending:
+                        result[record_id] = None
+
+        return result
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_pe_ids(tablename, record_ids):
+        """
+            Lookup the PE IDs for multiple records of an instance
+            type or super-entity, bulk variant of pr_get_pe_id
+
+            Args:
+                tablename: the instance or super-entity table name
+                record_ids: the record IDs
+
+            Returns:
+                a dict {record_id: pe_id}
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        record_ids = {record_id for record_id in record_ids if record_id}
+        table = s3db.table(tablename)
+        if not table or not record_ids:
+            return {}
+
+        key = table._id.name
+        if "pe_id" in table.fields:
+            rows = db(table._id.belongs(record_ids)).select(table._id,
+                                                            table.pe_id,
+                                                            )
+            return {row[key]: row.pe_id for row in rows}
+
+        if key == "id" or "instance_type" not in table.fields:
+            return {}
+
+        # Super-entity => look up the PE IDs in the instance tables
+        rows = db(table._id.belongs(record_ids)).select(table.instance_type,
+                                                        groupby = table.instance_type,
+                                                        )
+        pe_ids = {}
+        for row in rows:
+            itable = s3db.table(row.instance_type)
+            if not itable or "pe_id" not in itable.fields:
+                continue
+            query = itable[key].belongs(record_ids)
+            instances = db(query).select(itable[key], itable.pe_id)
+            for instance in instances:
+                pe_ids[instance[key]] = instance.pe_id
+        return pe_ids
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_realm_entity(table, record, entity=0):
@@ -5589,4 +5909,123 @@ Please go to %(url)s to approve this user."""
         else:
             return (table.organisation_id == None)
 
+# =============================================================================
+class UserRealms(dict):
+    """
+        The realms of the user's roles, a dict {group_id: [pe_id, ...]},
+        where None means the role applies site-wide
+            - stores only the realm entities the roles are assigned for
+              (also when pickled into the session), and expands them with
+              their subsidiaries (entity hierarchy) on first access of
+              the realms, which then gets memoized for the current request
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, realms=None, expand=False):
+        """
+            Args:
+                realms: the role assignments, dict {group_id: [pe_id, ...]}
+                expand: include subsidiaries of the realm entities
+        """
+
+        realms = realms or {}
+        super().__init__(realms)
+
+        self.assignments = {k: list(v) if v is not None else None
+                            for k, v in realms.items()}
+        self.expand = expand
+        self.expanded = not expand
+
+    # -------------------------------------------------------------------------
+    def __reduce__(self):
+        """ Pickle only the compact (unexpanded) role assignments """
+
+        return (self.__class__, (self.assignments, self.expand))
+
+    # -------------------------------------------------------------------------
+    def __expand(self):
+        """ Expand the realms with the subsidiaries of the realm entities """
+
+        if self.expanded:
+            return
+        self.expanded = True
+
+        start = time.time()
+
+        realms = dict(super().items())
+
+        # Get all entities in realms
+        entities = []
+        append = entities.append
+        for realm in realms.values():
+            if realm is not None:
+                for entity in realm:
+                    if entity not in entities:
+                        append(entity)
+
+        if entities:
+            # Lookup the subsidiaries of all realms and extensions
+            descendants = current.s3db.pr_descendants(entities)
+
+            # Add the subsidiaries to the realms
+            for realm in realms.values():
+                if realm is None:
+                    continue
+                append = realm.append
+                for entity in list(realm):
+                    if entity in descendants:
+                        for subsidiary in descendants[entity]:
+                            if subsidiary not in realm:
+                                append(subsidiary)
+
+        AuthS3.realm_timing("expand_realms", time.time() - start)
+
+    # -------------------------------------------------------------------------
+    def __getitem__(self, key):
+        self.__expand()
+        return super().__getitem__(key)
+
+    # Overriding __iter__ and keys makes dict(), {**realms} and dict.update
+    # use keys() and __getitem__ rather than copying the unexpanded values
+    def __iter__(self):
+        return super().__iter__()
+
+    def keys(self):
+        self.__expand()
+        return super().keys()
+
+    def __eq__(self, other):
+        self.__expand()
+        return super().__eq__(other)
+
+    # dict.__ne__ does not fall back to __eq__
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        self.__expand()
+        return super().__repr__()
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        self.__expand()
+        return super().get(key, default)
+
+    def values(self):
+        self.__expand()
+        return super().values()
+
+    def items(self):
+        self.__expand()
+        return super().items()
+
+    def pop(self, key, *args):
+        self.__expand()
+        return super().pop(key, *args)
+
+    def copy(self):
+        self.__expand()
+        return dict(super().items())
+
 # END =========================================================================
@@ -712,6 +712,8 @@ class LocationFilter(FilterWidget):
 class MapFilter(FilterWidget):
     """
         Map filter widget, normally configured for "~.location_id$the_geom"
+        (or "~.location_id$wkt" with settings.gis.spatial_index and no
+        spatial database)
 
         Keyword Args:
             label: label for the widget
@@ -735,7 +737,8 @@ class MapFilter(FilterWidget):
 
         settings = current.deployment_settings
 
-        if not settings.get_gis_spatialdb():
+        if not settings.get_gis_spatialdb() and \
+           not settings.get_gis_spatial_index():
             current.log.warning("No Spatial DB => Cannot do Intersects Query yet => Disabling MapFilter")
             return ""
 
@@ -1,4 +1,5 @@
 from .card import PDFCardWriter, PDFCardLayout
+from .geojson import GeoJSONWriter
 from .pdf import PDFWriter, EdenDocTemplate
 from .shp import SHPWriter
 from .svg import SVGWriter
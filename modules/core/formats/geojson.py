@@ -0,0 +1,282 @@
+"""
+    GeoJSON Writer
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("GeoJSONWriter",
+           )
+
+import json
+
+from gluon import current
+
+from ..tools import JSONSEPARATORS
+
+from .base import FormatWriter
+
+# =============================================================================
+class GeoJSONWriter(FormatWriter):
+    """
+        Native GeoJSON writer for feature layers
+
+        Encodes the bulk location data from GIS.get_location_data directly
+        as GeoJSON, without building an S3XML tree and transforming it with
+        static/formats/geojson/export.xsl; the output is equivalent to that
+        of the XSLT transformation for normal feature resources.
+
+        With the "cluster" and "zoom" URL parameters, features are clustered
+        server-side (see PointClusters), and only the representative record
+        of each cluster is encoded, with the cluster centroid as geometry
+        and the number of features in the "count" property.
+    """
+
+    # Tables that require special handling by the XSLT stylesheet
+    SPECIAL = ("gis_cache",
+               "gis_feature_query",
+               "gis_location",
+               "gis_theme_data",
+               )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def supports(cls, resource):
+        """
+            Checks whether a resource can be encoded with this writer
+
+            Args:
+                resource: the CRUDResource
+
+            Returns:
+                True|False
+        """
+
+        tablename = resource.tablename
+
+        return tablename not in cls.SPECIAL and \
+               not tablename.startswith("gis_layer_shapefile")
+
+    # -------------------------------------------------------------------------
+    def encode(self,
+               resource,
+               start = None,
+               limit = None,
+               location_data = None,
+               map_data = None,
+               **attr):
+        """
+            Encodes the resource as GeoJSON
+
+            Args:
+                resource: the CRUDResource
+                start: index of the first record to export (slicing)
+                limit: maximum number of records to export (slicing)
+                location_data: dictionary of location data which has been
+                               looked-up in bulk (from get_location_data)
+                map_data: dictionary of options which can be read by the map
+
+            Returns:
+                a JSON string, or None if the resource cannot be encoded
+                natively (caller should fall back to the XSLT export)
+        """
+
+        if not self.supports(resource):
+            return None
+
+        master = resource
+        tablename = resource.tablename
+
+        # Server-side clustering
+        clusters = None
+        get_vars = current.request.get_vars
+        if get_vars.get("cluster") and location_data is None:
+            clusters = self.clusters(resource, get_vars.get("zoom"))
+            if clusters is not None:
+                if not clusters:
+                    resource.results = 0
+                    return "{}"
+                # Encode only the representatives of the clusters
+                resource = current.s3db.resource(tablename, id=list(clusters))
+                start = limit = None
+
+        table = resource.table
+
+        # Load the master records (marker_fn may need all fields)
+        if current.request.get_vars.get("markers") and \
+           resource.get_config("marker_fn"):
+            fields = None
+        else:
+            fields = [fn for fn in ("location_id", "site_id") if fn in table.fields]
+            if not fields:
+                fields = [table._id.name]
+        rows = resource.load(fields = fields,
+                             start = start,
+                             limit = limit,
+                             virtual = False,
+                             cacheable = True,
+                             )
+        master.results = results = len(rows)
+        if not results:
+            return "{}"
+
+        # Bulk-lookup the location data
+        if location_data is None:
+            location_data = current.gis.get_location_data(resource,
+                                                          count = resource.count(),
+                                                          )
+        if not location_data:
+            return None
+
+        geojsons = location_data.get("geojsons", {}).get(tablename)
+        latlons = location_data.get("latlons", {}).get(tablename)
+        if geojsons is None and latlons is None:
+            return None
+
+        attributes = location_data.get("attributes", {}).get(tablename, {})
+        styles = location_data.get("styles", {}).get(tablename, {})
+
+        markers = location_data.get("markers", {}).get(tablename)
+        if markers and markers.get("image"):
+            # Single marker for all features
+            marker = self.marker(markers)
+            markers = None
+        else:
+            marker = None
+
+        features = []
+        append = features.append
+
+        feature = '{"type":"Feature","geometry":%s,"properties":%s}'
+        point = '{"type":"Point","coordinates":[%.4f,%.4f]}'
+        dumps = lambda obj: json.dumps(obj, separators=JSONSEPARATORS)
+
+        pkey = table._id.name
+        for row in rows:
+            record_id = row[pkey]
+
+            if geojsons is not None:
+                geometries = geojsons.get(record_id)
+                if not geometries:
+                    continue
+                if not isinstance(geometries, list):
+                    geometries = [geometries]
+                if markers:
+                    m = self.marker(markers.get(record_id))
+                else:
+                    m = marker
+            else:
+                latlon = latlons.get(record_id)
+                if not latlon:
+                    continue
+                lat, lon = latlon
+                if lat is None or lon is None:
+                    continue
+                geometries = [point % (lon, lat)]
+                # The XSLT does not pass markers for point features
+                m = None
+
+            properties = dict(m) if m else {}
+            properties["id"] = record_id
+            style = styles.get(record_id)
+            if style:
+                properties["style"] = json.loads(style)
+            attrs = attributes.get(record_id)
+            if attrs:
+                for key, value in attrs.items():
+                    if key not in properties:
+                        properties[key] = value
+            if clusters:
+                count, lat, lon = clusters[record_id]
+                if count > 1:
+                    # Cluster point at the centroid, with the attributes
+                    # of the representative record
+                    geometries = [point % (lon, lat)]
+                    properties["count"] = count
+                    properties["cluster"] = 1
+            properties = dumps(properties)
+
+            for geometry in geometries:
+                if geometry and geometry != "null":
+                    append(feature % (geometry, properties))
+
+        if results == 1 and len(features) <= 1:
+            # A single Feature not a Collection
+            return features[0] if features else "{}"
+
+        output = ['{"type":"FeatureCollection"']
+        if map_data:
+            output.append(',"s3":%s' % dumps(map_data))
+        output.append(',"features":[')
+        output.append(",".join(features))
+        output.append("]}")
+
+        return "".join(output)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def clusters(resource, zoom):
+        """
+            Clusters the features of a resource server-side
+
+            Args:
+                resource: the CRUDResource
+                zoom: the zoom level of the map
+
+            Returns:
+                dict {record_id: (count, lat, lon)} of the representative
+                records of the clusters, or None if the features cannot
+                be clustered
+        """
+
+        try:
+            zoom = int(zoom)
+        except (ValueError, TypeError):
+            return None
+
+        from ..gis import PointClusters
+        return PointClusters(resource).clusters(zoom)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def marker(marker):
+        """
+            Encodes a marker as feature properties
+
+            Args:
+                marker: the marker dict (image, height, width)
+
+            Returns:
+                dict of marker properties, or None if no marker
+        """
+
+        if not marker or not marker.get("image"):
+            return None
+
+        return {"marker_url": "/%s/static/img/markers/%s" % \
+                                (current.request.application, marker["image"]),
+                "marker_height": marker["height"],
+                "marker_width": marker["width"],
+                }
+
+# End =========================================================================
@@ -34,7 +34,7 @@ from gluon import HTTP, current
 from gluon.contenttype import contenttype
 from gluon.storage import Storage
 
-from ..tools import get_crud_string, s3_get_foreign_key, s3_str, s3_strip_markup
+from ..tools import get_crud_string, s3_get_foreign_key, s3_has_foreign_key, s3_str, s3_strip_markup
 
 from .base import FormatWriter
 
@@ -778,6 +778,11 @@ class XLSPivotTableWriter:
 
             Returns:
                 the XLS workbook
+
+            Note:
+                The rows are flushed from memory to the workbook's temporary
+                file as they are written, so the layout (=all rows and column
+                widths) is determined before writing
         """
 
         try:
@@ -802,7 +807,6 @@ class XLSPivotTableWriter:
         rows_dim = pt.rows
         cols_dim = pt.cols
 
-        numrows = pt.numrows
         numcols = pt.numcols
 
         # Resource fields for dimensions
@@ -830,252 +834,260 @@ class XLSPivotTableWriter:
                                            report_options.get("fact"),
                                            ))
 
-        # Index of the column for row totals
-        total_column = (numcols + 1) if cols_dim else 1
-
         # Sort+represent rows and columns
         rows, cols = self.sortrepr()
 
+        # Determine the number format for cell values
+        numfmt = self.number_format()
+        totfmt = "integer" if fact.method in ("count", "list") else numfmt
+
+        # Choose cell value style according to number format
+        fact_style = "numeric" if numfmt else None
+
+        # Get fact representation method
+        if fact.method == "list":
+            listrepr = self.listrepr
+            fact_repr = pt._represents([layer])[fact.selector]
+            field = fact_rfield.field
+            fk = field is not None and s3_has_foreign_key(field)
+        else:
+            listrepr = fk = fact_repr = None
+
         # Create workbook and sheet
         book = xlwt.Workbook(encoding="utf-8")
         sheet = book.add_sheet(s3_str(title))
 
-        write = self.write
+        # The rows to write, each a tuple (values, formats, colspans),
+        # with formats being a list of (style, numfmt) per cell (None
+        # for no cell), and colspans a dict {index: colspan}
+        lines = []
 
         # Write header
         title_row = current.deployment_settings.get_xls_title_row()
         if callable(title_row):
             # Custom header (returns number of header rows)
-            title_length = title_row(sheet)
+            title_length = offset = title_row(sheet)
 
         elif title_row:
             # Default header
             title_length = 2
+            offset = 0
 
             # Report title
-            write(sheet, 0, 0, s3_str(title),
-                  colspan = numcols + 2,
-                  style = "title",
-                  )
+            lines.append(([s3_str(title)],
+                          [("title", None)],
+                          {0: numcols + 2},
+                          ))
 
             # Current date/time (in local timezone)
             from ..tools import S3DateTime
             dt = S3DateTime.to_local(current.request.utcnow)
-            write(sheet, 1, 0, dt, style = "subheader", numfmt = "datetime")
+            lines.append(([dt], [("subheader", "datetime")], None))
 
         else:
             # No header
             title_length = -1
+            offset = 0
 
-        rowindex = title_length + 1
-
-        # Fact label
-        if rows_dim and cols_dim:
-            write(sheet, rowindex, 0, fact_label, style="fact_label")
+        # Empty row(s) between header and table
+        for _ in range(title_length + 1 - offset - len(lines)):
+            lines.append(([], [], None))
 
-        # Columns axis title
+        # Fact label and columns axis title
         if cols_dim:
-            write(sheet, rowindex, 1, cols_label,
-                  colspan = numcols,
-                  style = "axis_title",
-                  )
-            rowindex += 1
-
-        # Row axis title
-        write(sheet, rowindex, 0, rows_label, style="axis_title")
-
-        # Column labels
+            lines.append(([fact_label if rows_dim else None, cols_label],
+                          [("fact_label", None) if rows_dim else None, ("axis_title", None)],
+                          {1: numcols},
+                          ))
+
+        # Row axis title, column labels and row totals label
+        values = [rows_label]
+        formats = [("axis_title", None)]
         if cols_dim:
-            for idx, col in enumerate(cols):
-                write(sheet, rowindex, idx + 1, col[2]["text"],
-                      style = "col_label",
-                      )
+            values.extend(col[2]["text"] for col in cols)
+            formats.extend([("col_label", None)] * numcols)
             total_label = TOTAL
         else:
             # Use fact title as row total label if there is no column axis
             total_label = fact_label
+        values.append(total_label)
+        formats.append(("total_right", None))
+        lines.append((values, formats, None))
 
-        # Row totals label
-        write(sheet, rowindex, total_column, total_label, style="total_right")
-
-        # Determine the number format for cell values
-        numfmt = self.number_format()
-        totfmt = "integer" if fact.method in ("count", "list") else numfmt
-
-        # Choose cell value style according to number format
-        fact_style = "numeric" if numfmt else None
-
-        # Get fact representation method
-        if fact.method == "list":
-            listrepr = self.listrepr
-            fk, fact_repr = pt._represents([layer])[fact.selector]
-        else:
-            listrepr = fk = fact_repr = None
-
-        # Write data rows (if any)
-        rowindex += 1
+        # Data rows (if any), all with the same formats
         if rows_dim:
-            icell = pt.cell
-            for i in range(numrows):
-
-                row = rows[i]
-
-                # Row-label
-                write(sheet, rowindex + i, 0, row[2]["text"],
-                      style = "row_label",
-                      )
-
-                # Cell column values (if any)
-                if cols_dim:
-                    for j in range(numcols):
-                        cell = icell[row[0]][cols[j][0]]
-                        if listrepr:
-                            value = listrepr(cell, fact_rfield, fact_repr, fk=fk)
-                        else:
-                            value = cell[layer]
-                        write(sheet, rowindex + i, j + 1, value,
-                              numfmt = numfmt,
-                              style = fact_style,
-                              )
+            formats = [("row_label", None)]
+            if cols_dim:
+                formats.extend([(fact_style, numfmt)] * numcols)
+            formats.append(("total", totfmt))
 
-                # Row-total
-                write(sheet, rowindex + i, total_column, row[1],
-                      style = "total",
-                      numfmt = totfmt,
-                      )
-
-            rowindex += numrows
+            icell = pt.cell
+            cindex = [col[0] for col in cols] if cols_dim else ()
+            for row in rows:
+                cells = icell[row[0]]
+                values = [row[2]["text"]]
+                if listrepr:
+                    values.extend(listrepr(cells[j], fact_rfield, fact_repr, fk=fk)
+                                  for j in cindex)
+                else:
+                    values.extend(cells[j][layer] for j in cindex)
+                values.append(row[1])
+                lines.append((values, formats, None))
             total_label = TOTAL
         else:
             # Use fact label as column totals label if
             # there is no row dimension
             total_label = fact_label
 
-        # Column totals label
-        write(sheet, rowindex, 0, total_label, style="total_left")
-
-        # Column totals
+        # Column totals and grand total
+        values = [total_label]
+        formats = [("total_left", None)]
         if cols_dim:
-            for i in range(numcols):
-                write(sheet, rowindex, i + 1, cols[i][1],
-                      style = "total",
-                      numfmt = totfmt,
-                      )
-
-        # Grand total
-        total = pt.totals[layer]
-        write(sheet, rowindex, total_column, total,
-              style = "grand_total",
-              numfmt = totfmt,
-              )
+            values.extend(col[1] for col in cols)
+            formats.extend([("total", totfmt)] * numcols)
+        values.append(pt.totals[layer])
+        formats.append(("grand_total", totfmt))
+        lines.append((values, formats, None))
+
+        # Write all rows
+        self.write(sheet, lines, offset=offset)
 
         return book
 
     # -------------------------------------------------------------------------
-    def write(self,
-              sheet,
-              rowindex,
-              colindex,
-              value,
-              style=None,
-              numfmt=None,
-              rowspan=None,
-              colspan=None,
-              adjust=True
-              ):
+    def write(self, sheet, lines, offset=0):
         """
-            Write a value to a spreadsheet cell
+            Write rows to a spreadsheet, adjusting column widths and row
+            heights to the contents
 
             Args:
                 sheet: the work sheet
-                rowindex: the row index of the cell
-                colindex: the column index of the cell
-                value: the value to write
-                style: a style name (see styles property)
-                numfmt: a number format name (see formats property)
-                rowspan: number of rows to merge
-                colspan: number of columns to merge
-                adjust: True to adjust column width and row height,
-                        False to suppress automatic adjustment
+                lines: the rows, tuples (values, formats, colspans), see
+                       encode
+                offset: the index of the first row to write
+
+            Note:
+                Column widths and row heights are approximations, no exact
+                science (not possible except by enforcing a particular
+                fixed-width font, which we don't want), so manual
+                adjustments after export may still be necessary. Better
+                solutions welcome!
         """
 
-        styles = self.styles
-        if style:
-            style = styles.get(style)
-        if style is None:
-            style = styles["default"]
-
-        # Apply number format
-        if numfmt:
-            style.num_format_str = self.formats.get(numfmt, "")
+        from xlwt import XFStyle
 
-        # Get the row
-        row = sheet.row(rowindex)
+        import math
+        ceil = math.ceil
 
-        if type(value) is list:
-            labels = [s3_str(v) for v in value]
-            contents = "\n".join(labels)
-        else:
-            labels = [s3_str(value)]
-            contents = value
-
-        # Apply rowspan and colspan
-        rowspan = 0 if not rowspan or rowspan < 1 else rowspan - 1
-        colspan = 0 if not colspan or colspan < 1 else colspan - 1
-        if rowspan > 1 or colspan > 1:
-            # Write-merge
-            sheet.write_merge(rowindex, rowindex + rowspan,
-                              colindex, colindex + colspan,
-                              contents,
-                              style,
-                              )
-        else:
-            # Just write
-            row.write(colindex, contents, style)
-
-        # Reset number format
-        style.num_format_str = ""
-
-        # Adjust column width and row height
-        # NB approximations, no exact science (not possible except by
-        #    enforcing a particular fixed-width font, which we don't
-        #    want), so manual adjustments after export may still be
-        #    necessary. Better solutions welcome!
-        if adjust:
-
-            fontsize = float(style.font.height)
-
-            # Adjust column width
-            col = sheet.col(colindex)
-            if not colspan:
-                if labels:
-                    width = int(min(max(len(l) for l in labels), 28) *
-                                fontsize * 5.0 / 3.0)
+        styles = self.styles
+        formats = self.formats
+
+        # Shared cell formats, XFStyles with the number format applied
+        cell_formats = {}
+        def cell_format(fmt):
+            style, numfmt = fmt
+            base = styles.get(style) if style else None
+            if base is None:
+                base = styles["default"]
+            if numfmt:
+                xfstyle = XFStyle()
+                xfstyle.font = base.font
+                xfstyle.alignment = base.alignment
+                xfstyle.borders = base.borders
+                xfstyle.pattern = base.pattern
+                xfstyle.protection = base.protection
+                xfstyle.num_format_str = formats.get(numfmt, "")
+            else:
+                xfstyle = base
+            cell_formats[fmt] = xfstyle
+            return xfstyle
+
+        # Measure the contents, and determine the column widths
+        widths = []
+        measures = []
+        for values, fmts, colspans in lines:
+            lengths = []
+            for index, (value, fmt) in enumerate(zip(values, fmts)):
+                if fmt is None:
+                    lengths.append(None)
+                    continue
+                if type(value) is list:
+                    lengths.append([len(s3_str(v)) for v in value])
+                    width = max(lengths[-1]) if value else 0
                 else:
-                    width = 0
-                if width > col.width:
-                    col.width = width
+                    width = len(s3_str(value))
+                    lengths.append(width)
+                if index >= len(widths):
+                    widths.extend([0] * (index + 1 - len(widths)))
+                if colspans and colspans.get(index, 1) > 1:
+                    continue
+                style = cell_formats.get(fmt) or cell_format(fmt)
+                width = int(min(width, 28) * float(style.font.height) * 5.0 / 3.0)
+                if width > widths[index]:
+                    widths[index] = width
+            measures.append(lengths)
+
+        for index, width in enumerate(widths):
+            col = sheet.col(index)
+            if width > col.width:
+                col.width = width
+            widths[index] = col.width
+
+        # Write the rows
+        for rowindex, (line, lengths) in enumerate(zip(lines, measures), offset):
+
+            values, fmts, colspans = line
+            if not values:
+                continue
+            row = sheet.row(rowindex)
 
-            # Adjust row height
-            if not rowspan:
+            rowheight = 0
+            for index, (value, fmt) in enumerate(zip(values, fmts)):
+                if fmt is None:
+                    continue
+                style = cell_formats.get(fmt) or cell_format(fmt)
+
+                if type(value) is list:
+                    value = "\n".join(s3_str(v) for v in value)
+
+                # Write (merge) the cell
+                colspan = colspans.get(index, 1) if colspans else 1
+                if colspan > 2:
+                    sheet.write_merge(rowindex, rowindex,
+                                      index, index + colspan - 1,
+                                      value,
+                                      style,
+                                      )
+                else:
+                    row.write(index, value, style)
 
+                # Determine the row height
+                fontsize = float(style.font.height)
                 lineheight = 1.2 if style.font.bold else 1.0
 
-                import math
-                numlines = 0
-                width = (col.width * 0.8 * (colspan + 1))
-                for label in labels:
-                    numlines += math.ceil(len(label) * fontsize / width)
+                width = widths[index] * 0.8 * max(colspan, 1)
+
+                length = lengths[index]
+                if type(length) is list:
+                    numlines = sum(ceil(l * fontsize / width) for l in length)
+                else:
+                    numlines = ceil(length * fontsize / width)
 
                 if numlines > 1:
-                    lines = min(numlines, 10)
-                    height = int((lines + 0.8 / lineheight) *
-                                 fontsize * lineheight)
+                    numlines = min(numlines, 10)
+                    height = int((numlines + 0.8 / lineheight) * fontsize * lineheight)
                 else:
                     height = int(fontsize * lineheight)
-                if height > row.height:
-                    row.height = height
-                    row.height_mismatch = 1
+                if height > rowheight:
+                    rowheight = height
+
+            if rowheight > row.height:
+                row.height = rowheight
+                row.height_mismatch = 1
+
+            # Flush the rows from memory at regular intervals
+            if rowindex % 1000 == 999:
+                sheet.flush_row_data()
 
     # -------------------------------------------------------------------------
     @property
@@ -1266,6 +1278,7 @@ class XLSPivotTableWriter:
         rows_rfield = rfields[rows_dim] if rows_dim else None
         row_repr = pt._represent_method(rows_dim)
         irows = pt.row
+        self.prefetch(rows_rfield, irows)
         rows = []
         for i in range(pt.numrows):
             irow = irows[i]
@@ -1281,6 +1294,7 @@ class XLSPivotTableWriter:
         cols_rfield = rfields[cols_dim] if cols_dim else None
         col_repr = pt._represent_method(cols_dim)
         icols = pt.col
+        self.prefetch(cols_rfield, icols)
         cols = []
         for i in range(pt.numcols):
             icol = icols[i]
@@ -1293,6 +1307,31 @@ class XLSPivotTableWriter:
 
         return rows, cols
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def prefetch(rfield, headers):
+        """
+            Look up the representations of all values of a pivot table
+            axis at once (if the field representation supports bulk
+            lookups), rather than one-by-one when sorting/representing
+            the axis
+
+            Args:
+                rfield: the axis S3ResourceField
+                headers: the row/column headers of the axis
+        """
+
+        field = rfield.field if rfield else None
+        if field is None or not hasattr(field.represent, "bulk"):
+            return
+
+        values = {header.value for header in headers
+                               if "text" not in header and
+                                  header.value is not None and
+                                  type(header.value) is not list}
+        if values:
+            field.represent.bulk(list(values))
+
     # -------------------------------------------------------------------------
     def listrepr(self, cell, rfield, represent, fk=True):
         """
@@ -1318,6 +1357,7 @@ class XLSPivotTableWriter:
         valuemap = self.valuemap
 
         keys = []
+        seen = set()
 
         for record_id in cell["records"]:
             record = records[record_id]
@@ -1335,7 +1375,8 @@ class XLSPivotTableWriter:
                 if v is None:
                     continue
                 if fk:
-                    if v not in keys:
+                    if v not in seen:
+                        seen.add(v)
                         keys.append(v)
                     if v not in lookup:
                         lookup[v] = represent(v)
@@ -1343,11 +1384,13 @@ class XLSPivotTableWriter:
                     if v not in valuemap:
                         next_id = len(valuemap)
                         valuemap[v] = next_id
+                        seen.add(next_id)
                         keys.append(next_id)
                         lookup[next_id] = represent(v)
                     else:
                         prev_id = valuemap[v]
-                        if prev_id not in keys:
+                        if prev_id not in seen:
+                            seen.add(prev_id)
                             keys.append(prev_id)
 
         keys.sort(key=lambda i: lookup[i])
@@ -32,6 +32,7 @@ __all__ = ("XLSXWriter",
 import datetime
 import re
 
+from copy import copy
 from io import BytesIO
 
 from gluon import HTTP, current
@@ -566,13 +567,19 @@ class XLSXPivotTableWriter:
     # -------------------------------------------------------------------------
     def encode(self, title):
         """
-            Convert this pivot table into an XLS file
+            Convert this pivot table into an XLSX file
 
             Args:
                 title: the title of the report
 
             Returns:
-                the XLS workbook
+                the XLSX file contents
+
+            Note:
+                The sheet is written in write-only mode, i.e. the rows are
+                streamed into the file as they are appended rather than
+                kept in memory as cell objects, so the layout (=all rows
+                and column widths) is determined before writing
         """
 
         T = current.T
@@ -597,7 +604,6 @@ class XLSXPivotTableWriter:
         rows_dim = pt.rows
         cols_dim = pt.cols
 
-        numrows = pt.numrows
         numcols = pt.numcols
 
         # Resource fields for dimensions
@@ -618,148 +624,129 @@ class XLSXPivotTableWriter:
             cols_label = ""
         fact_label = s3_str(fact.get_label(fact_rfield, report_options.get("fact")))
 
-        # Index of the column for row totals
-        total_column = (numcols + 1) if cols_dim else 1
-
         # Sort+represent rows and columns
         rows, cols = self.sortrepr()
 
-        # Create workbook and add styles
-        book = Workbook(iso_dates=True)
+        # Determine the number format for cell values
+        numfmt = self.number_format()
+        totfmt = "integer" if fact.method in ("count", "list") else numfmt
+
+        # Choose cell value style according to number format
+        fact_style = "numeric" if numfmt else None
+
+        # Get fact representation method
+        if fact.method == "list":
+            listrepr = self.listrepr
+            fact_repr = pt._represents([layer])[fact.selector]
+            fk = self.is_foreign_key(fact)
+        else:
+            listrepr = fact_repr = None
+            fk = False
+
+        # Create workbook and add styles (write-only, unless a custom
+        # header requires random access to the sheet)
+        title_row = current.deployment_settings.get_xls_title_row()
+        write_only = not callable(title_row)
+
+        book = Workbook(iso_dates=True, write_only=write_only)
         for style in self.styles.values():
             book.add_named_style(style)
 
-        sheet = book.active
-        write = self.write
+        sheet = book.create_sheet() if write_only else book.active
 
-        # Write header
-        title_row = current.deployment_settings.get_xls_title_row()
+        # The rows to write, each a tuple (values, formats, colspans),
+        # with formats being a list of (style, numfmt) per cell (None
+        # for no cell), and colspans a dict {index: colspan}
+        lines = []
+
+        # Header
         if callable(title_row):
             # Custom header (returns number of header rows)
-            title_length = title_row(sheet)
+            title_length = offset = title_row(sheet)
 
         elif title_row:
             # Default header
             title_length = 2
+            offset = 0
 
             # Report title
-            write(sheet, 0, 0, s3_str(title),
-                  colspan = numcols + 2,
-                  style = "title",
-                  )
+            lines.append(([s3_str(title)],
+                          [("title", None)],
+                          {0: numcols + 2},
+                          ))
 
             # Current date/time (in local timezone)
             from ..tools import S3DateTime
             dt = S3DateTime.to_local(current.request.utcnow)
-            write(sheet, 1, 0, dt, style = "subheader", numfmt = "datetime")
+            lines.append(([dt], [("subheader", "datetime")], None))
 
         else:
             # No header
             title_length = -1
+            offset = 0
 
-        rowindex = title_length + 1
+        # Empty row(s) between header and table
+        for _ in range(title_length + 1 - offset - len(lines)):
+            lines.append(([], [], None))
 
-        # Fact label
-        if rows_dim and cols_dim:
-            write(sheet, rowindex, 0, fact_label, style="fact_label")
-
-        # Columns axis title
+        # Fact label and columns axis title
         if cols_dim:
-            write(sheet, rowindex, 1, cols_label,
-                  colspan = numcols,
-                  style = "axis_title",
-                  )
-            rowindex += 1
-
-        # Row axis title
-        write(sheet, rowindex, 0, rows_label, style="axis_title")
-
-        # Column labels
+            lines.append(([fact_label if rows_dim else None, cols_label],
+                          [("fact_label", None) if rows_dim else None, ("axis_title", None)],
+                          {1: numcols},
+                          ))
+
+        # Row axis title, column labels and row totals label
+        values = [rows_label]
+        formats = [("axis_title", None)]
         if cols_dim:
-            for idx, col in enumerate(cols):
-                write(sheet, rowindex, idx + 1, col[2]["text"],
-                      style = "col_label",
-                      )
+            values.extend(col[2]["text"] for col in cols)
+            formats.extend([("col_label", None)] * numcols)
             total_label = TOTAL
         else:
             # Use fact title as row total label if there is no column axis
             total_label = fact_label
+        values.append(total_label)
+        formats.append(("total_right", None))
+        lines.append((values, formats, None))
 
-        # Row totals label
-        write(sheet, rowindex, total_column, total_label, style="total_right")
-
-        # Determine the number format for cell values
-        numfmt = self.number_format()
-        totfmt = "integer" if fact.method in ("count", "list") else numfmt
-
-        # Choose cell value style according to number format
-        fact_style = "numeric" if numfmt else None
-
-        # Get fact representation method
-        if fact.method == "list":
-            listrepr = self.listrepr
-            fact_repr = pt._represents([layer])[fact.selector]
-            fk = self.is_foreign_key(fact)
-        else:
-            listrepr = fact_repr = None
-            fk = False
-
-        # Write data rows (if any)
-        rowindex += 1
+        # Data rows (if any), all with the same formats
         if rows_dim:
+            formats = [("row_label", None)]
+            if cols_dim:
+                formats.extend([(fact_style, numfmt)] * numcols)
+            formats.append(("total", totfmt))
+
             icell = pt.cell
-            for i in range(numrows):
-
-                row = rows[i]
-
-                # Row-label
-                write(sheet, rowindex + i, 0, row[2]["text"],
-                      style = "row_label",
-                      )
-
-                # Cell column values (if any)
-                if cols_dim:
-                    for j in range(numcols):
-                        cell = icell[row[0]][cols[j][0]]
-                        if listrepr:
-                            value = listrepr(cell, fact_rfield, fact_repr, fk=fk)
-                        else:
-                            value = cell[layer]
-                        write(sheet, rowindex + i, j + 1, value,
-                              numfmt = numfmt,
-                              style = fact_style,
-                              )
-
-                # Row-total
-                write(sheet, rowindex + i, total_column, row[1],
-                      style = "total",
-                      numfmt = totfmt,
-                      )
-
-            rowindex += numrows
+            cindex = [col[0] for col in cols] if cols_dim else ()
+            for row in rows:
+                cells = icell[row[0]]
+                values = [row[2]["text"]]
+                if listrepr:
+                    values.extend(listrepr(cells[j], fact_rfield, fact_repr, fk=fk)
+                                  for j in cindex)
+                else:
+                    values.extend(cells[j][layer] for j in cindex)
+                values.append(row[1])
+                lines.append((values, formats, None))
             total_label = TOTAL
         else:
             # Use fact label as column totals label if
             # there is no row dimension
             total_label = fact_label
 
-        # Column totals label
-        write(sheet, rowindex, 0, total_label, style="total_left")
-
-        # Column totals
+        # Column totals and grand total
+        values = [total_label]
+        formats = [("total_left", None)]
         if cols_dim:
-            for i in range(numcols):
-                write(sheet, rowindex, i + 1, cols[i][1],
-                      style = "total",
-                      numfmt = totfmt,
-                      )
-
-        # Grand total
-        total = pt.totals[layer]
-        write(sheet, rowindex, total_column, total,
-              style = "grand_total",
-              numfmt = totfmt,
-              )
+            values.extend(col[1] for col in cols)
+            formats.extend([("total", totfmt)] * numcols)
+        values.append(pt.totals[layer])
+        formats.append(("grand_total", totfmt))
+        lines.append((values, formats, None))
+
+        # Write all rows
+        self.write(sheet, lines, offset=offset)
 
         # Save workbook to temp file and return the contents
         from tempfile import NamedTemporaryFile
@@ -771,101 +758,134 @@ class XLSXPivotTableWriter:
         return output
 
     # -------------------------------------------------------------------------
-    def write(self,
-              sheet,
-              rowindex,
-              colindex,
-              value,
-              style=None,
-              numfmt=None,
-              rowspan=None,
-              colspan=None,
-              adjust=True
-              ):
+    def write(self, sheet, lines, offset=0):
         """
-            Write a value to a spreadsheet cell
+            Write rows to a spreadsheet, adjusting column widths and row
+            heights to the contents
 
             Args:
                 sheet: the work sheet
-                rowindex: the row index of the cell (0-based)
-                colindex: the column index of the cell (0-based)
-                value: the value to write
-                style: a style name (see styles property)
-                numfmt: a number format name (see formats property)
-                rowspan: number of rows to merge
-                colspan: number of columns to merge
-                adjust: True to adjust column width and row height,
-                        False to suppress automatic adjustment
-        """
-
-        rowindex += 1
-        colindex += 1
+                lines: the rows, tuples (values, formats, colspans), see
+                       encode
+                offset: the number of rows already written to the sheet
 
-        if type(value) is list:
-            labels = [s3_str(v) for v in value]
-            contents = "\n".join(labels)
-        else:
-            labels = [s3_str(value)]
-            contents = value
-
-        cell = sheet.cell(rowindex, colindex, value=contents)
-        cell.style = style if style else "default"
-        if numfmt:
-            cell.number_format = self.formats.get(numfmt, "")
-
-        # Apply rowspan and colspan
-        rowspan = 0 if not rowspan or rowspan < 1 else rowspan - 1
-        colspan = 0 if not colspan or colspan < 1 else colspan - 1
-        if rowspan > 0 or colspan > 0:
-            sheet.merge_cells(start_row = rowindex,
-                              start_column = colindex,
-                              end_row = rowindex + rowspan,
-                              end_column = colindex + colspan,
-                              )
-
-        # Adjust column width and row height
-        # NB approximations, no exact science (not possible except by
-        #    enforcing a particular fixed-width font, which we don't
-        #    want), so manual adjustments after export may still be
-        #    necessary. Better solutions welcome!
-        style = self.styles.get(style)
-        if style and adjust:
+            Note:
+                Column widths and row heights are approximations, no exact
+                science (not possible except by enforcing a particular
+                fixed-width font, which we don't want), so manual
+                adjustments after export may still be necessary. Better
+                solutions welcome!
+        """
 
-            from openpyxl.utils import get_column_letter
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+        from openpyxl.worksheet.cell_range import CellRange
 
-            fontsize = float(style.font.sz)
+        import math
+        ceil = math.ceil
 
-            row = sheet.row_dimensions[rowindex]
-            col = sheet.column_dimensions[get_column_letter(colindex)]
+        styles = self.styles
 
-            # Adjust column width
-            if not colspan:
-                if labels:
-                    width = min(max(len(l) for l in labels), 28) * 1.23
+        # Measure the contents, and determine the column widths
+        widths = []
+        measures = []
+        for values, formats, colspans in lines:
+            lengths = []
+            for index, (value, fmt) in enumerate(zip(values, formats)):
+                if not fmt or not fmt[0]:
+                    # Not adjusted
+                    lengths.append(None)
+                    continue
+                if type(value) is list:
+                    lengths.append([len(s3_str(v)) for v in value])
+                    width = max(lengths[-1]) if value else 0
                 else:
-                    width = 0
-                if width > col.width:
-                    col.width = float(width)
-
-            # Adjust row height
-            if not rowspan:
+                    width = len(s3_str(value))
+                    lengths.append(width)
+                if index >= len(widths):
+                    widths.extend([0] * (index + 1 - len(widths)))
+                if colspans and colspans.get(index, 1) > 1:
+                    continue
+                width = min(width, 28) * 1.23
+                if width > widths[index]:
+                    widths[index] = width
+            measures.append(lengths)
+
+        for index, width in enumerate(widths):
+            col = sheet.column_dimensions[get_column_letter(index + 1)]
+            if width > col.width:
+                col.width = float(width)
+            widths[index] = col.width
+
+        # Shared cell formats
+        cell_formats = {}
+        def cell_format(fmt):
+            style, numfmt = fmt
+            cell = WriteOnlyCell(sheet)
+            cell.style = style if style else "default"
+            if numfmt:
+                cell.number_format = self.formats.get(numfmt, "")
+            cell_formats[fmt] = cell._style
+            return cell._style
+
+        # Write the rows
+        for rowindex, (line, lengths) in enumerate(zip(lines, measures), offset + 1):
+
+            values, formats, colspans = line
+
+            # Adjust the row height (before writing the row)
+            rowheight = None
+            for index, length in enumerate(lengths):
+                if length is None:
+                    continue
+                style = styles[formats[index][0]]
 
+                fontsize = float(style.font.sz)
                 lineheight = 1.2 if style.font.bold else 1.0
 
-                import math
-                numlines = 0
-                width = col.width * (colspan + 1)
-                for label in labels:
-                    numlines += math.ceil(len(label) * 1.23 * (fontsize / 10) / width)
+                colspan = colspans.get(index, 1) if colspans else 1
+                width = widths[index] * max(colspan, 1)
+
+                factor = 1.23 * (fontsize / 10) / width
+                if type(length) is list:
+                    numlines = sum(ceil(l * factor) for l in length)
+                else:
+                    numlines = ceil(length * factor)
 
                 if numlines > 1:
-                    lines = min(numlines, 10)
-                    height = int((lines + 0.5 / lineheight) * fontsize * lineheight)
+                    numlines = min(numlines, 10)
+                    height = int((numlines + 0.5 / lineheight) * fontsize * lineheight)
                 else:
                     height = int(fontsize * lineheight)
 
-                if not row.height or height > row.height:
-                    row.height = height
+                if not rowheight or height > rowheight:
+                    rowheight = height
+            if rowheight:
+                sheet.row_dimensions[rowindex].height = rowheight
+
+            # Write the cells
+            cells = []
+            for index, (value, fmt) in enumerate(zip(values, formats)):
+                if fmt is None:
+                    cells.append(None)
+                    continue
+                if type(value) is list:
+                    value = "\n".join(s3_str(v) for v in value)
+                cell = WriteOnlyCell(sheet, value=value)
+                style = cell_formats.get(fmt)
+                cell._style = copy(style if style is not None else cell_format(fmt))
+                cells.append(cell)
+            sheet.append(cells)
+
+            # Merge cells
+            if colspans:
+                for index, colspan in colspans.items():
+                    if colspan > 1:
+                        sheet.merged_cells.add(CellRange(min_row = rowindex,
+                                                         min_col = index + 1,
+                                                         max_row = rowindex,
+                                                         max_col = index + colspan,
+                                                         ))
 
     # -------------------------------------------------------------------------
     @property
@@ -1047,6 +1067,7 @@ class XLSXPivotTableWriter:
         rows_rfield = rfields[rows_dim] if rows_dim else None
         row_repr = pt._represent_method(rows_dim)
         irows = pt.row
+        self.prefetch(rows_rfield, irows)
         rows = []
         for i in range(pt.numrows):
             irow = irows[i]
@@ -1062,6 +1083,7 @@ class XLSXPivotTableWriter:
         cols_rfield = rfields[cols_dim] if cols_dim else None
         col_repr = pt._represent_method(cols_dim)
         icols = pt.col
+        self.prefetch(cols_rfield, icols)
         cols = []
         for i in range(pt.numcols):
             icol = icols[i]
@@ -1074,6 +1096,31 @@ class XLSXPivotTableWriter:
 
         return rows, cols
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def prefetch(rfield, headers):
+        """
+            Look up the representations of all values of a pivot table
+            axis at once (if the field representation supports bulk
+            lookups), rather than one-by-one when sorting/representing
+            the axis
+
+            Args:
+                rfield: the axis S3ResourceField
+                headers: the row/column headers of the axis
+        """
+
+        field = rfield.field if rfield else None
+        if field is None or not hasattr(field.represent, "bulk"):
+            return
+
+        values = {header.value for header in headers
+                               if "text" not in header and
+                                  header.value is not None and
+                                  type(header.value) is not list}
+        if values:
+            field.represent.bulk(list(values))
+
     # -------------------------------------------------------------------------
     def listrepr(self, cell, rfield, represent, fk=True):
         """
@@ -1099,6 +1146,7 @@ class XLSXPivotTableWriter:
         valuemap = self.valuemap
 
         keys = []
+        seen = set()
 
         for record_id in cell["records"]:
             record = records[record_id]
@@ -1116,7 +1164,8 @@ class XLSXPivotTableWriter:
                 if v is None:
                     continue
                 if fk:
-                    if v not in keys:
+                    if v not in seen:
+                        seen.add(v)
                         keys.append(v)
                     if v not in lookup:
                         lookup[v] = represent(v)
@@ -1124,11 +1173,13 @@ class XLSXPivotTableWriter:
                     if v not in valuemap:
                         next_id = len(valuemap)
                         valuemap[v] = next_id
+                        seen.add(next_id)
                         keys.append(next_id)
                         lookup[next_id] = represent(v)
                     else:
                         prev_id = valuemap[v]
-                        if prev_id not in keys:
+                        if prev_id not in seen:
+                            seen.add(prev_id)
                             keys.append(prev_id)
 
         keys.sort(key=lambda i: lookup[i])
@@ -1,2 +1,8 @@
 from .base import GIS
 from .widgets import MAP, MAP2
+from .tiles import VectorTiles
+from .cluster import PointClusters
+from .spatialindex import SpatialIndex
+from .geocoder import GazetteerGeocoder
+from .configcache import MapConfigCache
+from .geodesy import Geodesy
@@ -28,9 +28,11 @@ __all__ = ("GIS",
            )
 
 import datetime
+import hashlib
 import json
 import os
 import sys
+import time
 
 from collections import OrderedDict
 from http import cookies as Cookie
@@ -48,6 +50,8 @@ from s3dal import Rows
 
 from ..tools import JSONSEPARATORS, S3Trackable, s3_str
 
+from .geodesy import Geodesy, RADIUS_EARTH
+
 KML_NAMESPACE = "http://earth.google.com/kml/2.2"
 
 # Map WKT types to db types
@@ -60,9 +64,6 @@ GEOM_TYPES = {"point": 1,
               "geometrycollection": 7,
               }
 
-# km
-RADIUS_EARTH = 6371.01
-
 # Garmin GPS Symbols
 GPS_SYMBOLS = ("Airport",
                "Amusement Park"
@@ -456,63 +457,260 @@ class GIS:
             Geocode an Address
             - used by LocationSelector
                       settings.get_gis_geocode_imported_addresses
+            - results are cached in gis_geocode_cache, see
+              settings.get_gis_geocode_cache_ttl
 
             Args:
                 address: street address
                 postcode: postcode
                 Lx_ids: list of ancestor IDs
                 geocoder: which geocoder service to use
+
+            Returns:
+                dict {"lat": lat, "lon": lon}, or an error message
         """
 
-        try:
-            from geopy import geocoders
-        except ImportError:
-            current.log.error("S3GIS unresolved dependency: geopy required for Geocoder support")
-            return "S3GIS unresolved dependency: geopy required for Geocoder support"
+        settings = current.deployment_settings
+        if geocoder is None:
+            geocoder = settings.get_gis_geocode_service()
+
+        ttl = settings.get_gis_geocode_cache_ttl()
+        if not ttl:
+            return GIS._geocode(address, postcode, Lx_ids, geocoder)
+
+        db = current.db
+        table = current.s3db.gis_geocode_cache
+
+        key = GIS.geocode_key(address, postcode, Lx_ids, geocoder)
+
+        # Look up from cache
+        earliest = current.request.utcnow - datetime.timedelta(days=ttl)
+        query = (table.address_key == key) & (table.created_on > earliest)
+        row = db(query).select(table.lat,
+                               table.lon,
+                               table.result,
+                               limitby = (0, 1),
+                               orderby = ~table.created_on,
+                               ).first()
+        if row:
+            if row.result:
+                return row.result
+            return {"lat": row.lat, "lon": row.lon}
+
+        output = GIS._geocode(address, postcode, Lx_ids, geocoder)
+
+        # Store in cache, unless a (possibly temporary) error occured
+        if isinstance(output, dict):
+            result = None
+        elif isinstance(output, str) and \
+             (output in ("No results found",
+                         "Multiple results found",
+                         "We can only geocode to the Lx",
+                         ) or
+              output.startswith("Returned value not within")):
+            result = output
+        else:
+            return output
+
+        db(table.address_key == key).delete()
+        table.insert(address_key = key,
+                     geocoder = geocoder if isinstance(geocoder, str) else \
+                                getattr(geocoder, "__name__", None),
+                     address = address,
+                     postcode = postcode,
+                     lat = output["lat"] if result is None else None,
+                     lon = output["lon"] if result is None else None,
+                     result = result,
+                     )
+
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geocode_key(address, postcode=None, Lx_ids=None, geocoder=None):
+        """
+            Generates the cache key for a geocoder request, from the
+            normalized address, postcode and Lx
+
+            Args:
+                address: street address
+                postcode: postcode
+                Lx_ids: list of ancestor IDs
+                geocoder: the geocoder service
 
+            Returns:
+                the key (hex digest)
+        """
+
+        normalize = lambda s: " ".join(s3_str(s).lower().replace(",", " ").split()) \
+                              if s else ""
+
+        if not isinstance(geocoder, str):
+            geocoder = getattr(geocoder, "__name__", None)
+
+        Lx = sorted(int(i) for i in Lx_ids) if Lx_ids else []
+
+        key = "|".join((geocoder or "",
+                        normalize(address),
+                        normalize(postcode),
+                        ",".join(str(i) for i in Lx),
+                        ))
+
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def geocode_batch(self, location_ids=None, geocoder=None):
+        """
+            Geocode the street addresses of locations which have no Lat/Lon
+            (or only Lat/Lon inherited from their parent)
+            - each distinct address is geocoded only once
+            - requests to the geocoder service are rate-limited, see
+              settings.get_gis_geocode_rate_limit
+            - used by the gis_geocode_location task
+
+            Args:
+                location_ids: list of gis_location IDs, None for all
+                geocoder: which geocoder service to use
+
+            Returns:
+                the number of locations updated
+        """
+
+        db = current.db
         settings = current.deployment_settings
+
         if geocoder is None:
             geocoder = settings.get_gis_geocode_service()
 
-        if geocoder == "nominatim":
-            g = geocoders.Nominatim(user_agent = "Sahana Eden")
-        elif geocoder == "geonames":
-            username = settings.get_gis_api_google()
-            if not username:
-                current.log.error("Geocoder: No Username defined for GeoNames")
-                return "No Username"
-            g = geocoders.GeoNames(username = username)
-        elif geocoder == "google":
-            api_key = settings.get_gis_geonames_username()
-            if not api_key:
-                current.log.error("Geocoder: No API Key defined for Google")
-                return "No API Key"
-            g = geocoders.GoogleV3(api_key = api_key)
-            #if current.gis.google_geocode_retry:
-            #    # Retry when reaching maximum requests per second
-            #    import time
-            #    from geopy.geocoders.googlev3 import GTooManyQueriesError
-            #    def geocode_(names, g=g, **kwargs):
-            #        attempts = 0
-            #        while attempts < 3:
-            #            try:
-            #                result = g.geocode(names, **kwargs)
-            #            except GTooManyQueriesError:
-            #                if attempts == 2:
-            #                    # Daily limit reached
-            #                    current.gis.google_geocode_retry = False
-            #                    raise
-            #                time.sleep(1)
-            #            else:
-            #                break
-            #            attempts += 1
-            #        return result
-            #else:
+        table = current.s3db.gis_location
+        # Include locations with inherited Lat/Lon, as the tree update
+        # may have run before (e.g. in a separate scheduler task)
+        query = (table.addr_street != None) & \
+                (((table.lat == None) & (table.lon == None)) | \
+                 (table.inherited == True)) & \
+                (table.deleted == False)
+        if location_ids is not None:
+            query &= (table.id.belongs(location_ids))
+        rows = db(query).select(table.id,
+                                table.parent,
+                                table.path,
+                                table.addr_street,
+                                table.addr_postcode,
+                                )
+
+        # Group the locations by address
+        addresses = {}
+        for row in rows:
+            path = row.path
+            if path:
+                Lx_ids = [int(i) for i in path.split("/")[:-1]]
+            elif row.parent:
+                Lx_ids = self.get_parents(row.parent, ids_only=True) or []
+                Lx_ids.append(row.parent)
+            else:
+                Lx_ids = None
+            key = self.geocode_key(row.addr_street, row.addr_postcode, Lx_ids, geocoder)
+            if key in addresses:
+                addresses[key][1].append(row.id)
+            else:
+                addresses[key] = ((row.addr_street, row.addr_postcode, Lx_ids), [row.id])
+
+        rate_limit = settings.get_gis_geocode_rate_limit()
+        interval = 1.0 / rate_limit if rate_limit and geocoder != "gazetteer" else 0
+
+        updated = []
+        last = None
+        for (address, postcode, Lx_ids), ids in addresses.values():
+
+            if interval and last is not None:
+                # Respect the usage limits of the geocoder service
+                wait = last + interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            last = time.time()
+
+            output = self.geocode(address, postcode, Lx_ids, geocoder)
+            if isinstance(output, dict):
+                db(table.id.belongs(ids)).update(lat = output["lat"],
+                                                 lon = output["lon"],
+                                                 inherited = False,
+                                                 )
+                updated.extend(ids)
+            else:
+                current.log.warning("Geocoder: %s (%s)" % (output, address))
+
+        if updated:
+            # Set point geometries (and the tree, in case it has not
+            # been updated yet)
+            self.rebuild_location_tree(updated)
+
+        return len(updated)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _geocode(address, postcode=None, Lx_ids=None, geocoder=None):
+        """
+            Geocode an Address, without cache (see geocode)
+
+            Args:
+                address: street address
+                postcode: postcode
+                Lx_ids: list of ancestor IDs
+                geocoder: which geocoder service to use
+        """
+
+        settings = current.deployment_settings
+        if geocoder is None:
+            geocoder = settings.get_gis_geocode_service()
+
+        if geocoder == "gazetteer":
+            from .geocoder import GazetteerGeocoder
+            g = GazetteerGeocoder()
         elif callable(geocoder):
             # A custom class
             g = geocoder()
         else:
-            raise NotImplementedError
+            try:
+                from geopy import geocoders
+            except ImportError:
+                current.log.error("S3GIS unresolved dependency: geopy required for Geocoder support")
+                return "S3GIS unresolved dependency: geopy required for Geocoder support"
+            if geocoder == "nominatim":
+                g = geocoders.Nominatim(user_agent = "Sahana Eden")
+            elif geocoder == "geonames":
+                username = settings.get_gis_api_google()
+                if not username:
+                    current.log.error("Geocoder: No Username defined for GeoNames")
+                    return "No Username"
+                g = geocoders.GeoNames(username = username)
+            elif geocoder == "google":
+                api_key = settings.get_gis_geonames_username()
+                if not api_key:
+                    current.log.error("Geocoder: No API Key defined for Google")
+                    return "No API Key"
+                g = geocoders.GoogleV3(api_key = api_key)
+                #if current.gis.google_geocode_retry:
+                #    # Retry when reaching maximum requests per second
+                #    import time
+                #    from geopy.geocoders.googlev3 import GTooManyQueriesError
+                #    def geocode_(names, g=g, **kwargs):
+                #        attempts = 0
+                #        while attempts < 3:
+                #            try:
+                #                result = g.geocode(names, **kwargs)
+                #            except GTooManyQueriesError:
+                #                if attempts == 2:
+                #                    # Daily limit reached
+                #                    current.gis.google_geocode_retry = False
+                #                    raise
+                #                time.sleep(1)
+                #            else:
+                #                break
+                #            attempts += 1
+                #        return result
+                #else:
+            else:
+                raise NotImplementedError
 
         geocode_ = lambda names, inst=g, **kwargs: inst.geocode(names, **kwargs)
 
@@ -586,7 +784,7 @@ class GIS:
                     results = geocode_(Lx_names, exactly_one=False)
                     if not results:
                         output = "Can't check that these results are specific enough"
-                    for result in results:
+                    for result in results or []:
                         place2 = result[0]
                         if place == place2:
                             output = "We can only geocode to the Lx"
@@ -747,23 +945,20 @@ class GIS:
         """
             Given a Start & End set of Coordinates, return a Bearing
             Formula from: http://www.movable-type.co.uk/scripts/latlong.html
-        """
 
-        import math
+            Args:
+                lat_start, lon_start: the start coordinates (degrees)
+                lat_end, lon_end: the end coordinates (degrees)
 
-        # shortcuts
-        cos = math.cos
-        sin = math.sin
+            Returns:
+                the compass bearing (degrees)
 
-        delta_lon = lon_start - lon_end
-        bearing = math.atan2(sin(delta_lon) * cos(lat_end),
-                             (cos(lat_start) * sin(lat_end)) - \
-                             (sin(lat_start) * cos(lat_end) * cos(delta_lon))
-                             )
-        # Convert to a compass bearing
-        bearing = (bearing + 360) % 360
+            Note:
+                to calculate bearings for many coordinates in one call,
+                use Geodesy.bearing
+        """
 
-        return bearing
+        return Geodesy.bearing(lat_start, lon_start, lat_end, lon_end)
 
     # -------------------------------------------------------------------------
     def get_bounds(self,
@@ -802,11 +997,6 @@ class GIS:
 
         if features:
 
-            lon_min = 180
-            lat_min = 90
-            lon_max = -180
-            lat_max = -90
-
             # Is this a simple feature set or the result of a join?
             try:
                 lon = features[0].lon
@@ -814,9 +1004,8 @@ class GIS:
             except (AttributeError, KeyError):
                 simple = False
 
-            # @ToDo: Optimised Geospatial routines rather than this crude hack
+            lats, lons = [], []
             for feature in features:
-
                 try:
                     if simple:
                         lon = feature.lon
@@ -828,16 +1017,21 @@ class GIS:
                 except AttributeError:
                     # Skip any rows without the necessary lat/lon fields
                     continue
-
-                # Also skip those set to None. Note must use explicit test,
-                # as zero is a legal value.
-                if lon is None or lat is None:
-                    continue
-
-                lon_min = min(lon, lon_min)
-                lat_min = min(lat, lat_min)
-                lon_max = max(lon, lon_max)
-                lat_max = max(lat, lat_max)
+                lats.append(lat)
+                lons.append(lon)
+
+            # Features without lat/lon are skipped
+            bounds = Geodesy.bounds(lats, lons)
+            if bounds:
+                lon_min = bounds["lon_min"]
+                lat_min = bounds["lat_min"]
+                lon_max = bounds["lon_max"]
+                lat_max = bounds["lat_max"]
+            else:
+                lon_min = 180
+                lat_min = 90
+                lon_max = -180
+                lat_max = -90
 
             # Assure a reasonable-sized box.
             settings = current.deployment_settings
@@ -1363,14 +1557,15 @@ class GIS:
 
             Returns the id of the config it actually used, if any.
 
+            The merged config is cached across requests (see MapConfigCache),
+            until any of the map configuration tables is written to.
+
             Args:
             :param: config_id. use '0' to set the SITE_DEFAULT
 
             @ToDo: Merge configs for Event
         """
 
-        cache = Storage()
-
         _gis = current.response.s3.gis
 
         # If an id has been supplied, try it first. If it matches what's in
@@ -1378,7 +1573,33 @@ class GIS:
         if config_id and not force_update_cache and \
            _gis.config and \
            _gis.config.id == config_id:
-            return cache
+            return Storage()
+
+        build = lambda: GIS._read_config(config_id)
+        if force_update_cache:
+            cache = build()
+        else:
+            from .configcache import MapConfigCache
+            cache = MapConfigCache.config(config_id, build)
+
+        # Store the values
+        _gis.config = cache
+        return cache
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _read_config(config_id=None):
+        """
+            Reads and merges the GIS config from the DB (see set_config)
+
+            Args:
+                config_id: the requested config ID
+
+            Returns:
+                the config (Storage)
+        """
+
+        cache = Storage()
 
         db = current.db
         s3db = current.s3db
@@ -1457,7 +1678,6 @@ class GIS:
                                                            ).first()
             if not row:
                 # No configs found at all
-                _gis.config = cache
                 return cache
 
         # If no id supplied, extend the site config with any personal or OU configs
@@ -1568,7 +1788,6 @@ class GIS:
 
             if not row:
                 # No configs found at all
-                _gis.config = cache
                 return cache
 
         if not cache:
@@ -1586,8 +1805,6 @@ class GIS:
                 cache["marker_%s" % key] = marker[key] if key in marker \
                                                        else None
 
-        # Store the values
-        _gis.config = cache
         return cache
 
     # -------------------------------------------------------------------------
@@ -2020,6 +2237,13 @@ class GIS:
             query &= (table.deleted == False)
         # @ToDo: Check AAA (do this as a resource filter?)
 
+        index = self.get_spatial_index()
+        if index:
+            # Restrict to the locations within the bounds of the polygon
+            location_ids = index.query(*polygon.bounds, limit=index.MAX_IDS)
+            if location_ids is not None:
+                query &= (locations.id.belongs(location_ids))
+
         features = db(query).select(locations.wkt,
                                     locations.lat,
                                     locations.lon,
@@ -2109,59 +2333,18 @@ class GIS:
             Compute a bounding box given a Radius (in km) of a LatLon Location
 
             Returns:
-                a dict containing the bounds with keys min_lon, max_lon,
-                min_lat, max_lat
+                a dict containing the bounds with keys lat_min, lat_max,
+                lon_min, lon_max
 
             See Also:
                 http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
-        """
 
-        import math
+            Note:
+                to calculate bounds for many locations in one call,
+                use Geodesy.bounds_from_radius
+        """
 
-        radians = math.radians
-        degrees = math.degrees
-
-        MIN_LAT = radians(-90)     # -PI/2
-        MAX_LAT = radians(90)      # PI/2
-        MIN_LON = radians(-180)    # -PI
-        MAX_LON = radians(180)     #  PI
-
-        # Convert to radians for the calculation
-        r = float(radius) / RADIUS_EARTH
-        radLat = radians(lat)
-        radLon = radians(lon)
-
-        # Calculate the bounding box
-        minLat = radLat - r
-        maxLat = radLat + r
-
-        if (minLat > MIN_LAT) and (maxLat < MAX_LAT):
-            deltaLon = math.asin(math.sin(r) / math.cos(radLat))
-            minLon = radLon - deltaLon
-            if (minLon < MIN_LON):
-                minLon += 2 * math.pi
-            maxLon = radLon + deltaLon
-            if (maxLon > MAX_LON):
-                maxLon -= 2 * math.pi
-        else:
-            # Special care for Poles & 180 Meridian:
-            # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates#PolesAnd180thMeridian
-            minLat = max(minLat, MIN_LAT)
-            maxLat = min(maxLat, MAX_LAT)
-            minLon = MIN_LON
-            maxLon = MAX_LON
-
-        # Convert back to degrees
-        minLat = degrees(minLat)
-        minLon = degrees(minLon)
-        maxLat = degrees(maxLat)
-        maxLon = degrees(maxLon)
-
-        return {"lat_min": minLat,
-                "lat_max": maxLat,
-                "lon_min": minLon,
-                "lon_max": maxLon,
-                }
+        return Geodesy.bounds_from_radius(float(lat), float(lon), float(radius))
 
     # -------------------------------------------------------------------------
     def get_features_in_radius(self, lat, lon, radius, tablename=None, category=None):
@@ -2262,10 +2445,20 @@ class GIS:
             # shortcut
             locations = db.gis_location
 
-            query = (locations.lat > bbox["lat_min"]) & \
-                    (locations.lat < bbox["lat_max"]) & \
-                    (locations.lon > bbox["lon_min"]) & \
-                    (locations.lon < bbox["lon_max"])
+            index = self.get_spatial_index()
+            location_ids = None
+            if index:
+                location_ids = index.query(bbox["lon_min"], bbox["lat_min"],
+                                           bbox["lon_max"], bbox["lat_max"],
+                                           limit = index.MAX_IDS,
+                                           )
+            if location_ids is not None:
+                query = (locations.id.belongs(location_ids))
+            else:
+                query = (locations.lat > bbox["lat_min"]) & \
+                        (locations.lat < bbox["lat_max"]) & \
+                        (locations.lon > bbox["lon_min"]) & \
+                        (locations.lon < bbox["lon_max"])
             deleted = (locations.deleted == False)
             empty = (locations.lat != None) & (locations.lon != None)
             query = deleted & empty & query
@@ -2295,24 +2488,19 @@ class GIS:
                                            locations.lon_min,
                                            locations.lat_max,
                                            locations.lon_max)
+            # Calculate the Great Circle distances
+            if tablename:
+                lats = [row["gis_location.lat"] for row in records]
+                lons = [row["gis_location.lon"] for row in records]
+            else:
+                lats = [row.lat for row in records]
+                lons = [row.lon for row in records]
+            within = Geodesy.nearest(lat, lon, lats, lons, radius=radius)
+
+            # Retain the original order of the records
             features = Rows()
-            for row in records:
-                # Calculate the Great Circle distance
-                if tablename:
-                    distance = self.greatCircleDistance(lat,
-                                                        lon,
-                                                        row["gis_location.lat"],
-                                                        row["gis_location.lon"])
-                else:
-                    distance = self.greatCircleDistance(lat,
-                                                        lon,
-                                                        row.lat,
-                                                        row.lon)
-                if distance < radius:
-                    features.records.append(row)
-                else:
-                    # skip
-                    continue
+            for i in sorted(i for i, _ in within):
+                features.records.append(records[i])
 
             return features
 
@@ -2365,11 +2553,20 @@ class GIS:
                       query,
                       join = True,
                       geojson = True,
+                      tolerance = DEFAULT,
                       ):
         """
             Returns the locations for an XML export
             - used by GIS.get_location_data() and S3PivotTable.geojson()
 
+            Args:
+                table: the table
+                query: the query (joining table and gis_location if join=True)
+                join: whether the query includes a join with gis_location
+                geojson: return GeoJSON rather than WKT
+                tolerance: the simplification tolerance, default: select
+                           from map zoom level or bbox in the request
+
             @ToDo: Support multiple locations for a single resource
                    (e.g. a Project working in multiple Communities)
         """
@@ -2378,10 +2575,59 @@ class GIS:
         tablename = table._tablename
         gtable = current.s3db.gis_location
         settings = current.deployment_settings
-        tolerance = settings.get_gis_simplify_tolerance()
+        if tolerance is DEFAULT:
+            tolerance = GIS.get_simplify_tolerance()
 
         output = {}
 
+        if geojson and tolerance and \
+           tolerance in settings.get_gis_simplify_tolerances():
+            # Use the pre-computed simplified geometries where available
+            stable = current.s3db.gis_location_simplified
+            left = stable.on((stable.location_id == gtable.id) & \
+                             (stable.tolerance == tolerance))
+            fields = [table._id,
+                      stable.geojson,
+                      stable.location_modified_on,
+                      gtable.modified_on,
+                      gtable.gis_feature_type,
+                      ]
+            if join:
+                fields.append(gtable.id)
+            rows = db(query).select(*fields, left=left)
+            missing = set()
+            stale = set()
+            for row in rows:
+                g = row[stable.geojson]
+                if g and \
+                   row[stable.location_modified_on] != row[gtable.modified_on]:
+                    # Location has been updated without re-computing
+                    # the simplified geometries (e.g. bulk import)
+                    g = None
+                if not g:
+                    location_id = row[gtable.id]
+                    missing.add(location_id)
+                    if row[gtable.gis_feature_type] != 1:
+                        stale.add(location_id)
+                elif join:
+                    key = row[table._id]
+                    if key in output:
+                        output[key].append(g)
+                    else:
+                        output[key] = [g]
+                else:
+                    # gis_location: always single
+                    output[row[table._id]] = g
+            if stale:
+                # Re-compute the simplified geometries (after commit)
+                current.s3task.defer("gis_location_simplify_batch",
+                                     args = [sorted(stale)],
+                                     )
+            if not missing:
+                return output
+            # Simplify the remaining geometries (e.g. points) on the fly
+            query &= gtable.id.belongs(missing)
+
         if settings.get_gis_spatialdb():
             if geojson:
                 precision = settings.get_gis_precision()
@@ -2976,9 +3222,24 @@ class GIS:
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def get_screenshot(config_id, temp=True, height=None, width=None):
+    def get_screenshot(config_id, temp=True, height=None, width=None, cache=True):
         """
             Save a Screenshot of a saved map
+            - rendered images are reused for identical requests (same
+              config, layers, bbox and size) for settings.gis.screenshot_cache
+              seconds, see screenshot_key
+
+            Args:
+                config_id: the gis_config record ID
+                temp: the config is just temporary for taking the screenshot
+                      (=delete it afterwards)
+                height: the height of the image (pixels)
+                width: the width of the image (pixels)
+                cache: reuse a cached image if available
+
+            Returns:
+                the file name of the image (in static/cache/jpg), or None
+                if the rendering failed
 
             @requires:
                 PhantomJS http://phantomjs.org
@@ -2988,14 +3249,14 @@ class GIS:
         # @ToDo: allow selection of map_id
         map_id = "default_map"
 
-        #from selenium import webdriver
-        # We include a Custom version which is patched to access native PhantomJS functions from:
-        # https://github.com/watsonmw/ghostdriver/commit/d9b65ed014ed9ff8a5e852cc40e59a0fd66d0cf1
-        from webdriver import WebDriver
-        from selenium.common.exceptions import TimeoutException, WebDriverException
-        from selenium.webdriver.support.ui import WebDriverWait
-
         request = current.request
+        settings = current.deployment_settings
+
+        if height is None:
+            # Set the size of the browser to match the map
+            height = settings.get_gis_map_height()
+        if width is None:
+            width = settings.get_gis_map_width()
 
         cachepath = os.path.join(request.folder, "static", "cache", "jpg")
 
@@ -3009,6 +3270,38 @@ class GIS:
                 current.session.error = error
                 redirect(URL(c="gis", f="index", vars={"config": config_id}))
 
+        def delete_temp_config():
+            # This was a temporary config for creating the screenshot, then delete it now
+            ctable = current.s3db.gis_config
+            the_set = current.db(ctable.id == config_id)
+            config = the_set.select(ctable.temp,
+                                    limitby = (0, 1)
+                                    ).first()
+            try:
+                if config.temp:
+                    the_set.delete()
+            except:
+                # Record not found?
+                pass
+
+        filename = "map_%s.jpg" % GIS.screenshot_key(config_id, height, width)
+        filepath = os.path.join(cachepath, filename)
+
+        expire = settings.get_gis_screenshot_cache()
+        if cache and expire and os.path.exists(filepath) and \
+           time.time() - os.path.getmtime(filepath) < expire:
+            # Reuse the cached image
+            if temp:
+                delete_temp_config()
+            return filename
+
+        #from selenium import webdriver
+        # We include a Custom version which is patched to access native PhantomJS functions from:
+        # https://github.com/watsonmw/ghostdriver/commit/d9b65ed014ed9ff8a5e852cc40e59a0fd66d0cf1
+        from webdriver import WebDriver
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+        from selenium.webdriver.support.ui import WebDriverWait
+
         # Copy the current working directory to revert back to later
         cwd = os.getcwd()
         # Change to the Cache folder (can't render directly there from execute_phantomjs)
@@ -3021,12 +3314,6 @@ class GIS:
         # Change back for other parts
         os.chdir(cwd)
 
-        settings = current.deployment_settings
-        if height is None:
-            # Set the size of the browser to match the map
-            height = settings.get_gis_map_height()
-        if width is None:
-            width = settings.get_gis_map_width()
         # For Screenshots
         #height = 410
         #width = 820
@@ -3040,7 +3327,7 @@ class GIS:
 
         response = current.response
         session_id = response.session_id
-        if not current.auth.override:
+        if not current.auth.override and session_id:
             # Reuse current session to allow access to ACL-controlled resources
             driver.add_cookie({"name":  response.session_id_name,
                                "value": session_id,
@@ -3076,10 +3363,9 @@ class GIS:
         # @ToDo: Can we use StringIO instead of cluttering filesystem?
         # @ToDo: Allow option of PDF (as well as JPG)
         # https://github.com/ariya/phantomjs/blob/master/examples/rasterize.js
-        if temp:
-            filename = "%s.jpg" % session_id
-        else:
-            filename = "config_%s.jpg" % config_id
+        # - render into a temporary file first, so that concurrent requests
+        #   never see an incomplete image
+        tempname = "%s.%s.jpg" % (filename[:-4], os.getpid())
 
         # Cannot control file size (no access to clipRect) or file format
         #driver.save_screenshot(os.path.join(cachepath, filename))
@@ -3101,7 +3387,7 @@ page.clipRect = {top: 10,
 page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                     {"width": width,
                      "height": height,
-                     "filename": filename,
+                     "filename": tempname,
                      }
         try:
             driver.execute_phantomjs(script)
@@ -3112,23 +3398,176 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         driver.quit()
 
+        try:
+            os.replace(os.path.join(cachepath, tempname), filepath)
+        except OSError as e:
+            current.log.error("GIS: screenshot could not be saved: %s" % e)
+            return None
+
         if temp:
-            # This was a temporary config for creating the screenshot, then delete it now
-            ctable = current.s3db.gis_config
-            the_set = current.db(ctable.id == config_id)
-            config = the_set.select(ctable.temp,
-                                    limitby = (0, 1)
-                                    ).first()
-            try:
-                if config.temp:
-                    the_set.delete()
-            except:
-                # Record not found?
-                pass
+            delete_temp_config()
 
         # Pass the result back to the User
         return filename
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def screenshot_key(config_id, height, width):
+        """
+            Generates the cache key for a map screenshot, from the map view
+            (bbox, zoom, projection), the layers and the image size
+
+            Temporary configs (e.g. for printing the current map view) are
+            identified by their contents, so that identical requests can
+            reuse the same image.
+
+            If any of the layers shows ACL-controlled data (feature, theme
+            or shapefile layers), the key also includes the roles of the
+            current user, as the screenshot is rendered with their session;
+            otherwise the image can be shared by all users, including those
+            pre-rendered by the scheduler (see seed_screenshots).
+
+            Args:
+                config_id: the gis_config record ID
+                height: the height of the image (pixels)
+                width: the width of the image (pixels)
+
+            Returns:
+                the key (hex digest)
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        ctable = s3db.gis_config
+        ltable = s3db.gis_layer_config
+        etable = s3db.gis_layer_entity
+
+        view = ("lat", "lon", "zoom",
+                "lat_min", "lat_max", "lon_min", "lon_max",
+                "projection_id",
+                )
+        fields = [ctable.id, ctable.temp, ctable.modified_on] + \
+                 [ctable[fn] for fn in view]
+        config = db(ctable.id == config_id).select(limitby = (0, 1),
+                                                   *fields).first()
+        if not config:
+            return hashlib.md5(("%s|%s|%s" % (config_id, height, width)).encode("utf-8")).hexdigest()
+
+        key = [str(config[fn]) for fn in view]
+        if not config.temp:
+            key.extend((str(config.id), str(config.modified_on)))
+
+        # Layers of this config and the site default config
+        config_ids = {config.id}
+        default = db(ctable.uuid == "SITE_DEFAULT").select(ctable.id,
+                                                           limitby = (0, 1),
+                                                           ).first()
+        if default:
+            config_ids.add(default.id)
+        query = (ltable.config_id.belongs(config_ids)) & \
+                (ltable.layer_id == etable.layer_id) & \
+                (ltable.deleted == False)
+        rows = db(query).select(ltable.config_id,
+                                ltable.layer_id,
+                                ltable.enabled,
+                                ltable.visible,
+                                ltable.base,
+                                ltable.modified_on,
+                                etable.instance_type,
+                                )
+
+        layers = []
+        acl = False
+        for row in rows:
+            layer = row.gis_layer_config
+            own = layer.config_id == config.id
+            layers.append("%s:%s:%s:%s:%s" % ("c" if own else layer.config_id,
+                                              layer.layer_id,
+                                              layer.enabled,
+                                              layer.visible,
+                                              layer.base,
+                                              ))
+            if not own or not config.temp:
+                layers.append(str(layer.modified_on))
+            if layer.enabled and row.gis_layer_entity.instance_type in ("gis_layer_feature",
+                                                                        "gis_layer_theme",
+                                                                        "gis_layer_shapefile",
+                                                                        ):
+                acl = True
+        key.extend(sorted(layers))
+
+        if acl:
+            # Rendered with the current session
+            if current.auth.override or not current.response.session_id:
+                roles = "public"
+            else:
+                roles = ",".join(str(r) for r in sorted(current.session.s3.roles or []))
+            key.append(roles)
+
+        key.append("%sx%s" % (width, height))
+
+        return hashlib.md5("|".join(key).encode("utf-8")).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def seed_screenshots(config_ids=None):
+        """
+            Pre-renders screenshots of saved maps in the sizes configured
+            in settings.gis.screenshot_seed, and removes expired images from
+            the cache; to be run in the scheduler (gis_screenshot_seed task)
+
+            Args:
+                config_ids: list of gis_config record IDs, None for all
+                            saved (=non-temporary) configs
+
+            Returns:
+                the number of images rendered (or reused)
+        """
+
+        db = current.db
+        settings = current.deployment_settings
+
+        ctable = current.s3db.gis_config
+
+        sizes = settings.get_gis_screenshot_seed()
+        expire = settings.get_gis_screenshot_cache()
+
+        rendered = 0
+        if sizes:
+            query = (ctable.temp == False) & (ctable.deleted == False)
+            if config_ids is not None:
+                query &= (ctable.id.belongs(config_ids))
+            rows = db(query).select(ctable.id)
+            for row in rows:
+                for width, height in sizes:
+                    if GIS.get_screenshot(row.id, False, height, width):
+                        rendered += 1
+
+        if expire and config_ids is None:
+            # Remove images not used for a while, except those
+            # in use as config images
+            cachepath = os.path.join(current.request.folder, "static", "cache", "jpg")
+            try:
+                filenames = os.listdir(cachepath)
+            except OSError:
+                filenames = []
+            if filenames:
+                images = db(ctable.image != None).select(ctable.image)
+                images = {row.image for row in images}
+                now = time.time()
+                for filename in filenames:
+                    if not filename.startswith("map_") or filename in images:
+                        continue
+                    path = os.path.join(cachepath, filename)
+                    try:
+                        if now - os.path.getmtime(path) > 2 * expire:
+                            os.remove(path)
+                    except OSError:
+                        pass
+
+        return rendered
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_shapefile_geojson(resource):
@@ -3262,37 +3701,13 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             Calculate the shortest distance (in km) over the earth's sphere between 2 points
             Formulae from: http://www.movable-type.co.uk/scripts/latlong.html
             (NB We could also use PostGIS functions, where possible, instead of this query)
-        """
 
-        import math
-
-        # shortcuts
-        cos = math.cos
-        sin = math.sin
-        radians = math.radians
-
-        if quick:
-            # Spherical Law of Cosines (accurate down to around 1m & computationally quick)
-            lat1 = radians(lat1)
-            lat2 = radians(lat2)
-            lon1 = radians(lon1)
-            lon2 = radians(lon2)
-            distance = math.acos(sin(lat1) * sin(lat2) + cos(lat1) * cos(lat2) * cos(lon2 - lon1)) * RADIUS_EARTH
-            return distance
+            Note:
+                to calculate distances for many points in one call,
+                use Geodesy.distance (or Geodesy.nearest for rankings)
+        """
 
-        else:
-            # Haversine
-            #asin = math.asin
-            sqrt = math.sqrt
-            pow = math.pow
-            dLat = radians(lat2 - lat1)
-            dLon = radians(lon2 - lon1)
-            a = pow(sin(dLat / 2), 2) + cos(radians(lat1)) * cos(radians(lat2)) * pow(sin(dLon / 2), 2)
-            c = 2 * math.atan2(sqrt(a), sqrt(1 - a))
-            #c = 2 * asin(sqrt(a))              # Alternate version
-            # Convert radians to kilometers
-            distance = RADIUS_EARTH * c
-            return distance
+        return Geodesy.distance(lat1, lon1, lat2, lon2, quick=quick)
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -4210,6 +4625,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         parentEdenCodeField = layer["parentEdenCodeField"]
         parentCodeQuery = (ttable.tag == parentEdenCodeField)
         count = 0
+        parents = set()
         for row in rows:
             # Read Attributes
             feat = lyr[count]
@@ -4287,6 +4703,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                                       gis_feature_type=gis_feature_type,
                                       wkt=wkt,
                                       parent=parent.id)
+                    parents.add(parent.id)
                     ttable.insert(location_id = id,
                                   tag = edenCodeField,
                                   value = code)
@@ -4305,7 +4722,8 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         current.log.debug("Updating Location Tree...")
         try:
-            self.update_location_tree()
+            # Only the subtrees with new locations
+            self.rebuild_location_tree(list(parents))
         except MemoryError:
             # If doing all L2s, it can break memory limits
             # @ToDo: Check now that we're doing by level
@@ -4615,6 +5033,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         # Parse File
         current_row = 0
+        subtrees = set()
 
         def in_bbox(row, bbox):
             return (row.lon_min < bbox[0]) & \
@@ -4694,9 +5113,14 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                 ttable.insert(location_id=new_id,
                               tag="geonames",
                               value=geonameid)
+                subtrees.add(parent or new_id)
             else:
                 continue
 
+        # Update the Location Tree for the subtrees with new locations
+        current.log.debug("Updating Location Tree...")
+        self.rebuild_location_tree(list(subtrees))
+
         current.log.debug("All done!")
         return
 
@@ -4764,6 +5188,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             Args:
                 feature: a feature dict to update the tree for
                          - if not provided then update the whole tree
+                           (set-based, see rebuild_location_tree)
                 all_locations: passed to recursive calls to indicate that this
                                is an update of the whole tree. Used to avoid
                                repeated attempts to update hierarchy locations
@@ -4869,30 +5294,8 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
 
         if not feature:
-            # We are updating all locations.
-            all_locations = True
-            # Do in chunks to save memory and also do in correct order
-            all_fields = (table.id, table.name, table.gis_feature_type,
-                          table.L0, table.L1, table.L2, table.L3, table.L4,
-                          table.lat, table.lon, table.wkt, table.inherited,
-                          # Handle Countries which start with Bounds set, yet are Points
-                          table.lat_min, table.lon_min, table.lat_max, table.lon_max,
-                          table.path, table.parent)
-            for level in ("L0", "L1", "L2", "L3", "L4", "L5", None):
-                query = (table.level == level) & (table.deleted == False)
-                try:
-                    features = db(query).select(*all_fields)
-                except MemoryError:
-                    current.log.error("S3GIS: Unable to update Location Tree for level %s: MemoryError" % level)
-                else:
-                    for feature in features:
-                        feature["level"] = level
-                        wkt = feature["wkt"]
-                        if wkt and not wkt.startswith("POI"):
-                            # Polygons aren't inherited
-                            feature["inherited"] = False
-                        update_location_tree(feature)  # all_locations is False here
-            # All Done!
+            # We are updating all locations => set-based rebuild
+            GIS.rebuild_location_tree()
             return None
 
 
@@ -5903,6 +6306,307 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         return _path
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_location_tree_batch(features):
+        """
+            Update the Location Tree for multiple features
+                - batch variant of update_location_tree, e.g. for
+                  bulk imports of locations, using the set-based
+                  rebuild_location_tree for the subtrees of all features
+
+            Args:
+                features: list of feature dicts (or JSON strings)
+
+            Returns:
+                the number of updated locations
+        """
+
+        if GIS.disable_update_location_tree:
+            return 0
+
+        location_ids = set()
+        for feature in features:
+            if isinstance(feature, str):
+                feature = json.loads(feature)
+            feature_id = feature.get("id")
+            if feature_id:
+                location_ids.add(int(feature_id))
+        if not location_ids:
+            return 0
+
+        return GIS.rebuild_location_tree(list(location_ids))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def rebuild_location_tree(location_ids=None):
+        """
+            Set-based rebuild of the Location Tree (Materialized path,
+            Lx locations and inherited Lat/Lon), for bulk updates:
+                - loads the hierarchy once, computes the tree level by
+                  level in memory, and writes back only the changed
+                  locations in batched UPDATEs
+                - does not re-calculate bounds/centroids of polygons
+                  (unlike update_location_tree for single features)
+
+            Args:
+                location_ids: update only the subtrees of these locations
+                              (e.g. after import), None for the whole tree
+
+            Returns:
+                the number of updated locations
+        """
+
+        if GIS.disable_update_location_tree:
+            return 0
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        LEVELS = ("L0", "L1", "L2", "L3", "L4", "L5")
+
+        # Geometry type from the WKT prefix ("POI", "POL", "MUL", "LIN")
+        wkt_type = table.wkt[:3]
+        fields = [table.id,
+                  table.parent,
+                  table.level,
+                  table.name,
+                  table.path,
+                  table.inherited,
+                  table.lat,
+                  table.lon,
+                  wkt_type,
+                  ] + [table[level] for level in LEVELS]
+
+        deleted = (table.deleted == False)
+        chunk = 10000
+
+        # Rows with the wkt_type expression are not compact, so extract
+        # the gis_location part and add the wkt_type to it
+        tablename = table._tablename
+        def extract(row):
+            location = row[tablename]
+            location.wkt_type = row[wkt_type]
+            return location
+
+        locations = {}
+        children = {}
+        def add(rows):
+            added = []
+            for row in rows:
+                location = extract(row)
+                location_id = location.id
+                if location_id not in locations:
+                    locations[location_id] = location
+                    children.setdefault(location.parent, []).append(location_id)
+                    added.append(location_id)
+            return added
+
+        # Load the hierarchy
+        ancestors = {}
+        if location_ids is None:
+            # All locations, in chunks
+            last = 0
+            while True:
+                rows = db((table.id > last) & deleted).select(*fields,
+                                                              orderby = table.id,
+                                                              limitby = (0, chunk),
+                                                              )
+                if not rows:
+                    break
+                add(rows)
+                last = rows.last()[table.id]
+            roots = [i for i, row in locations.items()
+                       if not row.parent or row.parent not in locations]
+        else:
+            # The subtrees, one query per tree level
+            roots = list(set(location_ids))
+            frontier = roots
+            query = table.id.belongs
+            while frontier:
+                added = []
+                for i in range(0, len(frontier), chunk):
+                    rows = db(query(frontier[i:i+chunk]) & deleted).select(*fields)
+                    added.extend(add(rows))
+                frontier = added
+                query = table.parent.belongs
+
+            # The parents of the roots (assumed to be up-to-date)
+            parents = {locations[i].parent for i in roots
+                       if i in locations and locations[i].parent}
+            parents.difference_update(locations)
+            if parents:
+                rows = db(table.id.belongs(parents)).select(*fields)
+                for row in rows:
+                    row = extract(row)
+                    ancestors[row.id] = (row.path or str(row.id),
+                                         tuple(row[level] for level in LEVELS),
+                                         row.lat,
+                                         row.lon,
+                                         )
+            roots = [i for i in roots if i in locations]
+
+        # Compute the tree, level by level (breadth-first)
+        update_tree = []
+        update_point = []
+
+        visited = set()
+        states = dict(ancestors)
+        queue = roots
+        while queue:
+            next_queue = []
+            for location_id in queue:
+                if location_id in visited:
+                    # Loop in the hierarchy
+                    continue
+                visited.add(location_id)
+                row = locations[location_id]
+
+                level = row.level
+                parent = states.get(row.parent) if row.parent else None
+                if level == "L0" or not parent:
+                    path = str(location_id)
+                    lx = (None,) * 6
+                    parent_lat = parent_lon = None
+                else:
+                    parent_path, lx, parent_lat, parent_lon = parent
+                    path = "%s/%s" % (parent_path, location_id)
+                if level in LEVELS:
+                    index = LEVELS.index(level)
+                    lx = lx[:index] + (row.name,) + (None,) * (5 - index)
+
+                # Polygons (and L0s) don't inherit
+                geometry = row.wkt_type
+                polygon = bool(geometry) and geometry != "POI"
+                inherited = row.inherited
+                lat, lon = row.lat, row.lon
+                if level == "L0" or polygon:
+                    inherited = False
+                elif inherited or lat is None or lon is None:
+                    inherited = True
+                    lat, lon = parent_lat, parent_lon
+
+                states[location_id] = (path, lx, lat, lon)
+
+                current_lx = tuple(row[l] for l in LEVELS)
+                changed = path != row.path or \
+                          lx != current_lx or \
+                          bool(inherited) != bool(row.inherited) or \
+                          lat != row.lat or lon != row.lon
+
+                values = (path,) + lx + (bool(inherited), lat, lon)
+                if not polygon and lat is not None and lon is not None and \
+                   (changed or not geometry):
+                    # Point geometry needs updating too
+                    update_point.append(values + (location_id,))
+                elif changed:
+                    update_tree.append(values + (location_id,))
+
+                next_queue.extend(children.get(location_id, ()))
+            queue = next_queue
+
+        unreached = len(locations) - len(visited)
+        if unreached:
+            current.log.warning("S3GIS: %s locations not reachable from the hierarchy roots (loops?)" % unreached)
+
+        # Write back
+        GIS._update_location_tree_rows(update_tree, point=False)
+        GIS._update_location_tree_rows(update_point, point=True)
+
+        return len(update_tree) + len(update_point)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _update_location_tree_rows(rows, point=False):
+        """
+            Writes computed location tree data back to the database,
+            using executemany with batches of rows
+
+            Args:
+                rows: list of tuples (path, L0, L1, L2, L3, L4, L5,
+                      inherited, lat, lon, id)
+                point: also update the point geometry (WKT, bounds and,
+                       with spatial DB, the_geom) from lat/lon
+
+            Note:
+                This bypasses the DAL, so the modified_on/modified_by meta
+                fields are set here, and caches invalidated explicitly
+        """
+
+        if not rows:
+            return
+
+        db = current.db
+        adapter = db._adapter
+        table = current.s3db.gis_location
+
+        paramstyle = getattr(adapter.driver, "paramstyle", "qmark")
+        placeholder = "?" if paramstyle == "qmark" else "%s"
+
+        settings = current.deployment_settings
+
+        columns = ["path", "L0", "L1", "L2", "L3", "L4", "L5", "lat", "lon"]
+        if point:
+            columns.extend(("wkt", "lat_min", "lat_max", "lon_min", "lon_max"))
+            spatial = settings.get_gis_spatialdb()
+        else:
+            spatial = False
+
+        # Meta fields (same values for all rows, as with DAL updates)
+        meta = []
+        for fn in ("modified_on", "modified_by"):
+            if fn in table.fields:
+                value = table[fn].update
+                meta.append(value() if callable(value) else value)
+                columns.append(fn)
+
+        assignments = ["%s=%s" % (table[fn]._rname, placeholder) for fn in columns]
+        if spatial:
+            assignments.append("%s=ST_GeomFromText(%s,4326)" % \
+                               (table.the_geom._rname, placeholder))
+
+        # Booleans are represented adapter-specifically, so inline them
+        statements = {}
+        for flag in (True, False):
+            statements[flag] = "UPDATE %s SET %s,%s=%s WHERE %s=%s;" % \
+                                (table._rname,
+                                 ",".join(assignments),
+                                 table.inherited._rname,
+                                 adapter.represent(flag, "boolean"),
+                                 table.id._rname,
+                                 placeholder,
+                                 )
+
+        batches = {True: [], False: []}
+        for row in rows:
+            params = list(row[:7]) + [row[8], row[9]]
+            if point:
+                lat, lon = row[8], row[9]
+                wkt = "POINT (%s %s)" % (lon, lat)
+                params.extend((wkt, lat, lat, lon, lon))
+            params.extend(meta)
+            if point and spatial:
+                params.append(wkt)
+            params.append(row[10])
+            batches[row[7]].append(params)
+
+        cursor = adapter.cursor
+        for flag, params in batches.items():
+            statement = statements[flag]
+            for i in range(0, len(params), 1000):
+                cursor.executemany(statement, params[i:i+1000])
+
+        # Invalidate cached reports involving locations
+        if settings.get_ui_report_cache():
+            from ..methods import S3PivotTableCache
+            S3PivotTableCache.invalidate("gis_location")
+
+        # Journal the updates in the spatial index (bypassing the DAL
+        # callbacks), including the inherited lat/lon of non-points
+        if GIS.get_spatial_index():
+            from .spatialindex import SpatialIndex
+            SpatialIndex.journal([row[10] for row in rows])
+
     # -------------------------------------------------------------------------
     @staticmethod
     def wkt_centroid(form):
@@ -6069,12 +6773,40 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         """
 
         table = current.s3db.gis_location
+
+        index = GIS.get_spatial_index()
+        if index:
+            location_ids = index.query(lon_min, lat_min, lon_max, lat_max,
+                                       limit = index.MAX_IDS,
+                                       )
+            if location_ids is not None:
+                return table.id.belongs(location_ids)
+
         query = (table.lat_min <= lat_max) & \
                 (table.lat_max >= lat_min) & \
                 (table.lon_min <= lon_max) & \
                 (table.lon_max >= lon_min)
         return query
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_spatial_index():
+        """
+            The in-process spatial index of locations, if enabled
+
+            Returns:
+                the SpatialIndex, or None if disabled or the database
+                has spatial extensions
+        """
+
+        settings = current.deployment_settings
+        if settings.get_gis_spatialdb() or \
+           not settings.get_gis_spatial_index():
+            return None
+
+        from .spatialindex import SpatialIndex
+        return SpatialIndex.instance()
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_features_by_bbox(lon_min, lat_min, lon_max, lat_max):
@@ -6198,6 +6930,147 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                              lon_max=table.lon,
                              lat_max=table.lat)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_simplify_tolerance():
+        """
+            Selects the simplification tolerance for the current request:
+            the coarsest pre-computed tolerance that is still finer than
+            one map pixel, as determined from the "zoom" or "bbox" URL
+            parameters
+
+            Returns:
+                the tolerance (falls back to the global tolerance), or
+                None if all pre-computed tolerances are coarser than a
+                pixel (i.e. at high zoom levels, to use the raw geometry)
+        """
+
+        settings = current.deployment_settings
+        tolerance = settings.get_gis_simplify_tolerance()
+
+        tolerances = settings.get_gis_simplify_tolerances()
+        if not tolerance or not tolerances:
+            return tolerance
+
+        get_vars = current.request.get_vars
+        resolution = None
+
+        zoom = get_vars.get("zoom")
+        bbox = get_vars.get("bbox")
+        if zoom:
+            # Degrees per pixel at this zoom level (256px tiles)
+            try:
+                resolution = 360.0 / (256 * 2 ** int(zoom))
+            except (ValueError, TypeError):
+                pass
+        elif bbox:
+            # Degrees per pixel for the map width
+            if isinstance(bbox, list):
+                bbox = bbox[0]
+            try:
+                lon_min, lat_min, lon_max, lat_max = [float(v) for v in bbox.split(",")]
+            except (ValueError, AttributeError):
+                pass
+            else:
+                resolution = abs(lon_max - lon_min) / (settings.get_gis_map_width() or 1000)
+
+        if resolution is not None:
+            candidates = [t for t in tolerances if t <= resolution]
+            tolerance = max(candidates) if candidates else None
+
+        return tolerance
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_simplified(location_ids=None):
+        """
+            Pre-computes the simplified geometries of locations for all
+            tolerances in settings.gis.simplify_tolerances
+
+            Args:
+                location_ids: list of gis_location record IDs,
+                              None to update all locations
+
+            Returns:
+                the number of locations updated
+        """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        gtable = s3db.gis_location
+        stable = s3db.gis_location_simplified
+
+        tolerances = settings.get_gis_simplify_tolerances()
+
+        # Points do not need simplifying
+        query = (gtable.deleted == False) & \
+                (gtable.gis_feature_type != 1) & \
+                (gtable.wkt != None)
+
+        if location_ids is None:
+            db(stable.id > 0).delete()
+            rows = db(query).select(gtable.id)
+            location_ids = [row.id for row in rows]
+        else:
+            if not isinstance(location_ids, (list, tuple, set)):
+                location_ids = [location_ids]
+            db(stable.location_id.belongs(location_ids)).delete()
+
+        if not tolerances or not location_ids:
+            return 0
+
+        precision = settings.get_gis_precision()
+        spatial = settings.get_gis_spatialdb()
+        simplify = GIS.simplify
+
+        updated = 0
+        chunk_size = 500
+        for i in range(0, len(location_ids), chunk_size):
+            chunk = location_ids[i:i + chunk_size]
+            cquery = query & (gtable.id.belongs(chunk))
+
+            items = []
+            if spatial:
+                the_geom = gtable.the_geom
+                for tolerance in tolerances:
+                    g = the_geom.st_simplifypreservetopology(tolerance) \
+                                .st_asgeojson(precision=precision) \
+                                .with_alias("geojson")
+                    rows = db(cquery).select(gtable.id, gtable.modified_on, g)
+                    for row in rows:
+                        items.append({"location_id": row[gtable.id],
+                                      "location_modified_on": row[gtable.modified_on],
+                                      "tolerance": tolerance,
+                                      "geojson": row.geojson,
+                                      })
+                updated += len(rows)
+            else:
+                rows = db(cquery).select(gtable.id,
+                                         gtable.modified_on,
+                                         gtable.wkt,
+                                         )
+                for row in rows:
+                    for tolerance in tolerances:
+                        g = simplify(row.wkt,
+                                     tolerance = tolerance,
+                                     output = "geojson",
+                                     precision = precision,
+                                     )
+                        if g:
+                            items.append({"location_id": row.id,
+                                          "location_modified_on": row.modified_on,
+                                          "tolerance": tolerance,
+                                          "geojson": g,
+                                          })
+                updated += len(rows)
+
+            if items:
+                stable.bulk_insert(items)
+
+        return updated
+
     # -------------------------------------------------------------------------
     @staticmethod
     def simplify(wkt,
@@ -0,0 +1,395 @@
+"""
+    Server-side Clustering of Point Features
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("PointClusters",
+           )
+
+import hashlib
+
+from gluon import current
+
+from ..resource import S3Joins
+
+# Maximum latitude of the spherical mercator projection
+MAX_LAT = 85.0511287798
+
+# =============================================================================
+class PointClusters:
+    """
+        Grid-based clustering of the features of a resource by their
+        location (lat/lon), per zoom level
+
+        The index (projected coordinates of all features) is cached in
+        RAM, and invalidated whenever features or locations are added,
+        modified or deleted; cluster results are cached per zoom level
+        within the index.
+
+        The index is built without the bbox filter of the request (so it
+        can be reused as the map is panned), and filtered by the bbox
+        when clustering.
+    """
+
+    # Size of the grid cells in pixels
+    GRID = 60
+
+    # Cache expiry (seconds)
+    EXPIRE = 3600
+
+    def __init__(self, resource):
+        """
+            Args:
+                resource: the CRUDResource
+        """
+
+        self.resource = resource
+
+    # -------------------------------------------------------------------------
+    def clusters(self, zoom):
+        """
+            Clusters the features for a zoom level
+
+            Args:
+                zoom: the zoom level (integer)
+
+            Returns:
+                dict {record_id: (count, lat, lon)}, where record_id is the
+                ID of the representative record of the cluster, and lat/lon
+                the centroid of the cluster; or None if the resource cannot
+                be clustered (e.g. numpy not installed)
+        """
+
+        try:
+            import numpy as np
+        except ImportError:
+            current.log.error("GIS unresolved dependency: numpy required for server-side clustering")
+            return None
+
+        index = self.index()
+        if index is None:
+            return None
+
+        zoom = max(0, min(int(zoom), 22))
+
+        ids, x, y = index["ids"], index["x"], index["y"]
+
+        bboxes = self.bboxes()
+        if bboxes:
+            # Filter the index by the bbox(es) of the request
+            mask = np.ones(len(ids), dtype=bool)
+            for min_lon, min_lat, max_lon, max_lat in bboxes:
+                (x0, x1), (y1, y0) = self.project(np.array([min_lat, max_lat]),
+                                                  np.array([min_lon, max_lon]),
+                                                  )
+                mask &= (x > x0) & (x < x1) & (y > y0) & (y < y1)
+            clusters = self.cluster(ids[mask], x[mask], y[mask], zoom)
+        else:
+            clusters = index["zoom"].get(zoom)
+            if clusters is None:
+                clusters = self.cluster(ids, x, y, zoom)
+                index["zoom"][zoom] = clusters
+
+        return clusters
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def cluster(cls, ids, x, y, zoom):
+        """
+            Clusters features by grid cells
+
+            Args:
+                ids: array of record IDs
+                x: array of normalized mercator x-coordinates
+                y: array of normalized mercator y-coordinates
+                zoom: the zoom level
+
+            Returns:
+                dict {record_id: (count, lat, lon)}, see clusters()
+        """
+
+        import numpy as np
+
+        if not len(ids):
+            return {}
+
+        # Assign the features to grid cells (x/y are normalized
+        # mercator coordinates in the range 0..1)
+        size = cls.GRID / (256.0 * 2 ** zoom)
+        cols = np.floor(x / size).astype(np.int64)
+        rows = np.floor(y / size).astype(np.int64)
+        cells = cols * (int(1.0 / size) + 2) + rows
+
+        cells, first, inverse, counts = np.unique(cells,
+                                                  return_index = True,
+                                                  return_inverse = True,
+                                                  return_counts = True,
+                                                  )
+
+        # Cluster centroids
+        cx = np.bincount(inverse, weights=x) / counts
+        cy = np.bincount(inverse, weights=y) / counts
+        lat, lon = cls.unproject(cx, cy)
+
+        # The first feature in a cell represents the cluster
+        representatives = ids[first]
+
+        return {int(r): (int(c), float(la), float(lo))
+                for r, c, la, lo in zip(representatives, counts, lat, lon)
+                }
+
+    # -------------------------------------------------------------------------
+    def bboxes(self):
+        """
+            The bounding boxes from the resource URL filter
+
+            Returns:
+                list of tuples (min_lon, min_lat, max_lon, max_lat)
+        """
+
+        get_vars = self.resource.vars
+        if not get_vars or get_vars.get("track"):
+            return []
+
+        bboxes = []
+        for k, v in get_vars.items():
+            if k[:4] == "bbox":
+                if type(v) is list:
+                    v = v[-1]
+                try:
+                    bbox = tuple(float(c) for c in v.split(","))
+                except (ValueError, AttributeError):
+                    continue
+                if len(bbox) == 4:
+                    bboxes.append(bbox)
+        return bboxes
+
+    # -------------------------------------------------------------------------
+    def index(self):
+        """
+            The cluster index of the resource, i.e. the projected coordinates
+            of all its features, looked up from cache if available
+
+            Returns:
+                a dict {"version": the data version,
+                        "ids": array of record IDs,
+                        "x": array of normalized mercator x-coordinates,
+                        "y": array of normalized mercator y-coordinates,
+                        "zoom": {zoom: clusters},
+                        }
+        """
+
+        query = self.feature_query()
+        if query is None:
+            return None
+        query, join, left = query
+
+        key = "%s|%s|%s" % (query, join, left)
+        key = "gis_clusters_%s" % hashlib.md5(key.encode("utf-8")).hexdigest()
+
+        version = self.version()
+        build = lambda: self.build(query, join, left, version)
+
+        cache = current.cache.ram
+        index = cache(key, build, time_expire=self.EXPIRE)
+        if index["version"] != version:
+            # Features or locations have changed => rebuild
+            cache(key, None)
+            index = cache(key, build, time_expire=self.EXPIRE)
+
+        return index
+
+    # -------------------------------------------------------------------------
+    def build(self, query, join, left, version):
+        """
+            Builds the cluster index
+
+            Args:
+                query: the feature query
+                join: the inner joins for the query
+                left: the left joins for the query
+                version: the data version
+
+            Returns:
+                the index (see index())
+        """
+
+        import numpy as np
+
+        table = self.resource.table
+        gtable = current.s3db.gis_location
+
+        query &= (gtable.lat != None) & (gtable.lon != None)
+        rows = current.db(query).select(table._id,
+                                        gtable.lat,
+                                        gtable.lon,
+                                        join = join,
+                                        left = left,
+                                        distinct = True,
+                                        )
+
+        ids, lats, lons = [], [], []
+        for row in rows:
+            ids.append(row[table._id])
+            lats.append(row[gtable.lat])
+            lons.append(row[gtable.lon])
+
+        x, y = self.project(np.array(lats, dtype=np.float64),
+                            np.array(lons, dtype=np.float64),
+                            )
+
+        return {"version": version,
+                "ids": np.array(ids, dtype=np.int64),
+                "x": x,
+                "y": y,
+                "zoom": {},
+                }
+
+    # -------------------------------------------------------------------------
+    def feature_query(self):
+        """
+            The query for the resource features joined with their locations
+
+            Returns:
+                tuple (query, join, left), or None if the features
+                cannot be clustered
+        """
+
+        s3db = current.s3db
+
+        resource = self.resource
+        table = resource.table
+        tablename = resource.tablename
+        gtable = s3db.gis_location
+
+        rfilter = resource.rfilter
+        if rfilter.get_filter() is not None:
+            # Virtual filter => not cacheable
+            return None
+
+        # Remove the bbox filter (and its joins) from the query, so that
+        # the index can be reused for other bboxes
+        get_vars = resource.vars
+        bbox, bbox_joins = None, None
+        if get_vars and not get_vars.get("track"):
+            bbox, bbox_joins = rfilter.parse_bbox_query(resource, get_vars)
+
+        all_queries, all_ljoins = rfilter.queries, rfilter.ljoins
+        if bbox is not None:
+            rfilter.queries = [q for q in all_queries if str(q) != str(bbox)]
+            rfilter.ljoins = {tn: j for tn, j in all_ljoins.items() if tn not in bbox_joins}
+            rfilter.query = None
+        try:
+            query = resource.get_query()
+            ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+            ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+        finally:
+            if bbox is not None:
+                rfilter.queries, rfilter.ljoins = all_queries, all_ljoins
+                rfilter.query = None
+        join = ijoins.as_list(prefer=ljoins)
+        left = ljoins.as_list()
+
+        if tablename == "gis_location":
+            pass
+        elif "location_id" in table.fields:
+            query &= (table.location_id == gtable.id)
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            query &= (table.site_id == stable.site_id) & \
+                     (stable.location_id == gtable.id)
+        else:
+            return None
+
+        return query, join, left
+
+    # -------------------------------------------------------------------------
+    def version(self):
+        """
+            A version string of the resource data, changes whenever
+            features or their locations are added, modified or deleted
+
+            Returns:
+                the version string
+        """
+
+        db = current.db
+
+        version = []
+        for t in (self.resource.table, current.s3db.gis_location):
+            if "modified_on" in t.fields:
+                cnt = t._id.count()
+                mtime = t.modified_on.max()
+                row = db(t._id > 0).select(cnt, mtime).first()
+                version.extend((row[cnt], row[mtime]))
+
+        return "|".join(str(v) for v in version)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def project(lat, lon):
+        """
+            Projects lat/lon to normalized spherical mercator coordinates
+
+            Args:
+                lat: array of latitudes
+                lon: array of longitudes
+
+            Returns:
+                tuple of arrays (x, y), in the range 0..1, origin top-left
+        """
+
+        import numpy as np
+
+        lat = np.clip(lat, -MAX_LAT, MAX_LAT)
+
+        x = (lon + 180.0) / 360.0
+        sin = np.sin(np.radians(lat))
+        y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)
+
+        return np.clip(x, 0.0, 1.0), np.clip(y, 0.0, 1.0)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def unproject(x, y):
+        """
+            Converts normalized spherical mercator coordinates back to lat/lon
+
+            Args:
+                x: array of x-coordinates
+                y: array of y-coordinates
+
+            Returns:
+                tuple of arrays (lat, lon)
+        """
+
+        import numpy as np
+
+        lon = x * 360.0 - 180.0
+        lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y))))
+
+        return lat, lon
+
+# END =========================================================================
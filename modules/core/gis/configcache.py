@@ -0,0 +1,615 @@
+"""
+    Map Configuration Cache
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__all__ = ("MapConfigCache",
+           )
+
+import copy
+import json
+import os
+import uuid
+
+from functools import partial
+
+from gluon import current, HTTP
+from gluon.storage import Storage
+
+from ..tools import JSONSEPARATORS
+
+from .layers import LayerArcREST, LayerBing, LayerCoordinate, LayerEmpty, LayerFeature, \
+                    LayerGPX, LayerGeoJSON, LayerGeoRSS, LayerGoogle, LayerJS, LayerKML, \
+                    LayerOSM, LayerOpenWeatherMap, LayerShapefile, LayerTMS, LayerTheme, \
+                    LayerWFS, LayerWMS, LayerXYZ
+
+LAYER_TYPES = {"gis_layer_openstreetmap": LayerOSM,
+               # NB v3 doesn't work when initially hidden
+               "gis_layer_google": LayerGoogle,
+               "gis_layer_arcrest": LayerArcREST,
+               "gis_layer_bing": LayerBing,
+               "gis_layer_tms": LayerTMS,
+               "gis_layer_wms": LayerWMS,
+               "gis_layer_xyz": LayerXYZ,
+               "gis_layer_empty": LayerEmpty,
+               "gis_layer_js": LayerJS,
+               "gis_layer_theme": LayerTheme,
+               "gis_layer_geojson": LayerGeoJSON,
+               "gis_layer_gpx": LayerGPX,
+               "gis_layer_coordinate": LayerCoordinate,
+               "gis_layer_georss": LayerGeoRSS,
+               "gis_layer_kml": LayerKML,
+               "gis_layer_openweathermap": LayerOpenWeatherMap,
+               "gis_layer_shapefile": LayerShapefile,
+               "gis_layer_wfs": LayerWFS,
+               "gis_layer_feature": LayerFeature,
+               }
+
+# =============================================================================
+class MapConfigCache:
+    """
+        Cache for compiled map configurations, i.e. the merged gis_config
+        (see GIS.set_config) and the serialized layer definitions of maps,
+        shared between requests
+
+        Entries are cached in RAM, and invalidated by writes to any of the
+        map configuration tables (see watch) - across processes by means of
+        a version stamp in uploads/gis_cache. Writes to temporary configs
+        (e.g. for printing) and their layer configs and styles do not
+        invalidate the cache.
+    """
+
+    # Cache expiry (seconds)
+    EXPIRE = 3600
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def path(cls):
+        """
+            The path of the version stamp file
+
+            Returns:
+                the path
+        """
+
+        return os.path.join(current.request.folder,
+                            "uploads", "gis_cache", "map_config.version",
+                            )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def version(cls):
+        """
+            The current version of the map configuration tables
+
+            Returns:
+                the version string
+        """
+
+        try:
+            with open(cls.path(), "r") as f:
+                version = f.read().strip()
+        except IOError:
+            version = None
+
+        return version or "0"
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, *args):
+        """
+            Invalidates all cached map configurations; now, and again
+            after the current transaction has been committed (so that
+            no other process can cache uncommitted data meanwhile)
+
+            Args:
+                args: (ignored) args of the DAL callbacks
+        """
+
+        cls.touch()
+        current.s3task.defer("gis_map_config_invalidate",
+                             key = "gis_map_config_invalidate",
+                             )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def touch(cls):
+        """
+            Writes a new version stamp
+        """
+
+        path = cls.path()
+
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+
+        try:
+            with open(path, "w") as f:
+                f.write(uuid.uuid4().hex)
+        except IOError as e:
+            current.log.error("GIS: map config cache could not be invalidated: %s" % e)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def watch(cls, *tables):
+        """
+            Installs callbacks to invalidate the cache on writes to tables
+
+            Args:
+                tables: the tables (Table instances)
+        """
+
+        for table in tables:
+            if getattr(table, "_map_config_watched", False):
+                continue
+            if table._tablename == "gis_config":
+                table._after_insert.append(cls.config_inserted)
+                table._before_update.append(cls.config_updated)
+                table._before_delete.append(cls.config_deleted)
+            elif "config_id" in table.fields:
+                table._after_insert.append(cls.layer_config_inserted)
+                table._before_update.append(partial(cls.layer_config_updated, table))
+                table._before_delete.append(partial(cls.layer_config_deleted, table))
+            else:
+                table._after_insert.append(cls.invalidate)
+                table._after_update.append(cls.invalidate)
+                table._after_delete.append(cls.invalidate)
+            table._map_config_watched = True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def temporary(config_ids):
+        """
+            Checks whether configs are all temporary
+
+            Args:
+                config_ids: the gis_config record IDs
+
+            Returns:
+                True if all configs are temporary, otherwise False
+        """
+
+        config_ids = [config_id for config_id in config_ids if config_id]
+        if not config_ids:
+            return False
+
+        ctable = current.s3db.gis_config
+        query = (ctable.id.belongs(config_ids)) & \
+                ((ctable.temp == False) | (ctable.temp == None))
+        row = current.db(query).select(ctable.id, limitby=(0, 1)).first()
+
+        return row is None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def config_inserted(cls, fields, record_id):
+        """
+            DAL callback after insert into gis_config
+        """
+
+        # Temporary configs don't change any other configs
+        if not fields.get("temp"):
+            cls.invalidate()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def config_updated(cls, dbset, fields):
+        """
+            DAL callback before update of gis_config
+        """
+
+        if "temp" in fields and not fields["temp"]:
+            # Config becomes permanent
+            cls.invalidate()
+        else:
+            table = current.s3db.gis_config
+            config_ids = [row.id for row in dbset.select(table.id)]
+            if not cls.temporary(config_ids):
+                cls.invalidate()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def config_deleted(cls, dbset):
+        """
+            DAL callback before delete from gis_config
+        """
+
+        cls.config_updated(dbset, {})
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def layer_config_inserted(cls, fields, record_id):
+        """
+            DAL callback after insert into tables with a config_id
+            (gis_layer_config, gis_style)
+        """
+
+        if not cls.temporary([fields.get("config_id")]):
+            cls.invalidate()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def layer_config_updated(cls, table, dbset, fields):
+        """
+            DAL callback before update of tables with a config_id
+        """
+
+        config_ids = {row.config_id for row in dbset.select(table.config_id)}
+        config_ids.add(fields.get("config_id"))
+        if not cls.temporary(config_ids):
+            cls.invalidate()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def layer_config_deleted(cls, table, dbset):
+        """
+            DAL callback before delete from tables with a config_id
+        """
+
+        cls.layer_config_updated(table, dbset, {})
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, key, build):
+        """
+            Looks up an entry from the cache, builds it if not available
+
+            Args:
+                key: the entry key
+                build: function to build the entry
+
+            Returns:
+                the entry
+        """
+
+        key = "gis_map_config_%s_%s" % (cls.version(), key)
+
+        return current.cache.ram(key, build, time_expire=cls.EXPIRE)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls, key):
+        """
+            Removes an entry from the cache
+
+            Args:
+                key: the entry key
+        """
+
+        key = "gis_map_config_%s_%s" % (cls.version(), key)
+        current.cache.ram(key, None)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def config(cls, config_id, build):
+        """
+            Looks up the merged GIS config for the current user
+
+            Args:
+                config_id: the requested config ID
+                build: function to build the config (Storage)
+
+            Returns:
+                the config (Storage)
+        """
+
+        auth = current.auth
+
+        # Personal and OU configs depend on the user
+        user = auth.user
+        if user and auth.is_logged_in():
+            ukey = "%s:%s:%s:%s" % (user.get("pe_id"),
+                                    user.get("organisation_id"),
+                                    user.get("site_id"),
+                                    user.get("org_group_id"),
+                                    )
+        else:
+            ukey = "-"
+
+        key = "config_%s_%s" % (config_id, ukey)
+        config = cls.lookup(key, build)
+
+        # Return a copy, so the cached config is not modified by the caller
+        config = Storage(config)
+        for k, v in config.items():
+            if isinstance(v, (list, dict)):
+                config[k] = copy.deepcopy(v)
+
+        return config
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def layers(cls, config, options, catalogue_layers=False, openlayers=6):
+        """
+            Adds the layer definitions for a map to the map options,
+            looked up from cache if possible
+
+            Args:
+                config: the GIS config (see GIS.set_config)
+                options: the map options (dict) to add the layers to
+                catalogue_layers: add all enabled layers from the catalogue
+                                  rather than just the default base layer
+                openlayers: the OpenLayers version
+
+            Returns:
+                list of scripts to load with the map
+        """
+
+        s3 = current.response.s3
+
+        # Keep the layers in case we build the entry, to avoid
+        # having to load them again for uncacheable layer types
+        loaded = []
+        def load():
+            layers = cls.load_layers(config, catalogue_layers)
+            loaded.append(layers)
+            return layers
+
+        key = cls.layers_key(config, catalogue_layers, openlayers)
+        build = lambda: cls.build_layers(load(), openlayers)
+        if key:
+            entry = cls.lookup(key, build)
+            if entry["errors"]:
+                # Do not cache errors
+                cls.clear(key)
+        else:
+            entry = build()
+
+        for dictname, output in entry["layers"].items():
+            options[dictname] = json.loads(output)
+
+        scripts = list(entry["scripts"])
+        if entry["get_feature_info"]:
+            s3.gis.get_feature_info = True
+
+        errors = list(entry["errors"])
+
+        # Instantiate uncacheable layer types
+        uncached = entry["uncached"]
+        if uncached:
+            layers = loaded[0] if loaded else cls.load_layers(config, catalogue_layers)
+            for tablename in uncached:
+                LayerType = LAYER_TYPES[tablename]
+                try:
+                    layer = LayerType(layers, openlayers=openlayers)
+                    layer.as_dict(options)
+                    scripts.extend(layer.scripts)
+                except Exception as exception:
+                    errors.append("%s not shown: %s" % (LayerType.__name__, exception))
+
+        if errors:
+            response = current.response
+            for error in errors:
+                current.log.error(error)
+                if s3.debug:
+                    raise HTTP(500, error)
+                else:
+                    response.warning = "%s%s" % (response.warning or "", error)
+
+        return scripts
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def layers_key(config, catalogue_layers, openlayers):
+        """
+            The cache key for the layer definitions of a map
+
+            Args:
+                config: the GIS config
+                catalogue_layers: all layers rather than just the base layer
+                openlayers: the OpenLayers version
+
+            Returns:
+                the key, or None if the layers cannot be cached
+        """
+
+        if not config or not config.ids:
+            return None
+
+        auth = current.auth
+        request = current.request
+
+        # Layer access depends on the user roles
+        if auth.override:
+            roles = "override"
+        else:
+            session_s3 = current.session.s3
+            roles = session_s3.roles if session_s3 else None
+            roles = ",".join(str(r) for r in sorted(roles or []))
+
+        return "layers_%s" % "|".join(str(item) for item in (
+                    ",".join(str(i) for i in config.ids),
+                    config.epsg,
+                    1 if catalogue_layers else 0,
+                    openlayers,
+                    roles,
+                    current.T.accepted_language,
+                    # Layers requested to be visible via URL (e.g. embedded map)
+                    request.get_vars.get("layers"),
+                    1 if current.response.s3.debug else 0,
+                    ))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build_layers(cls, layers, openlayers):
+        """
+            Serializes the layer definitions of a map
+
+            Args:
+                layers: the layers (Rows, see load_layers)
+                openlayers: the OpenLayers version
+
+            Returns:
+                dict {"layers": {dictname: JSON},
+                      "scripts": [scripts to load with the map],
+                      "get_feature_info": whether any layers are queryable,
+                      "uncached": [tablenames of uncacheable layer types],
+                      "errors": [error messages],
+                      }
+        """
+
+        s3gis = current.response.s3.gis
+
+        if layers:
+            layer_types = set()
+            for layer in layers:
+                tablename = layer["gis_layer_entity.instance_type"]
+                if tablename in LAYER_TYPES:
+                    layer_types.add(tablename)
+        else:
+            # Just show EmptyLayer
+            layer_types = {"gis_layer_empty"}
+
+        output = {}
+        scripts = []
+        uncached = []
+        errors = []
+
+        get_feature_info = s3gis.get_feature_info
+        s3gis.get_feature_info = False
+
+        for tablename in layer_types:
+            LayerType = LAYER_TYPES[tablename]
+            if not LayerType.cache_definitions:
+                uncached.append(tablename)
+                continue
+            try:
+                # Instantiate the Class
+                layer = LayerType(layers, openlayers=openlayers)
+                ldict = layer.as_dict()
+                if ldict:
+                    output[LayerType.dictname] = json.dumps(ldict, separators=JSONSEPARATORS)
+                scripts.extend(layer.scripts)
+            except Exception as exception:
+                errors.append("%s not shown: %s" % (LayerType.__name__, exception))
+
+        queryable = bool(s3gis.get_feature_info)
+        s3gis.get_feature_info = get_feature_info
+
+        return {"layers": output,
+                "scripts": scripts,
+                "get_feature_info": queryable,
+                "uncached": uncached,
+                "errors": errors,
+                }
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def load_layers(config, catalogue_layers=False):
+        """
+            Loads the layers for a map from the catalogue
+
+            Args:
+                config: the GIS config
+                catalogue_layers: all enabled layers rather than just
+                                  the default base layer
+
+            Returns:
+                Rows
+        """
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        ctable = db.gis_config
+        ltable = db.gis_layer_config
+        etable = db.gis_layer_entity
+        query = (ltable.deleted == False)
+        join = [etable.on(etable.layer_id == ltable.layer_id)]
+        fields = [etable.instance_type,
+                  ltable.layer_id,
+                  ltable.enabled,
+                  ltable.visible,
+                  ltable.base,
+                  ltable.dir,
+                  ]
+
+        if catalogue_layers:
+            # Add all enabled Layers from the Catalogue
+            stable = db.gis_style
+            mtable = db.gis_marker
+            query &= (ltable.config_id.belongs(config.ids))
+            join.append(ctable.on(ctable.id == ltable.config_id))
+            fields.extend((stable.style,
+                           stable.cluster_distance,
+                           stable.cluster_threshold,
+                           stable.opacity,
+                           stable.popup_format,
+                           mtable.image,
+                           mtable.height,
+                           mtable.width,
+                           ctable.pe_type))
+            left = [stable.on((stable.layer_id == etable.layer_id) & \
+                              (stable.record_id == None) & \
+                              ((stable.config_id == ctable.id) | \
+                               (stable.config_id == None))),
+                    mtable.on(mtable.id == stable.marker_id),
+                    ]
+            limitby = None
+            # @ToDo: Need to fix this?: make the style lookup a different call
+            if settings.get_database_type() == "postgres":
+                # None is last
+                orderby = [ctable.pe_type, stable.config_id]
+            else:
+                # None is 1st
+                orderby = [ctable.pe_type, ~stable.config_id]
+            if settings.get_gis_layer_metadata():
+                cptable = s3db.cms_post_layer
+                left.append(cptable.on(cptable.layer_id == etable.layer_id))
+                fields.append(cptable.post_id)
+        else:
+            # Add just the default Base Layer
+            query &= (ltable.base == True) & \
+                     (ltable.config_id == config.id)
+            # Base layer doesn't need a style
+            left = None
+            limitby = (0, 1)
+            orderby = None
+
+        layers = db(query).select(join = join,
+                                  left = left,
+                                  limitby = limitby,
+                                  orderby = orderby,
+                                  *fields)
+        if not layers:
+            # Use Site Default base layer
+            # (Base layer doesn't need a style)
+            query = (etable.id == ltable.layer_id) & \
+                    (ltable.config_id == ctable.id) & \
+                    (ctable.uuid == "SITE_DEFAULT") & \
+                    (ltable.base == True) & \
+                    (ltable.enabled == True)
+            layers = db(query).select(*fields,
+                                      limitby = (0, 1))
+
+        return layers
+
+# END =========================================================================
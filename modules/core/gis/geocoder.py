@@ -0,0 +1,118 @@
+"""
+    Local Geocoder
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__all__ = ("GazetteerGeocoder",
+           )
+
+from gluon import current
+
+from ..tools import s3_str
+
+# =============================================================================
+class GazetteerGeocoder:
+    """
+        Stand-in geocoder looking up addresses in the local gazetteer
+        (gis_location) rather than querying an external service; usable
+        offline and in tests
+
+        Implements the same interface as geopy geocoders, i.e.:
+            - geocode(query, exactly_one=True) => (place, (lat, lon))
+
+        The first item of the (comma-separated) query is matched against
+        the name or street address of locations, the remaining items (e.g.
+        postcode, names of Lx) are used to disambiguate multiple matches.
+    """
+
+    LEVELS = ("L5", "L4", "L3", "L2", "L1", "L0")
+
+    # -------------------------------------------------------------------------
+    def geocode(self, query, exactly_one=True, **kwargs):
+        """
+            Looks up an address in the gazetteer
+
+            Args:
+                query: the address, comma-separated items
+                exactly_one: return only the first match rather
+                             than a list of all matches
+
+            Returns:
+                - with exactly_one: tuple (place, (lat, lon))
+                - otherwise: list of such tuples
+                - None if no match was found
+        """
+
+        items = [s3_str(item).strip() for item in s3_str(query).split(",")]
+        items = [item for item in items if item]
+        if not items:
+            return None
+
+        name = items[0].lower()
+        context = {item.lower() for item in items[1:]}
+
+        table = current.s3db.gis_location
+        levels = self.LEVELS
+
+        query = ((table.name.lower() == name) |
+                 (table.addr_street.lower() == name)) & \
+                (table.lat != None) & \
+                (table.lon != None) & \
+                (table.deleted == False)
+        fields = [table.id,
+                  table.name,
+                  table.addr_postcode,
+                  table.lat,
+                  table.lon,
+                  ] + [table[level] for level in levels]
+        rows = current.db(query).select(orderby=table.id, *fields)
+        if not rows:
+            return None
+
+        if context:
+            # Prefer matches within the given postcode or Lx
+            def within(row):
+                names = {s3_str(row[fn]).lower()
+                         for fn in ("addr_postcode",) + levels if row[fn]}
+                return bool(context & names)
+            matches = [row for row in rows if within(row)]
+            if matches:
+                rows = matches
+
+        results = []
+        for row in rows:
+            place = [s3_str(row.name)]
+            for level in levels:
+                value = s3_str(row[level]) if row[level] else None
+                if value and value not in place:
+                    place.append(value)
+            results.append((", ".join(place),
+                            (row.lat, row.lon),
+                            ))
+
+        return results[0] if exactly_one else results
+
+# END =========================================================================
@@ -0,0 +1,404 @@
+"""
+    Vectorized Geodesic Calculations
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__all__ = ("Geodesy",
+           "RADIUS_EARTH",
+           )
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    # Fall back to element-wise calculation
+    np = None
+
+# km
+RADIUS_EARTH = 6371.01
+
+# =============================================================================
+class Geodesy:
+    """
+        Great-circle distances, bearings, bounds and nearest-neighbour
+        rankings for many coordinates in a single call
+
+        All methods accept scalars or sequences/arrays of coordinates (in
+        degrees), broadcasting scalars against sequences; missing values
+        (None) produce NaN results and are ignored in aggregates.
+
+        Uses numpy if installed, otherwise calculates element-wise.
+    """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def distance(cls, lat1, lon1, lat2, lon2, quick=True):
+        """
+            Calculates the shortest distance (in km) over the earth's
+            sphere between points
+            Formulae from: http://www.movable-type.co.uk/scripts/latlong.html
+
+            Args:
+                lat1, lon1: the start coordinates
+                lat2, lon2: the end coordinates
+                quick: use the Spherical Law of Cosines (accurate down to
+                       around 1m & computationally quick) rather than the
+                       Haversine formula
+
+            Returns:
+                the distance(s), float or array
+        """
+
+        if np is None:
+            return cls._apply(cls._distance, lat1, lon1, lat2, lon2, quick=quick)
+
+        lat1, lon1, lat2, lon2 = cls._radians(lat1, lon1, lat2, lon2)
+
+        if quick:
+            # Spherical Law of Cosines
+            c = np.sin(lat1) * np.sin(lat2) + \
+                np.cos(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+            angle = np.arccos(np.clip(c, -1.0, 1.0))
+        else:
+            # Haversine
+            a = np.sin((lat2 - lat1) / 2) ** 2 + \
+                np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+            angle = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        return cls._result(angle * RADIUS_EARTH)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def bearing(cls, lat1, lon1, lat2, lon2):
+        """
+            Calculates the initial bearing (compass degrees) from start
+            to end points
+            Formula from: http://www.movable-type.co.uk/scripts/latlong.html
+
+            Args:
+                lat1, lon1: the start coordinates
+                lat2, lon2: the end coordinates
+
+            Returns:
+                the bearing(s) in the range 0..360, float or array
+        """
+
+        if np is None:
+            return cls._apply(cls._bearing, lat1, lon1, lat2, lon2)
+
+        lat1, lon1, lat2, lon2 = cls._radians(lat1, lon1, lat2, lon2)
+
+        delta_lon = lon2 - lon1
+        bearing = np.arctan2(np.sin(delta_lon) * np.cos(lat2),
+                             np.cos(lat1) * np.sin(lat2) - \
+                             np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon),
+                             )
+
+        return cls._result((np.degrees(bearing) + 360) % 360)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def bounds(cls, lat, lon):
+        """
+            Calculates the bounding box of points
+
+            Args:
+                lat: the latitudes
+                lon: the longitudes
+
+            Returns:
+                dict {"lat_min", "lon_min", "lat_max", "lon_max"},
+                or None if there are no points with valid coordinates
+        """
+
+        if np is None:
+            points = [(y, x) for y, x in zip(lat, lon)
+                             if y is not None and x is not None]
+            if not points:
+                return None
+            lats, lons = zip(*points)
+            return {"lat_min": min(lats),
+                    "lon_min": min(lons),
+                    "lat_max": max(lats),
+                    "lon_max": max(lons),
+                    }
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        if not valid.any():
+            return None
+        lat, lon = lat[valid], lon[valid]
+
+        return {"lat_min": float(lat.min()),
+                "lon_min": float(lon.min()),
+                "lat_max": float(lat.max()),
+                "lon_max": float(lon.max()),
+                }
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def bounds_from_radius(cls, lat, lon, radius):
+        """
+            Computes the bounding boxes of circles (radius in km) around
+            points
+
+            Args:
+                lat: the latitude(s) of the center(s)
+                lon: the longitude(s) of the center(s)
+                radius: the radius (or radii)
+
+            Returns:
+                dict {"lat_min", "lon_min", "lat_max", "lon_max"} with
+                floats or arrays
+
+            See Also:
+                http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+        """
+
+        if np is None:
+            bounds = cls._apply(cls._bounds_from_radius, lat, lon, radius)
+            if isinstance(bounds, list):
+                keys = ("lat_min", "lon_min", "lat_max", "lon_max")
+                return {k: [b[i] if b else None for b in bounds]
+                        for i, k in enumerate(keys)}
+            return dict(zip(("lat_min", "lon_min", "lat_max", "lon_max"), bounds))
+
+        lat, lon = cls._radians(lat, lon)
+        r = np.asarray(radius, dtype=np.float64) / RADIUS_EARTH
+
+        half_pi = np.pi / 2
+
+        lat_min = lat - r
+        lat_max = lat + r
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta_lon = np.arcsin(np.sin(r) / np.cos(lat))
+        lon_min = lon - delta_lon
+        lon_min = np.where(lon_min < -np.pi, lon_min + 2 * np.pi, lon_min)
+        lon_max = lon + delta_lon
+        lon_max = np.where(lon_max > np.pi, lon_max - 2 * np.pi, lon_max)
+
+        # Special care for Poles & 180 Meridian:
+        # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates#PolesAnd180thMeridian
+        pole = (lat_min <= -half_pi) | (lat_max >= half_pi) | np.isnan(delta_lon)
+        lat_min = np.maximum(lat_min, -half_pi)
+        lat_max = np.minimum(lat_max, half_pi)
+        lon_min = np.where(pole, -np.pi, lon_min)
+        lon_max = np.where(pole, np.pi, lon_max)
+
+        result = cls._result
+        return {"lat_min": result(np.degrees(lat_min)),
+                "lon_min": result(np.degrees(lon_min)),
+                "lat_max": result(np.degrees(lat_max)),
+                "lon_max": result(np.degrees(lon_max)),
+                }
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def nearest(cls, lat, lon, lats, lons, limit=None, radius=None, quick=True):
+        """
+            Ranks points by their distance from a location
+
+            Args:
+                lat: the latitude of the location
+                lon: the longitude of the location
+                lats: the latitudes of the points
+                lons: the longitudes of the points
+                limit: return only the nearest N points
+                radius: return only points within this distance (km)
+                quick: use the Spherical Law of Cosines (see distance)
+
+            Returns:
+                list of tuples (index, distance), ordered by distance,
+                where index is the position of the point in lats/lons;
+                points without coordinates are skipped
+        """
+
+        if np is None:
+            distances = cls.distance(lat, lon, lats, lons, quick=quick)
+            if not isinstance(distances, list):
+                distances = [distances]
+            ranking = sorted((d, i) for i, d in enumerate(distances)
+                                    if d is not None and (radius is None or d < radius))
+            if limit is not None:
+                ranking = ranking[:limit]
+            return [(i, d) for d, i in ranking]
+
+        distances = np.atleast_1d(cls.distance(lat, lon,
+                                               np.asarray(lats, dtype=np.float64),
+                                               np.asarray(lons, dtype=np.float64),
+                                               quick = quick,
+                                               ))
+        valid = ~np.isnan(distances)
+        if radius is not None:
+            valid &= (distances < radius)
+        index = np.flatnonzero(valid)
+
+        if limit is not None and limit < len(index):
+            # Partial sort: select the nearest first
+            index = index[np.argpartition(distances[index], max(limit - 1, 0))[:limit]]
+        index = index[np.argsort(distances[index], kind="stable")]
+
+        return [(int(i), float(distances[i])) for i in index]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _radians(*args):
+        """
+            Converts coordinates to arrays of radians
+
+            Args:
+                args: the coordinates (scalars or sequences) in degrees
+
+            Returns:
+                tuple of arrays
+        """
+
+        return tuple(np.radians(np.asarray(a, dtype=np.float64)) for a in args)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _result(array):
+        """
+            Converts 0-dimensional arrays into floats
+
+            Args:
+                array: the array
+
+            Returns:
+                the array, or a float
+        """
+
+        return float(array) if np.ndim(array) == 0 else array
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _apply(function, *args, **kwargs):
+        """
+            Applies a scalar function element-wise (without numpy),
+            broadcasting scalars against sequences
+
+            Args:
+                function: the function
+                args: the arguments, scalars or sequences
+                kwargs: keyword arguments for the function
+
+            Returns:
+                the result of the function, or a list of results if any
+                of args was a sequence; None for elements with missing values
+        """
+
+        is_sequence = lambda a: isinstance(a, (list, tuple)) or \
+                                hasattr(a, "__len__") and not isinstance(a, str)
+
+        sizes = [len(a) for a in args if is_sequence(a)]
+        if not sizes:
+            if any(a is None for a in args):
+                return None
+            return function(*args, **kwargs)
+
+        size = max(sizes)
+        columns = [a if is_sequence(a) else [a] * size for a in args]
+
+        results = []
+        for values in zip(*columns):
+            if any(v is None for v in values):
+                results.append(None)
+            else:
+                results.append(function(*values, **kwargs))
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _distance(lat1, lon1, lat2, lon2, quick=True):
+        """ Scalar variant of distance() """
+
+        sin, cos, radians = math.sin, math.cos, math.radians
+
+        lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+        if quick:
+            c = sin(lat1) * sin(lat2) + cos(lat1) * cos(lat2) * cos(lon2 - lon1)
+            angle = math.acos(max(-1.0, min(1.0, c)))
+        else:
+            a = sin((lat2 - lat1) / 2) ** 2 + \
+                cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+            angle = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+        return angle * RADIUS_EARTH
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bearing(lat1, lon1, lat2, lon2):
+        """ Scalar variant of bearing() """
+
+        sin, cos, radians = math.sin, math.cos, math.radians
+
+        lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+        delta_lon = lon2 - lon1
+        bearing = math.atan2(sin(delta_lon) * cos(lat2),
+                             cos(lat1) * sin(lat2) - \
+                             sin(lat1) * cos(lat2) * cos(delta_lon),
+                             )
+
+        return (math.degrees(bearing) + 360) % 360
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bounds_from_radius(lat, lon, radius):
+        """ Scalar variant of bounds_from_radius(), returns a tuple """
+
+        radians = math.radians
+        degrees = math.degrees
+
+        half_pi = math.pi / 2
+
+        r = float(radius) / RADIUS_EARTH
+        lat, lon = radians(lat), radians(lon)
+
+        lat_min = lat - r
+        lat_max = lat + r
+
+        ratio = math.sin(r) / math.cos(lat) if lat_min > -half_pi and lat_max < half_pi else None
+        if ratio is not None and ratio <= 1:
+            delta_lon = math.asin(ratio)
+            lon_min = lon - delta_lon
+            if lon_min < -math.pi:
+                lon_min += 2 * math.pi
+            lon_max = lon + delta_lon
+            if lon_max > math.pi:
+                lon_max -= 2 * math.pi
+        else:
+            # Special care for Poles & 180 Meridian
+            lat_min = max(lat_min, -half_pi)
+            lat_max = min(lat_max, half_pi)
+            lon_min = -math.pi
+            lon_max = math.pi
+
+        return degrees(lat_min), degrees(lon_min), degrees(lat_max), degrees(lon_max)
+
+# END =========================================================================
@@ -57,6 +57,9 @@ class Layer:
     tablename = None
     dictname = "layer_generic"
     style = False
+    # Whether the layer definitions can be cached (see MapConfigCache),
+    # i.e. have no side-effects and only depend on config and user roles
+    cache_definitions = True
 
     def __init__(self, all_layers, openlayers=6):
 
@@ -502,6 +505,11 @@ class LayerFeature(Layer):
                       "url": url,
                       }
 
+            if not self.aggregate and \
+               current.deployment_settings.get_gis_vector_tiles():
+                output["tiles"] = "%s/{z}/{x}/{y}.mvt" % \
+                                  URL(c="gis", f="tiles", args=[self.layer_id])
+
             popup_format = self.popup_format
             if popup_format:
                 # New-style
@@ -600,6 +608,7 @@ class LayerGeoRSS(Layer):
     tablename = "gis_layer_georss"
     dictname = "layers_georss"
     style = True
+    cache_definitions = False
 
     def __init__(self, all_layers, openlayers=6):
         super(LayerGeoRSS, self).__init__(all_layers, openlayers)
@@ -696,6 +705,7 @@ class LayerGoogle(Layer):
     tablename = "gis_layer_google"
     dictname = "Google"
     style = False
+    cache_definitions = False
 
     # -------------------------------------------------------------------------
     def as_dict(self, options=None):
@@ -864,6 +874,7 @@ class LayerKML(Layer):
     tablename = "gis_layer_kml"
     dictname = "layers_kml"
     style = True
+    cache_definitions = False
 
     # -------------------------------------------------------------------------
     def __init__(self, all_layers, openlayers=6, init=True):
@@ -1047,6 +1058,7 @@ class LayerOpenWeatherMap(Layer):
     tablename = "gis_layer_openweathermap"
     dictname = "layers_openweathermap"
     style = False
+    cache_definitions = False
 
     # -------------------------------------------------------------------------
     def as_dict(self, options=None):
@@ -1147,6 +1159,10 @@ class LayerTheme(Layer):
                       "url": url,
                       }
 
+            if current.deployment_settings.get_gis_vector_tiles():
+                output["tiles"] = "%s/{z}/{x}/{y}.mvt" % \
+                                  URL(c="gis", f="tiles", args=[self.layer_id])
+
             # Attributes which are defaulted client-side if not set
             self.setup_folder_visibility_and_opacity(output)
             self.setup_clustering(output)
@@ -0,0 +1,697 @@
+"""
+    In-process Spatial Index for Locations
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("STRTree",
+           "SpatialIndex",
+           )
+
+import math
+import os
+import pickle
+import threading
+import time
+
+from array import array
+
+from gluon import current
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# =============================================================================
+class STRTree:
+    """
+        Static R-tree of bounding boxes, packed with the Sort-Tile-Recursive
+        algorithm; the nodes are stored level by level in flat arrays to
+        keep the memory footprint low for large numbers of items
+    """
+
+    # Maximum number of children per node
+    NODE_SIZE = 16
+
+    def __init__(self, items):
+        """
+            Args:
+                items: iterable of tuples (item_id, xmin, ymin, xmax, ymax)
+        """
+
+        node_size = self.NODE_SIZE
+
+        # Leaf level: the items
+        nodes = self.pack([(xmin, ymin, xmax, ymax, item_id)
+                           for item_id, xmin, ymin, xmax, ymax in items])
+        levels = [self.level(nodes)]
+
+        # Upper levels: each node references NODE_SIZE consecutive
+        # nodes of the level below
+        while len(nodes) > node_size:
+            parents = []
+            append = parents.append
+            for i in range(0, len(nodes), node_size):
+                children = nodes[i:i+node_size]
+                append((min(n[0] for n in children),
+                        min(n[1] for n in children),
+                        max(n[2] for n in children),
+                        max(n[3] for n in children),
+                        i,
+                        ))
+            nodes = self.pack(parents)
+            levels.append(self.level(nodes))
+
+        self.levels = levels
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+
+        return len(self.levels[0][1])
+
+    # -------------------------------------------------------------------------
+    def pack(self, nodes):
+        """
+            Sorts nodes into STR order, i.e. vertical slices sorted by
+            x-center, each slice sorted by y-center
+
+            Args:
+                nodes: list of tuples (xmin, ymin, xmax, ymax, ref)
+
+            Returns:
+                the sorted list
+        """
+
+        if not nodes:
+            return nodes
+
+        node_size = self.NODE_SIZE
+
+        num_parents = math.ceil(len(nodes) / node_size)
+        num_slices = math.ceil(math.sqrt(num_parents))
+        slice_size = num_slices * node_size
+
+        nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+
+        packed = []
+        for i in range(0, len(nodes), slice_size):
+            packed.extend(sorted(nodes[i:i+slice_size], key=lambda n: n[1] + n[3]))
+
+        return packed
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def level(nodes):
+        """
+            Converts a list of nodes into flat arrays
+
+            Args:
+                nodes: list of tuples (xmin, ymin, xmax, ymax, ref)
+
+            Returns:
+                tuple (bounds, refs), where bounds is an array of
+                4 doubles per node and refs an array of integers
+        """
+
+        bounds = array("d")
+        refs = array("q")
+        for node in nodes:
+            bounds.extend(node[:4])
+            refs.append(node[4])
+
+        return bounds, refs
+
+    # -------------------------------------------------------------------------
+    def query(self, xmin, ymin, xmax, ymax, limit=None):
+        """
+            Finds all items whose bounding box intersects a bounding box
+
+            Args:
+                xmin, ymin, xmax, ymax: the bounding box
+                limit: stop after this number of results
+
+            Returns:
+                list of item IDs, or None if the limit was exceeded
+        """
+
+        node_size = self.NODE_SIZE
+        levels = self.levels
+
+        result = []
+        append = result.append
+
+        top = len(levels) - 1
+        stack = [(top, 0, len(levels[top][1]))]
+        pop = stack.pop
+        push = stack.append
+
+        while stack:
+            level, start, end = pop()
+            bounds, refs = levels[level]
+            if level:
+                size = len(levels[level - 1][1])
+            for i in range(start, end):
+                j = i * 4
+                if bounds[j] <= xmax and bounds[j+2] >= xmin and \
+                   bounds[j+1] <= ymax and bounds[j+3] >= ymin:
+                    ref = refs[i]
+                    if level:
+                        push((level - 1, ref, min(ref + node_size, size)))
+                    else:
+                        append(ref)
+                        if limit is not None and len(result) > limit:
+                            return None
+        return result
+
+# =============================================================================
+class SpatialIndex:
+    """
+        Spatial index of the bounding boxes of all locations, for bbox,
+        radius and polygon queries in databases without spatial extensions
+
+        The index is persisted to disk (uploads/gis_cache/spatial_index),
+        and shared by all processes: an STRTree snapshot of gis_location,
+        plus a journal of subsequent location updates which is replayed
+        by each process and consolidated into a new snapshot once it
+        exceeds REBUILD entries.
+
+        Snapshots are only built by the scheduler (as they require reading
+        all locations); until a snapshot is available, queries return None,
+        and callers fall back to conventional queries.
+
+        All writes to gis_location coordinates or bounds are journaled:
+        DAL writes by table callbacks (see watch), bulk updates bypassing
+        the DAL explicitly (see journal) - in web requests after commit,
+        otherwise immediately.
+
+        Journal appends and its truncation after building a snapshot are
+        serialized with a file lock (where available, otherwise the
+        journal is never truncated), so that no entries are lost.
+    """
+
+    # Fields which affect the bounds of a location
+    FIELDS = ("lat", "lon", "lat_min", "lat_max", "lon_min", "lon_max", "deleted")
+
+    # Number of journal entries to trigger a rebuild of the snapshot
+    REBUILD = 10000
+
+    # Number of records per DB query when building the snapshot
+    CHUNK = 50000
+
+    # Maximum number of IDs to use in a DB query, fall back to a
+    # conventional query if a bbox contains more locations
+    MAX_IDS = 10000
+
+    # Minimum interval (seconds) between attempts to schedule a build
+    SCHEDULE_INTERVAL = 60
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+            Args:
+                path: the directory to store the index files
+        """
+
+        self.path = path
+
+        self.snapshot = os.path.join(path, "locations.idx")
+        self.journal = os.path.join(path, "locations.log")
+
+        self.tree = None
+        self.mtime = None
+        self.offset = 0
+        self.updates = {}
+
+        self.scheduled = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def instance(cls, path=None):
+        """
+            The spatial index instance of this process
+
+            Args:
+                path: the directory to store the index files (defaults
+                      to uploads/gis_cache/spatial_index)
+
+            Returns:
+                the SpatialIndex
+        """
+
+        if path is None:
+            path = os.path.join(current.request.folder,
+                                "uploads", "gis_cache", "spatial_index",
+                                )
+
+        instances = cls._instances
+        with cls._lock:
+            index = instances.get(path)
+            if index is None:
+                index = instances[path] = cls(path)
+        return index
+
+    # -------------------------------------------------------------------------
+    def query(self, lon_min, lat_min, lon_max, lat_max, limit=None):
+        """
+            Finds all locations whose bounds intersect a bounding box
+
+            Args:
+                lon_min, lat_min, lon_max, lat_max: the bounding box
+                limit: stop after this number of results
+
+            Returns:
+                list of gis_location record IDs, or None if the limit
+                was exceeded or no snapshot is available yet
+        """
+
+        with self._lock:
+            if not self.refresh():
+                self.schedule_build()
+                return None
+            tree, updates = self.tree, self.updates
+
+            candidates = tree.query(lon_min, lat_min, lon_max, lat_max, limit=limit)
+            if candidates is None:
+                return None
+
+            if updates:
+                # Apply the journal
+                result = [location_id for location_id in candidates
+                          if location_id not in updates]
+                for location_id, bounds in updates.items():
+                    if bounds and \
+                       bounds[0] <= lon_max and bounds[2] >= lon_min and \
+                       bounds[1] <= lat_max and bounds[3] >= lat_min:
+                        result.append(location_id)
+                if limit is not None and len(result) > limit:
+                    return None
+            else:
+                result = candidates
+
+        return result
+
+    # -------------------------------------------------------------------------
+    def intersects(self, wkt):
+        """
+            Finds all locations which intersect a geometry
+
+            Args:
+                wkt: the geometry as WKT
+
+            Returns:
+                list of gis_location record IDs, or None if no snapshot
+                is available yet
+        """
+
+        from shapely.prepared import prep
+        from shapely.wkt import loads as wkt_loads
+
+        shape = wkt_loads(wkt)
+        candidates = self.query(*shape.bounds)
+        if candidates is None:
+            return None
+        if not candidates:
+            return []
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        shape = prep(shape)
+        intersects = shape.intersects
+
+        result = []
+        chunk = self.CHUNK
+        for i in range(0, len(candidates), chunk):
+            query = table.id.belongs(candidates[i:i+chunk])
+            rows = db(query).select(table.id,
+                                    table.wkt,
+                                    table.lat,
+                                    table.lon,
+                                    )
+            for row in rows:
+                wkt = row.wkt
+                if not wkt:
+                    lat, lon = row.lat, row.lon
+                    if lat is None or lon is None:
+                        continue
+                    wkt = "POINT (%f %f)" % (lon, lat)
+                try:
+                    if intersects(wkt_loads(wkt)):
+                        result.append(row.id)
+                except Exception:
+                    current.log.error("Error reading wkt of location with id", value=row.id)
+
+        return result
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Loads the snapshot if it has changed, and replays the journal
+            from the last read position
+
+            Returns:
+                True if a snapshot is available, otherwise False
+        """
+
+        snapshot = self.snapshot
+
+        try:
+            mtime = os.path.getmtime(snapshot)
+        except OSError:
+            return False
+
+        if mtime != self.mtime:
+            # Load the snapshot
+            with open(snapshot, "rb") as f:
+                data = pickle.load(f)
+            self.tree = data["tree"]
+            self.offset = data["offset"]
+            self.updates = {}
+            self.mtime = mtime
+
+        # Read the new journal entries
+        try:
+            size = os.path.getsize(self.journal)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            # Journal has been truncated
+            self.offset = size
+        elif size > self.offset:
+            with open(self.journal, "rb") as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+            end = data.rfind(b"\n") + 1
+            updates = self.updates
+            for line in data[:end].decode("utf-8").splitlines():
+                items = line.split()
+                if not items:
+                    continue
+                location_id = int(items[0])
+                if len(items) == 5:
+                    updates[location_id] = tuple(float(v) for v in items[1:])
+                else:
+                    updates[location_id] = None
+            self.offset += end
+
+        return True
+
+    # -------------------------------------------------------------------------
+    def schedule_build(self):
+        """
+            Schedules a (re)build of the snapshot in the scheduler, or
+            builds it right away if already running in the scheduler
+        """
+
+        if current.request.is_scheduler:
+            self.build()
+            return
+
+        now = time.time()
+        scheduled = self.scheduled
+        if scheduled and now - scheduled < self.SCHEDULE_INTERVAL:
+            return
+        self.scheduled = now
+
+        # Scheduled only once (duplicate check)
+        current.s3task.schedule_task("gis_spatial_index_update_batch",
+                                     timeout = 3600,
+                                     user_id = False,
+                                     )
+
+    # -------------------------------------------------------------------------
+    def build(self):
+        """
+            Builds a new snapshot of the index from the database
+
+            Returns:
+                the number of indexed locations
+        """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        path = self.path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Journal entries up to here are included in the snapshot
+        try:
+            offset = os.path.getsize(self.journal)
+        except OSError:
+            offset = 0
+
+        fields = (table.id,
+                  table.lat,
+                  table.lon,
+                  table.lat_min,
+                  table.lat_max,
+                  table.lon_min,
+                  table.lon_max,
+                  )
+
+        items = []
+        append = items.append
+
+        base = (table.deleted == False)
+        last = 0
+        while True:
+            query = base & (table.id > last)
+            rows = db(query).select(*fields,
+                                    orderby = table.id,
+                                    limitby = (0, self.CHUNK),
+                                    )
+            if not rows:
+                break
+            for row in rows:
+                bounds = self.bounds(row)
+                if bounds:
+                    append((row.id,) + bounds)
+            last = rows.last().id
+
+        tree = STRTree(items)
+
+        if offset and fcntl:
+            with open(self.journal, "r+b") as f:
+                # Lock the journal, so that no entries can be appended
+                # between the size check and the truncation
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if os.fstat(f.fileno()).st_size == offset:
+                    # No concurrent updates => start a new journal
+                    self.save(tree, 0)
+                    f.truncate(0)
+                    return len(tree)
+
+        self.save(tree, offset)
+
+        return len(tree)
+
+    # -------------------------------------------------------------------------
+    def save(self, tree, offset):
+        """
+            Writes a snapshot (atomically)
+
+            Args:
+                tree: the STRTree
+                offset: the journal offset from where to replay
+        """
+
+        tmp = "%s.%s.tmp" % (self.snapshot, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump({"tree": tree, "offset": offset},
+                        f,
+                        protocol = pickle.HIGHEST_PROTOCOL,
+                        )
+        os.replace(tmp, self.snapshot)
+
+    # -------------------------------------------------------------------------
+    def update(self, location_ids):
+        """
+            Updates the index for locations which have been created,
+            modified or deleted (appends them to the journal)
+
+            Args:
+                location_ids: list of gis_location record IDs
+        """
+
+        # Journal even if there is no snapshot yet, as a snapshot may
+        # be in the making (entries are then replayed on top of it)
+        path = self.path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        query = table.id.belongs(location_ids)
+        rows = db(query).select(table.id,
+                                table.deleted,
+                                table.lat,
+                                table.lon,
+                                table.lat_min,
+                                table.lat_max,
+                                table.lon_min,
+                                table.lon_max,
+                                )
+
+        entries = {location_id: None for location_id in location_ids}
+        for row in rows:
+            if not row.deleted:
+                entries[row.id] = self.bounds(row)
+
+        lines = []
+        for location_id, bounds in entries.items():
+            if bounds:
+                lines.append("%d %r %r %r %r\n" % ((location_id,) + bounds))
+            else:
+                lines.append("%d\n" % location_id)
+
+        # Append to the journal (single write to keep lines intact)
+        with open(self.journal, "ab") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("".join(lines).encode("utf-8"))
+
+        # Rebuild the snapshot if the journal is getting long
+        with self._lock:
+            if self.refresh() and len(self.updates) > self.REBUILD:
+                self.schedule_build()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def watch(cls, table):
+        """
+            Installs callbacks to journal all writes to location bounds
+
+            Args:
+                table: the gis_location Table
+        """
+
+        if getattr(table, "_spatial_index_watched", False):
+            return
+
+        fields = cls.FIELDS
+        relevant = lambda written: any(fn in written for fn in fields)
+
+        def collect(dbset):
+            # Collect the IDs of the locations to update or delete
+            # (before the write, as the set may change with it)
+            location_ids = [row[table._id] for row in dbset.select(table._id)]
+            s3 = current.response.s3
+            stack = s3.spatial_index_writes
+            if stack is None:
+                stack = s3.spatial_index_writes = []
+            stack.append(location_ids)
+
+        def written():
+            stack = current.response.s3.spatial_index_writes
+            if stack:
+                cls.journal(stack.pop())
+
+        def before_update(dbset, fields):
+            if relevant(fields):
+                collect(dbset)
+        def after_update(dbset, fields):
+            if relevant(fields):
+                written()
+        def after_insert(fields, record_id):
+            if relevant(fields):
+                cls.journal([record_id])
+        def before_delete(dbset):
+            collect(dbset)
+        def after_delete(dbset):
+            written()
+
+        table._before_update.append(before_update)
+        table._after_update.append(after_update)
+        table._after_insert.append(after_insert)
+        table._before_delete.append(before_delete)
+        table._after_delete.append(after_delete)
+        table._spatial_index_watched = True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def journal(location_ids):
+        """
+            Journals writes to locations in the spatial index: after
+            commit in web requests (locally, so that queries are not
+            using outdated bounds until a worker picks up the task),
+            otherwise right away
+
+            Args:
+                location_ids: the gis_location record IDs
+        """
+
+        if not location_ids:
+            return
+
+        request = current.request
+        if request.is_scheduler or request.is_shell:
+            index = current.gis.get_spatial_index()
+            if index:
+                index.update(location_ids)
+        elif len(location_ids) == 1:
+            location_id = location_ids[0]
+            current.s3task.defer("gis_spatial_index_update",
+                                 args = [location_id],
+                                 key = location_id,
+                                 local = True,
+                                 )
+        else:
+            current.s3task.defer("gis_spatial_index_update_batch",
+                                 args = [list(location_ids)],
+                                 local = True,
+                                 )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def bounds(row):
+        """
+            The bounding box of a location
+
+            Args:
+                row: the gis_location Row
+
+            Returns:
+                tuple (lon_min, lat_min, lon_max, lat_max), or None if
+                the location has no coordinates
+        """
+
+        lat_min, lat_max = row.lat_min, row.lat_max
+        lon_min, lon_max = row.lon_min, row.lon_max
+
+        if None in (lat_min, lat_max, lon_min, lon_max):
+            lat, lon = row.lat, row.lon
+            if lat is None or lon is None:
+                return None
+            lat_min = lat_max = lat
+            lon_min = lon_max = lon
+
+        return (float(lon_min), float(lat_min), float(lon_max), float(lat_max))
+
+# END =========================================================================
@@ -0,0 +1,821 @@
+"""
+    Vector Tiles for Feature and Theme Layers
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("MVTEncoder",
+           "VectorTiles",
+           )
+
+import hashlib
+import math
+import os
+import shutil
+import struct
+
+from urllib.parse import parse_qsl
+
+from gluon import current, HTTP
+
+from ..resource import S3Joins
+
+# Half the circumference of the earth in EPSG:3857 (spherical mercator)
+MERCATOR_MAX = 20037508.342789244
+
+# =============================================================================
+class MVTEncoder:
+    """
+        Minimal encoder for Mapbox Vector Tiles (protocol buffers,
+        specification version 2), for environments without a spatial
+        database
+    """
+
+    # Geometry types
+    POINT = 1
+    LINESTRING = 2
+    POLYGON = 3
+
+    # Commands
+    MOVE_TO = 1
+    LINE_TO = 2
+    CLOSE_PATH = 7
+
+    def __init__(self, extent=4096):
+        """
+            Args:
+                extent: the tile extent (in tile coordinate units)
+        """
+
+        self.extent = extent
+        self.layers = []
+
+    # -------------------------------------------------------------------------
+    def add_layer(self, name, features):
+        """
+            Adds a layer to the tile
+
+            Args:
+                name: the layer name
+                features: iterable of tuples (feature_id, geometry, properties),
+                          where the geometry is a shapely geometry in tile
+                          coordinates (y-axis pointing down)
+        """
+
+        self.layers.append((name, features))
+
+    # -------------------------------------------------------------------------
+    def encode(self):
+        """
+            Encodes the tile
+
+            Returns:
+                the tile as bytes
+        """
+
+        tile = b""
+        for name, features in self.layers:
+            layer = self.encode_layer(name, features)
+            if layer:
+                tile += self.field(3, layer)
+        return tile
+
+    # -------------------------------------------------------------------------
+    def encode_layer(self, name, features):
+        """
+            Encodes a layer
+
+            Args:
+                name: the layer name
+                features: the features (see add_layer)
+
+            Returns:
+                the encoded layer, or None if it has no features
+        """
+
+        keys, values = {}, {}
+
+        encoded = []
+        for feature_id, geometry, properties in features:
+
+            geometry_type, commands = self.geometry(geometry)
+            if not commands:
+                continue
+
+            tags = []
+            if properties:
+                for key, value in properties.items():
+                    if value is None:
+                        continue
+                    key_index = keys.setdefault(key, len(keys))
+                    value_key = (type(value).__name__, value)
+                    value_index = values.setdefault(value_key, len(values))
+                    tags.extend((key_index, value_index))
+
+            feature = b""
+            if feature_id is not None:
+                feature += self.key(1, 0) + self.varint(feature_id)
+            if tags:
+                feature += self.field(2, self.packed(tags))
+            feature += self.key(3, 0) + self.varint(geometry_type)
+            feature += self.field(4, self.packed(commands))
+            encoded.append(feature)
+
+        if not encoded:
+            return None
+
+        layer = self.key(15, 0) + self.varint(2)
+        layer += self.field(1, name.encode("utf-8"))
+        for feature in encoded:
+            layer += self.field(2, feature)
+        for key in keys:
+            layer += self.field(3, str(key).encode("utf-8"))
+        for value_type, value in values:
+            layer += self.field(4, self.value(value))
+        layer += self.key(5, 0) + self.varint(self.extent)
+
+        return layer
+
+    # -------------------------------------------------------------------------
+    def geometry(self, geometry):
+        """
+            Encodes a geometry as sequence of commands
+
+            Args:
+                geometry: the shapely geometry (tile coordinates)
+
+            Returns:
+                tuple (geometry_type, commands)
+        """
+
+        if geometry is None or geometry.is_empty:
+            return None, None
+
+        gtype = geometry.geom_type
+        if gtype in ("Point", "MultiPoint"):
+            points = [geometry] if gtype == "Point" else list(geometry.geoms)
+            coords = [(p.x, p.y) for p in points]
+            cursor = [0, 0]
+            commands = [self.command(self.MOVE_TO, len(coords))]
+            commands.extend(self.deltas(cursor, coords))
+            return self.POINT, commands
+
+        elif gtype in ("LineString", "MultiLineString"):
+            lines = [geometry] if gtype == "LineString" else list(geometry.geoms)
+            cursor = [0, 0]
+            commands = []
+            for line in lines:
+                commands.extend(self.path(cursor, list(line.coords), close=False))
+            return self.LINESTRING, commands
+
+        elif gtype in ("Polygon", "MultiPolygon"):
+            from shapely.geometry.polygon import orient
+            polygons = [geometry] if gtype == "Polygon" else list(geometry.geoms)
+            cursor = [0, 0]
+            commands = []
+            for polygon in polygons:
+                # Exterior ring must have positive area in tile coordinates
+                polygon = orient(polygon, sign=1.0)
+                exterior = self.path(cursor, list(polygon.exterior.coords)[:-1], close=True)
+                if not exterior:
+                    continue
+                commands.extend(exterior)
+                for interior in polygon.interiors:
+                    commands.extend(self.path(cursor, list(interior.coords)[:-1], close=True))
+            return self.POLYGON, commands
+
+        elif gtype == "GeometryCollection":
+            # Encode the first part that has a supported type
+            for part in geometry.geoms:
+                geometry_type, commands = self.geometry(part)
+                if commands:
+                    return geometry_type, commands
+
+        return None, None
+
+    # -------------------------------------------------------------------------
+    def path(self, cursor, coords, close=False):
+        """
+            Encodes a line path or polygon ring
+
+            Args:
+                cursor: the current cursor position [x, y] (updated in-place)
+                coords: the vertices
+                close: close the path (polygon rings)
+
+            Returns:
+                list of command integers
+        """
+
+        # Remove consecutive duplicates after rounding
+        vertices = []
+        for x, y in coords:
+            vertex = (int(round(x)), int(round(y)))
+            if not vertices or vertex != vertices[-1]:
+                vertices.append(vertex)
+        if len(vertices) < (3 if close else 2):
+            return []
+
+        commands = [self.command(self.MOVE_TO, 1)]
+        commands.extend(self.deltas(cursor, vertices[:1]))
+        commands.append(self.command(self.LINE_TO, len(vertices) - 1))
+        commands.extend(self.deltas(cursor, vertices[1:]))
+        if close:
+            commands.append(self.command(self.CLOSE_PATH, 1))
+
+        return commands
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def deltas(cursor, coords):
+        """
+            Encodes vertices as zigzag-encoded deltas from the cursor
+
+            Args:
+                cursor: the current cursor position [x, y] (updated in-place)
+                coords: the vertices
+
+            Returns:
+                list of parameter integers
+        """
+
+        params = []
+        for x, y in coords:
+            x, y = int(round(x)), int(round(y))
+            dx, dy = x - cursor[0], y - cursor[1]
+            params.append((dx << 1) ^ (dx >> 31))
+            params.append((dy << 1) ^ (dy >> 31))
+            cursor[0], cursor[1] = x, y
+        return params
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def command(cid, count):
+
+        return (cid & 0x7) | (count << 3)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def value(cls, value):
+        """
+            Encodes a property value
+
+            Args:
+                value: the value
+
+            Returns:
+                the encoded Value message
+        """
+
+        if isinstance(value, bool):
+            return cls.key(7, 0) + cls.varint(int(value))
+        elif isinstance(value, int):
+            if value >= 0:
+                return cls.key(5, 0) + cls.varint(value)
+            else:
+                return cls.key(6, 0) + cls.varint((value << 1) ^ (value >> 63))
+        elif isinstance(value, float):
+            return cls.key(3, 1) + struct.pack("<d", value)
+        else:
+            return cls.field(1, str(value).encode("utf-8"))
+
+    # -------------------------------------------------------------------------
+    # Protocol buffer primitives
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def varint(number):
+
+        output = bytearray()
+        while True:
+            byte = number & 0x7f
+            number >>= 7
+            if number:
+                output.append(byte | 0x80)
+            else:
+                output.append(byte)
+                break
+        return bytes(output)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def key(cls, field_number, wire_type):
+
+        return cls.varint((field_number << 3) | wire_type)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def field(cls, field_number, data):
+        """ Length-delimited field """
+
+        return cls.key(field_number, 2) + cls.varint(len(data)) + data
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def packed(cls, numbers):
+
+        return b"".join(cls.varint(n) for n in numbers)
+
+# =============================================================================
+class VectorTiles:
+    """
+        Generator for Mapbox Vector Tiles (MVT) of a Feature or Theme
+        Layer, clipping and simplifying the geometries per tile (using
+        ST_AsMVT with PostGIS, or shapely and MVTEncoder otherwise)
+
+        Tiles are cached on disk, keyed by the layer, a version of the
+        data and the effective resource query (=layer filter plus accessible
+        query, so tiles are not shared between users with different
+        permissions); tiles of older versions are removed as soon as a
+        new version gets cached.
+    """
+
+    EXTENT = 4096
+    BUFFER = 64
+
+    # Time (seconds) to cache the data version per layer
+    VERSION_EXPIRE = 30
+
+    def __init__(self, layer_id):
+        """
+            Args:
+                layer_id: the gis_layer_entity layer_id
+        """
+
+        self.layer_id = layer_id
+
+        self._resource = None
+        self._layer = None
+
+    # -------------------------------------------------------------------------
+    @property
+    def layer(self):
+        """
+            The layer record, with tablename and instance type added
+
+            Raises:
+                HTTP 404 if the layer does not exist, is not supported
+                         or has no table configured
+                HTTP 403 if the user is not permitted to access the layer
+        """
+
+        layer = self._layer
+        if layer is None:
+
+            db = current.db
+            s3db = current.s3db
+            auth = current.auth
+
+            etable = s3db.gis_layer_entity
+            entity = db(etable.layer_id == self.layer_id).select(etable.instance_type,
+                                                                 limitby = (0, 1),
+                                                                 ).first()
+            instance_type = entity.instance_type if entity else None
+            if instance_type not in ("gis_layer_feature", "gis_layer_theme"):
+                raise HTTP(404)
+
+            table = s3db[instance_type]
+            query = (table.layer_id == self.layer_id) & \
+                    (table.deleted == False)
+            layer = db(query).select(table.ALL, limitby=(0, 1)).first()
+            if not layer:
+                raise HTTP(404)
+            if layer.role_required and not auth.s3_has_role(layer.role_required):
+                raise HTTP(403)
+
+            layer.instance_type = instance_type
+            if instance_type == "gis_layer_feature":
+                if not auth.permission.has_permission("read",
+                                                      c = layer.controller,
+                                                      f = layer.function,
+                                                      ):
+                    raise HTTP(403)
+                if not layer.tablename:
+                    raise HTTP(404, "No table configured for layer")
+            else:
+                layer.tablename = "gis_theme_data"
+
+            self._layer = layer
+
+        return layer
+
+    # -------------------------------------------------------------------------
+    @property
+    def resource(self):
+        """
+            The resource for the layer, with the layer filter applied
+        """
+
+        resource = self._resource
+        if resource is None:
+
+            layer = self.layer
+            s3db = current.s3db
+
+            tablename = layer.tablename
+            if s3db.table(tablename) is None:
+                raise HTTP(404)
+
+            if layer.instance_type == "gis_layer_theme":
+                query = (s3db.gis_theme_data.layer_theme_id == layer.id)
+                resource = s3db.resource(tablename, filter=query)
+            else:
+                filter_vars = dict(parse_qsl(layer.filter)) if layer.filter else None
+                resource = s3db.resource(tablename, vars=filter_vars)
+
+            self._resource = resource
+
+        return resource
+
+    # -------------------------------------------------------------------------
+    def tile(self, z, x, y):
+        """
+            Returns a tile, from cache if available
+
+            Args:
+                z: the zoom level
+                x: the tile column
+                y: the tile row (from the top, as in XYZ/Slippy Map tiles)
+
+            Returns:
+                the tile as bytes (empty for tiles without features)
+        """
+
+        if z < 0 or z > 24 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise HTTP(400, "Invalid tile coordinates")
+
+        path = self.cache_path(z, x, y)
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        if current.deployment_settings.get_gis_spatialdb():
+            data = self.tile_postgis(z, x, y)
+        else:
+            data = self.tile_shapely(z, x, y)
+
+        if path:
+            folder = os.path.dirname(path)
+            try:
+                if not os.path.exists(folder):
+                    self.prune(path)
+                    os.makedirs(folder)
+                with open(path, "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                current.log.error("GIS: vector tile could not be cached: %s" % e)
+
+        return data
+
+    # -------------------------------------------------------------------------
+    def cache_path(self, z, x, y):
+        """
+            The path of the cache file for a tile
+
+            Args:
+                z: the zoom level
+                x: the tile column
+                y: the tile row
+
+            Returns:
+                the file path, or None if the cache folder is not writable
+        """
+
+        folder = os.path.join(current.request.folder, "uploads", "gis_cache", "mvt")
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                return None
+        elif not os.access(folder, os.W_OK):
+            return None
+
+        version = hashlib.md5(self.version().encode("utf-8")).hexdigest()
+        query = hashlib.md5(str(self.resource.get_query()).encode("utf-8")).hexdigest()
+
+        return os.path.join(folder,
+                            str(self.layer_id),
+                            version,
+                            query,
+                            str(z),
+                            str(x),
+                            "%s.mvt" % y,
+                            )
+
+    @staticmethod
+    def prune(path):
+        """
+            Removes the cached tiles of all other versions of the layer
+
+            Args:
+                path: the cache path of a tile of the current version
+        """
+
+        # path = .../<layer_id>/<version>/<query>/<z>/<x>/<y>.mvt
+        folder = path
+        for _ in range(4):
+            folder = os.path.dirname(folder)
+        version = os.path.basename(folder)
+        layer_folder = os.path.dirname(folder)
+
+        if not os.path.isdir(layer_folder):
+            return
+        for name in os.listdir(layer_folder):
+            if name != version:
+                shutil.rmtree(os.path.join(layer_folder, name), ignore_errors=True)
+
+    # -------------------------------------------------------------------------
+    def version(self):
+        """
+            A version string of the layer data, changes whenever features
+            or their locations are added, modified or deleted; cached
+            briefly as it requires aggregates over the full tables
+
+            Returns:
+                the version string
+        """
+
+        key = "gis_mvt_version_%s" % self.layer_id
+        return current.cache.ram(key,
+                                 self._version,
+                                 time_expire = self.VERSION_EXPIRE,
+                                 )
+
+    # -------------------------------------------------------------------------
+    def _version(self):
+        """
+            Computes the version string of the layer data
+
+            Returns:
+                the version string
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        layer = self.layer
+        table = self.resource.table
+        gtable = s3db.gis_location
+
+        version = [layer.modified_on]
+        for t in (table, gtable):
+            if "modified_on" in t.fields:
+                cnt = t._id.count()
+                mtime = t.modified_on.max()
+                row = db(t._id > 0).select(cnt, mtime).first()
+                version.extend((row[cnt], row[mtime]))
+
+        return "|".join(str(v) for v in version)
+
+    # -------------------------------------------------------------------------
+    def feature_query(self):
+        """
+            The query for the layer features joined with their locations
+
+            Returns:
+                tuple (query, join, left, extra), where extra is a list
+                of additional fields to include as feature properties
+        """
+
+        s3db = current.s3db
+
+        resource = self.resource
+        table = resource.table
+        tablename = resource.tablename
+        gtable = s3db.gis_location
+
+        # Effective resource query (incl. accessible query and layer filter)
+        rfilter = resource.rfilter
+        query = resource.get_query()
+        if rfilter.get_filter() is not None:
+            # Virtual filter => must filter in Python
+            rows = resource.select([table._id.name], limit=None, as_rows=True)
+            query = table._id.belongs({row[table._id] for row in rows})
+            join = left = None
+        else:
+            ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+            ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+            join = ijoins.as_list(prefer=ljoins)
+            left = ljoins.as_list()
+
+        # Join with the locations
+        if tablename == "gis_location":
+            pass
+        elif "location_id" in table.fields and not self.layer.get("use_site"):
+            query &= (table.location_id == gtable.id)
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            query &= (table.site_id == stable.site_id) & \
+                     (stable.location_id == gtable.id)
+        else:
+            # Resource can't be mapped
+            raise HTTP(404)
+
+        if tablename == "gis_theme_data":
+            extra = [table.value]
+        else:
+            extra = []
+
+        return query, join, left, extra
+
+    # -------------------------------------------------------------------------
+    def tile_postgis(self, z, x, y):
+        """
+            Generates a tile with PostGIS (ST_AsMVT)
+
+            Args:
+                z: the zoom level
+                x: the tile column
+                y: the tile row
+
+            Returns:
+                the tile as bytes
+        """
+
+        db = current.db
+        gtable = current.s3db.gis_location
+
+        table = self.resource.table
+        query, join, left, extra = self.feature_query()
+
+        minx, miny, maxx, maxy = self.bounds(z, x, y)
+        envelope = "ST_MakeEnvelope(%.8f,%.8f,%.8f,%.8f,3857)" % (minx, miny, maxx, maxy)
+
+        west, south, east, north = self.lonlat_bounds(z, x, y)
+        bbox = "POLYGON((%.8f %.8f,%.8f %.8f,%.8f %.8f,%.8f %.8f,%.8f %.8f))" % \
+               (west, south, east, south, east, north, west, north, west, south)
+        query &= (gtable.the_geom.st_intersects(bbox))
+
+        fields = [table._id.with_alias("fid"), gtable.the_geom.with_alias("geom")]
+        fields.extend(extra)
+        subselect = db(query)._select(*fields, join=join, left=left)
+        subselect = subselect.rstrip().rstrip(";")
+
+        columns = ", ".join(["f.%s" % f.name for f in extra] + ["f.fid"])
+        sql = "SELECT ST_AsMVT(t.*, %(name)s, %(extent)s, 'geom', 'fid') " \
+              "FROM (SELECT %(columns)s, " \
+                    "ST_AsMVTGeom(ST_Transform(f.geom, 3857), %(envelope)s, " \
+                                 "%(extent)s, %(buffer)s, true) AS geom " \
+                    "FROM (%(subselect)s) AS f) AS t " \
+              "WHERE t.geom IS NOT NULL;" % {"name": db._adapter.represent("layer_%s" % self.layer_id, "string"),
+                                             "extent": self.EXTENT,
+                                             "buffer": self.BUFFER,
+                                             "columns": columns,
+                                             "envelope": envelope,
+                                             "subselect": subselect,
+                                             }
+        rows = db.executesql(sql)
+        data = rows[0][0] if rows else None
+
+        return bytes(data) if data else b""
+
+    # -------------------------------------------------------------------------
+    def tile_shapely(self, z, x, y):
+        """
+            Generates a tile with shapely and MVTEncoder
+
+            Args:
+                z: the zoom level
+                x: the tile column
+                y: the tile row
+
+            Returns:
+                the tile as bytes
+        """
+
+        from shapely.geometry import box, Point
+        from shapely.ops import transform
+        from shapely.wkt import loads as wkt_loads
+
+        db = current.db
+        gtable = current.s3db.gis_location
+
+        table = self.resource.table
+        query, join, left, extra = self.feature_query()
+
+        # Bounding box pre-filter
+        west, south, east, north = self.lonlat_bounds(z, x, y)
+        query &= (((gtable.lat_min <= north) & (gtable.lat_max >= south) & \
+                   (gtable.lon_min <= east) & (gtable.lon_max >= west)) | \
+                  ((gtable.lat_min == None) & \
+                   (gtable.lat <= north) & (gtable.lat >= south) & \
+                   (gtable.lon <= east) & (gtable.lon >= west)))
+
+        fields = [table._id, gtable.wkt, gtable.lat, gtable.lon]
+        fields.extend(extra)
+        rows = db(query).select(*fields, join=join, left=left)
+
+        # Transformation into tile coordinates
+        extent = self.EXTENT
+        minx, miny, maxx, maxy = self.bounds(z, x, y)
+        scale = extent / (maxx - minx)
+        def project(lon, lat, z=None):
+            mx, my = self.mercator(lon, lat)
+            return (mx - minx) * scale, (maxy - my) * scale
+
+        buffer = self.BUFFER
+        clip = box(-buffer, -buffer, extent + buffer, extent + buffer)
+
+        features = []
+        append = features.append
+        single = table is gtable
+        for row in rows:
+            location = row if single else row.gis_location
+            if location.wkt:
+                try:
+                    geometry = wkt_loads(location.wkt)
+                except Exception:
+                    continue
+            elif location.lat is not None and location.lon is not None:
+                geometry = Point(location.lon, location.lat)
+            else:
+                continue
+
+            geometry = transform(project, geometry)
+            if not geometry.intersects(clip):
+                continue
+            if geometry.geom_type not in ("Point", "MultiPoint"):
+                # Simplify to the tile resolution
+                geometry = geometry.simplify(0.5, preserve_topology=True)
+                geometry = geometry.intersection(clip)
+                if geometry.is_empty:
+                    continue
+
+            properties = {f.name: row[f] for f in extra}
+            append((row[table._id], geometry, properties))
+
+        encoder = MVTEncoder(extent=extent)
+        encoder.add_layer("layer_%s" % self.layer_id, features)
+
+        return encoder.encode()
+
+    # -------------------------------------------------------------------------
+    # Tile Math
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def bounds(z, x, y):
+        """
+            The bounds of a tile in spherical mercator
+
+            Returns:
+                tuple (minx, miny, maxx, maxy)
+        """
+
+        size = 2 * MERCATOR_MAX / (2 ** z)
+        minx = -MERCATOR_MAX + x * size
+        maxy = MERCATOR_MAX - y * size
+
+        return minx, maxy - size, minx + size, maxy
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def lonlat_bounds(z, x, y):
+        """
+            The bounds of a tile in WGS84
+
+            Returns:
+                tuple (west, south, east, north)
+        """
+
+        n = 2 ** z
+        lat = lambda row: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+        return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def mercator(lon, lat):
+        """
+            Projects WGS84 coordinates into spherical mercator
+
+            Returns:
+                tuple (x, y)
+        """
+
+        lat = max(min(lat, 85.0511287798), -85.0511287798)
+        mx = lon * MERCATOR_MAX / 180
+        my = math.log(math.tan((90 + lat) * math.pi / 360)) * MERCATOR_MAX / math.pi
+
+        return mx, my
+
+# END =========================================================================
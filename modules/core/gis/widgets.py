@@ -30,17 +30,14 @@ import re
 
 from urllib.parse import quote as urllib_quote
 
-from gluon import current, URL, DIV, XML, A, HTTP
+from gluon import current, URL, DIV, XML, A
 from gluon.languages import regex_translate
 
 from ..tools import JSONERRORS, JSONSEPARATORS, include_ext_js, include_underscore_js, s3_str
 
 from .base import GIS
-from .layers import LayerArcREST, LayerBing, LayerCoordinate, LayerEmpty, LayerFeature, \
-                    LayerGPX, LayerGeoJSON, LayerGeoRSS, LayerGoogle, LayerJS, LayerKML, \
-                    LayerOSM, LayerOpenWeatherMap, LayerShapefile, LayerTMS, LayerTheme, \
-                    LayerWFS, LayerWMS, LayerXYZ, \
-                    CLUSTER_ATTRIBUTE, CLUSTER_DISTANCE, CLUSTER_THRESHOLD
+from .configcache import MapConfigCache
+from .layers import CLUSTER_ATTRIBUTE, CLUSTER_DISTANCE, CLUSTER_THRESHOLD
 from .marker import Marker
 
 # =============================================================================
@@ -609,142 +606,11 @@ class MAP(DIV):
             options["feature_resources"] = addFeatureResources(feature_resources)
 
         # Layers
-        db = current.db
-        ltable = db.gis_layer_config
-        etable = db.gis_layer_entity
-        query = (ltable.deleted == False)
-        join = [etable.on(etable.layer_id == ltable.layer_id)]
-        fields = [etable.instance_type,
-                  ltable.layer_id,
-                  ltable.enabled,
-                  ltable.visible,
-                  ltable.base,
-                  ltable.dir,
-                  ]
-
-        if opts_get("catalogue_layers", False):
-            # Add all enabled Layers from the Catalogue
-            stable = db.gis_style
-            mtable = db.gis_marker
-            query &= (ltable.config_id.belongs(config.ids))
-            join.append(ctable.on(ctable.id == ltable.config_id))
-            fields.extend((stable.style,
-                           stable.cluster_distance,
-                           stable.cluster_threshold,
-                           stable.opacity,
-                           stable.popup_format,
-                           mtable.image,
-                           mtable.height,
-                           mtable.width,
-                           ctable.pe_type))
-            left = [stable.on((stable.layer_id == etable.layer_id) & \
-                              (stable.record_id == None) & \
-                              ((stable.config_id == ctable.id) | \
-                               (stable.config_id == None))),
-                    mtable.on(mtable.id == stable.marker_id),
-                    ]
-            limitby = None
-            # @ToDo: Need to fix this?: make the style lookup a different call
-            if settings.get_database_type() == "postgres":
-                # None is last
-                orderby = [ctable.pe_type, stable.config_id]
-            else:
-                # None is 1st
-                orderby = [ctable.pe_type, ~stable.config_id]
-            if settings.get_gis_layer_metadata():
-                cptable = s3db.cms_post_layer
-                left.append(cptable.on(cptable.layer_id == etable.layer_id))
-                fields.append(cptable.post_id)
-        else:
-            # Add just the default Base Layer
-            query &= (ltable.base == True) & \
-                     (ltable.config_id == config.id)
-            # Base layer doesn't need a style
-            left = None
-            limitby = (0, 1)
-            orderby = None
-
-        layer_types = []
-        lappend = layer_types.append
-        layers = db(query).select(join = join,
-                                  left = left,
-                                  limitby = limitby,
-                                  orderby = orderby,
-                                  *fields)
-        if not layers:
-            # Use Site Default base layer
-            # (Base layer doesn't need a style)
-            query = (etable.id == ltable.layer_id) & \
-                    (ltable.config_id == ctable.id) & \
-                    (ctable.uuid == "SITE_DEFAULT") & \
-                    (ltable.base == True) & \
-                    (ltable.enabled == True)
-            layers = db(query).select(*fields,
-                                      limitby = (0, 1))
-            if not layers:
-                # Just show EmptyLayer
-                layer_types = [LayerEmpty]
-
-        for layer in layers:
-            layer_type = layer["gis_layer_entity.instance_type"]
-            if layer_type == "gis_layer_openstreetmap":
-                lappend(LayerOSM)
-            elif layer_type == "gis_layer_google":
-                # NB v3 doesn't work when initially hidden
-                lappend(LayerGoogle)
-            elif layer_type == "gis_layer_arcrest":
-                lappend(LayerArcREST)
-            elif layer_type == "gis_layer_bing":
-                lappend(LayerBing)
-            elif layer_type == "gis_layer_tms":
-                lappend(LayerTMS)
-            elif layer_type == "gis_layer_wms":
-                lappend(LayerWMS)
-            elif layer_type == "gis_layer_xyz":
-                lappend(LayerXYZ)
-            elif layer_type == "gis_layer_empty":
-                lappend(LayerEmpty)
-            elif layer_type == "gis_layer_js":
-                lappend(LayerJS)
-            elif layer_type == "gis_layer_theme":
-                lappend(LayerTheme)
-            elif layer_type == "gis_layer_geojson":
-                lappend(LayerGeoJSON)
-            elif layer_type == "gis_layer_gpx":
-                lappend(LayerGPX)
-            elif layer_type == "gis_layer_coordinate":
-                lappend(LayerCoordinate)
-            elif layer_type == "gis_layer_georss":
-                lappend(LayerGeoRSS)
-            elif layer_type == "gis_layer_kml":
-                lappend(LayerKML)
-            elif layer_type == "gis_layer_openweathermap":
-                lappend(LayerOpenWeatherMap)
-            elif layer_type == "gis_layer_shapefile":
-                lappend(LayerShapefile)
-            elif layer_type == "gis_layer_wfs":
-                lappend(LayerWFS)
-            elif layer_type == "gis_layer_feature":
-                lappend(LayerFeature)
-
-        # Make unique
-        layer_types = set(layer_types)
-        scripts = []
-        scripts_append = scripts.append
-        for LayerType in layer_types:
-            try:
-                # Instantiate the Class
-                layer = LayerType(layers, openlayers=2)
-                layer.as_dict(options)
-                for script in layer.scripts:
-                    scripts_append(script)
-            except Exception as exception:
-                error = "%s not shown: %s" % (LayerType.__name__, exception)
-                current.log.error(error)
-                if s3.debug:
-                    raise HTTP(500, error)
-                else:
-                    response.warning += error
+        scripts = MapConfigCache.layers(config,
+                                        options,
+                                        catalogue_layers = opts_get("catalogue_layers", False),
+                                        openlayers = 2,
+                                        )
 
         # WMS getFeatureInfo
         # (loads conditionally based on whether queryable WMS Layers have been added)
@@ -946,7 +812,6 @@ class MAP2(DIV):
         # Read options for this Map
         get_vars_get = current.request.get_vars.get
         opts_get = self.opts.get
-        settings = current.deployment_settings
 
         ##########
         # Viewport
@@ -1093,145 +958,10 @@ class MAP2(DIV):
             options["feature_resources"] = addFeatureResources(feature_resources)
 
         # Layers
-        db = current.db
-        ctable = db.gis_config
-        ltable = db.gis_layer_config
-        etable = db.gis_layer_entity
-        query = (ltable.deleted == False)
-        join = [etable.on(etable.layer_id == ltable.layer_id)]
-        fields = [etable.instance_type,
-                  ltable.layer_id,
-                  ltable.enabled,
-                  ltable.visible,
-                  ltable.base,
-                  ltable.dir,
-                  ]
-
-        if opts_get("catalogue_layers", False):
-            # Add all enabled Layers from the Catalogue
-            stable = db.gis_style
-            mtable = db.gis_marker
-            query &= (ltable.config_id.belongs(config.ids))
-            join.append(ctable.on(ctable.id == ltable.config_id))
-            fields.extend((stable.style,
-                           stable.cluster_distance,
-                           stable.cluster_threshold,
-                           stable.opacity,
-                           stable.popup_format,
-                           mtable.image,
-                           mtable.height,
-                           mtable.width,
-                           ctable.pe_type))
-            left = [stable.on((stable.layer_id == etable.layer_id) & \
-                              (stable.record_id == None) & \
-                              ((stable.config_id == ctable.id) | \
-                               (stable.config_id == None))),
-                    mtable.on(mtable.id == stable.marker_id),
-                    ]
-            limitby = None
-            # @ToDo: Need to fix this?: make the style lookup a different call
-            if settings.get_database_type() == "postgres":
-                # None is last
-                orderby = [ctable.pe_type, stable.config_id]
-            else:
-                # None is 1st
-                orderby = [ctable.pe_type, ~stable.config_id]
-            if settings.get_gis_layer_metadata():
-                cptable = current.s3db.cms_post_layer
-                left.append(cptable.on(cptable.layer_id == etable.layer_id))
-                fields.append(cptable.post_id)
-        else:
-            # Add just the default Base Layer
-            query &= (ltable.base == True) & \
-                     (ltable.config_id == config.id)
-            # Base layer doesn't need a style
-            left = None
-            limitby = (0, 1)
-            orderby = None
-
-        layer_types = []
-        lappend = layer_types.append
-        layers = db(query).select(join = join,
-                                  left = left,
-                                  limitby = limitby,
-                                  orderby = orderby,
-                                  *fields)
-        if not layers:
-            # Use Site Default base layer
-            # (Base layer doesn't need a style)
-            query = (etable.id == ltable.layer_id) & \
-                    (ltable.config_id == ctable.id) & \
-                    (ctable.uuid == "SITE_DEFAULT") & \
-                    (ltable.base == True) & \
-                    (ltable.enabled == True)
-            layers = db(query).select(*fields,
-                                      limitby = (0, 1)
-                                      )
-            if not layers:
-                # Just show EmptyLayer
-                layer_types = [LayerEmpty]
-
-        for layer in layers:
-            layer_type = layer["gis_layer_entity.instance_type"]
-            if layer_type == "gis_layer_openstreetmap":
-                lappend(LayerOSM)
-            elif layer_type == "gis_layer_google":
-                # NB v3 doesn't work when initially hidden
-                lappend(LayerGoogle)
-            elif layer_type == "gis_layer_arcrest":
-                lappend(LayerArcREST)
-            elif layer_type == "gis_layer_bing":
-                lappend(LayerBing)
-            elif layer_type == "gis_layer_tms":
-                lappend(LayerTMS)
-            elif layer_type == "gis_layer_wms":
-                lappend(LayerWMS)
-            elif layer_type == "gis_layer_xyz":
-                lappend(LayerXYZ)
-            elif layer_type == "gis_layer_empty":
-                lappend(LayerEmpty)
-            elif layer_type == "gis_layer_js":
-                lappend(LayerJS)
-            elif layer_type == "gis_layer_theme":
-                lappend(LayerTheme)
-            elif layer_type == "gis_layer_geojson":
-                lappend(LayerGeoJSON)
-            elif layer_type == "gis_layer_gpx":
-                lappend(LayerGPX)
-            elif layer_type == "gis_layer_coordinate":
-                lappend(LayerCoordinate)
-            elif layer_type == "gis_layer_georss":
-                lappend(LayerGeoRSS)
-            elif layer_type == "gis_layer_kml":
-                lappend(LayerKML)
-            elif layer_type == "gis_layer_openweathermap":
-                lappend(LayerOpenWeatherMap)
-            elif layer_type == "gis_layer_shapefile":
-                lappend(LayerShapefile)
-            elif layer_type == "gis_layer_wfs":
-                lappend(LayerWFS)
-            elif layer_type == "gis_layer_feature":
-                lappend(LayerFeature)
-
-        # Make unique
-        layer_types = set(layer_types)
-        scripts = []
-        scripts_append = scripts.append
-        for layer_type_class in layer_types:
-            try:
-                # Instantiate the Class
-                layer = layer_type_class(layers)
-                layer.as_dict(options)
-                for script in layer.scripts:
-                    scripts_append(script)
-            except Exception as exception:
-                error = "%s not shown: %s" % (layer_type_class.__name__, exception)
-                current.log.error(error)
-                response = current.response
-                if response.s3.debug:
-                    raise HTTP(500, error)
-                else:
-                    response.warning += error
+        MapConfigCache.layers(config,
+                              options,
+                              catalogue_layers = opts_get("catalogue_layers", False),
+                              )
 
         return options
 
@@ -27,17 +27,26 @@
 
 __all__ = ("S3Report",
            "S3PivotTable",
+           "S3PivotTableCache",
            "S3ReportRepresent",
            )
 
 import datetime
+import hashlib
+import heapq
 import json
 import os
 import re
 import sys
+import uuid
 
 from itertools import product, chain
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from gluon import current
 from gluon.contenttype import contenttype
 from gluon.html import BUTTON, DIV, FIELDSET, FORM, INPUT, LABEL, LEGEND, TAG, XML
@@ -46,11 +55,14 @@ from gluon.sqlhtml import OptionsWidget
 from gluon.storage import Storage
 from gluon.validators import IS_IN_SET, IS_EMPTY_OR
 
+from s3dal import original_tablename
+
 from ..formats import S3XMLFormat
-from ..resource import FS, S3Joins
+from ..resource import FS, S3Joins, SummaryTable
 from ..tools import IS_NUMBER, JSONERRORS, JSONSEPARATORS, \
                     MarkupStripper, get_crud_string, s3_flatlist, \
-                    s3_has_foreign_key, s3_represent_value, s3_str
+                    s3_get_foreign_key, s3_has_foreign_key, s3_represent_value, \
+                    s3_str
 
 from .base import CRUDMethod
 
@@ -61,6 +73,9 @@ LAYER = re.compile(r"([a-zA-Z]+)\((.*)\)\Z")
 FACT = re.compile(r"([a-zA-Z]+)\(([a-zA-Z0-9_.$:\,~]+)\),*(.*)\Z")
 SELECTOR = re.compile(r"^[a-zA-Z0-9_.$:\~]+\Z")
 
+# Pivot table and items of a forked worker process (see _pivot_init)
+_PARALLEL = None
+
 # =============================================================================
 class S3Report(CRUDMethod):
     """ RESTful method for pivot table reports """
@@ -153,25 +168,29 @@ class S3Report(CRUDMethod):
                 current.log.error(sys.exc_info()[1])
                 facts = None
             if not facts or not any([rows, cols]):
-                pivottable = None
+                axes = None
             else:
                 prefix = resource.prefix_selector
                 get_vars["rows"] = prefix(rows) if rows else None
                 get_vars["cols"] = prefix(cols) if cols else None
                 get_vars["fact"] = ",".join("%s(%s)" % (fact.method, fact.selector) for fact in facts)
 
-                pivottable = S3PivotTable(resource, rows, cols, facts,
-                                          precision = report_options.get("precision"),
-                                          )
+                axes = (rows, cols, facts)
         else:
-            pivottable = None
+            axes = None
+
+        precision = report_options.get("precision")
 
         representation = r.representation
         if representation in ("html", "iframe", "json"):
 
             # Generate JSON-serializable dict
-            if pivottable is not None:
-                pivotdata = pivottable.json(maxrows=maxrows, maxcols=maxcols)
+            if axes:
+                pivotdata = self.pivotdata(resource, *axes,
+                                           precision = precision,
+                                           maxrows = maxrows,
+                                           maxcols = maxcols,
+                                           )
             else:
                 pivotdata = None
 
@@ -243,7 +262,9 @@ class S3Report(CRUDMethod):
 
         elif r.representation == "xlsx":
 
-            if pivottable:
+            if axes:
+
+                pivottable = S3PivotTable(resource, *axes, precision=precision)
 
                 # Report title
                 title = get_crud_string(r.tablename, "title_report")
@@ -511,25 +532,24 @@ class S3Report(CRUDMethod):
                 current.log.error(sys.exc_info()[1])
                 facts = None
             if not facts or not any([rows, cols]):
-                pivottable = None
+                axes = None
             else:
                 prefix = resource.prefix_selector
                 get_vars["rows"] = prefix(rows) if rows else None
                 get_vars["cols"] = prefix(cols) if cols else None
                 get_vars["fact"] = ",".join("%s(%s)" % (fact.method, fact.selector) for fact in facts)
 
-                if visible:
-                    pivottable = S3PivotTable(resource, rows, cols, facts,
-                                              precision = report_options.get("precision"),
-                                              )
-                else:
-                    pivottable = None
+                axes = (rows, cols, facts) if visible else None
         else:
-            pivottable = None
+            axes = None
 
         # Render as JSON-serializable dict
-        if pivottable is not None:
-            pivotdata = pivottable.json(maxrows=maxrows, maxcols=maxcols)
+        if axes:
+            pivotdata = self.pivotdata(resource, *axes,
+                                       precision = report_options.get("precision"),
+                                       maxrows = maxrows,
+                                       maxcols = maxcols,
+                                       )
         else:
             pivotdata = None
 
@@ -572,6 +592,41 @@ class S3Report(CRUDMethod):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pivotdata(resource, rows, cols, facts, precision=None, maxrows=None, maxcols=None):
+        """
+            Generates the pivot table data for a report, looked up
+            from cache if possible (see S3PivotTableCache)
+
+            Args:
+                resource: the CRUDResource
+                rows: the rows selector
+                cols: the columns selector
+                facts: the list of S3PivotTableFacts
+                precision: the precision of aggregate computations
+                maxrows: maximum number of rows
+                maxcols: maximum number of columns
+
+            Returns:
+                the pivot table data (JSON-serializable dict)
+        """
+
+        def build():
+            # Compute only the top rows/columns in detail?
+            collapse = current.deployment_settings.get_ui_report_collapse_tail()
+            pivottable = S3PivotTable(resource, rows, cols, facts,
+                                      precision = precision,
+                                      maxrows = maxrows if collapse else None,
+                                      maxcols = maxcols if collapse else None,
+                                      )
+            return pivottable.json(maxrows=maxrows, maxcols=maxcols)
+
+        return S3PivotTableCache.lookup(resource, rows, cols, facts, build,
+                                        maxrows = maxrows,
+                                        maxcols = maxcols,
+                                        )
+
     # -------------------------------------------------------------------------
     def explore(self, r, **attr):
         """
@@ -1434,6 +1489,311 @@ class S3ReportRepresent:
 
         return represent
 
+# =============================================================================
+class S3PivotTableCache:
+    """
+        Cache for pivot table data (see S3PivotTable.json), shared between
+        requests (e.g. dashboards and summary tabs re-rendering the same
+        report)
+
+        Entries are keyed by the resource and its filters, the report axes
+        and facts, the realms of the user and the language, and expire
+        after a configurable time (see expire); they are invalidated by
+        writes to any of the tables involved (see watch) - across processes
+        by means of per-table version stamps in uploads/report_cache, which
+        are stored with the entries and compared on lookup.
+    """
+
+    # Default cache expiry (seconds)
+    EXPIRE = 300
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def path(tablename):
+        """
+            The path of the version stamp file for a table
+
+            Args:
+                tablename: the table name
+
+            Returns:
+                the path
+        """
+
+        return os.path.join(current.request.folder,
+                            "uploads", "report_cache", "%s.version" % tablename,
+                            )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def version(cls, tablename):
+        """
+            The current data version of a table
+
+            Args:
+                tablename: the table name
+
+            Returns:
+                the version string
+        """
+
+        try:
+            with open(cls.path(tablename), "r") as f:
+                version = f.read().strip()
+        except IOError:
+            version = None
+
+        return version or "0"
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def touch(cls, tablename):
+        """
+            Writes a new version stamp for a table
+
+            Args:
+                tablename: the table name
+        """
+
+        path = cls.path(tablename)
+
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+
+        try:
+            with open(path, "w") as f:
+                f.write(uuid.uuid4().hex)
+        except IOError as e:
+            current.log.error("Report cache for %s could not be invalidated: %s" % (tablename, e))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, tablename):
+        """
+            Invalidates all cached reports involving a table; now, and
+            again after the current transaction has been committed (so
+            that no other process can cache outdated data meanwhile)
+
+            Args:
+                tablename: the table name
+        """
+
+        # Touch only once per request
+        s3 = current.response.s3
+        touched = s3.report_cache_touched
+        if touched is None:
+            touched = s3.report_cache_touched = set()
+        elif tablename in touched:
+            return
+        touched.add(tablename)
+
+        cls.touch(tablename)
+        current.s3task.defer("report_cache_invalidate",
+                             args = [tablename],
+                             key = "report_cache_invalidate_%s" % tablename,
+                             )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def watch(cls, table):
+        """
+            Installs callbacks to invalidate the cache on writes to a table
+
+            Args:
+                table: the Table
+        """
+
+        if getattr(table, "_report_cache_watched", False):
+            return
+
+        tablename = original_tablename(table)
+        invalidate = lambda *args: cls.invalidate(tablename)
+
+        table._after_insert.append(invalidate)
+        table._after_update.append(invalidate)
+        table._after_delete.append(invalidate)
+        table._report_cache_watched = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def expire(cls, resource):
+        """
+            The cache expiry for reports of a resource, configurable
+            per table as:
+                report_cache = <seconds> (or False to not cache the reports)
+
+            Args:
+                resource: the CRUDResource
+
+            Returns:
+                the expiry in seconds, or None if reports of the resource
+                shall not be cached
+        """
+
+        if not current.deployment_settings.get_ui_report_cache():
+            # Tables are not watched => can not cache
+            return None
+
+        expire = resource.get_config("report_cache", True)
+        if expire is True:
+            expire = current.deployment_settings.get_ui_report_cache()
+            if expire is True:
+                expire = cls.EXPIRE
+
+        return expire if expire else None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, resource, rows, cols, facts, build, maxrows=None, maxcols=None):
+        """
+            Looks up the pivot table data for a report from the cache,
+            builds them if not available
+
+            Args:
+                resource: the CRUDResource
+                rows: the rows selector
+                cols: the columns selector
+                facts: the list of S3PivotTableFacts
+                build: function to build the pivot table data
+                maxrows: maximum number of rows
+                maxcols: maximum number of columns
+
+            Returns:
+                the pivot table data (JSON-serializable dict)
+        """
+
+        expire = cls.expire(resource)
+        key = cls.key(resource, rows, cols, facts, maxrows, maxcols) if expire else None
+        if not key:
+            return build()
+
+        # Entries are stored with the data versions of the tables involved,
+        # and replaced if outdated (rather than keying them by versions,
+        # which would leave outdated entries behind until expiry)
+        versions = cls.versions(resource, rows, cols, facts)
+
+        cache = current.cache.ram
+        entry = cache(key, lambda: (versions, build()), time_expire=expire)
+        if entry[0] != versions:
+            data = build()
+            entry = cache(key, lambda: (versions, data), time_expire=0)
+
+        return entry[1]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def key(cls, resource, rows, cols, facts, maxrows=None, maxcols=None):
+        """
+            The cache key for a report
+
+            Args:
+                resource: the CRUDResource
+                rows: the rows selector
+                cols: the columns selector
+                facts: the list of S3PivotTableFacts
+                maxrows: maximum number of rows
+                maxcols: maximum number of columns
+
+            Returns:
+                the key, or None if the report cannot be cached
+        """
+
+        auth = current.auth
+
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+        if rfilter.get_extra_filters():
+            # Extra filters can not be serialized
+            return None
+
+        vfltr = rfilter.get_filter()
+        vfltr = vfltr.represent(resource) if vfltr else None
+
+        # Accessible records depend on the realms of the user
+        # - using the role assignments rather than the realms, so
+        #   as to not expand them with the subsidiaries of the realm
+        #   entities (changes to the entity hierarchy take effect
+        #   after expiry of the cache entries)
+        if auth.override:
+            realms = "override"
+        elif auth.user:
+            realms = auth.user.realms
+            realms = getattr(realms, "assignments", realms)
+            realms = json.dumps(realms, sort_keys=True, default=str)
+        else:
+            realms = "-"
+
+        key = "|".join(str(item) for item in (
+                    resource.tablename,
+                    resource.alias,
+                    resource.get_query(),
+                    vfltr,
+                    rows,
+                    cols,
+                    ",".join("%s(%s)" % (fact.method, fact.selector) for fact in facts),
+                    maxrows,
+                    maxcols,
+                    realms,
+                    current.T.accepted_language,
+                    ))
+
+        return "pivottable_%s" % hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def versions(cls, resource, rows, cols, facts):
+        """
+            The current data versions of all tables involved in a report
+
+            Args:
+                resource: the CRUDResource
+                rows: the rows selector
+                cols: the columns selector
+                facts: the list of S3PivotTableFacts
+
+            Returns:
+                the versions as string
+        """
+
+        rfilter = resource.rfilter
+        if rfilter is None:
+            rfilter = resource.build_query()
+
+        # Tables involved
+        tablenames = {resource.tablename}
+        tablenames.update(rfilter.get_joins(left=False, as_list=False))
+        tablenames.update(rfilter.get_joins(left=True, as_list=False))
+        if resource.parent:
+            tablenames.add(resource.parent.tablename)
+
+        selectors = [fact.selector for fact in facts]
+        selectors.extend(s for s in (rows, cols) if s)
+        for selector in selectors:
+            try:
+                rfield = resource.resolve_selector(selector)
+            except (AttributeError, SyntaxError):
+                continue
+            tablenames.add(rfield.tname)
+            tablenames.update(rfield.left)
+            field = rfield.field
+            if field is not None:
+                # Values are represented by the referenced table
+                ktablename = s3_get_foreign_key(field)[0]
+                if ktablename:
+                    tablenames.add(ktablename)
+
+        db = current.db
+        tablenames = sorted({original_tablename(getattr(db, tn)) if hasattr(db, tn) else tn
+                             for tn in tablenames
+                             })
+
+        return ",".join("%s:%s" % (tn, cls.version(tn)) for tn in tablenames)
+
 # =============================================================================
 class S3PivotTableFact:
     """ Class representing a fact layer """
@@ -1579,6 +1939,79 @@ class S3PivotTableFact:
             total = self.compute(totals)
         return total
 
+    # -------------------------------------------------------------------------
+    def merge(self, partials):
+        """
+            Merge partial aggregates (e.g. of cells into row totals)
+
+            Args:
+                partials: iterable of partial aggregates, for count the
+                          number of values, otherwise tuples
+                          (sum, count, min, max) of the numeric values
+
+            Returns:
+                the merged partial aggregate
+        """
+
+        if self.method == "count":
+            return sum(p for p in partials if p)
+
+        total, number, minimum, maximum = None, 0, None, None
+        for partial in partials:
+            if not partial:
+                continue
+            s, n, mn, mx = partial
+            if s is not None:
+                total = s if total is None else total + s
+            number += n if n else 0
+            if mn is not None and (minimum is None or mn < minimum):
+                minimum = mn
+            if mx is not None and (maximum is None or mx > maximum):
+                maximum = mx
+
+        return (total, number, minimum, maximum)
+
+    # -------------------------------------------------------------------------
+    def result(self, partial, precision=None):
+        """
+            Compute the aggregate value from a partial aggregate, with the
+            same results as compute() for the values the partial aggregate
+            has been computed from
+
+            Args:
+                partial: the partial aggregate (see merge)
+                precision: limit the precision of the result to this
+                           number of decimals
+
+            Returns:
+                the aggregate value
+        """
+
+        method = self.method
+
+        if method == "count":
+            return partial if partial else 0
+
+        total, number, minimum, maximum = partial if partial else (None, 0, None, None)
+
+        if method == "sum":
+            result = total if total is not None else 0
+        elif method == "min":
+            result = minimum
+        elif method == "max":
+            result = maximum
+        elif method == "avg":
+            if not number:
+                return 0.0
+            result = total / float(number)
+        else:
+            return None
+
+        if type(result) is float and precision is not None:
+            return round(result, precision)
+        else:
+            return result
+
     # -------------------------------------------------------------------------
     @classmethod
     def parse(cls, fact):
@@ -1744,7 +2177,17 @@ class S3PivotTableFact:
 class S3PivotTable:
     """ Class representing a pivot table of a resource """
 
-    def __init__(self, resource, rows, cols, facts, strict=True, precision=None):
+    def __init__(self,
+                 resource,
+                 rows,
+                 cols,
+                 facts,
+                 strict = True,
+                 precision = None,
+                 aggregate = None,
+                 maxrows = None,
+                 maxcols = None,
+                 ):
         """
             Args:
                 resource: the CRUDResource
@@ -1755,11 +2198,32 @@ class S3PivotTable:
                         the resource filter
                 precision: maximum precision of aggregate computations,
                            a dict {selector: number_of_decimals}
+                aggregate: compute the aggregates in the database (True),
+                           by extracting the records (False), or decide
+                           automatically by the number of records (None)
+                maxrows: compute only the top maxrows-1 rows in detail
+                         and collapse all others into one "Others" row
+                maxcols: compute only the top maxcols-1 columns in detail
+                         and collapse all others into one "Others" column
 
             Note:
                 Constructor extracts all unique records, generates a pivot
                 table from them with the given dimensions and computes the
                 aggregated values for each cell.
+
+                Where all facts and axes are simple (see _aggregate_in_db),
+                the aggregates can instead be computed with GROUP BY queries
+                in the database; the pivot table then does not contain the
+                record IDs per cell (i.e. no cell exploration). Unless
+                aggregate is False, the aggregates are taken from a
+                materialized summary of the resource table instead, if
+                there is one that can answer the report (see SummaryTable).
+
+                With maxrows/maxcols, the rows/columns are ranked by the
+                totals of the first fact (least first for "min", otherwise
+                top first), and the "Others" row/column is aggregated like
+                any other row/column (flagged as "other" in its header, with
+                the list of collapsed dimension values as its value).
         """
 
         # Initialize ----------------------------------------------------------
@@ -1779,6 +2243,9 @@ class S3PivotTable:
 
         self.precision = precision if isinstance(precision, dict) else {}
 
+        self.maxrows = maxrows
+        self.maxcols = maxcols
+
         # API variables -------------------------------------------------------
         #
         self.records = None
@@ -1795,6 +2262,11 @@ class S3PivotTable:
         self.numcols = None
         """ The number of columns in the pivot table """
 
+        self.rother = None
+        """ The index of the "Others" row (collapsed rows), if any """
+        self.cother = None
+        """ The index of the "Others" column (collapsed columns), if any """
+
         self.cell = None
         """ Array of pivot table cells in [rows[columns]]-order, each
             cell is a Storage like:
@@ -1828,6 +2300,9 @@ class S3PivotTable:
 
         self.values = {}
 
+        self.numrecords = 0
+        """ The total number of records in the pivot table """
+
         # Get the fields ------------------------------------------------------
         #
         tablename = resource.tablename
@@ -1856,79 +2331,14 @@ class S3PivotTable:
                 if axis in exclude_empty:
                     resource.add_filter(FS(axis) != None)
 
-        # Retrieve the records ------------------------------------------------
+        # Compute the pivot table ---------------------------------------------
         #
-        data = resource.select(list(self.rfields.keys()), limit=None)
-        drows = data["rows"]
-        if drows:
-
-            key = str(resource.table._id)
-            records = Storage([(i[key], i) for i in drows])
-
-            # Generate the data frame -----------------------------------------
-            #
-            gfields = self.gfields
-            pkey_colname = gfields[self.pkey]
-            rows_colname = gfields[rows]
-            cols_colname = gfields[cols]
-
-            if strict:
-                rfields = self.rfields
-                axes = (rfield
-                        for rfield in (rfields[rows], rfields[cols])
-                        if rfield != None)
-                axisfilter = self.axisfilter(resource, axes)
-            else:
-                axisfilter = None
-
-            dataframe = []
-            extend = dataframe.extend
-            expand = self._expand
-
-            for _id in records:
-                row = records[_id]
-                item = {key: _id}
-                if rows_colname:
-                    item[rows_colname] = row[rows_colname]
-                if cols_colname:
-                    item[cols_colname] = row[cols_colname]
-                extend(expand(item, axisfilter=axisfilter))
-
-            self.records = records
-
-            # Group the records -----------------------------------------------
-            #
-            matrix, rnames, cnames = self._pivot(dataframe,
-                                                 pkey_colname,
-                                                 rows_colname,
-                                                 cols_colname)
-
-            # Initialize columns and rows -------------------------------------
-            #
-            if cols:
-                self.col = [Storage({"value": v}) for v in cnames]
-                self.numcols = len(self.col)
-            else:
-                self.col = [Storage({"value": None})]
-                self.numcols = 1
-
-            if rows:
-                self.row = [Storage({"value": v}) for v in rnames]
-                self.numrows = len(self.row)
-            else:
-                self.row = [Storage({"value": None})]
-                self.numrows = 1
-
-            # Add the layers --------------------------------------------------
-            #
-            add_layer = self._add_layer
-            for fact in self.facts:
-                add_layer(matrix, fact)
-
+        if aggregate is not False and self._summarize():
+            pass
+        elif self._aggregate_in_db(aggregate):
+            self._aggregate()
         else:
-            # No items to report on -------------------------------------------
-            #
-            self.empty = True
+            self._select(strict=strict)
 
     # -------------------------------------------------------------------------
     # API methods
@@ -1936,11 +2346,7 @@ class S3PivotTable:
     def __len__(self):
         """ Total number of records in the report """
 
-        items = self.records
-        if items is None:
-            return 0
-        else:
-            return len(self.records)
+        return self.numrecords
 
     # -------------------------------------------------------------------------
     def geojson(self,
@@ -2059,6 +2465,11 @@ class S3PivotTable:
                 least: render the least n rows/columns rather than
                        the top n (with maxrows/maxcols)
 
+            Note:
+                maxrows/maxcols have no effect on axes that have already
+                been collapsed when computing the pivot table, the rows/
+                columns then contain only the top n and "Others"
+
             JSON Format:
                 {labels: {
                     layer:
@@ -2110,9 +2521,13 @@ class S3PivotTable:
 
             # Group and sort the rows (grouping = determine "others")
             irows = self.row
+            rother = self.rother
             rows = []
             rtail = (None, None)
             for i in range(self.numrows):
+                if i == rother:
+                    # Rows already collapsed by the engine
+                    continue
                 irow = irows[i]
                 totals = [irow[layer] for layer in layers]
                 sort_total = totals[0]
@@ -2121,10 +2536,18 @@ class S3PivotTable:
                                             else row_repr(irow.value),
                           }
                 rows.append((i, sort_total, totals, header))
-            if maxrows is not None:
+            if maxrows is not None and rother is None:
                 rtail = self._tail(rows, maxrows, least=least, facts=facts)
             self._sortdim(rows, rfields[rows_dim])
-            if rtail[1] is not None:
+            if rother is not None:
+                irow = irows[rother]
+                totals = [irow[layer] for layer in layers]
+                rows.append((OTHER,
+                             totals[0],
+                             totals,
+                             {"value": irow.value, "text": others},
+                             ))
+            elif rtail[1] is not None:
                 values = [irows[i]["value"] for i in rtail[0]]
                 rows.append((OTHER,
                              rtail[1],
@@ -2134,9 +2557,13 @@ class S3PivotTable:
 
             # Group and sort the cols (grouping = determine "others")
             icols = self.col
+            cother = self.cother
             cols = []
             ctail = (None, None)
             for i in range(self.numcols):
+                if i == cother:
+                    # Columns already collapsed by the engine
+                    continue
                 icol = icols[i]
                 totals = [icol[layer] for layer in layers]
                 sort_total = totals[0]
@@ -2145,10 +2572,18 @@ class S3PivotTable:
                                             else col_repr(icol.value),
                           }
                 cols.append((i, sort_total, totals, header))
-            if maxcols is not None:
+            if maxcols is not None and cother is None:
                 ctail = self._tail(cols, maxcols, least=least, facts=facts)
             self._sortdim(cols, rfields[cols_dim])
-            if ctail[1] is not None:
+            if cother is not None:
+                icol = icols[cother]
+                totals = [icol[layer] for layer in layers]
+                cols.append((OTHER,
+                             totals[0],
+                             totals,
+                             {"value": icol.value, "text": others},
+                             ))
+            elif ctail[1] is not None:
                 values = [icols[i]["value"] for i in ctail[0]]
                 cols.append((OTHER,
                              ctail[1],
@@ -2165,11 +2600,17 @@ class S3PivotTable:
             cells = {}
             for i in range(self.numrows):
                 irow = icell[i]
-                ridx = (i, OTHER) if rothers and i in rothers else (i,)
+                if i == rother:
+                    ridx = (OTHER,)
+                else:
+                    ridx = (i, OTHER) if rothers and i in rothers else (i,)
 
                 for j in range(self.numcols):
                     cell = irow[j]
-                    cidx = (j, OTHER) if cothers and j in cothers else (j,)
+                    if j == cother:
+                        cidx = (OTHER,)
+                    else:
+                        cidx = (j, OTHER) if cothers and j in cothers else (j,)
 
                     cell_records = cell["records"]
 
@@ -2526,7 +2967,7 @@ class S3PivotTable:
     @classmethod
     def _tail(cls, items, length=10, least=False, facts=None):
         """
-            Find the top/least <length> items (by total)
+            Find the items beyond the top/least <length>-1 items (by total)
 
             Args:
                 items: the items as list of tuples
@@ -2534,18 +2975,21 @@ class S3PivotTable:
                 length: the maximum number of items
                 least: find least rather than top
                 facts: the facts to aggregate the tail totals
+
+            Returns:
+                tuple (indexes, total, totals) of the tail items,
+                or (None, None, None) if there are no more than
+                <length> items
         """
 
         try:
             if len(items) > length:
-                l = list(items)
-                l.sort(lambda x, y: int(y[1]-x[1]))
-                if least:
-                    l.reverse()
-                keys = [item[0] for item in l[length-1:]]
+                top = cls._top([item[1] for item in items], length - 1, least=least)
+                tail = [item for i, item in enumerate(items) if i not in top]
+                keys = [item[0] for item in tail]
                 totals = []
                 for i, fact in enumerate(facts):
-                    subtotals = [item[2][i] for item in l[length-1:]]
+                    subtotals = [item[2][i] for item in tail]
                     totals.append(fact.aggregate_totals(subtotals))
                 return (keys, totals[0], totals)
         except (TypeError, ValueError):
@@ -2554,15 +2998,40 @@ class S3PivotTable:
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def _totals(values, facts, append=None):
+    def _top(totals, length, least=False):
         """
-            Get the totals of a row/column/report
+            Select the top/least <length> items by total, with a heap
+            rather than sorting all items
 
             Args:
-                values: the values dictionary
-                facts: the facts
-                append: callback to collect the totals for JSON data
-                        (currently only collects the first layer)
+                totals: the totals of the items (list)
+                length: the number of items to select
+                least: select the least rather than the top items
+
+            Returns:
+                set of the indexes of the selected items
+        """
+
+        if least:
+            select, missing = heapq.nsmallest, float("inf")
+        else:
+            select, missing = heapq.nlargest, float("-inf")
+
+        key = lambda i: missing if totals[i] is None else totals[i]
+
+        return set(select(length, range(len(totals)), key=key))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _totals(values, facts, append=None):
+        """
+            Get the totals of a row/column/report
+
+            Args:
+                values: the values dictionary
+                facts: the facts
+                append: callback to collect the totals for JSON data
+                        (currently only collects the first layer)
         """
 
         totals = []
@@ -2644,9 +3113,979 @@ class S3PivotTable:
         return matrix, rnames, cnames
 
     # -------------------------------------------------------------------------
-    def _add_layer(self, matrix, fact):
+    def _aggregate_in_db(self, aggregate=None):
+        """
+            Determine whether the aggregates can (and should) be computed
+            in the database rather than from the extracted records; this
+            requires:
+                - that all axes and facts are real, single-valued fields
+                  (i.e. no virtual or list:type fields, no multiple
+                  components)
+                - that all facts use count, or sum/min/max/avg of
+                  numeric fields
+                - that the resource filter can be fully resolved into
+                  a DAL query
+
+            Args:
+                aggregate: True to aggregate in the database if possible,
+                           False to never aggregate in the database, None
+                           to aggregate in the database if the number of
+                           records exceeds the report_aggregate_threshold
+                           deployment setting
+
+            Returns:
+                True|False
+        """
+
+        if aggregate is False:
+            return False
+
+        resource = self.resource
+        if resource.linked is not None or \
+           resource.get_config("postprocess_select"):
+            return False
+
+        # Filter must be fully resolvable into a DAL query
+        if resource.get_filter() is not None or \
+           resource.rfilter.get_extra_filters():
+            return False
+
+        rfields = self.rfields
+
+        # Axes must be single-valued real fields
+        for selector in (self.rows, self.cols):
+            if selector and (selector not in rfields or \
+                             not rfields[selector].is_single_valued):
+                return False
+
+        # Facts must be simple aggregates of single-valued real fields
+        for fact in self.facts:
+            selector = fact.selector
+            if selector not in rfields or not rfields[selector].is_single_valued:
+                return False
+            method = fact.method
+            if method == "count":
+                continue
+            elif method not in ("sum", "min", "max", "avg") or \
+                 rfields[selector].ftype not in ("integer", "double", "float"):
+                return False
+
+        if aggregate is None:
+            threshold = current.deployment_settings.get_ui_report_aggregate_threshold()
+            if threshold is None or resource.count() < threshold:
+                return False
+
+        return True
+
+    # -------------------------------------------------------------------------
+    def _aggregate(self):
+        """
+            Compute the pivot table with a GROUP BY query in the database,
+            without extracting the individual records
+        """
+
+        db = current.db
+
+        resource = self.resource
+        table = resource.table
+        tablename = table._tablename
+
+        rfields = self.rfields
+        facts = self.facts
+
+        # The filter query
+        query = resource.get_query()
+        rfilter = resource.rfilter
+        ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+        ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+        if ijoins or ljoins:
+            # Filter joins could multiply the rows, so use a sub-select
+            subselect = db(query)._select(table._id,
+                                          join = ijoins.as_list(prefer=ljoins),
+                                          left = ljoins.as_list(),
+                                          distinct = True,
+                                          )
+            query = table._id.belongs(subselect)
+
+        # Retain the accessible-context of the parent resource
+        aqueries = {}
+        parent = resource.parent
+        if parent and parent.accessible_query is not None:
+            method = []
+            if parent._approved:
+                method.append("read")
+            if parent._unapproved:
+                method.append("review")
+            aqueries[parent.tablename] = parent.accessible_query(method,
+                                                                 parent.table,
+                                                                 )
+
+        # Axis fields (all single-valued, so joins don't multiply rows)
+        joins = S3Joins(tablename)
+        axes = []
+        for selector in (self.rows, self.cols):
+            if selector:
+                rfield = rfields[selector]
+                joins.extend(rfield.left)
+                axes.append(rfield.field)
+            else:
+                axes.append(None)
+        groupby = [f for f in axes if f is not None]
+
+        # Aggregate expressions
+        cnt = table._id.count(distinct=True)
+        fields = groupby + [cnt]
+        expressions = []
+        for fact in facts:
+            rfield = rfields[fact.selector]
+            joins.extend(rfield.left)
+            field = rfield.field
+            if fact.method == "count":
+                expr = (field.count(distinct=True),)
+            else:
+                expr = (field.sum(), field.count(), field.min(), field.max())
+            expressions.append(expr)
+            fields.extend(expr)
+
+        rows = db(query).select(groupby = groupby if groupby else None,
+                                left = joins.as_list(aqueries=aqueries),
+                                *fields)
+
+        # Collect the partial aggregates per cell
+        rindex, cindex = {}, {}
+        partials = {}
+        numrecords = 0
+        for row in rows:
+
+            # An empty group (no records at all)
+            number = row[cnt]
+            if not number:
+                continue
+            numrecords += number
+
+            key = []
+            for field, index in zip(axes, (rindex, cindex)):
+                value = row[field] if field is not None else None
+                if value not in index:
+                    index[value] = len(index)
+                key.append(index[value])
+
+            cell = []
+            for expr in expressions:
+                if len(expr) == 1:
+                    cell.append(row[expr[0]])
+                else:
+                    cell.append(tuple(row[e] for e in expr))
+            partials[tuple(key)] = cell
+
+        self._add_partials(sorted(rindex, key=rindex.get),
+                           sorted(cindex, key=cindex.get),
+                           partials,
+                           numrecords,
+                           )
+
+    # -------------------------------------------------------------------------
+    def _summarize(self):
+        """
+            Compute the pivot table from a materialized summary of the
+            resource table (see SummaryTable), if there is one that can
+            answer this report
+
+            Returns:
+                True if the pivot table could be computed from a summary,
+                otherwise False
+        """
+
+        pkey = self.pkey
+
+        # Count facts are only additive for the number of records
+        measures = []
+        for fact in self.facts:
+            method = fact.method
+            if method == "count":
+                if fact.selector != pkey:
+                    return False
+            elif method not in ("sum", "min", "max", "avg"):
+                return False
+            measures.append(fact.selector)
+
+        axes = [selector for selector in (self.rows, self.cols) if selector]
+
+        groups = SummaryTable.lookup(self.resource, axes, measures)
+        if groups is None:
+            return False
+
+        # Collect the partial aggregates per cell
+        rindex, cindex = {}, {}
+        partials = {}
+        numrecords = 0
+        for _, values, records, aggregates in groups:
+
+            numrecords += records
+
+            values = iter(values)
+            key = []
+            for selector, index in zip((self.rows, self.cols), (rindex, cindex)):
+                value = next(values) if selector else None
+                if value not in index:
+                    index[value] = len(index)
+                key.append(index[value])
+
+            # Convert (count, sum, min, max) into fact partials
+            cell = []
+            for fact in self.facts:
+                partial = aggregates.get(fact.selector)
+                if fact.method == "count":
+                    partial = partial[0] if partial else 0
+                elif partial:
+                    number, total, minimum, maximum = partial
+                    partial = (total, number, minimum, maximum)
+                cell.append(partial)
+            partials[tuple(key)] = cell
+
+        self._add_partials(sorted(rindex, key=rindex.get),
+                           sorted(cindex, key=cindex.get),
+                           partials,
+                           numrecords,
+                           )
+        return True
+
+    # -------------------------------------------------------------------------
+    def _add_partials(self, rnames, cnames, partials, numrecords):
+        """
+            Compute the pivot table from partial aggregates per cell
+
+            Args:
+                rnames: the row dimension values
+                cnames: the column dimension values
+                partials: the partial aggregates per cell, a dict
+                          {(row index, column index): [partial per fact]}
+                numrecords: the total number of records
+        """
+
+        facts = self.facts
+
+        self.numrecords = numrecords
+        if not partials:
+            self.empty = True
+            return
+
+        # Collapse the rows/columns beyond the top n
+        if self.maxrows or self.maxcols:
+            rnames, cnames, partials = self._collapse_partials(rnames,
+                                                               cnames,
+                                                               partials,
+                                                               )
+
+        # Initialize columns and rows
+        self._headers(rnames, cnames)
+
+        numrows, numcols = self.numrows, self.numcols
+        self.cell = [[Storage(records=[]) for c in range(numcols)]
+                     for r in range(numrows)]
+        for header in self.row + self.col:
+            header["records"] = []
+
+        # Compute the values per layer
+        totals = self.totals
+        for i, fact in enumerate(facts):
+
+            layer = fact.layer
+            precision = self.precision.get(fact.selector)
+            merge, result = fact.merge, fact.result
+
+            rpartials = [[] for r in range(numrows)]
+            cpartials = [[] for c in range(numcols)]
+
+            for r in range(numrows):
+                row = self.cell[r]
+                for c in range(numcols):
+                    cell = partials.get((r, c))
+                    partial = cell[i] if cell else None
+                    row[c][layer] = result(partial, precision=precision)
+                    rpartials[r].append(partial)
+                    cpartials[c].append(partial)
+
+            rtotals = [merge(p) for p in rpartials]
+            for header, partial in zip(self.row, rtotals):
+                header[layer] = result(partial, precision=precision)
+            for header, p in zip(self.col, cpartials):
+                header[layer] = result(merge(p), precision=precision)
+
+            totals[layer] = result(merge(rtotals), precision=precision)
+            self.values[layer] = []
+
+    # -------------------------------------------------------------------------
+    def _collapse_axis(self, names, totals, length):
+        """
+            Determine which values of an axis to collapse into "Others"
+
+            Args:
+                names: the dimension values
+                totals: the ranking totals per dimension value
+                length: the maximum number of values, including "Others"
+
+            Returns:
+                tuple (mapping, names, other), with mapping being the new
+                index for each old index, names being the new dimension
+                values with the list of collapsed values in the last
+                position, and other the index of the "Others" value
+        """
+
+        least = self.facts[0].method == "min"
+        top = self._top(totals, length - 1, least=least)
+
+        collapsed = []
+        tail = []
+        mapping = []
+        for index, name in enumerate(names):
+            if index in top:
+                mapping.append(len(collapsed))
+                collapsed.append(name)
+            else:
+                mapping.append(None)
+                tail.append(name)
+
+        other = len(collapsed)
+        collapsed.append(tail)
+
+        mapping = [other if i is None else i for i in mapping]
+        return mapping, collapsed, other
+
+    # -------------------------------------------------------------------------
+    def _collapse(self, matrix, rnames, cnames, frame=None):
+        """
+            Collapse the rows/columns beyond the top maxrows-1/maxcols-1
+            (ranked by the totals of the first fact) into one "Others"
+            row/column, before computing the layers
+
+            Args:
+                matrix: the cell matrix
+                rnames: the row dimension values
+                cnames: the column dimension values
+                frame: the columnar frame (see _pivot_columnar)
+
+            Returns:
+                tuple (matrix, rnames, cnames, frame, counts), collapsed,
+                with counts being a list of tuples (fact, {cell index: count})
+                for all count-facts if any rows/columns have been collapsed
+
+            Note:
+                Counts in collapsed cells are the sums of the distinct
+                counts of the merged cells (like the totals), so that they
+                match the counts from database aggregation (_collapse_partials)
+        """
+
+        facts = self.facts
+        for fact in facts:
+            if fact.selector is None:
+                fact.selector = self.pkey
+        fact = facts[0]
+
+        numrows, numcols = len(rnames), len(cnames)
+
+        # Aggregate the first fact and all count-facts per cell
+        items = [(record_id, r * numcols + c) for r in range(numrows)
+                                              for c in range(numcols)
+                                              for record_id in matrix[r][c] or ()]
+        counted = [f for f in facts if f.method == "count" and f is not fact]
+        accumulated = self._accumulate(items, [fact] + counted)
+        partials = accumulated[0]
+        if fact.method == "count":
+            counted.insert(0, fact)
+        else:
+            accumulated = accumulated[1:]
+
+        def ranking(axis, length):
+            # Merge the cell aggregates per row/column, like the totals
+            # in _add_layers
+            grouped = [[] for i in range(length)]
+            for index, partial in partials.items():
+                grouped[index // numcols if axis == 0 else index % numcols].append(partial)
+            if fact.method in ("count", "list"):
+                return [sum(len(p) for p in g) for g in grouped]
+            else:
+                return [fact.result(fact.merge(g)) for g in grouped]
+
+        rmap = cmap = None
+
+        maxrows = self.maxrows
+        if self.rows and maxrows and numrows > maxrows:
+            rmap, rnames, self.rother = self._collapse_axis(rnames,
+                                                            ranking(0, numrows),
+                                                            maxrows,
+                                                            )
+        maxcols = self.maxcols
+        if self.cols and maxcols and numcols > maxcols:
+            cmap, cnames, self.cother = self._collapse_axis(cnames,
+                                                            ranking(1, numcols),
+                                                            maxcols,
+                                                            )
+
+        if rmap is None and cmap is None:
+            return matrix, rnames, cnames, frame, None
+
+        rmap = rmap or list(range(numrows))
+        cmap = cmap or list(range(numcols))
+        width = len(cnames)
+
+        # Sum up the counts of the merged cells
+        counts = []
+        for f, cells in zip(counted, accumulated):
+            merged = {}
+            for index, values in cells.items():
+                target = rmap[index // numcols] * width + cmap[index % numcols]
+                merged[target] = merged.get(target, 0) + len(values)
+            counts.append((f, merged))
+
+        # Merge the record lists of collapsed cells (a record can be in
+        # multiple collapsed cells with list:type axes => skip duplicates)
+        collapsed = [[None] * width for r in range(len(rnames))]
+        for r in range(numrows):
+            row = collapsed[rmap[r]]
+            for c in range(numcols):
+                ids = matrix[r][c]
+                if not ids:
+                    continue
+                target = row[cmap[c]]
+                if target is None:
+                    row[cmap[c]] = dict.fromkeys(ids)
+                else:
+                    target.update(dict.fromkeys(ids))
+        collapsed = [[list(ids) if ids is not None else None for ids in row]
+                     for row in collapsed]
+
+        if frame is not None:
+            # Re-index the cells of the columnar frame
+            ids, cells = frame["ids"], frame["cells"]
+            cells = np.array(rmap, dtype=np.int64)[cells // numcols] * width + \
+                    np.array(cmap, dtype=np.int64)[cells % numcols]
+            # Skip duplicate items (retaining their order)
+            unique = np.sort(np.unique(np.column_stack((cells, ids)),
+                                       axis = 0,
+                                       return_index = True,
+                                       )[1])
+            frame = {"ids": ids[unique], "cells": cells[unique]}
+
+        return collapsed, rnames, cnames, frame, counts
+
+    # -------------------------------------------------------------------------
+    def _add_merged_counts(self, counts):
+        """
+            Replace the count-layers of a collapsed pivot table with
+            the sums of the counts of the merged cells (see _collapse)
+
+            Args:
+                counts: list of tuples (fact, {cell index: count})
+        """
+
+        rows = self.row
+        cols = self.col
+        cells = self.cell
+        numcols = len(cols)
+
+        for fact, merged in counts:
+            layer = fact.layer
+            get = merged.get
+            for r, row in enumerate(rows):
+                values = [get(r * numcols + c, 0) for c in range(numcols)]
+                for c, value in enumerate(values):
+                    cells[r][c][layer] = value
+                row[layer] = sum(values)
+            for c, col in enumerate(cols):
+                col[layer] = sum(get(r * numcols + c, 0) for r in range(len(rows)))
+            self.totals[layer] = sum(merged.values())
+
+    # -------------------------------------------------------------------------
+    def _collapse_partials(self, rnames, cnames, partials):
         """
-            Compute an aggregation layer, updates:
+            Collapse the rows/columns beyond the top maxrows-1/maxcols-1
+            (ranked by the totals of the first fact) into one "Others"
+            row/column, merging their partial aggregates
+
+            Args:
+                rnames: the row dimension values
+                cnames: the column dimension values
+                partials: the partial aggregates per cell (see _add_partials)
+
+            Returns:
+                tuple (rnames, cnames, partials), collapsed
+        """
+
+        facts = self.facts
+        fact = facts[0]
+
+        numrows, numcols = len(rnames), len(cnames)
+
+        def ranking(axis, length):
+            # Merge the partials of the first fact per row/column
+            grouped = [[] for i in range(length)]
+            for key, cell in partials.items():
+                grouped[key[axis]].append(cell[0])
+            return [fact.result(fact.merge(p)) for p in grouped]
+
+        rmap = cmap = None
+
+        maxrows = self.maxrows
+        if self.rows and maxrows and numrows > maxrows:
+            rmap, rnames, self.rother = self._collapse_axis(rnames,
+                                                            ranking(0, numrows),
+                                                            maxrows,
+                                                            )
+        maxcols = self.maxcols
+        if self.cols and maxcols and numcols > maxcols:
+            cmap, cnames, self.cother = self._collapse_axis(cnames,
+                                                            ranking(1, numcols),
+                                                            maxcols,
+                                                            )
+
+        if rmap is None and cmap is None:
+            return rnames, cnames, partials
+
+        collapsed = {}
+        for (r, c), cell in partials.items():
+            key = (rmap[r] if rmap else r, cmap[c] if cmap else c)
+            merged = collapsed.get(key)
+            if merged is None:
+                collapsed[key] = cell
+            else:
+                collapsed[key] = [f.merge((a, b)) for f, a, b in zip(facts, merged, cell)]
+
+        return rnames, cnames, collapsed
+
+    # -------------------------------------------------------------------------
+    def _headers(self, rnames, cnames):
+        """
+            Initialize the row and column headers
+
+            Args:
+                rnames: the row dimension values
+                cnames: the column dimension values
+        """
+
+        if self.cols:
+            self.col = [Storage({"value": v}) for v in cnames]
+            self.numcols = len(self.col)
+        else:
+            self.col = [Storage({"value": None})]
+            self.numcols = 1
+
+        if self.rows:
+            self.row = [Storage({"value": v}) for v in rnames]
+            self.numrows = len(self.row)
+        else:
+            self.row = [Storage({"value": None})]
+            self.numrows = 1
+
+        # Flag the "Others" row/column
+        if self.rother is not None:
+            self.row[self.rother]["other"] = True
+        if self.cother is not None:
+            self.col[self.cother]["other"] = True
+
+    # -------------------------------------------------------------------------
+    def _select(self, strict=True):
+        """
+            Extract all unique records and compute the pivot table from them
+
+            Args:
+                strict: filter out dimension values which don't match
+                        the resource filter
+        """
+
+        resource = self.resource
+        rows = self.rows
+        cols = self.cols
+
+        # Retrieve the records ------------------------------------------------
+        #
+        data = resource.select(list(self.rfields.keys()), limit=None)
+        drows = data["rows"]
+        if drows:
+
+            key = str(resource.table._id)
+            records = Storage([(i[key], i) for i in drows])
+
+            # Generate the data frame -----------------------------------------
+            #
+            gfields = self.gfields
+            pkey_colname = gfields[self.pkey]
+            rows_colname = gfields[rows]
+            cols_colname = gfields[cols]
+
+            if strict:
+                rfields = self.rfields
+                axes = (rfield
+                        for rfield in (rfields[rows], rfields[cols])
+                        if rfield != None)
+                axisfilter = self.axisfilter(resource, axes)
+            else:
+                axisfilter = None
+
+            dataframe = []
+            extend = dataframe.extend
+            expand = self._expand
+
+            for _id in records:
+                row = records[_id]
+                item = {key: _id}
+                if rows_colname:
+                    item[rows_colname] = row[rows_colname]
+                if cols_colname:
+                    item[cols_colname] = row[cols_colname]
+                extend(expand(item, axisfilter=axisfilter))
+
+            self.records = records
+            self.numrecords = len(records)
+
+            # Group the records -----------------------------------------------
+            #
+            if np is not None:
+                matrix, rnames, cnames, frame = self._pivot_columnar(dataframe,
+                                                                     pkey_colname,
+                                                                     rows_colname,
+                                                                     cols_colname,
+                                                                     )
+            else:
+                matrix, rnames, cnames = self._pivot(dataframe,
+                                                     pkey_colname,
+                                                     rows_colname,
+                                                     cols_colname)
+                frame = None
+
+            # Collapse the rows/columns beyond the top n ----------------------
+            #
+            counts = None
+            if self.maxrows or self.maxcols:
+                matrix, rnames, cnames, frame, counts = self._collapse(matrix,
+                                                                       rnames,
+                                                                       cnames,
+                                                                       frame,
+                                                                       )
+
+            # Initialize columns and rows -------------------------------------
+            #
+            self._headers(rnames, cnames)
+
+            # Add the layers --------------------------------------------------
+            #
+            # Large reports computed in parallel worker processes use the
+            # item-wise engine for all layers
+            if self._workers(self.numrecords) > 1:
+                frame = None
+            itemwise, columnar = [], []
+            for fact in self.facts:
+                if frame is None or fact.method == "list":
+                    itemwise.append(fact)
+                else:
+                    columnar.append(fact)
+            if itemwise:
+                # Compute list-layers (or all layers) from the records
+                self._add_layers(matrix, itemwise)
+            if columnar:
+                # Compute all other layers from the columnar frame
+                self._add_layers_columnar(matrix, frame, columnar)
+            if counts:
+                # Counts in collapsed cells from the counts of merged cells
+                self._add_merged_counts(counts)
+
+        else:
+            # No items to report on -------------------------------------------
+            #
+            self.empty = True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _pivot_columnar(items, pkey_colname, rows_colname, cols_colname):
+        """
+            2-dimensional pivoting of a list of unique items, columnar
+            variant of _pivot which encodes the dimension values as
+            integer codes (requires numpy)
+
+            Args:
+                items: list of unique items as dicts
+                pkey_colname: column name of the primary key
+                rows_colname: column name of the row dimension
+                cols_colname: column name of the column dimension
+
+            Returns:
+                tuple of (cell matrix, row headers, column headers, frame),
+                like _pivot, and frame being a dict with the arrays
+                    {"ids": the record ID of each item,
+                     "cells": the cell index (row * numcols + col) of each item
+                     }
+        """
+
+        rvalues = {}
+        cvalues = {}
+
+        ids = []
+        rcodes = []
+        ccodes = []
+
+        for item in items:
+
+            rvalue = item[rows_colname] if rows_colname else None
+            cvalue = item[cols_colname] if cols_colname else None
+
+            r = rvalues.get(rvalue)
+            if r is None:
+                r = rvalues[rvalue] = len(rvalues)
+            c = cvalues.get(cvalue)
+            if c is None:
+                c = cvalues[cvalue] = len(cvalues)
+
+            ids.append(item[pkey_colname])
+            rcodes.append(r)
+            ccodes.append(c)
+
+        numrows = len(rvalues)
+        numcols = len(cvalues)
+
+        cells = np.array(rcodes, dtype=np.int64) * numcols + \
+                np.array(ccodes, dtype=np.int64)
+        ids = np.array(ids)
+
+        # Group the record IDs by cell (retaining their order)
+        counts = np.bincount(cells, minlength=numrows * numcols).tolist()
+        grouped = ids[np.argsort(cells, kind="stable")].tolist()
+
+        matrix = []
+        offset = 0
+        for r in range(numrows):
+            row = []
+            for c in range(numcols):
+                count = counts[r * numcols + c]
+                row.append(grouped[offset:offset + count] if count else None)
+                offset += count
+            matrix.append(row)
+
+        rnames = sorted(rvalues, key=rvalues.get)
+        cnames = sorted(cvalues, key=cvalues.get)
+
+        return matrix, rnames, cnames, {"ids": ids, "cells": cells}
+
+    # -------------------------------------------------------------------------
+    def _add_layers_columnar(self, matrix, frame, facts):
+        """
+            Compute aggregation layers from a columnar frame with grouped
+            array reductions, same results as _add_layers (except for the
+            "list" method, which is not supported here)
+
+            Args:
+                matrix: the cell matrix
+                frame: the columnar frame (see _pivot_columnar)
+                facts: the facts to compute
+        """
+
+        rows = self.row
+        cols = self.col
+        numrows = len(rows)
+        numcols = len(cols)
+        numcells = numrows * numcols
+
+        RECORDS = "records"
+
+        # Initialize cells and headers (unless done by _add_layers)
+        if self.cell is None:
+            self.cell = [[Storage({RECORDS: matrix[r][c] or []})
+                          for c in range(numcols)]
+                         for r in range(numrows)]
+            for r, row in enumerate(rows):
+                row[RECORDS] = list(chain.from_iterable(matrix[r][c] or []
+                                                        for c in range(numcols)))
+            for c, col in enumerate(cols):
+                col[RECORDS] = list(chain.from_iterable(matrix[r][c] or []
+                                                        for r in range(numrows)))
+        cells = self.cell
+
+        records = self.records
+        record_ids = list(records.keys())
+        position = {record_id: i for i, record_id in enumerate(record_ids)}
+
+        # The record (position) and cell of each item
+        item_records = np.array([position[i] for i in frame["ids"].tolist()],
+                                dtype = np.int64,
+                                )
+        item_cells = frame["cells"]
+
+        # Extract the values of all facts in a single pass over the records,
+        # each selector only once; count-facts use codes of distinct values,
+        # all other facts the numeric values
+        columns = {}
+        extractions = {}
+        for fact in facts:
+            selector = fact.selector
+            count = fact.method == "count"
+            key = (selector, count)
+            if count and selector == self.pkey or key in columns:
+                continue
+            column = columns[key] = [[], [], {} if count else None, False]
+            extractions.setdefault(selector, []).append(column)
+        extractions = list(extractions.items())
+
+        extract = self._extract
+        for index, record_id in enumerate(record_ids):
+            record = records[record_id]
+            for selector, targets in extractions:
+                value = extract(record, selector)
+                if value is None:
+                    continue
+                for v in s3_flatlist(value) if type(value) is list else (value,):
+                    if v is None:
+                        continue
+                    for column in targets:
+                        codes = column[2]
+                        if codes is not None:
+                            # Encode distinct values
+                            code = codes.get(v)
+                            if code is None:
+                                code = codes[v] = len(codes)
+                            column[0].append(code)
+                        elif isinstance(v, (int, float)):
+                            if type(v) is float:
+                                column[3] = True
+                            column[0].append(v)
+                        else:
+                            continue
+                        column[1].append(index)
+
+        for fact in facts:
+
+            selector = fact.selector
+            layer = fact.layer
+            precision = self.precision.get(selector)
+            count = fact.method == "count"
+
+            if count and selector == self.pkey:
+                # Counting records = number of distinct items per cell
+                numrecords = max(len(record_ids), 1)
+                distinct = np.unique(item_cells * numrecords + item_records)
+                self._add_counts(layer, np.bincount(distinct // numrecords,
+                                                    minlength = numcells,
+                                                    ))
+                self.values[layer] = []
+                continue
+
+            values, owners, codes, is_float = columns[(selector, count)]
+
+            dtype = np.float64 if is_float else np.int64
+            values = np.array(values, dtype=dtype)
+            owners = np.array(owners, dtype=np.int64)
+
+            # Expand into (cell, value) pairs for all items
+            numvalues = np.bincount(owners, minlength=len(record_ids))
+            offsets = np.cumsum(numvalues) - numvalues
+            repeat = numvalues[item_records]
+            starts = np.cumsum(repeat) - repeat
+            pair_cells = np.repeat(item_cells, repeat)
+            pair_values = values[np.arange(int(repeat.sum())) +
+                                 np.repeat(offsets[item_records] - starts, repeat)]
+
+            result = fact.result
+
+            if count:
+                # Number of distinct values per cell, totals are the
+                # sums of the cell counts
+                numcodes = max(len(codes), 1)
+                distinct = np.unique(pair_cells * numcodes + pair_values)
+                self._add_counts(layer, np.bincount(distinct // numcodes,
+                                                    minlength = numcells,
+                                                    ))
+
+            else:
+                # Partial aggregates per cell
+                if is_float:
+                    lowest, highest = -np.inf, np.inf
+                else:
+                    info = np.iinfo(dtype)
+                    lowest, highest = info.min, info.max
+                sums = np.zeros(numcells, dtype=dtype)
+                numbers = np.zeros(numcells, dtype=np.int64)
+                minima = np.full(numcells, highest, dtype=dtype)
+                maxima = np.full(numcells, lowest, dtype=dtype)
+
+                if len(pair_cells):
+                    order = np.argsort(pair_cells, kind="stable")
+                    pair_cells = pair_cells[order]
+                    pair_values = pair_values[order]
+                    first = np.flatnonzero(np.r_[True, pair_cells[1:] != pair_cells[:-1]])
+                    groups = pair_cells[first]
+                    sums[groups] = np.add.reduceat(pair_values, first)
+                    numbers[groups] = np.diff(np.r_[first, len(pair_cells)])
+                    minima[groups] = np.minimum.reduceat(pair_values, first)
+                    maxima[groups] = np.maximum.reduceat(pair_values, first)
+
+                def results(s, n, mn, mx):
+                    return [result((s_, n_, mn_, mx_) if n_ else None,
+                                   precision = precision,
+                                   )
+                            for s_, n_, mn_, mx_ in zip(s.tolist(),
+                                                        n.tolist(),
+                                                        mn.tolist(),
+                                                        mx.tolist(),
+                                                        )]
+
+                shape = (numrows, numcols)
+                sums = sums.reshape(shape)
+                numbers = numbers.reshape(shape)
+                minima = minima.reshape(shape)
+                maxima = maxima.reshape(shape)
+
+                for r in range(numrows):
+                    row = cells[r]
+                    for c, value in enumerate(results(sums[r], numbers[r], minima[r], maxima[r])):
+                        row[c][layer] = value
+
+                for axis, headers in ((1, rows), (0, cols)):
+                    for header, value in zip(headers, results(sums.sum(axis=axis),
+                                                              numbers.sum(axis=axis),
+                                                              minima.min(axis=axis),
+                                                              maxima.max(axis=axis),
+                                                              )):
+                        header[layer] = value
+
+                self.totals[layer] = results(sums.sum(keepdims=True).ravel(),
+                                             numbers.sum(keepdims=True).ravel(),
+                                             minima.min(keepdims=True).ravel(),
+                                             maxima.max(keepdims=True).ravel(),
+                                             )[0]
+
+            self.values[layer] = []
+
+    # -------------------------------------------------------------------------
+    def _add_counts(self, layer, counts):
+        """
+            Add a count-layer from an array of counts per cell, totals
+            being the sums of the cell counts
+
+            Args:
+                layer: the layer
+                counts: the counts as array in cell index order
+        """
+
+        rows = self.row
+        cols = self.col
+        cells = self.cell
+
+        counts = counts.reshape(len(rows), len(cols))
+
+        for r, values in enumerate(counts.tolist()):
+            row = cells[r]
+            for c, value in enumerate(values):
+                row[c][layer] = value
+        for header, value in zip(rows, counts.sum(axis=1).tolist()):
+            header[layer] = value
+        for header, value in zip(cols, counts.sum(axis=0).tolist()):
+            header[layer] = value
+
+        self.totals[layer] = int(counts.sum())
+
+    # -------------------------------------------------------------------------
+    def _add_layers(self, matrix, facts):
+        """
+            Compute aggregation layers in a single pass over the records,
+            with one accumulator per fact and cell, updates:
                 - self.cell: the aggregated values per cell
                 - self.row: the totals per row
                 - self.col: the totals per column
@@ -2654,122 +4093,278 @@ class S3PivotTable:
 
             Args:
                 matrix: the cell matrix
-                fact: the fact field
-                method: the aggregation method
+                facts: the facts to compute
+
+            Note:
+                Row, column and grand totals are merged from the cell
+                accumulators, so (as with S3PivotTableFact.compute) the
+                count-totals are the sums of the per-cell distinct counts
         """
 
         rows = self.row
         cols = self.col
-        records = self.records
-        extract = self._extract
-        resource = self.resource
+        numrows = len(rows)
+        numcols = len(cols)
 
         RECORDS = "records"
-        VALUES = "values"
 
-        table = resource.table
-        pkey = table._id.name
-
-        layer = fact.layer
-        precision = self.precision.get(fact.selector)
-
-        numcols = len(self.col)
-        numrows = len(self.row)
+        pkey = self.resource.table._id.name
+        for fact in facts:
+            if fact.selector is None:
+                fact.selector = pkey
 
-        # Initialize cells
+        # Initialize cells and headers, and collect the (record, cell) items
         if self.cell is None:
-            self.cell = [[Storage()
-                          for i in range(numcols)]
-                         for j in range(numrows)]
+            self.cell = [[Storage() for c in range(numcols)]
+                         for r in range(numrows)]
         cells = self.cell
 
-        all_values = []
+        for header in chain(rows, cols):
+            header[RECORDS] = []
+
+        items = []
         for r in range(numrows):
+            row_records = rows[r][RECORDS]
+            for c in range(numcols):
+                ids = matrix[r][c]
+                if not ids:
+                    ids = []
+                elif None in ids:
+                    ids = [i for i in ids if i is not None]
+                cells[r][c][RECORDS] = ids
+                row_records.extend(ids)
+                cols[c][RECORDS].extend(ids)
+
+                index = r * numcols + c
+                items.extend((record_id, index) for record_id in ids)
+
+        # Accumulate partial aggregates per fact and cell
+        partials = self._partials(items, facts)
+
+        # Compute the aggregates
+        for fact, accumulators in zip(facts, partials):
+
+            layer = fact.layer
+            method = fact.method
+            precision = self.precision.get(fact.selector)
+
+            if method in ("count", "list"):
+                # Distinct values per cell, totals are the number of
+                # (non-null) values per cell summed up
+                counts = [0] * (numrows * numcols)
+                all_values = []
+                for index, values in accumulators.items():
+                    if method == "list":
+                        cells[index // numcols][index % numcols][layer] = \
+                            list(values) if values else None
+                        all_values.extend(values)
+                        counts[index] = len(values) - (None in values)
+                    else:
+                        counts[index] = len(values)
+                if method == "count":
+                    for r in range(numrows):
+                        for c in range(numcols):
+                            cells[r][c][layer] = counts[r * numcols + c]
+                for r, row in enumerate(rows):
+                    row[layer] = sum(counts[r * numcols:(r + 1) * numcols])
+                for c, col in enumerate(cols):
+                    col[layer] = sum(counts[c::numcols])
+                self.totals[layer] = sum(counts)
+                self.values[layer] = all_values
 
-            # Initialize row header
-            row = rows[r]
-            row[RECORDS] = []
-            row[VALUES] = []
+            else:
+                # Partial aggregates per cell, merged for totals
+                result = fact.result
+                merge = fact.merge
+                get = accumulators.get
+                for r in range(numrows):
+                    row = cells[r]
+                    for c in range(numcols):
+                        row[c][layer] = result(get(r * numcols + c),
+                                               precision = precision,
+                                               )
+                for r, row in enumerate(rows):
+                    partial = merge(get(r * numcols + c) for c in range(numcols))
+                    row[layer] = result(partial, precision=precision)
+                for c, col in enumerate(cols):
+                    partial = merge(get(r * numcols + c) for r in range(numrows))
+                    col[layer] = result(partial, precision=precision)
+                self.totals[layer] = result(merge(accumulators.values()),
+                                            precision = precision,
+                                            )
+                self.values[layer] = []
 
-            row_records = row[RECORDS]
-            row_values = row[VALUES]
+    # -------------------------------------------------------------------------
+    def _workers(self, numrecords):
+        """
+            Determine the number of worker processes to compute the
+            aggregates of the extracted records
 
-            for c in range(numcols):
+            Args:
+                numrecords: the number of records
+
+            Returns:
+                the number of worker processes, 1 to compute the
+                aggregates in the current process
+        """
+
+        settings = current.deployment_settings
+
+        threshold = settings.get_ui_report_parallel_threshold()
+        if threshold is None or numrecords < threshold:
+            return 1
+
+        workers = settings.get_ui_report_workers() or os.cpu_count() or 1
+        return max(1, min(workers, numrecords))
+
+    # -------------------------------------------------------------------------
+    def _partials(self, items, facts):
+        """
+            Compute the partial aggregates per fact and cell, in parallel
+            worker processes for large numbers of records
+
+            Args:
+                items: list of tuples (record ID, cell index)
+                facts: the facts
+
+            Returns:
+                list of dicts {cell index: partial aggregate}, one per fact,
+                see _accumulate
+        """
+
+        workers = self._workers(len(items))
+        if workers > 1:
+            import multiprocessing
+            try:
+                context = multiprocessing.get_context("fork")
+            except ValueError:
+                # Workers would have to re-import the application
+                context = None
+            if context:
+                size = -(-len(items) // workers)
+                chunks = [(i, i + size) for i in range(0, len(items), size)]
+                # NB the workers inherit pivot table and items when forked
+                #    (initargs are not pickled with the fork start method),
+                #    so nothing is shared with concurrent requests
+                try:
+                    with context.Pool(len(chunks),
+                                      initializer = _pivot_init,
+                                      initargs = (self, items, facts),
+                                      ) as pool:
+                        results = pool.map(_pivot_worker, chunks)
+                except OSError:
+                    # Could not start the workers
+                    results = None
+                if results:
+                    return self._merge_partials(facts, results)
+
+        return self._accumulate(items, facts)
+
+    # -------------------------------------------------------------------------
+    def _accumulate(self, items, facts):
+        """
+            Accumulate the partial aggregates of all facts per cell in
+            a single pass over the items
+
+            Args:
+                items: iterable of tuples (record ID, cell index)
+                facts: the facts
+
+            Returns:
+                list of dicts {cell index: partial aggregate}, one per fact,
+                where the partial aggregate is the set of distinct values
+                for count/list, otherwise [sum, count, min, max] of the
+                numeric values
+        """
+
+        records = self.records
+        extract = self._extract
+
+        layers = []
+        partials = []
+        for fact in facts:
+            accumulators = {}
+            partials.append(accumulators)
+            layers.append((fact.selector,
+                           fact.method in ("count", "list"),
+                           fact.method == "list",
+                           accumulators,
+                           ))
+
+        for record_id, index in items:
+            record = records[record_id]
+
+            for selector, distinct, keep_none, accumulators in layers:
+
+                value = extract(record, selector)
+                if value is None:
+                    continue
 
-                # Initialize column header
-                col = cols[c]
-                if RECORDS not in col:
-                    col[RECORDS] = []
-                col_records = col[RECORDS]
-                if VALUES not in col:
-                    col[VALUES] = []
-                col_values = col[VALUES]
-
-                # Get the records
-                cell = cells[r][c]
-                if RECORDS in cell and cell[RECORDS] is not None:
-                    ids = cell[RECORDS]
+                if type(value) is list:
+                    values = list(s3_flatlist(value))
+                    if distinct:
+                        if not keep_none:
+                            values = [v for v in values if v is not None]
+                    else:
+                        values = [v for v in values if isinstance(v, (int, float))]
+                        if not values:
+                            continue
+                        total, number = sum(values), len(values)
+                        minimum, maximum = min(values), max(values)
+                elif distinct:
+                    values = (value,)
+                elif isinstance(value, (int, float)):
+                    total = minimum = maximum = value
+                    number = 1
                 else:
-                    data = matrix[r][c]
-                    if data:
-                        remove = data.remove
-                        while None in data:
-                            remove(None)
-                        ids = data
+                    continue
+
+                accumulator = accumulators.get(index)
+                if distinct:
+                    if accumulator is None:
+                        accumulators[index] = set(values)
                     else:
-                        ids = []
-                    cell[RECORDS] = ids
-                row_records.extend(ids)
-                col_records.extend(ids)
-
-                # Get the values
-                if fact.selector is None:
-                    fact.selector = pkey
-                    values = ids
-                    row_values = row_records
-                    col_values = row_records
-                    all_values = list(records.keys())
+                        accumulator.update(values)
+                elif accumulator is None:
+                    accumulators[index] = [total, number, minimum, maximum]
                 else:
-                    values = []
-                    append = values.append
-                    for i in ids:
-                        value = extract(records[i], fact.selector)
-                        if value is None:
-                            continue
-                        append(value)
-                    values = list(s3_flatlist(values))
-                    if fact.method in ("list", "count"):
-                        values =  list(set(values))
-                    row_values.extend(values)
-                    col_values.extend(values)
-                    all_values.extend(values)
-
-                # Aggregate values
-                value = fact.compute(values, precision=precision)
-                cell[layer] = value
-
-            # Compute row total
-            row[layer] = fact.compute(row_values,
-                                      totals = True,
-                                      precision = precision,
-                                      )
-            del row[VALUES]
+                    accumulator[0] += total
+                    accumulator[1] += number
+                    if minimum < accumulator[2]:
+                        accumulator[2] = minimum
+                    if maximum > accumulator[3]:
+                        accumulator[3] = maximum
 
-        # Compute column total
-        for c in range(numcols):
-            col = cols[c]
-            col[layer] = fact.compute(col[VALUES],
-                                      totals = True,
-                                      precision = precision,
-                                      )
-            del col[VALUES]
+        return partials
 
-        # Compute overall total
-        self.totals[layer] = fact.compute(all_values,
-                                          totals = True,
-                                          precision = precision,
-                                          )
-        self.values[layer] = all_values
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _merge_partials(facts, results):
+        """
+            Merge the partial aggregates of several workers
+
+            Args:
+                facts: the facts
+                results: the partial aggregates of each worker (see
+                         _accumulate)
+
+            Returns:
+                the merged partial aggregates
+        """
+
+        partials = results[0]
+        for other in results[1:]:
+            for fact, accumulators, additions in zip(facts, partials, other):
+                distinct = fact.method in ("count", "list")
+                for index, partial in additions.items():
+                    accumulator = accumulators.get(index)
+                    if accumulator is None:
+                        accumulators[index] = partial
+                    elif distinct:
+                        accumulator |= partial
+                    else:
+                        accumulators[index] = fact.merge((accumulator, partial))
+        return partials
 
     # -------------------------------------------------------------------------
     def _get_fields(self, fields=None):
@@ -3191,4 +4786,36 @@ class S3AxisFilter:
             return [], li
         return [], []
 
+# =============================================================================
+def _pivot_init(pivottable, items, facts):
+    """
+        Initialize a forked worker process for S3PivotTable._partials
+
+        Args:
+            pivottable: the S3PivotTable
+            items: the pivot table items
+            facts: the facts
+    """
+
+    global _PARALLEL
+    _PARALLEL = (pivottable, items, facts)
+
+# =============================================================================
+def _pivot_worker(chunk):
+    """
+        Accumulate the partial aggregates for a chunk of the pivot table
+        items, in a forked worker process (see S3PivotTable._partials)
+
+        Args:
+            chunk: tuple (start, end) of the chunk in the items list
+
+        Returns:
+            the partial aggregates (see S3PivotTable._accumulate)
+    """
+
+    pivottable, items, facts = _PARALLEL
+    start, end = chunk
+
+    return pivottable._accumulate(items[start:end], facts)
+
 # END =========================================================================
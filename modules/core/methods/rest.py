@@ -219,6 +219,21 @@ class RESTful(CRUDMethod):
         if target == resource.tablename:
             # Master resource targetted
             target = None
+
+        # Encode feature layers natively as GeoJSON (without XSLT)
+        if representation == "geojson" and \
+           not r.component and not target and not msince and \
+           "transform" not in r.vars and "xsltmode" not in get_vars:
+            formats = current.deployment_settings.get_xml_formats()
+            if not isinstance(formats, dict) or representation not in formats:
+                from ..formats import GeoJSONWriter
+                output = GeoJSONWriter().encode(resource,
+                                                start = start,
+                                                limit = limit,
+                                                )
+                if output is not None:
+                    return output
+
         output = resource.export_xml(start = start,
                                      limit = limit,
                                      msince = msince,
@@ -470,6 +470,14 @@ class DataModel:
             if meta:
                 fields = fields + MetaFields.all_meta_fields()
             table = db.define_table(tablename, *fields, **args)
+            if current.deployment_settings.get_ui_report_cache():
+                # Invalidate cached reports upon writes to this table
+                from ..methods import S3PivotTableCache
+                S3PivotTableCache.watch(table)
+            if DataModel.get_config(tablename, "summary_tables"):
+                # Update summary tables upon writes to this table
+                from ..resource import SummaryTable
+                SummaryTable.watch(table)
         return table
 
     # -------------------------------------------------------------------------
@@ -532,6 +540,11 @@ class DataModel:
         if tn not in config:
             config[tn] = {}
         config[tn].update(attr)
+
+        if attr.get("summary_tables") and hasattr(current.db, tn):
+            # Update summary tables upon writes to this table
+            from ..resource import SummaryTable
+            SummaryTable.watch(current.db[tn])
         return
 
     # -------------------------------------------------------------------------
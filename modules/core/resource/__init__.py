@@ -8,3 +8,4 @@ from .resource import *
 #from .rfilter import *
 #from .data import *
 from .rtb import *
+from .summary import SummaryTable
@@ -210,6 +210,13 @@ class DataExporter:
         from gluon.serializers import json as jsons
         return jsons(rows)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def geojson(*args, **kwargs):
+
+        from ..formats import GeoJSONWriter
+        return GeoJSONWriter().encode(*args, **kwargs)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pdf(*args, **kwargs):
@@ -46,7 +46,7 @@ from urllib import parse as urlparse
 from gluon import current, IS_EMPTY_OR, IS_IN_SET
 from gluon.storage import Storage
 
-from s3dal import Field, Row
+from s3dal import Field, Query, Row
 
 from ..tools import S3RepresentLazy, S3TypeConverter, s3_get_foreign_key, s3_str
 
@@ -945,6 +945,52 @@ class S3ResourceField:
             self._is_list = is_list
         return is_list
 
+    # -------------------------------------------------------------------------
+    @property
+    def is_single_valued(self):
+        """
+            Check whether this is a real field with no more than one
+            value per record of the resource, i.e. not a virtual or
+            list:type field, and not in a multiple component
+
+            Returns:
+                True|False
+        """
+
+        if self.field is None or self.is_list:
+            return False
+
+        resource = self.resource
+        selector = resource.prefix_selector(self.selector)
+
+        head, tail = (selector.split("$", 1) + [""])[:2]
+        alias, fname = head.split(".", 1)
+
+        if fname[:1] == "(":
+            # Context expression => resolve
+            context = resource.get_config("context")
+            expression = context.get(fname.strip("()")) if context else None
+            if not expression:
+                return False
+            expression = resource.prefix_selector(expression)
+            if tail:
+                expression = "%s$%s" % (expression, tail)
+            head, tail = (expression.split("$", 1) + [""])[:2]
+            alias = head.split(".", 1)[0]
+
+        if "." in tail:
+            # Component of a referenced table
+            return False
+
+        if alias not in ("~", resource.alias):
+            # Must be a single component
+            component = resource.components.get(alias)
+            if not component or component.multiple:
+                return False
+
+        # Otherwise just foreign keys (=many-to-one)
+        return True
+
 # =============================================================================
 class S3Joins:
     """ A collection of joins """
@@ -1620,7 +1666,9 @@ class S3ResourceQuery:
                 r: the right operand
         """
 
-        hierarchy, field, nodeset, none = self._resolve_hierarchy(l, r)
+        hierarchy, field, nodeset, none = self._resolve_hierarchy(l, r,
+                                                                  subquery = True,
+                                                                  )
         if not hierarchy:
             # Not a hierarchical query => use simple belongs
             return self._query_belongs(l, r)
@@ -1630,7 +1678,10 @@ class S3ResourceQuery:
 
         # Construct the subquery
         list_type = str(field.type)[:5] == "list:"
-        if nodeset:
+        if isinstance(nodeset, Query):
+            # Subtree query from hierarchy index
+            q = nodeset
+        elif nodeset:
             if list_type:
                 q = (field.contains(list(nodeset)))
             elif len(nodeset) > 1:
@@ -1655,13 +1706,15 @@ class S3ResourceQuery:
 
     # -------------------------------------------------------------------------
     @classmethod
-    def _resolve_hierarchy(cls, l, r):
+    def _resolve_hierarchy(cls, l, r, subquery=False):
         """
             Resolve the hierarchical lookup in a typeof-query
 
             Args:
                 l: the left operand
                 r: the right operand
+                subquery: return the node set as subquery (Query) if
+                          the hierarchy has a current subtree index
         """
 
         from ..tools import S3Hierarchy
@@ -1737,7 +1790,12 @@ class S3ResourceQuery:
                         continue
                     nodes.add(node_id)
             if hierarchy.config is not None:
-                nodeset = hierarchy.findall(nodes, inclusive=True)
+                if subquery and str(field.type)[:5] != "list:":
+                    nodeset = hierarchy.subtree_query(field, nodes,
+                                                      inclusive = True,
+                                                      )
+                if nodeset is None:
+                    nodeset = hierarchy.findall(nodes, inclusive=True)
             else:
                 nodeset = nodes
 
@@ -1818,7 +1876,8 @@ class S3ResourceQuery:
     def _query_intersects(self, l, r):
         """
             Resolve INTERSECTS into a DAL expression;
-            will be ignored for non-spatial DBs
+            will be ignored for non-spatial DBs unless the in-process
+            spatial index is enabled
 
             Args:
                 l: the left operand (Field)
@@ -1855,8 +1914,25 @@ class S3ResourceQuery:
                 return l.belongs(set())
 
         else:
-            # Ignore sub-query for non-spatial DB
-            expr = False
+            expr = None
+
+            # Use the in-process spatial index, if enabled
+            index = current.gis.get_spatial_index()
+            if index and isinstance(r, str) and \
+               (getattr(l.table, "_ot", None) or l.tablename) == "gis_location":
+                try:
+                    location_ids = index.intersects(r)
+                except Exception:
+                    # Invalid WKT => log and fail by default
+                    current.log.error("INTERSECTS: %s" % sys.exc_info()[1])
+                    location_ids = []
+                if location_ids is not None:
+                    # Otherwise, index not available yet
+                    expr = l.table._id.belongs(location_ids)
+
+            if expr is None:
+                # Ignore sub-query for non-spatial DB
+                expr = False
 
         return expr
 
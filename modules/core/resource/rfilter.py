@@ -801,6 +801,19 @@ class S3ResourceFilter:
                             # Old DAL or non-spatial database
                             pass
 
+                    elif (getattr(gtable, "_ot", None) or gtable._tablename) == "gis_location":
+                        # Use the in-process spatial index, if enabled
+                        index = current.gis.get_spatial_index()
+                        if index:
+                            location_ids = index.query(float(minLon),
+                                                       float(minLat),
+                                                       float(maxLon),
+                                                       float(maxLat),
+                                                       limit = index.MAX_IDS,
+                                                       )
+                            if location_ids is not None:
+                                bbox_filter = gtable.id.belongs(location_ids)
+
                     if bbox_filter is None:
                         # Standard Query
                         bbox_filter = (gtable.lon > float(minLon)) & \
@@ -0,0 +1,1293 @@
+"""
+    Materialized Summary Tables
+
+    Copyright: 2022 (c) Sahana Software Foundation
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("SummaryTable",
+           )
+
+import datetime
+
+from dateutil.relativedelta import relativedelta
+from functools import reduce
+
+from gluon import current
+
+from s3dal import Field, original_tablename
+
+from ..tools import S3TypeConverter, s3_utc
+
+from .query import S3FieldSelector, S3ResourceQuery
+
+# =============================================================================
+class SummaryTable:
+    """
+        A materialized summary of a table: the number of records and
+        partial aggregates (count, sum, min, max) of numeric fields,
+        grouped by time period and dimension fields; kept up-to-date
+        incrementally, so that reports (S3PivotTable, TimeSeries) over
+        large tables can be computed without reading the records
+
+        Summary tables are declared per table, e.g.:
+
+            s3db.configure("dvr_case_event",
+                           summary_tables = {
+                                "daily": {"timestamp": "date",
+                                          "grain": "day",
+                                          "dimensions": ["type_id"],
+                                          "measures": ["quantity"],
+                                          },
+                                },
+                           )
+
+            s3db.configure("inv_inv_item",
+                           summary_tables = {
+                                "stock": {"dimensions": ["site_id", "item_id"],
+                                          "measures": ["quantity"],
+                                          },
+                                },
+                           )
+
+            - timestamp: the date/datetime field for the time axis
+            - grain: the period length ("year"|"month"|"day"|"hour"),
+                     None for summaries without time axis
+            - dimensions: fields to group by (master table fields of
+                          type reference, integer, string or boolean)
+            - measures: numeric fields to aggregate
+            - hooks: update the summary upon every write (default True),
+                     otherwise the summary is updated only by periodic
+                     s3_summary_refresh tasks (see refresh)
+            - max_age: the maximum age (seconds) of the summary for reports
+                       to use it, defaults to MAX_AGE for summaries without
+                       hooks, and to no limit otherwise (None)
+
+        The write hooks are installed when the table is defined with the
+        setting, so summary tables should be declared in the model (or in
+        a customise-hook that applies to all requests) - otherwise writes
+        in other requests would go unnoticed until the next refresh.
+
+        In web requests, the write hooks defer the refresh until after
+        the commit. Outside of web requests (scheduler, shell), deferred
+        tasks would run immediately, i.e. inside the writing transaction,
+        so the write hooks only collect the affected periods and mark
+        the summary as pending; scripts should call SummaryTable.flush()
+        after committing their writes - otherwise the summary remains
+        pending until the next periodic s3_summary_refresh.
+
+        Reports use a summary table only if it answers them exactly, i.e.
+        if all axes are dimensions, all facts are record counts or
+        aggregates of measures, the resource filter refers to dimensions
+        only (or to the timestamp, at period boundaries), and the user
+        is permitted to read all records of the table - and if the summary
+        is current, i.e. no refresh is pending after writes, and it is not
+        older than max_age.
+    """
+
+    GRAINS = ("year", "month", "day", "hour")
+
+    # Overlap of delta refreshes (seconds), to catch up with records
+    # written by transactions which were still open at the last refresh
+    LATENCY = 300
+
+    # Maximum number of periods to recompute with a single query
+    CHUNK = 50
+
+    # Default maximum age (seconds) of summaries without write hooks
+    MAX_AGE = 3600
+
+    def __init__(self, tablename, name, definition):
+        """
+            Args:
+                tablename: the name of the summarized table
+                name: the name of the summary
+                definition: the summary definition (dict)
+
+            Raises:
+                SyntaxError: for invalid definitions
+        """
+
+        table = current.s3db.table(tablename)
+        if table is None:
+            raise SyntaxError("Undefined table: %s" % tablename)
+
+        self.tablename = tablename
+        self.name = name
+        self.table = table
+
+        # Time axis
+        grain = definition.get("grain")
+        if grain:
+            if grain not in self.GRAINS:
+                raise SyntaxError("Invalid summary grain: %s" % grain)
+            timestamp = definition.get("timestamp")
+            if not timestamp or timestamp not in table.fields:
+                raise SyntaxError("Invalid summary timestamp: %s" % timestamp)
+            ftype = table[timestamp].type
+            if ftype not in ("date", "datetime") or \
+               ftype == "date" and grain == "hour":
+                raise SyntaxError("Invalid summary timestamp: %s" % timestamp)
+        else:
+            grain = timestamp = None
+        self.grain = grain
+        self.timestamp = timestamp
+
+        # Dimensions
+        dimensions = []
+        for fieldname in definition.get("dimensions", ()):
+            if fieldname not in table.fields or \
+               self.pytype(table[fieldname]) is None:
+                raise SyntaxError("Invalid summary dimension: %s" % fieldname)
+            dimensions.append(fieldname)
+        self.dimensions = dimensions
+
+        # Measures
+        measures = []
+        for fieldname in definition.get("measures", ()):
+            if fieldname not in table.fields or \
+               table[fieldname].type not in ("integer", "double", "float"):
+                raise SyntaxError("Invalid summary measure: %s" % fieldname)
+            measures.append(fieldname)
+        self.measures = measures
+
+        self.hooks = hooks = definition.get("hooks", True)
+        self.max_age = definition.get("max_age", None if hooks else self.MAX_AGE)
+
+        # Whether the summary only includes approved records
+        auth = current.auth
+        self.approved = "approved_by" in table.fields and \
+                        bool(auth.permission.requires_approval(table))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def configured(cls, tablename):
+        """
+            The summary tables configured for a table
+
+            Args:
+                tablename: the table name
+
+            Returns:
+                list of SummaryTable instances
+        """
+
+        config = current.s3db.get_config(tablename, "summary_tables")
+        if not config:
+            return []
+
+        summaries = []
+        for name in sorted(config):
+            try:
+                summary = cls(tablename, name, config[name])
+            except SyntaxError as e:
+                current.log.error("Summary %s of %s ignored: %s" % (name, tablename, e))
+                continue
+            summaries.append(summary)
+
+        return summaries
+
+    # -------------------------------------------------------------------------
+    @property
+    def definition(self):
+        """
+            The effective definition of this summary, as stored with
+            the summary data (=a summary is rebuilt when this changes)
+        """
+
+        return {"timestamp": self.timestamp,
+                "grain": self.grain,
+                "dimensions": self.dimensions,
+                "measures": self.measures,
+                "approved": self.approved,
+                }
+
+    # -------------------------------------------------------------------------
+    @property
+    def exact(self):
+        """
+            Whether periods are identical with timestamps (i.e. date
+            timestamps summarized per day)
+        """
+
+        return self.grain == "day" and self.table[self.timestamp].type == "date"
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pytype(field):
+        """
+            The Python type of dimension values
+
+            Args:
+                field: the Field
+
+            Returns:
+                the type, or None if the field can not be a dimension
+        """
+
+        ftype = str(field.type)
+        if ftype[:9] == "reference" or ftype in ("id", "integer"):
+            pytype = int
+        elif ftype == "boolean":
+            pytype = bool
+        elif ftype == "string":
+            pytype = str
+        else:
+            pytype = None
+
+        return pytype
+
+    # -------------------------------------------------------------------------
+    # Periods
+    # -------------------------------------------------------------------------
+    def period(self, value):
+        """
+            The start of the period a timestamp falls into
+
+            Args:
+                value: the timestamp (date or datetime)
+
+            Returns:
+                the period start (datetime), or None for summaries
+                without time axis or if value is None
+        """
+
+        grain = self.grain
+        if not grain or value is None:
+            return None
+
+        parts = [value.year, value.month, value.day]
+        if isinstance(value, datetime.datetime):
+            parts.append(value.hour)
+
+        return self.start(parts[:self.GRAINS.index(grain) + 1])
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def start(parts):
+        """
+            The period start from truncated timestamp parts
+
+            Args:
+                parts: list of timestamp parts [year, month, day, hour]
+
+            Returns:
+                the period start (datetime), or None if parts are None
+        """
+
+        if not parts or parts[0] is None:
+            return None
+
+        return datetime.datetime(*(list(parts) + [1] * (3 - len(parts))))
+
+    # -------------------------------------------------------------------------
+    def next_period(self, start):
+        """
+            The start of the period following a period
+
+            Args:
+                start: the period start (datetime)
+
+            Returns:
+                the start of the next period (datetime)
+        """
+
+        delta = {self.grain + "s": 1}
+        return start + relativedelta(**delta)
+
+    # -------------------------------------------------------------------------
+    def parts(self):
+        """
+            The expressions to truncate timestamps to their period
+
+            Returns:
+                list of expressions (empty list if no time axis)
+        """
+
+        if not self.grain:
+            return []
+
+        field = self.table[self.timestamp]
+        return [field.year(),
+                field.month(),
+                field.day(),
+                field.hour(),
+                ][:self.GRAINS.index(self.grain) + 1]
+
+    # -------------------------------------------------------------------------
+    def periods(self, dbset):
+        """
+            The periods of a set of records
+
+            Args:
+                dbset: the Set of records
+
+            Returns:
+                set of period starts (datetime or None)
+        """
+
+        parts = self.parts()
+        if not parts:
+            return {None}
+
+        rows = dbset.select(groupby=parts, *parts)
+        return {self.start([row[p] for p in parts]) for row in rows}
+
+    # -------------------------------------------------------------------------
+    def period_query(self, start):
+        """
+            A query for the records of a period
+
+            Args:
+                start: the period start (datetime)
+
+            Returns:
+                the Query (None for summaries without time axis)
+        """
+
+        if not self.grain:
+            return None
+
+        field = self.table[self.timestamp]
+        if start is None:
+            return (field == None)
+
+        end = self.next_period(start)
+        if field.type == "date":
+            start, end = start.date(), end.date()
+
+        return (field >= start) & (field < end)
+
+    # -------------------------------------------------------------------------
+    # Storage
+    # -------------------------------------------------------------------------
+    def base_query(self):
+        """
+            The query for all records included in this summary
+
+            Returns:
+                the Query
+        """
+
+        table = self.table
+
+        if self.approved:
+            query = (table.approved_by != None)
+        else:
+            query = (table._id > 0)
+        if "deleted" in table.fields:
+            query &= (table.deleted == False)
+
+        return query
+
+    # -------------------------------------------------------------------------
+    def compute(self, query):
+        """
+            Compute the summary rows for a set of records, with a GROUP
+            BY query
+
+            Args:
+                query: the query for the records
+
+            Returns:
+                list of dicts {period, dimensions, records, measures}
+        """
+
+        table = self.table
+
+        parts = self.parts()
+        dimensions = [table[fn] for fn in self.dimensions]
+        groupby = parts + dimensions
+
+        records = table._id.count()
+        expressions = []
+        for fn in self.measures:
+            field = table[fn]
+            expressions.append((fn, (field.count(),
+                                     field.sum(),
+                                     field.min(),
+                                     field.max(),
+                                     )))
+
+        fields = groupby + [records]
+        for _, expr in expressions:
+            fields.extend(expr)
+
+        rows = current.db(query).select(groupby = groupby if groupby else None,
+                                        *fields)
+
+        items = []
+        for row in rows:
+            number = row[records]
+            if not number:
+                # Empty table
+                continue
+            items.append({"period": self.start([row[p] for p in parts]),
+                          "dimensions": [row[f] for f in dimensions],
+                          "records": number,
+                          "measures": {fn: [row[e] for e in expr]
+                                       for fn, expr in expressions},
+                          })
+        return items
+
+    # -------------------------------------------------------------------------
+    def lock(self):
+        """
+            Get (or create) the summary record, and lock it until the
+            end of the transaction, so that concurrent refreshes of the
+            same summary are serialized
+
+            Note:
+                If a concurrent transaction creates the summary record at
+                the same time, the current transaction is rolled back - so
+                this should be called at the start of the transaction
+
+            Returns:
+                the summary record (Row)
+        """
+
+        db = current.db
+        stable = current.s3db.s3_summary
+
+        query = (stable.tablename == self.tablename) & \
+                (stable.name == self.name)
+
+        now = datetime.datetime.utcnow()
+        if not db(query).update(modified_on=now):
+            try:
+                stable.insert(tablename = self.tablename,
+                              name = self.name,
+                              summary_key = "%s.%s" % (self.tablename, self.name),
+                              dirty = True,
+                              )
+            except Exception:
+                # Created by a concurrent transaction (unique summary_key)
+                # => roll back, and lock the existing record instead
+                db.rollback()
+                db(query).update(modified_on=now)
+
+        return db(query).select(stable.id,
+                                stable.definition,
+                                stable.dirty,
+                                stable.pending,
+                                stable.refreshed_on,
+                                limitby = (0, 1),
+                                ).first()
+
+    # -------------------------------------------------------------------------
+    def rebuild(self, record=None):
+        """
+            Rebuild this summary from all records
+
+            Args:
+                record: the summary record (if already locked)
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        if record is None:
+            record = self.lock()
+        summary_id = record.id
+
+        now = datetime.datetime.utcnow()
+
+        dtable = s3db.s3_summary_data
+        db(dtable.summary_id == summary_id).delete()
+        self.insert(summary_id, self.compute(self.base_query()))
+
+        db(s3db.s3_summary.id == summary_id).update(definition = self.definition,
+                                                     dirty = False,
+                                                     refreshed_on = now,
+                                                     pending = None,
+                                                     )
+        self.invalidate_reports()
+
+    # -------------------------------------------------------------------------
+    def refresh(self, periods=None):
+        """
+            Bring this summary up-to-date, rebuilding it if it has never
+            been built, has been marked dirty, or its definition has changed
+
+            Args:
+                periods: additional periods to recompute after writes
+                         (datetime or ISO-format string); all periods with
+                         records modified since the last refresh are
+                         recomputed in any case
+
+            Note:
+                Recomputing modified periods catches all writes except
+                hard deletions and changes of the timestamp (the record
+                is no longer in the original period), which are handled
+                by the write hooks (see watch) - hence a pending summary
+                is rebuilt if the affected periods are not specified
+                (e.g. periodic refresh after writes outside of web requests)
+        """
+
+        record = self.lock()
+        if record.dirty or \
+           record.refreshed_on is None or \
+           record.definition != self.definition or \
+           record.pending and periods is None:
+            self.rebuild(record)
+            return
+
+        table = self.table
+        if "modified_on" not in table.fields:
+            self.rebuild(record)
+            return
+
+        # Recompute all periods with records modified since the last
+        # refresh (=including writes of other transactions which are
+        # still pending), and the periods explicitly requested
+        watermark = datetime.datetime.utcnow()
+        since = record.refreshed_on - datetime.timedelta(seconds=self.LATENCY)
+        modified = self.periods(current.db(table.modified_on > since))
+        if periods is not None:
+            modified.update(datetime.datetime.fromisoformat(p)
+                            if isinstance(p, str) else p for p in periods)
+
+        self.update(record.id, modified)
+
+        stable = current.s3db.s3_summary
+        current.db(stable.id == record.id).update(refreshed_on = watermark,
+                                                  pending = None,
+                                                  )
+        self.invalidate_reports()
+
+    # -------------------------------------------------------------------------
+    def invalidate_reports(self):
+        """
+            Invalidate cached reports of the summarized table after a
+            refresh (they may have been computed from outdated summary data)
+        """
+
+        if current.deployment_settings.get_ui_report_cache():
+            from ..methods import S3PivotTableCache
+            S3PivotTableCache.invalidate(self.tablename)
+
+    # -------------------------------------------------------------------------
+    def update(self, summary_id, periods):
+        """
+            Recompute the summary rows for periods
+
+            Args:
+                summary_id: the summary record ID
+                periods: the period starts (datetime or None)
+        """
+
+        db = current.db
+        dtable = current.s3db.s3_summary_data
+
+        if not self.grain:
+            periods = [None]
+        else:
+            periods = sorted(set(periods), key=lambda p: (p is not None, p))
+
+        base_query = self.base_query()
+        period_query = self.period_query
+        chunk = self.CHUNK
+
+        for index in range(0, len(periods), chunk):
+            starts = periods[index:index + chunk]
+
+            query = (dtable.summary_id == summary_id)
+            if self.grain:
+                query &= reduce(lambda x, y: x | y, [(dtable.period == s) for s in starts])
+            db(query).delete()
+
+            query = base_query
+            if self.grain:
+                query &= reduce(lambda x, y: x | y, [period_query(s) for s in starts])
+            self.insert(summary_id, self.compute(query))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def insert(summary_id, items):
+        """
+            Store summary rows
+
+            Args:
+                summary_id: the summary record ID
+                items: the summary rows (see compute)
+        """
+
+        if not items:
+            return
+
+        for item in items:
+            item["summary_id"] = summary_id
+
+        current.s3db.s3_summary_data.bulk_insert(items)
+
+    # -------------------------------------------------------------------------
+    # Write hooks
+    # -------------------------------------------------------------------------
+    @classmethod
+    def watch(cls, table):
+        """
+            Installs callbacks to update the summaries of a table upon
+            writes; the periods affected by the writes are collected, and
+            recomputed after the transaction has been committed (deferred
+            s3_summary_refresh task in web requests, see schedule)
+
+            Args:
+                table: the Table
+        """
+
+        if getattr(table, "_summary_watched", False):
+            return
+
+        tablename = original_tablename(table)
+
+        def before_update(dbset, fields):
+            cls.collect(tablename, dbset=dbset, fields=fields)
+        def after_update(dbset, fields):
+            cls.collect(tablename, dbset=dbset, fields=fields, after=True)
+        def after_insert(fields, record_id):
+            cls.collect(tablename, fields=fields, record_id=record_id, after=True)
+        def before_delete(dbset):
+            cls.collect(tablename, dbset=dbset)
+        def after_delete(dbset):
+            cls.collect(tablename, after=True)
+
+        table._before_update.append(before_update)
+        table._after_update.append(after_update)
+        table._after_insert.append(after_insert)
+        table._before_delete.append(before_delete)
+        table._after_delete.append(after_delete)
+        table._summary_watched = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def collect(cls, tablename, dbset=None, fields=None, record_id=None, after=False):
+        """
+            Collects the periods affected by a write, and schedules the
+            summaries for refresh after the write
+
+            Args:
+                tablename: the table name
+                dbset: the Set of records updated or deleted
+                fields: the fields written (insert or update)
+                record_id: the ID of the inserted record
+                after: the write has been performed
+        """
+
+        summaries = [s for s in cls.configured(tablename) if s.hooks]
+        if not summaries:
+            return
+
+        s3 = current.response.s3
+        dirty = s3.summary_periods
+        if dirty is None:
+            dirty = s3.summary_periods = {}
+
+        for summary in summaries:
+
+            timestamp = summary.timestamp
+            if fields is not None and record_id is None:
+                # Update: only relevant if any summarized field is written
+                names = summary.dimensions + summary.measures + \
+                        [timestamp, "deleted", "approved_by"]
+                if not any(fn in fields for fn in names if fn):
+                    continue
+
+            key = (tablename, summary.name)
+            periods = dirty.get(key)
+            if periods is None:
+                periods = dirty[key] = set()
+
+            if not summary.grain:
+                periods.add(None)
+
+            elif record_id is not None:
+                # After insert: the period of the new record
+                value = fields[timestamp] if timestamp in fields else False
+                query = (summary.table._id == record_id)
+                periods |= summary.affected(value, current.db(query))
+
+            elif dbset is not None:
+                if not after:
+                    # Before update/delete: the periods of the records
+                    periods |= summary.periods(dbset)
+                elif timestamp in fields:
+                    # After update: the periods of the new timestamp
+                    periods |= summary.affected(fields[timestamp], dbset)
+
+            if after:
+                summary.schedule(periods)
+
+    # -------------------------------------------------------------------------
+    def affected(self, value, dbset):
+        """
+            The periods affected by writing a timestamp
+
+            Args:
+                value: the timestamp value written (False if not written)
+                dbset: the Set of records written
+
+            Returns:
+                set of period starts
+        """
+
+        if value is None or isinstance(value, datetime.date):
+            return {self.period(value)}
+        else:
+            # Default, expression or string => look up from the records
+            return self.periods(dbset)
+
+    # -------------------------------------------------------------------------
+    def schedule(self, periods):
+        """
+            Schedules a refresh of periods after commit; called from
+            DAL callbacks, so must neither commit nor roll back
+
+            Args:
+                periods: the period starts (datetime or None)
+
+            Note:
+                Outside of web requests, S3Task.defer would run the
+                refresh immediately (inside the writing transaction), so
+                the periods are only collected for flush() then
+        """
+
+        # Mark the summary as pending until refreshed
+        self.mark_pending()
+
+        request = current.request
+        if request.is_scheduler or request.is_shell:
+            return
+
+        starts = [p.isoformat() if p else None for p in periods]
+        current.s3task.defer("s3_summary_refresh",
+                             args = [self.tablename, self.name],
+                             vars = {"periods": starts},
+                             key = "s3_summary_refresh/%s/%s" % (self.tablename, self.name),
+                             )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def flush(cls):
+        """
+            Refreshes all summaries affected by writes of the current
+            process, with the periods collected by the write hooks; to
+            be called outside of web requests after committing the writes
+            (the caller must commit again afterwards)
+
+            Returns:
+                the number of refreshed summaries
+        """
+
+        s3 = current.response.s3
+
+        dirty = s3.summary_periods
+        s3.summary_periods = {}
+        s3.summary_pending = None
+        if not dirty:
+            return 0
+
+        refreshed = 0
+        for (tablename, name), periods in dirty.items():
+            for summary in cls.configured(tablename):
+                if summary.name == name:
+                    summary.refresh(periods)
+                    refreshed += 1
+
+        return refreshed
+
+    # -------------------------------------------------------------------------
+    def mark_pending(self):
+        """
+            Mark this summary as pending a refresh, so that it is not used
+            for reports until refreshed; as part of the writing transaction,
+            and only once per request
+        """
+
+        s3 = current.response.s3
+        marked = s3.summary_pending
+        if marked is None:
+            marked = s3.summary_pending = set()
+
+        key = (self.tablename, self.name)
+        if key in marked:
+            return
+        marked.add(key)
+
+        stable = current.s3db.s3_summary
+        query = (stable.tablename == self.tablename) & \
+                (stable.name == self.name) & \
+                (stable.pending == None)
+        current.db(query).update(pending=datetime.datetime.utcnow())
+
+    # -------------------------------------------------------------------------
+    # Reports
+    # -------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, resource, dimensions, measures, timestamp=None, grain=None):
+        """
+            Look up the partial aggregates for a report from a summary
+            table that can answer it
+
+            Args:
+                resource: the CRUDResource (incl. filters)
+                dimensions: selectors for the report axes
+                measures: selectors for the fields to aggregate, the
+                          primary key for the number of records
+                timestamp: selector for the time axis of the report
+                grain: the longest period the time axis can work with
+                       (None to require exact timestamps)
+
+            Returns:
+                list of tuples (period, values, records, partials), grouped
+                by period (if the report has a time axis) and dimensions,
+                with values being a tuple of the dimension values, and
+                partials a dict {selector: (count, sum, min, max)}; or None
+                if no summary table can answer the report
+        """
+
+        if resource.linked is not None or \
+           resource.get_config("postprocess_select") or \
+           resource.rfilter.get_extra_filters():
+            return None
+
+        for summary in cls.configured(resource.tablename):
+            result = summary.answer(resource,
+                                    dimensions,
+                                    measures,
+                                    timestamp = timestamp,
+                                    grain = grain,
+                                    )
+            if result is not None:
+                return result
+
+        return None
+
+    # -------------------------------------------------------------------------
+    def answer(self, resource, dimensions, measures, timestamp=None, grain=None):
+        """
+            Answer a report from this summary, if possible
+
+            Args:
+                see lookup
+
+            Returns:
+                see lookup
+        """
+
+        table = self.table
+        tablename = self.tablename
+
+        # Time axis
+        if timestamp:
+            if not self.grain:
+                return None
+            rfield = resource.resolve_selector(timestamp)
+            if not self.is_master_field(rfield) or \
+               rfield.fname != self.timestamp:
+                return None
+            if not self.exact and \
+               (not grain or self.GRAINS.index(self.grain) < self.GRAINS.index(grain)):
+                return None
+
+        # Dimensions
+        indexes = []
+        for selector in dimensions:
+            rfield = resource.resolve_selector(selector)
+            if not self.is_master_field(rfield) or \
+               rfield.fname not in self.dimensions:
+                return None
+            indexes.append(self.dimensions.index(rfield.fname))
+
+        # Measures
+        pkey = table._id.name
+        columns = []
+        for selector in measures:
+            rfield = resource.resolve_selector(selector)
+            if not self.is_master_field(rfield):
+                return None
+            fname = rfield.fname
+            if fname != pkey and fname not in self.measures:
+                return None
+            columns.append((selector, fname))
+
+        # Resource must include all records of the summary
+        rfilter = resource.rfilter
+        if rfilter.queries or str(rfilter.mquery) != str(self.base_query()):
+            return None
+
+        # Filters must be decidable from dimensions and periods
+        if rfilter.filters:
+            query = reduce(lambda x, y: x & y, rfilter.filters)
+            try:
+                match = self.predicate(resource, query)
+            except (AttributeError, KeyError, SyntaxError, TypeError, ValueError):
+                return None
+        else:
+            match = None
+
+        # Summary must have been built with the current definition,
+        # and be current
+        db = current.db
+        s3db = current.s3db
+        stable = s3db.s3_summary
+        query = (stable.tablename == tablename) & \
+                (stable.name == self.name)
+        record = db(query).select(stable.id,
+                                  stable.definition,
+                                  stable.dirty,
+                                  stable.refreshed_on,
+                                  stable.pending,
+                                  limitby = (0, 1),
+                                  ).first()
+        if not record or record.dirty or record.pending or \
+           record.definition != self.definition:
+            return None
+        max_age = self.max_age
+        if max_age:
+            earliest = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+            if not record.refreshed_on or record.refreshed_on < earliest:
+                return None
+
+        dtable = s3db.s3_summary_data
+        rows = db(dtable.summary_id == record.id).select(dtable.period,
+                                                         dtable.dimensions,
+                                                         dtable.records,
+                                                         dtable.measures,
+                                                         )
+
+        # Group the summary rows
+        groups = {}
+        try:
+            for row in rows:
+                period, values = row.period, row.dimensions
+                if match is not None and match(period, values) is not True:
+                    continue
+
+                key = (period if timestamp else None,
+                       tuple(values[i] for i in indexes),
+                       )
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = [0, {}]
+                records = row.records
+                group[0] += records
+
+                partials = group[1]
+                aggregates = row.measures
+                for selector, fname in columns:
+                    if fname == pkey:
+                        partial = (records, None, None, None)
+                    else:
+                        partial = aggregates.get(fname)
+                    partials[selector] = self.merge(partials.get(selector), partial)
+        except ValueError:
+            # Filter not decidable for some period
+            return None
+
+        return [(key[0], key[1], group[0], group[1])
+                for key, group in groups.items()]
+
+    # -------------------------------------------------------------------------
+    def is_master_field(self, rfield):
+        """
+            Check whether a resource field is a real field of the
+            summarized table itself (i.e. not a joined field)
+
+            Args:
+                rfield: the S3ResourceField
+
+            Returns:
+                True|False
+        """
+
+        return rfield.field is not None and \
+               rfield.colname == "%s.%s" % (self.tablename, rfield.fname)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def merge(a, b):
+        """
+            Merge two partial aggregates
+
+            Args:
+                a: partial aggregate (count, sum, min, max), or None
+                b: partial aggregate (count, sum, min, max), or None
+
+            Returns:
+                the merged partial aggregate
+        """
+
+        if not a:
+            return tuple(b) if b else None
+        if not b:
+            return a
+
+        count = (a[0] or 0) + (b[0] or 0)
+        total = a[1] if b[1] is None else b[1] if a[1] is None else a[1] + b[1]
+        minimum = a[2] if b[2] is None else b[2] if a[2] is None else min(a[2], b[2])
+        maximum = a[3] if b[3] is None else b[3] if a[3] is None else max(a[3], b[3])
+
+        return (count, total, minimum, maximum)
+
+    # -------------------------------------------------------------------------
+    # Filters
+    # -------------------------------------------------------------------------
+    def predicate(self, resource, query):
+        """
+            Convert a resource query into a function to match summary
+            rows, following SQL semantics (i.e. None for unknown)
+
+            Args:
+                resource: the CRUDResource
+                query: the S3ResourceQuery
+
+            Returns:
+                a function f(period, values) => True|False|None, which
+                raises ValueError if the query can not be decided for the
+                period as a whole
+
+            Raises:
+                SyntaxError: if the query can not be answered from this
+                             summary
+        """
+
+        Q = S3ResourceQuery
+        op = query.op
+
+        if op in (Q.AND, Q.OR):
+            left = self.predicate(resource, query.left)
+            right = self.predicate(resource, query.right)
+            if op == Q.AND:
+                def match(p, v):
+                    l, r = left(p, v), right(p, v)
+                    if l is False or r is False:
+                        return False
+                    return None if l is None or r is None else True
+            else:
+                def match(p, v):
+                    l, r = left(p, v), right(p, v)
+                    if l is True or r is True:
+                        return True
+                    return None if l is None or r is None else False
+            return match
+
+        elif op == Q.NOT:
+            inner = self.predicate(resource, query.left)
+            def match(p, v):
+                result = inner(p, v)
+                return None if result is None else not result
+            return match
+
+        if op not in (Q.EQ, Q.NE, Q.LT, Q.LE, Q.GT, Q.GE, Q.BELONGS):
+            raise SyntaxError("Unsupported operator: %s" % op)
+
+        # Resolve the field
+        left = query.left
+        if isinstance(left, S3FieldSelector):
+            if left.op:
+                raise SyntaxError("Unsupported expression")
+            rfield = resource.resolve_selector(left.name)
+            if not self.is_master_field(rfield):
+                raise SyntaxError("Not a master table field")
+            field = rfield.field
+        elif isinstance(left, Field):
+            field = left
+            if original_tablename(field.table) != self.tablename:
+                raise SyntaxError("Not a master table field")
+        else:
+            raise SyntaxError("Invalid query")
+        fname = field.name
+
+        value = query.right
+        if isinstance(value, (S3FieldSelector, Field)):
+            raise SyntaxError("Unsupported expression")
+
+        invert = False
+        if isinstance(value, (list, tuple, set)):
+            if op == Q.EQ:
+                op = Q.BELONGS
+            elif op == Q.NE:
+                op = Q.BELONGS
+                invert = True
+            elif op != Q.BELONGS:
+                raise SyntaxError("Unsupported expression")
+
+        if fname in self.dimensions:
+            match = self.dimension_predicate(field, op, value)
+        elif self.grain and fname == self.timestamp:
+            match = self.period_predicate(field, op, value)
+        else:
+            raise SyntaxError("Not a summary dimension: %s" % fname)
+
+        if invert:
+            inner = match
+            def match(p, v):
+                result = inner(p, v)
+                return None if result is None else not result
+        return match
+
+    # -------------------------------------------------------------------------
+    def dimension_predicate(self, field, op, value):
+        """
+            A function to match the dimension values of summary rows
+
+            Args:
+                field: the dimension Field
+                op: the operator
+                value: the value to compare with
+
+            Returns:
+                a function f(period, values) => True|False|None
+        """
+
+        Q = S3ResourceQuery
+
+        pytype = self.pytype(field)
+        index = self.dimensions.index(field.name)
+
+        if op == Q.BELONGS:
+            items = value if isinstance(value, (list, tuple, set)) else [value]
+            if pytype is str and \
+               any(isinstance(item, str) and ("*" in item or "%" in item) for item in items):
+                raise SyntaxError("Unsupported wildcard")
+            items = {S3TypeConverter.convert(pytype, item) for item in items}
+            null = None in items
+            def match(p, v):
+                if v[index] is None:
+                    return True if null else None
+                return v[index] in items
+            return match
+
+        value = S3TypeConverter.convert(pytype, value)
+        if value is None:
+            if op == Q.EQ:
+                return lambda p, v: v[index] is None
+            elif op == Q.NE:
+                return lambda p, v: v[index] is not None
+            else:
+                return lambda p, v: None
+
+        compare = self.compare(op)
+        return lambda p, v: None if v[index] is None else compare(v[index], value)
+
+    # -------------------------------------------------------------------------
+    def period_predicate(self, field, op, value):
+        """
+            A function to match the periods of summary rows, deciding
+            for the period as a whole
+
+            Args:
+                field: the timestamp Field
+                op: the operator
+                value: the value to compare with
+
+            Returns:
+                a function f(period, values) => True|False|None, which
+                raises ValueError if the result is not the same for all
+                timestamps within the period
+        """
+
+        Q = S3ResourceQuery
+
+        date = field.type == "date"
+        pytype = datetime.date if date else datetime.datetime
+
+        def convert(v):
+            v = S3TypeConverter.convert(pytype, v)
+            if date:
+                if isinstance(v, datetime.datetime):
+                    raise ValueError("Datetime for date field")
+            elif v is not None and v.tzinfo is not None:
+                v = s3_utc(v).replace(tzinfo=None)
+            return v
+
+        # First and last possible timestamp of a period
+        if date:
+            step = datetime.timedelta(days=1)
+            bounds = lambda p: (p.date(), self.next_period(p).date() - step)
+        else:
+            step = datetime.timedelta(microseconds=1)
+            bounds = lambda p: (p, self.next_period(p) - step)
+
+        if op == Q.BELONGS:
+            items = value if isinstance(value, (list, tuple, set)) else [value]
+            items = [convert(item) for item in items]
+            null = None in items
+            items = [item for item in items if item is not None]
+            def match(p, v):
+                if p is None:
+                    return null
+                first, last = bounds(p)
+                inside = [item for item in items if first <= item <= last]
+                if not inside:
+                    return False
+                if first == last:
+                    return True
+                raise ValueError("Period not decidable")
+            return match
+
+        value = convert(value)
+        if value is None:
+            if op == Q.EQ:
+                return lambda p, v: p is None
+            elif op == Q.NE:
+                return lambda p, v: p is not None
+            else:
+                return lambda p, v: None
+
+        compare = self.compare(op)
+        def match(p, v):
+            if p is None:
+                return None
+            first, last = bounds(p)
+            a, b = compare(first, value), compare(last, value)
+            if a != b or op in (Q.EQ, Q.NE) and first != last and \
+               first <= value <= last:
+                raise ValueError("Period not decidable")
+            return a
+        return match
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def compare(op):
+        """
+            The comparison function for an operator
+
+            Args:
+                op: the operator
+
+            Returns:
+                a function f(a, b) => True|False
+        """
+
+        Q = S3ResourceQuery
+
+        return {Q.EQ: lambda a, b: a == b,
+                Q.NE: lambda a, b: a != b,
+                Q.LT: lambda a, b: a < b,
+                Q.LE: lambda a, b: a <= b,
+                Q.GT: lambda a, b: a > b,
+                Q.GE: lambda a, b: a >= b,
+                }[op]
+
+# END =========================================================================
@@ -325,6 +325,9 @@ class S3Hierarchy:
 
         # Update status
         self.__status(dirty=False, dbupdate=None, dbstatus=True)
+
+        # Rebuild the subtree index (asynchronously)
+        self.schedule_index(tablename)
         return
 
     # -------------------------------------------------------------------------
@@ -362,14 +365,242 @@ class S3Hierarchy:
             query = (htable.tablename == tablename)
             row = current.db(query).select(htable.id,
                                            htable.dirty,
+                                           htable.index_version,
                                            limitby=(0, 1)).first()
             if not row:
                 htable.insert(tablename=tablename, dirty=True)
-            elif not row.dirty:
-                row.update_record(dirty=True)
+            else:
+                if not row.dirty:
+                    row.update_record(dirty=True)
+                if row.index_version:
+                    # Hierarchy is indexed => rebuild the index
+                    cls.schedule_index(tablename)
             flags["dbstatus"] = False
+        flags["indexed"] = False
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def schedule_index(tablename):
+        """
+            Schedule a rebuild of the subtree index of a hierarchy
+            (after commit)
+
+            Args:
+                tablename: the tablename
+        """
+
+        current.s3task.defer("s3_hierarchy_index", args=[tablename])
+
+    # -------------------------------------------------------------------------
+    def fingerprint(self):
+        """
+            Compute a fingerprint of the current state of the hierarchical
+            table (and link table, if any), to detect whether the subtree
+            index is stale
+
+            Returns:
+                the fingerprint as string
+        """
+
+        tablename = self.tablename
+        if not tablename:
+            return None
+
+        s3db = current.s3db
+        db = current.db
+
+        tablenames = [tablename]
+        if self.link:
+            tablenames.append(self.link)
+
+        fingerprint = []
+        for tn in tablenames:
+            table = s3db.table(tn)
+            if not table:
+                return None
+            count = table._id.count()
+            fields = [count]
+            if "modified_on" in table.fields:
+                latest = table.modified_on.max()
+                fields.append(latest)
+            else:
+                latest = None
+            row = db(table._id > 0).select(*fields).first()
+            if not row:
+                return None
+            fingerprint.append("%s:%s" % (row[count],
+                                          row[latest] if latest else "-",
+                                          ))
+        return ";".join(fingerprint)
+
+    # -------------------------------------------------------------------------
+    @property
+    def indexed(self):
+        """
+            Whether the subtree index of this hierarchy is current,
+            checked once per request; schedules a rebuild of the index
+            if it is stale
+
+            Returns:
+                True|False
+        """
+
+        if not self.config:
+            return False
+
+        indexed = self.__status("indexed")
+        if indexed is None:
+            htable = current.s3db.s3_hierarchy
+            query = (htable.tablename == self.tablename)
+            row = current.db(query).select(htable.index_version,
+                                           limitby = (0, 1),
+                                           ).first()
+            if row and row.index_version:
+                indexed = row.index_version == self.fingerprint()
+                if not indexed:
+                    # Index is stale => rebuild it
+                    self.schedule_index(self.tablename)
+            else:
+                indexed = False
+            self.__status(indexed=indexed)
+
+        return indexed
+
+    # -------------------------------------------------------------------------
+    def build_index(self, refresh=True):
+        """
+            Rebuild the subtree index of this hierarchy, i.e. number
+            all nodes as nested sets (left/right values), so that
+            descendants of a node can be found with a range query
+            in SQL rather than by expanding the subtree in Python
+
+            Args:
+                refresh: re-read the hierarchy from the target table first
+
+            Returns:
+                the number of indexed nodes
+        """
+
+        if not self.config:
+            return 0
+        tablename = self.tablename
+
+        s3db = current.s3db
+        db = current.db
+
+        # Fingerprint before reading, so that concurrent updates
+        # render the index stale rather than being missed
+        version = self.fingerprint()
+
+        theset = self.theset
+        if refresh:
+            self.read()
+
+        # Nested-set numbering by iterative depth-first traversal
+        roots = [node_id for node_id, node in theset.items()
+                         if not node["p"] or node["p"] not in theset]
+        stack = [(node_id, False) for node_id in roots]
+        counter = 0
+        visited = set()
+        lft = {}
+        items = []
+        while stack:
+            node_id, done = stack.pop()
+            counter += 1
+            if done:
+                items.append({"tablename": tablename,
+                              "node_id": node_id,
+                              "lft": lft.pop(node_id),
+                              "rgt": counter,
+                              })
+                continue
+            if node_id in visited:
+                # Cyclic reference
+                counter -= 1
+                continue
+            visited.add(node_id)
+            lft[node_id] = counter
+            stack.append((node_id, True))
+            stack.extend((child_id, False) for child_id in theset[node_id]["s"])
+
+        # Replace the index
+        itable = s3db.s3_hierarchy_index
+        db(itable.tablename == tablename).delete()
+        chunk = 1000
+        for i in range(0, len(items), chunk):
+            itable.bulk_insert(items[i:i+chunk])
+
+        # Store the version
+        htable = s3db.s3_hierarchy
+        query = (htable.tablename == tablename)
+        row = db(query).select(htable.id, limitby=(0, 1)).first()
+        if row:
+            row.update_record(index_version=version)
+        else:
+            htable.insert(tablename = tablename,
+                          dirty = True,
+                          index_version = version,
+                          )
+        self.__status(indexed = bool(version))
+
+        return len(items)
+
+    # -------------------------------------------------------------------------
+    def subtree_query(self, field, node_ids, inclusive=True):
+        """
+            Construct a query for all descendants of nodes using the
+            subtree index, i.e. as range predicates evaluated in SQL
+
+            Args:
+                field: the field referencing the node ID
+                node_ids: the node IDs (iterable)
+                inclusive: include the start nodes
+
+            Returns:
+                a Query, or None if the index is not current (caller
+                must fall back to findall)
+        """
+
+        if not self.indexed:
+            return None
+
+        db = current.db
+        itable = current.s3db.s3_hierarchy_index
+
+        tablename = self.tablename
+
+        node_ids = {node_id for node_id in node_ids if node_id is not None}
+        if not node_ids:
+            return field.belongs(set())
+
+        query = (itable.tablename == tablename) & \
+                (itable.node_id.belongs(node_ids))
+        rows = db(query).select(itable.lft,
+                                itable.rgt,
+                                orderby = itable.lft,
+                                )
+
+        # Drop ranges contained in other ranges
+        ranges = []
+        for row in rows:
+            if ranges and row.rgt <= ranges[-1][1]:
+                continue
+            ranges.append((row.lft, row.rgt))
+        if not ranges:
+            return field.belongs(set())
+
+        subquery = None
+        for lft, rgt in ranges:
+            if inclusive:
+                q = (itable.lft >= lft) & (itable.rgt <= rgt)
+            else:
+                q = (itable.lft > lft) & (itable.rgt < rgt)
+            subquery = q if subquery is None else subquery | q
+
+        subquery &= (itable.tablename == tablename)
+        return field.belongs(db(subquery)._select(itable.node_id))
+
     # -------------------------------------------------------------------------
     def read(self):
         """ Rebuild this hierarchy from the target table """
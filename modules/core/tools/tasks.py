@@ -41,6 +41,7 @@ __all__ = ("S3Task",)
 
 import datetime
 import json
+import time
 
 from gluon import current, IS_EMPTY_OR, IS_INT_IN_RANGE
 from gluon.storage import Storage
@@ -54,6 +55,16 @@ class S3Task:
 
     TASK_TABLENAME = "scheduler_task"
 
+    # Metrics for deferred tasks (per process)
+    deferred_stats = {"queued": 0,      # total number of deferred tasks
+                      "coalesced": 0,   # number of tasks merged into others
+                      "dispatched": 0,  # number of tasks passed to scheduler
+                      "executed": 0,    # number of tasks run locally
+                      "failed": 0,      # number of failed local runs
+                      "max_depth": 0,   # max queue depth per transaction
+                      "latency": 0.0,   # total latency (enqueue to start), s
+                      }
+
     # -------------------------------------------------------------------------
     def __init__(self):
 
@@ -297,6 +308,384 @@ class S3Task:
         # Return task ID so that status can be polled
         return queued.id
 
+    # -------------------------------------------------------------------------
+    def defer(self, task, args=None, vars=None, key=None, timeout=300, local=False):
+        """
+            Defer a task until after the current transaction has been
+            committed, for expensive side-effects of onaccept-hooks
+                - tasks must be idempotent
+                - tasks with the same key are coalesced within the
+                  transaction, i.e. only the last submission is run
+                - after commit, the tasks are queued in the scheduler
+                  if a worker is alive, or otherwise run locally one
+                  by one (each committed separately)
+                - local tasks are always run locally after commit, for
+                  cheap side-effects which must not be delayed
+
+            Args:
+                task: the name of the task
+                args: the list of unnamed args to send to the function
+                vars: the list of named vars to send to the function
+                key: the coalescing key (defaults to the task name
+                     with the JSON-serialized args and vars)
+                timeout: the scheduler timeout for the task
+                local: run the task locally even if a worker is alive
+
+            Returns:
+                True if the task was queued, False if it was coalesced
+                with an already-queued task
+
+            Note:
+                Outside of web requests (i.e. in CLI scripts or scheduler
+                tasks) there is no commit hook, so the task is run
+                immediately, i.e. synchronously within the transaction
+                of the caller and before the caller commits. Tasks which
+                commit (or roll back) themselves must therefore not be
+                deferred from within write paths (e.g. onaccept or DAL
+                callbacks), as they would commit the caller's transaction
+                prematurely.
+        """
+
+        if args is None:
+            args = []
+        if vars is None:
+            vars = {}
+
+        # Check that task is defined (and callable)
+        tasks = current.response.s3.tasks
+        if not tasks or not callable(tasks.get(task)):
+            return False
+
+        # Check that args/vars are JSON-serializable
+        try:
+            json_args, json_vars = json.dumps(args), json.dumps(vars)
+        except (ValueError, TypeError):
+            msg = "S3Task.defer args/vars not JSON-serializable: %s, %s" % (args, vars)
+            current.log.error(msg)
+            raise
+
+        request = current.request
+        if request.is_scheduler or request.is_shell:
+            # Not a web request => no commit hook, so run immediately
+            tasks[task](*args, **vars)
+            return True
+
+        if key is None:
+            key = (task, json_args, json_vars)
+        else:
+            key = (task, key)
+
+        stats = self.deferred_stats
+
+        queue = self._deferred()
+        coalesced = key in queue
+        queue[key] = {"task": task,
+                      "args": args,
+                      "vars": vars,
+                      "timeout": timeout,
+                      "local": local,
+                      "queued": time.time(),
+                      }
+        if coalesced:
+            stats["coalesced"] += 1
+        else:
+            stats["queued"] += 1
+            stats["max_depth"] = max(stats["max_depth"], len(queue))
+
+        return not coalesced
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """
+            Run or dispatch all deferred tasks; to be called after commit
+                - called automatically by the commit hook at the end
+                  of the web request
+
+            Returns:
+                the number of processed tasks
+        """
+
+        queue = self._deferred()
+        if not queue:
+            return 0
+
+        db = current.db
+        tasks = current.response.s3.tasks
+        stats = self.deferred_stats
+
+        # Take the jobs from the queue (in order of first submission)
+        jobs = list(queue.values())
+        queue.clear()
+
+        # Collect the jobs for tasks with batch variant
+        batches = {}
+        single = []
+        for job in jobs:
+            task = job["task"]
+            if len(job["args"]) == 1 and not job["vars"] and \
+               callable(tasks.get(self.batch_name(task))):
+                key = (task, job.get("local", False))
+                if key in batches:
+                    batches[key]["items"].append(job["args"][0])
+                else:
+                    batches[key] = {"items": [job["args"][0]],
+                                    "timeout": job["timeout"],
+                                    "queued": job["queued"],
+                                    }
+            else:
+                single.append(job)
+
+        # Dispatch to scheduler if alive, except tasks to run locally
+        alive = self._is_alive()
+        dispatched = False
+        run = []
+        for job in single:
+            if not alive or job.get("local"):
+                run.append(job)
+                continue
+            vars = dict(job["vars"])
+            try:
+                vars["user_id"] = current.auth.user.id
+            except AttributeError:
+                pass
+            self.scheduler.queue_task(job["task"],
+                                      pargs = job["args"],
+                                      pvars = vars,
+                                      application_name = "%s/default" % \
+                                                         current.request.application,
+                                      function_name = job["task"],
+                                      timeout = job["timeout"],
+                                      )
+            dispatched = True
+            stats["dispatched"] += 1
+            stats["latency"] += time.time() - job["queued"]
+        for (task, local), batch in batches.items():
+            if not alive or local:
+                run.append({"task": self.batch_name(task),
+                            "args": [batch["items"]],
+                            "vars": {},
+                            "queued": batch["queued"],
+                            })
+                continue
+            self.queue_batch(task, batch["items"], timeout=batch["timeout"])
+            dispatched = True
+            stats["dispatched"] += 1
+            stats["latency"] += time.time() - batch["queued"]
+        if dispatched:
+            db.commit()
+
+        # Run the remaining tasks locally, each in its own transaction
+        for job in run:
+            stats["latency"] += time.time() - job["queued"]
+            try:
+                tasks[job["task"]](*job["args"], **job["vars"])
+            except Exception as e:
+                db.rollback()
+                stats["failed"] += 1
+                current.log.error("Deferred task %s failed: %s" % (job["task"], e))
+            else:
+                db.commit()
+                stats["executed"] += 1
+
+        current.log.debug("S3Task: %s deferred tasks processed" % len(jobs))
+
+        processed = len(jobs)
+        if queue:
+            # Process tasks deferred by the tasks run locally
+            processed += self.flush()
+
+        return processed
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def batch_name(task):
+        """
+            The name of the batch variant of a task
+
+            Args:
+                task: the task name
+
+            Returns:
+                the name of the batch task
+        """
+
+        return "%s_batch" % task
+
+    # -------------------------------------------------------------------------
+    def queue_batch(self, task, items, window=60, timeout=300):
+        """
+            Queue items for the batch variant of a task, coalescing them
+            with a batch of the same task which is queued but not yet
+            started, rather than queuing a separate task for each item
+                - the batch variant of a task (registered as <task>_batch)
+                  receives the list of items as its only positional argument
+                - each item corresponds to the (single) positional argument
+                  of one call of the original task
+                - items are only coalesced with batches of the same user,
+                  as the batch task runs as the user who queued it
+                - falls back to running the batch synchronously if no
+                  worker is alive
+
+            Args:
+                task: the name of the original task
+                items: the list of items
+                window: the coalescing window in seconds, i.e. the delay
+                        before the batch task is started
+                timeout: the scheduler timeout for the batch task
+
+            Returns:
+                the scheduler task ID of the batch, None if the batch
+                was run synchronously, or False if the batch task is
+                not defined
+        """
+
+        batch_task = self.batch_name(task)
+
+        # Check that the batch task is defined (and callable)
+        tasks = current.response.s3.tasks
+        if not tasks or not callable(tasks.get(batch_task)):
+            return False
+
+        # Check that items are JSON-serializable
+        try:
+            json.dumps(items)
+        except (ValueError, TypeError):
+            msg = "S3Task.queue_batch items not JSON-serializable: %s" % items
+            current.log.error(msg)
+            raise
+
+        # Run synchronously if scheduler not running
+        if not self._is_alive():
+            tasks[batch_task](items)
+            return None
+
+        db = current.db
+        ttable = db.scheduler_task
+
+        now = datetime.datetime.now()
+        task_name = "%s (batch)" % task
+
+        # The batch runs as the current user
+        vars = {}
+        try:
+            vars["user_id"] = current.auth.user.id
+        except AttributeError:
+            pass
+        json_vars = json.dumps(vars)
+
+        # Find a queued batch of the same user which has not yet started
+        query = (ttable.task_name == task_name) & \
+                (ttable.function_name == batch_task) & \
+                (ttable.vars == json_vars) & \
+                (ttable.status == "QUEUED") & \
+                (ttable.next_run_time > now)
+        for _ in range(3):
+            row = db(query).select(ttable.id,
+                                   ttable.args,
+                                   orderby = ~ttable.next_run_time,
+                                   limitby = (0, 1),
+                                   ).first()
+            if not row:
+                break
+
+            # Merge the items into the batch
+            args = json.loads(row.args)
+            batch = args[0] if args else []
+            keys = {json.dumps(item) for item in batch}
+            for item in items:
+                key = json.dumps(item)
+                if key not in keys:
+                    keys.add(key)
+                    batch.append(item)
+
+            # Update only if the batch has neither started nor been
+            # extended by a concurrent request in the meantime,
+            # otherwise retry with the current args
+            update = (ttable.id == row.id) & \
+                     (ttable.status == "QUEUED") & \
+                     (ttable.args == row.args)
+            if db(update).update(args=json.dumps([batch])):
+                return row.id
+
+        # Queue a new batch
+        start_time = now + datetime.timedelta(seconds=window)
+        task_id = ttable.insert(application_name = "%s/default" % \
+                                                   current.request.application,
+                                task_name = task_name,
+                                function_name = batch_task,
+                                args = json.dumps([items]),
+                                vars = json_vars,
+                                start_time = start_time,
+                                next_run_time = start_time,
+                                timeout = timeout,
+                                )
+        return task_id
+
+    # -------------------------------------------------------------------------
+    def _deferred(self):
+        """
+            Get the queue of deferred tasks for the current request,
+            and install the commit hook to flush it
+
+            Returns:
+                the queue, a dict {key: job}
+        """
+
+        response = current.response
+        s3 = response.s3
+
+        queue = s3.deferred_tasks
+        if queue is None:
+            queue = s3.deferred_tasks = {}
+            # Chain to any previously installed commit hook
+            commit = response.custom_commit
+            response.custom_commit = lambda adapter: self._commit(adapter, commit)
+        return queue
+
+    # -------------------------------------------------------------------------
+    def _commit(self, adapter, commit=None):
+        """
+            Custom commit at the end of the request: commits the
+            transaction, then flushes the queue of deferred tasks
+
+            Args:
+                adapter: the DB adapter
+                commit: the previously installed commit hook, to
+                        commit with instead of adapter.commit
+        """
+
+        if commit:
+            commit(adapter)
+        else:
+            adapter.commit()
+        try:
+            self.flush()
+        except Exception as e:
+            # Transaction is already committed, so must not fail here
+            adapter.rollback()
+            current.log.error("S3Task: flushing deferred tasks failed: %s" % e)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def deferred_metrics(cls):
+        """
+            Get the metrics for deferred tasks, incl. the current
+            queue depth and the average latency
+
+            Returns:
+                a dict with the metrics
+        """
+
+        metrics = dict(cls.deferred_stats)
+
+        queue = current.response.s3.deferred_tasks
+        metrics["depth"] = len(queue) if queue else 0
+
+        processed = metrics["dispatched"] + metrics["executed"] + metrics["failed"]
+        metrics["avg_latency"] = metrics["latency"] / processed if processed else 0.0
+
+        return metrics
+
     # -------------------------------------------------------------------------
     def schedule_task(self,
                       task,
@@ -37,8 +37,10 @@ import datetime
 import dateutil.tz
 import re
 
+from bisect import bisect_left, bisect_right
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import DAILY, HOURLY, MONTHLY, WEEKLY, YEARLY, rrule
+from itertools import product
 
 from gluon import current
 from gluon.storage import Storage
@@ -51,9 +53,14 @@ tp_datetime = lambda year, *t: datetime.datetime(year, *t, tzinfo=dateutil.tz.tz
 tp_tzsafe = lambda dt: dt.replace(tzinfo=dateutil.tz.tzutc()) \
                        if dt and dt.tzinfo is None else dt
 
+tp_add = lambda x, y: x + y if x is not None and y is not None else None
+
 DEFAULT = lambda: None
 NUMERIC_TYPES = ("integer", "double", "id")
 
+# Units to truncate event start dates to for aggregation in the database
+TRUNCATE = ("year", "month", "day", "hour")
+
 dt_regex = Storage(
     YEAR = re.compile(r"\A\s*(\d{4})\s*\Z"),
     YEAR_MONTH = re.compile(r"\A\s*(\d{4})-([0]*[1-9]|[1][12])\s*\Z"),
@@ -81,6 +88,7 @@ class TimeSeries:
                  facts = None,
                  baseline = None,
                  title = None,
+                 aggregate = True,
                  ):
         """
             Args:
@@ -95,12 +103,16 @@ class TimeSeries:
                 facts: an array of facts (TimeSeriesFact)
                 baseline: the baseline field (field selector)
                 title: the time series title
+                aggregate: group and aggregate the events in the database
+                           where possible (see _aggregate_in_db), or look
+                           them up from a summary table (see _summarize)
         """
 
         self.resource = resource
         self.rfields = {}
 
         self.title = title
+        self.aggregate = aggregate
 
         # Resolve timestamp
         self.resolve_timestamp(event_start, event_end)
@@ -476,6 +488,9 @@ class TimeSeries:
         # Get event frame
         event_frame = self.event_frame
 
+        # Look up pre-aggregated events from a summary table if possible
+        summary = self._summarize() if self.aggregate else None
+
         # Filter by event frame start:
         if not cumulative and event_end:
             # End date of events must be after the event frame start date
@@ -515,8 +530,16 @@ class TimeSeries:
                     value += v
         event_frame.baseline = value
 
+        # Group and aggregate the events in the database if possible
+        if summary is not None:
+            events, rows_keys, cols_keys = summary
+        elif self.aggregate and self._aggregate_in_db():
+            events, rows_keys, cols_keys = self._aggregate()
+        else:
+            events = None
+
         # Extract the records
-        data = resource.select(fields)
+        data = resource.select(fields) if events is None else None
 
         # Remove the filter we just added
         rfilter = resource.rfilter
@@ -524,6 +547,13 @@ class TimeSeries:
         rfilter.query = None
         rfilter.transformed = None
 
+        if events is not None:
+            if events:
+                event_frame.extend(events)
+            self.rows_keys = rows_keys
+            self.cols_keys = cols_keys
+            return None
+
         # Do we need to convert dates into datetimes?
         if event_start.ftype == "date":
             convert_start = lambda d: datetime.datetime.fromordinal(d.toordinal())
@@ -587,6 +617,340 @@ class TimeSeries:
 
         return data
 
+    # -------------------------------------------------------------------------
+    def _aggregate_in_db(self):
+        """
+            Determine whether the events can be grouped and aggregated in
+            the database rather than extracting them one by one; this
+            requires:
+                - that all facts use count, or sum/min/max/avg of numeric
+                  fields (i.e. no cumulate)
+                - that events have no end date, or start and end are the
+                  same field (i.e. no intervals)
+                - that event start, axes and facts are real, single-valued
+                  fields (i.e. no virtual or list:type fields, no multiple
+                  components)
+                - that the resource filter can be fully resolved into
+                  a DAL query
+
+            Returns:
+                True|False
+        """
+
+        resource = self.resource
+        if resource.linked is not None or \
+           resource.get_config("postprocess_select"):
+            return False
+
+        # Filter must be fully resolvable into a DAL query
+        if resource.get_filter() is not None or \
+           resource.rfilter.get_extra_filters():
+            return False
+
+        rfields = self.rfields
+
+        # Events must be points in time or open-ended
+        event_start = rfields.get("event_start")
+        event_end = rfields.get("event_end")
+        if not event_start or \
+           event_start.ftype not in ("date", "datetime") or \
+           not event_start.is_single_valued or \
+           event_end and event_end.colname != event_start.colname:
+            return False
+
+        # Axes must be single-valued real fields
+        for axis in ("rows", "cols"):
+            rfield = rfields.get(axis)
+            if rfield and not rfield.is_single_valued:
+                return False
+
+        # Facts must be simple aggregates of single-valued real fields
+        for fact in self.facts:
+            rfield = fact.base_rfield
+            if not rfield or not rfield.is_single_valued:
+                return False
+            method = fact.method
+            if method == "count":
+                continue
+            elif method not in ("sum", "min", "max", "avg") or \
+                 rfield.ftype not in ("integer", "double", "float"):
+                return False
+
+        return True
+
+    # -------------------------------------------------------------------------
+    def _aggregate(self):
+        """
+            Group and aggregate the events in the database, by their start
+            (truncated to the largest unit that all period boundaries are
+            aligned with) and their axis values, without extracting the
+            individual records
+
+            Returns:
+                tuple (events, rows_keys, cols_keys), with events being
+                a list of TimeSeriesEvents, each representing a group of
+                events with pre-aggregated fact values (count, sum, min,
+                max) per fact column
+        """
+
+        from ..resource import S3Joins
+
+        db = current.db
+
+        resource = self.resource
+        table = resource.table
+        tablename = table._tablename
+
+        rfields = self.rfields
+
+        # The filter query
+        query = resource.get_query()
+        rfilter = resource.rfilter
+        ijoins = S3Joins(tablename, rfilter.get_joins(left=False))
+        ljoins = S3Joins(tablename, rfilter.get_joins(left=True))
+        if ijoins or ljoins:
+            # Filter joins could multiply the rows, so use a sub-select
+            subselect = db(query)._select(table._id,
+                                          join = ijoins.as_list(prefer=ljoins),
+                                          left = ljoins.as_list(),
+                                          distinct = True,
+                                          )
+            query = table._id.belongs(subselect)
+
+        # Retain the accessible-context of the parent resource
+        aqueries = {}
+        parent = resource.parent
+        if parent and parent.accessible_query is not None:
+            method = []
+            if parent._approved:
+                method.append("read")
+            if parent._unapproved:
+                method.append("review")
+            aqueries[parent.tablename] = parent.accessible_query(method,
+                                                                 parent.table,
+                                                                 )
+
+        joins = S3Joins(tablename)
+
+        # Event start, truncated if possible
+        event_start = rfields["event_start"]
+        joins.extend(event_start.left)
+        start_field = event_start.field
+        ftype = event_start.ftype
+        unit = self._truncate(ftype)
+        if unit:
+            timestamp = [start_field.year(),
+                         start_field.month(),
+                         start_field.day(),
+                         start_field.hour(),
+                         ][:TRUNCATE.index(unit) + 1]
+        else:
+            timestamp = [start_field]
+
+        # Axes (all single-valued, so joins don't multiply rows)
+        axes = []
+        for axis in ("rows", "cols"):
+            rfield = rfields.get(axis)
+            if rfield:
+                joins.extend(rfield.left)
+                axes.append(rfield.field)
+            else:
+                axes.append(None)
+        groupby = timestamp + [f for f in axes if f is not None]
+
+        # Aggregate expressions per fact column
+        expressions = {}
+        for fact in self.facts:
+            rfield = fact.base_rfield
+            joins.extend(rfield.left)
+            field = rfield.field
+            expr = expressions.get(fact.base_column)
+            if fact.method != "count":
+                expr = (field.count(), field.sum(), field.min(), field.max())
+            elif not expr:
+                expr = (field.count(),)
+            expressions[fact.base_column] = expr
+
+        fields = list(groupby)
+        for expr in expressions.values():
+            fields.extend(expr)
+
+        rows = db(query).select(groupby = groupby,
+                                left = joins.as_list(aqueries=aqueries),
+                                *fields)
+
+        # Convert the groups into events
+        events = []
+        rows_keys = set()
+        cols_keys = set()
+        point = rfields["event_end"] is not None
+        eod = datetime.time(23, 59, 59) # End of day
+        for index, row in enumerate(rows):
+
+            # Start/end date of the group
+            if unit:
+                parts = [row[expr] for expr in timestamp]
+                if parts[0] is not None:
+                    start = datetime.datetime(*(parts + [1] * (3 - len(parts))))
+                else:
+                    start = None
+            else:
+                start = row[start_field]
+                if start and ftype == "date":
+                    start = datetime.datetime.fromordinal(start.toordinal())
+            if not point or start is None:
+                end = None
+            elif ftype == "date":
+                end = datetime.datetime.combine(start.date(), eod)
+            else:
+                end = start
+
+            # Pre-aggregated values
+            aggregates = {}
+            for colname, expr in expressions.items():
+                values = [row[e] for e in expr]
+                aggregates[colname] = tuple(values + [None] * (4 - len(values)))
+
+            # Grouping keys
+            grouping = {}
+            for key, field in zip(("row", "col"), axes):
+                if field is not None:
+                    grouping[key] = row[field]
+
+            event = TimeSeriesEvent(index,
+                                    start = start,
+                                    end = end,
+                                    aggregates = aggregates,
+                                    **grouping)
+            events.append(event)
+            rows_keys |= event.rows
+            cols_keys |= event.cols
+
+        return events, rows_keys, cols_keys
+
+    # -------------------------------------------------------------------------
+    def _summarize(self):
+        """
+            Look up the events grouped and aggregated by period and axis
+            values from a materialized summary of the resource table (see
+            SummaryTable), if there is one that can answer this time series
+
+            Returns:
+                tuple (events, rows_keys, cols_keys) like _aggregate, or
+                None if no summary can answer the time series
+        """
+
+        from ..resource import SummaryTable
+
+        rfields = self.rfields
+
+        # Events must be points in time or open-ended
+        event_start = rfields.get("event_start")
+        event_end = rfields.get("event_end")
+        if not event_start or \
+           event_start.ftype not in ("date", "datetime") or \
+           event_end and event_end.colname != event_start.colname:
+            return None
+
+        # Facts must be simple aggregates
+        measures = []
+        for fact in self.facts:
+            rfield = fact.base_rfield
+            if not rfield or fact.method not in ("count", "sum", "min", "max", "avg"):
+                return None
+            measures.append(rfield.selector)
+
+        axes = [rfields.get(axis) for axis in ("rows", "cols")]
+        dimensions = [rfield.selector for rfield in axes if rfield]
+
+        ftype = event_start.ftype
+        groups = SummaryTable.lookup(self.resource,
+                                     dimensions,
+                                     measures,
+                                     timestamp = event_start.selector,
+                                     grain = self._truncate(ftype),
+                                     )
+        if groups is None:
+            return None
+
+        # Convert the groups into events
+        events = []
+        rows_keys = set()
+        cols_keys = set()
+        point = event_end is not None
+        eod = datetime.time(23, 59, 59) # End of day
+        for index, (start, values, _, partials) in enumerate(groups):
+
+            # Start/end date of the group
+            if not point or start is None:
+                end = None
+            elif ftype == "date":
+                end = datetime.datetime.combine(start.date(), eod)
+            else:
+                end = start
+
+            # Pre-aggregated values
+            aggregates = {}
+            for fact in self.facts:
+                aggregates[fact.base_column] = partials.get(fact.base_rfield.selector)
+
+            # Grouping keys
+            grouping = {}
+            values = iter(values)
+            for key, rfield in zip(("row", "col"), axes):
+                if rfield:
+                    grouping[key] = next(values)
+
+            event = TimeSeriesEvent(index,
+                                    start = start,
+                                    end = end,
+                                    aggregates = aggregates,
+                                    **grouping)
+            events.append(event)
+            rows_keys |= event.rows
+            cols_keys |= event.cols
+
+        return events, rows_keys, cols_keys
+
+    # -------------------------------------------------------------------------
+    def _truncate(self, ftype):
+        """
+            Determine the largest unit that all period boundaries of the
+            event frame are aligned with, i.e. to which event start dates
+            can be truncated without changing the periods they fall into
+
+            Args:
+                ftype: the type of the event start field
+
+            Returns:
+                the unit ("year"|"month"|"day"|"hour"), or None if event
+                start dates can not be truncated
+        """
+
+        rule = self.event_frame.rule
+        if not rule:
+            return None
+
+        # Dates can't be truncated to less than a day anyway
+        units = TRUNCATE[:2] if ftype == "date" else TRUNCATE
+
+        unit = None
+        for index, name in enumerate(units):
+            # Components of the boundaries that must be at their minimum
+            attr = ("month", "day", "hour", "minute")[index:]
+            minimum = (1, 1, 0, 0)[index:]
+            aligned = True
+            for dt in rule:
+                if dt.second or dt.microsecond or \
+                   any(getattr(dt, a) != m for a, m in zip(attr, minimum)):
+                    aligned = False
+                    break
+            if aligned:
+                unit = name
+                break
+
+        return unit
+
     # -------------------------------------------------------------------------
     @staticmethod
     def default_timestamp(table, event_end=None):
@@ -825,6 +1189,7 @@ class TimeSeriesEvent:
                  values = None,
                  row = DEFAULT,
                  col = DEFAULT,
+                 aggregates = None,
                  ):
         """
             Args:
@@ -835,6 +1200,9 @@ class TimeSeriesEvent:
                         values for the event
                 row: the series row for this event
                 col: the series column for this event
+                aggregates: for an event representing a group of events,
+                            a dict of pre-aggregated values per attribute,
+                            {key: (count, sum, min, max)}
         """
 
         self.event_id = event_id
@@ -846,6 +1214,7 @@ class TimeSeriesEvent:
             self.values = values
         else:
             self.values = {}
+        self.aggregates = aggregates
 
         self.row = row
         self.col = col
@@ -1035,7 +1404,14 @@ class TimeSeriesFact:
 
         elif base:
 
+            partials = []
             for event in events:
+                if event.aggregates is not None:
+                    # Group of events
+                    partial = event.aggregates.get(base)
+                    if partial:
+                        partials.append(partial)
+                    continue
                 value = event[base]
                 if value is None:
                     continue
@@ -1044,7 +1420,9 @@ class TimeSeriesFact:
                 else:
                     values.append(value)
 
-            if method == "count":
+            if partials:
+                result = self.merge(values, partials)
+            elif method == "count":
                 result = len(values)
             else:
                 result = self.compute(values)
@@ -1103,6 +1481,47 @@ class TimeSeriesFact:
 
         return result
 
+    # -------------------------------------------------------------------------
+    def merge(self, values, partials):
+        """
+            Aggregate a list of values together with pre-aggregated
+            values of groups of events (see TimeSeries._aggregate)
+
+            Args:
+                values: iterable of values
+                partials: iterable of tuples (count, sum, min, max)
+        """
+
+        method = self.method
+        if method == "cumulate":
+            return None
+
+        values = [v for v in values if v is not None]
+        partials = [p for p in partials if p[0]]
+
+        num = len(values) + sum(p[0] for p in partials)
+        result = None
+
+        try:
+            if method == "count":
+                result = num
+            elif method in ("sum", "avg"):
+                total = sum(values) + sum(p[1] for p in partials)
+                if method == "sum":
+                    result = total
+                elif num:
+                    result = total / float(num)
+            elif method == "min":
+                items = values + [p[2] for p in partials]
+                result = min(items) if items else None
+            elif method == "max":
+                items = values + [p[3] for p in partials]
+                result = max(items) if items else None
+        except (TypeError, ValueError):
+            result = None
+
+        return result
+
     # -------------------------------------------------------------------------
     @classmethod
     def parse(cls, fact):
@@ -1373,13 +1792,20 @@ class TimeSeriesEventFrame:
             Args:
                 events: iterable of events
 
+            Note:
+                Events are assigned to periods by a single sweep over
+                the period boundaries: each event is added as current
+                event to the periods it spans, and as previous event
+                only to the first period after its end - later periods
+                include it through their preceding period (see
+                TimeSeriesPeriod.pevents and previous_totals).
+
             TODO integrate in constructor
             TODO handle self.rule == None
         """
 
         if not events:
             return
-        empty = self.empty
 
         # Order events by start datetime
         events = sorted(events)
@@ -1394,60 +1820,52 @@ class TimeSeriesEventFrame:
         else:
             first = rule.before(start, inc=True)
 
-        current_events = {}
-        previous_events = {}
-        for start in rule.between(first, self.end, inc=True):
-
-            # Compute end of this period
-            end = rule.after(start)
-            if not end:
-                if start < self.end:
-                    end = self.end
-                else:
-                    # Period start is at the end of the event frame
-                    break
-
-            # Find all current events
-            last_index = None
-            for index, event in enumerate(events):
-                last_index = index
-                if event.end and event.end < start:
-                    # Event ended before this period
-                    previous_events[event.event_id] = event
-                elif event.start is None or event.start < end:
-                    # Event starts before or during this period
-                    current_events[event.event_id] = event
-                else:
-                    # Event starts only after this period
-                    break
+        # Period boundaries
+        end = self.end
+        starts = [dt for dt in rule.between(first, end, inc=True) if dt < end]
+        if not starts:
+            return
+        ends = starts[1:] + [end]
 
-            # Add current events to current period
+        # Get or create the periods, and link each to its predecessor
+        frame = []
+        preceding = None
+        for start, end in zip(starts, ends):
             period = periods.get(start)
             if period is None:
                 period = periods[start] = TimeSeriesPeriod(start, end=end)
-            for event in current_events.values():
-                period.add_current(event)
-            for event in previous_events.values():
-                period.add_previous(event)
-
-            empty = False
-
-            # Remaining events
-            events = events[last_index:] if last_index is not None else None
-            if not events:
-                # No more events
-                break
-
-            # Remove events which end during this period
-            remaining = {}
-            for event_id, event in current_events.items():
-                if not event.end or event.end > end:
-                    remaining[event_id] = event
-                else:
-                    previous_events[event_id] = event
-            current_events = remaining
-
-        self.empty = empty
+            if preceding is not None:
+                period.preceding = preceding
+            frame.append(period)
+            preceding = period
+
+        # Assign the events to periods
+        numperiods = len(frame)
+        for event in events:
+
+            # Event is current in all periods it overlaps
+            start, end = event.start, event.end
+            first = 0 if start is None else bisect_right(ends, start)
+            if end is None:
+                last = numperiods
+            else:
+                last = bisect_left(starts, end)
+                if last <= first < numperiods and \
+                   start is not None and starts[first] <= start <= end:
+                    # Zero-length event at the start of a period
+                    last = first + 1
+            for index in range(first, last):
+                frame[index].add_current(event)
+
+            # ...and previous in all periods starting after its end
+            if last < numperiods:
+                frame[last].add_previous(event)
+
+        # Running totals must be recomputed
+        for period in periods.values():
+            period.ptotals = {}
+
+        self.empty = False
         return
 
     # -------------------------------------------------------------------------
@@ -1492,8 +1910,14 @@ class TimeSeriesPeriod:
         self.end = tp_tzsafe(end)
 
         # Event sets
-        self.pevents = {}
         self.cevents = {}
+        self._pevents = {}
+
+        # The preceding period in the event frame (all its previous
+        # events are also previous events in this period), and the
+        # running totals of previous events per cumulative fact
+        self.preceding = None
+        self.ptotals = {}
 
         self._matrix = None
         self._rows = None
@@ -1537,7 +1961,28 @@ class TimeSeriesPeriod:
                 event: the TimeSeriesEvent
         """
 
-        self.pevents[event.event_id] = event
+        self._pevents[event.event_id] = event
+        self.ptotals = {}
+
+    # -------------------------------------------------------------------------
+    @property
+    def pevents(self):
+        """
+            All previous events in this period, including those of
+            preceding periods
+
+            Returns:
+                dict {event_id: TimeSeriesEvent}
+        """
+
+        pevents = {}
+
+        period = self
+        while period is not None:
+            pevents.update(period._pevents)
+            period = period.preceding
+
+        return pevents
 
     # -------------------------------------------------------------------------
     def as_dict(self, rows=None, cols=None, isoformat=True):
@@ -1605,7 +2050,6 @@ class TimeSeriesPeriod:
         rows = {}
         cols = {}
         matrix = {}
-        from itertools import product
         for index, events in enumerate(event_sets):
             for event_id, event in events.items():
                 for key in event.rows:
@@ -1634,6 +2078,11 @@ class TimeSeriesPeriod:
 
             Args:
                 facts: list of facts to aggregate
+
+            Note:
+                Cumulative facts add the running totals of previous
+                events (see previous_totals) to the aggregates of the
+                current events
         """
 
         # Reset
@@ -1647,65 +2096,108 @@ class TimeSeriesPeriod:
 
         if not isinstance(facts, (list, tuple)):
             facts = [facts]
-        if any(fact.method == "cumulate" for fact in facts):
-            self.group(cumulative=True)
-        else:
-            self.group()
+        self.group()
 
+        # Running totals of previous events
+        ptotals = {}
         for fact in facts:
+            if fact.method != "cumulate":
+                continue
+            previous = ptotals[fact] = self.previous_totals(fact)
 
-            method = fact.method
+            # Include the axis keys of previous events
+            for groups, keys in zip((self._rows, self._cols, self._matrix), previous):
+                for key in keys:
+                    if key not in groups:
+                        groups[key] = (set(), set())
 
-            # Select events
-            if method == "cumulate":
-                events = dict(self.pevents)
-                events.update(self.cevents)
-                cumulative = True
-            else:
-                events = self.cevents
-                cumulative = False
+        events = self.cevents
+        for fact in facts:
 
             aggregate = fact.aggregate
 
-            # Aggregate rows
-            for key, event_sets in self._rows.items():
-                event_ids = event_sets[0]
-                if cumulative:
-                    event_ids |= event_sets[1]
-                items = [events[event_id] for event_id in event_ids]
-                if key not in rows:
-                    rows[key] = [aggregate(self, items)]
-                else:
-                    rows[key].append(aggregate(self, items))
-
-            # Aggregate columns
-            for key, event_sets in self._cols.items():
-                event_ids = event_sets[0]
-                if cumulative:
-                    event_ids |= event_sets[1]
-                items = [events[event_id] for event_id in event_ids]
-                if key not in cols:
-                    cols[key] = [aggregate(self, items)]
-                else:
-                    cols[key].append(aggregate(self, items))
-
-            # Aggregate matrix
-            for key, event_sets in self._matrix.items():
-                event_ids = event_sets[0]
-                if cumulative:
-                    event_ids |= event_sets[1]
-                items = [events[event_id] for event_id in event_ids]
-                if key not in matrix:
-                    matrix[key] = [aggregate(self, items)]
-                else:
-                    matrix[key].append(aggregate(self, items))
+            previous = ptotals.get(fact)
+            if previous:
+                prows, pcols, pmatrix, ptotal = previous
+            else:
+                prows = pcols = pmatrix = ptotal = None
+
+            # Aggregate rows, columns and matrix
+            for groups, results, pvalues in ((self._rows, rows, prows),
+                                             (self._cols, cols, pcols),
+                                             (self._matrix, matrix, pmatrix),
+                                             ):
+                for key, event_sets in groups.items():
+                    items = [events[event_id] for event_id in event_sets[0]]
+                    value = aggregate(self, items)
+                    if pvalues is not None:
+                        value = tp_add(value, pvalues.get(key, 0))
+                    if key not in results:
+                        results[key] = [value]
+                    else:
+                        results[key].append(value)
 
             # Aggregate total
-            totals.append(aggregate(self, list(events.values())))
+            total = aggregate(self, list(events.values()))
+            if previous:
+                total = tp_add(total, ptotal)
+            totals.append(total)
 
         self.totals = totals
         return totals
 
+    # -------------------------------------------------------------------------
+    def previous_totals(self, fact):
+        """
+            Aggregate a cumulative fact over all previous events in this
+            period, as running totals over the preceding periods
+
+            Args:
+                fact: the TimeSeriesFact (method "cumulate")
+
+            Returns:
+                tuple (rows, cols, matrix, total), with rows, cols and
+                matrix being dicts {key: total}
+
+            Note:
+                Previous events have ended before the start of the period,
+                so they contribute the same value to all later periods
+        """
+
+        key = (fact.base_column, fact.slope_column, fact.interval)
+
+        # Find the nearest period with running totals
+        chain = []
+        period = self
+        while period is not None and key not in period.ptotals:
+            chain.append(period)
+            period = period.preceding
+        if period is not None:
+            totals = period.ptotals[key]
+        else:
+            totals = ({}, {}, {}, 0)
+
+        # Add the previous events of all subsequent periods
+        aggregate = fact.aggregate
+        for period in reversed(chain):
+            pevents = period._pevents
+            if pevents:
+                rows, cols, matrix = [dict(t) for t in totals[:3]]
+                total = totals[3]
+                for event in pevents.values():
+                    value = aggregate(period, [event])
+                    total = tp_add(total, value)
+                    for k in event.rows:
+                        rows[k] = tp_add(rows.get(k, 0), value)
+                    for k in event.cols:
+                        cols[k] = tp_add(cols.get(k, 0), value)
+                    for k in product(event.rows, event.cols):
+                        matrix[k] = tp_add(matrix.get(k, 0), value)
+                totals = (rows, cols, matrix, total)
+            period.ptotals[key] = totals
+
+        return totals
+
     # -------------------------------------------------------------------------
     def duration(self, event, interval):
         """
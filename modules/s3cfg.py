@@ -1466,6 +1466,27 @@ class S3Config(Storage):
         """
         return self.gis.get("config_screenshot")
 
+    def get_gis_screenshot_cache(self):
+        """
+            Number of seconds to reuse rendered map screenshots for
+            identical requests (same config, layers, bbox and size),
+            0 to always render
+            - cached screenshots do not reflect changes of the layer
+              data, so this should only be enabled where that is
+              acceptable
+        """
+        return self.gis.get("screenshot_cache", 0)
+
+    def get_gis_screenshot_seed(self):
+        """
+            Sizes of map screenshots to pre-render for all saved maps
+            in the scheduler (gis_screenshot_seed task)
+            - list of tuples (width, height)
+            - pre-rendered screenshots are only used if
+              settings.gis.screenshot_cache is enabled
+        """
+        return self.gis.get("screenshot_seed")
+
     def get_gis_countries(self):
         """
             Which ISO2 country codes should be accessible to the location selector?
@@ -1496,9 +1517,24 @@ class S3Config(Storage):
                 "nominatim" (default)
                 "geonames"
                 "google"
+                "gazetteer" (local lookup of gis_location names, offline)
         """
         return self.gis.get("geocode_service", "nominatim")
 
+    def get_gis_geocode_cache_ttl(self):
+        """
+            Number of days to cache Geocoder results (in gis_geocode_cache),
+            0 to disable caching
+        """
+        return self.gis.get("geocode_cache_ttl", 30)
+
+    def get_gis_geocode_rate_limit(self):
+        """
+            Maximum number of requests per second to the Geocoder Service
+            when geocoding in batches (Nominatim usage policy: 1)
+        """
+        return self.gis.get("geocode_rate_limit", 1)
+
     def get_gis_geocode_imported_addresses(self):
         """
             Should Addresses imported from CSV be passed to a
@@ -1506,6 +1542,13 @@ class S3Config(Storage):
         """
         return self.gis.get("geocode_imported_addresses", False)
 
+    def get_gis_geocode_deferred(self):
+        """
+            Geocode imported addresses in a (batch) background task
+            rather than during import (see get_gis_geocode_imported_addresses)
+        """
+        return self.gis.get("geocode_deferred", False)
+
     def get_gis_ignore_geocode_errors(self):
         """
             Whether failure to geocode imported addresses shall
@@ -1770,6 +1813,15 @@ class S3Config(Storage):
         """
         return self.gis.get("simplify_tolerance", 0.01)
 
+    def get_gis_simplify_tolerances(self):
+        """
+            Tolerances for which simplified Polygons are pre-computed
+            (multi-resolution pyramid, selected by map zoom level or bbox)
+            - e.g. (0.1, 0.01, 0.001)
+            - default empty list = disabled
+        """
+        return self.gis.get("simplify_tolerances", ())
+
     def get_gis_precision(self):
         """
             Number of Decimal places to put in output
@@ -1788,6 +1840,22 @@ class S3Config(Storage):
         else:
             return self.gis.get("spatialdb", False)
 
+    def get_gis_spatial_index(self):
+        """
+            Use an in-process spatial index (R-tree) of location bounds
+            for bbox, radius and polygon queries if the database has
+            no spatial extensions (see get_gis_spatialdb)
+        """
+        return self.gis.get("spatial_index", False)
+
+    def get_gis_vector_tiles(self):
+        """
+            Whether Feature and Theme Layers should advertise a tiled
+            vector endpoint (gis/tiles, Mapbox Vector Tiles) in addition
+            to the GeoJSON URL
+        """
+        return self.gis.get("vector_tiles", False)
+
     def get_gis_widget_catalogue_layers(self):
         """
             Should Map Widgets display Catalogue Layers?
@@ -2526,6 +2594,55 @@ class S3Config(Storage):
         """
         return self.ui.get("report_timeout", 10000)
 
+    def get_ui_report_aggregate_threshold(self):
+        """
+            Minimum number of records in a pivot table report to compute
+            the aggregates in the database rather than from the extracted
+            records (faster and less memory, but without cell exploration
+            of the contributing records), None to always extract the records
+        """
+        return self.ui.get("report_aggregate_threshold", 10000)
+
+    def get_ui_report_collapse_tail(self):
+        """
+            Compute only the top rows/columns of pivot table reports (as
+            shown in charts) in detail, and collapse all others into one
+            "Others" row/column - faster for axes with many distinct values,
+            but the table then shows only the top rows/columns
+        """
+        return self.ui.get("report_collapse_tail", False)
+
+    def get_ui_report_parallel_threshold(self):
+        """
+            Minimum number of records in a pivot table report to compute
+            the aggregates from the extracted records in parallel worker
+            processes (requires the "fork" start method), None to always
+            compute them in the request process
+
+            NB This forks the server process; if that process runs multiple
+               threads (e.g. Rocket, or uWSGI with threads), only the request
+               thread continues in the workers, and locks held by other
+               threads remain locked there - use only with single-threaded
+               server processes (e.g. uWSGI without threads)
+        """
+        return self.ui.get("report_parallel_threshold", None)
+
+    def get_ui_report_workers(self):
+        """
+            Maximum number of worker processes to compute a pivot table
+            report in parallel, None for the number of CPUs
+        """
+        return self.ui.get("report_workers", None)
+
+    def get_ui_report_cache(self):
+        """
+            Cache pivot table report data between requests, True to
+            enable with the default expiry, or the expiry in seconds;
+            - can be overridden per table with report_cache=<seconds>,
+              or report_cache=False to not cache the reports of a table
+        """
+        return self.ui.get("report_cache", False)
+
     def get_ui_use_button_icons(self):
         """
             Use icons on action buttons (requires corresponding CSS)
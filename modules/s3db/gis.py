@@ -28,6 +28,8 @@
 __all__ = ("GISLocationModel",
            "GISLocationNameModel",
            "GISLocationTagModel",
+           "GISLocationSimplifiedModel",
+           "GISGeocodeCacheModel",
            "GISLocationGroupModel",
            "GISLocationHierarchyModel",
            "GISConfigModel",
@@ -295,6 +297,10 @@ class GISLocationModel(DataModel):
                                                          filterby = "level",
                                                          filter_opts = hierarchy_level_keys,
                                                          orderby = "gis_location.name"))),
+
+                 # Journal all writes in the in-process spatial index
+                 SpatialIndex.watch(table) \
+                    if current.gis.get_spatial_index() else None,
                  ]
             )
 
@@ -459,15 +465,37 @@ class GISLocationModel(DataModel):
             db = current.db
             db(db.gis_location.id == location_id).update(path = None)
 
+        if current.response.s3.bulk and \
+           form_vars_get("addr_street") and \
+           form_vars_get("lat") is None and form_vars_get("lon") is None:
+            settings = current.deployment_settings
+            if settings.get_gis_geocode_imported_addresses() and \
+               settings.get_gis_geocode_deferred():
+                # Geocode the imported address (after commit, in batches)
+                current.s3task.defer("gis_geocode_location",
+                                     args = [location_id],
+                                     key = location_id,
+                                     )
+
         if not auth.override and \
            not auth.rollback:
-            # Update the Path (async if-possible)
+            # Update the Path (after commit, async if-possible)
             # (skip during prepop)
             feature = json.dumps({"id": location_id,
                                   "level": form_vars_get("level", False),
                                   })
-            current.s3task.run_async("gis_update_location_tree",
-                                     args = [feature],
+            current.s3task.defer("gis_update_location_tree",
+                                 args = [feature],
+                                 key = location_id,
+                                 )
+
+            if "wkt" in form.vars and \
+               current.deployment_settings.get_gis_simplify_tolerances():
+                # Update the simplified geometries (after commit),
+                # or remove them if the wkt has been cleared
+                current.s3task.defer("gis_location_simplify",
+                                     args = [location_id],
+                                     key = location_id,
                                      )
 
     # -------------------------------------------------------------------------
@@ -499,7 +527,7 @@ class GISLocationModel(DataModel):
         if addr_street and lat is None and lon is None and bulk:
 
             geocoder = settings.get_gis_geocode_imported_addresses()
-            if geocoder:
+            if geocoder and not settings.get_gis_geocode_deferred():
                 # Geocode imported addresses
                 postcode = vars_get("postcode", None)
                 # Build Path (won't be populated yet). Note get_parents will not
@@ -1376,6 +1404,84 @@ class GISLocationTagModel(DataModel):
             od[opt.id] = opt.name
         return od
 
+# =============================================================================
+class GISLocationSimplifiedModel(DataModel):
+    """
+        Simplified Geometries model
+        - pre-computed simplified versions of location geometries at
+          several tolerances (settings.gis.simplify_tolerances), so that
+          maps can use a resolution suitable for the zoom level without
+          simplifying at request time
+    """
+
+    names = ("gis_location_simplified",
+             )
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Simplified Geometries
+        # - one GeoJSON geometry per location and tolerance
+        # - maintained by GIS.update_simplified
+        #
+        tablename = "gis_location_simplified"
+        self.define_table(tablename,
+                          self.gis_location_id(empty = False,
+                                               ondelete = "CASCADE",
+                                               ),
+                          # The modified_on of the location the geometry
+                          # was computed from, to detect stale geometries
+                          Field("location_modified_on", "datetime"),
+                          Field("tolerance", "double",
+                                notnull = True,
+                                ),
+                          Field("geojson", "text"),
+                          meta = False,
+                          )
+
+        # Pass names back to global scope (s3.*)
+        return None
+
+# =============================================================================
+class GISGeocodeCacheModel(DataModel):
+    """
+        Geocoder Cache model
+        - results of geocoder lookups, to avoid repeated requests to the
+          geocoder service for the same address (e.g. in imports)
+    """
+
+    names = ("gis_geocode_cache",
+             )
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Geocoder Cache
+        # - one entry per normalized address/postcode/Lx and geocoder
+        # - maintained by GIS.geocode, entries expire after
+        #   settings.gis.geocode_cache_ttl days
+        #
+        tablename = "gis_geocode_cache"
+        self.define_table(tablename,
+                          Field("address_key", length=64,
+                                notnull = True,
+                                ),
+                          Field("geocoder"),
+                          Field("address"),
+                          Field("postcode"),
+                          Field("lat", "double"),
+                          Field("lon", "double"),
+                          # Message if no (unique) result was found
+                          Field("result"),
+                          Field("created_on", "datetime",
+                                default = current.request.utcnow,
+                                ),
+                          meta = False,
+                          )
+
+        # Pass names back to global scope (s3.*)
+        return None
+
 # =============================================================================
 class GISLocationGroupModel(DataModel):
     """
@@ -2056,6 +2162,12 @@ class GISConfigModel(DataModel):
             # msg_record_deleted = T("Menu Entry deleted"),
             # msg_list_empty = T("No Menu Entries currently defined"))
 
+        # Invalidate cached map configurations on writes
+        MapConfigCache.watch(db.gis_config,
+                             db.gis_marker,
+                             db.gis_projection,
+                             )
+
         # Pass names back to global scope (s3.*)
         return {"gis_config_form_setup": self.gis_config_form_setup,
                 "gis_config_id": config_id,
@@ -2288,14 +2400,14 @@ class GISConfigModel(DataModel):
             settings = current.deployment_settings
             screenshot = settings.get_gis_config_screenshot()
             if screenshot is not None:
-                # Save a screenshot
-                width = screenshot[0]
-                height = screenshot[1]
-                filename = current.gis.get_screenshot(config_id,
-                                                      False,
-                                                      height,
-                                                      width)
-                db(db.gis_config.id == config_id).update(image=filename)
+                # Save a screenshot (after commit, async if-possible),
+                # rendered with the permissions of the current user
+                user_id = auth.user.id if auth.user else None
+                current.s3task.defer("gis_config_screenshot",
+                                     args = [config_id],
+                                     vars = {"user_id": user_id},
+                                     key = config_id,
+                                     )
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -2754,6 +2866,13 @@ class GISLayerEntityModel(DataModel):
             msg_list_empty = T("No Map Styles currently defined")
         )
 
+        # Invalidate cached map configurations on writes
+        db = current.db
+        MapConfigCache.watch(db.gis_layer_entity,
+                             db.gis_layer_config,
+                             db.gis_style,
+                             )
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         return {"gis_layer_types": layer_types,
@@ -2898,6 +3017,13 @@ class GISFeatureLayerModel(DataModel):
                                               _title="%s|%s /" % (T("Function"),
                                                                   T("Part of the URL to call to access the Features"))),
                                 ),
+                          Field("tablename", length=64,
+                                label = T("Table"),
+                                requires = IS_EMPTY_OR(IS_LENGTH(64)),
+                                comment = DIV(_class="tooltip",
+                                              _title="%s|%s" % (T("Table"),
+                                                                T("The database table holding the Features (required for Vector Tiles)"))),
+                                ),
                           Field("filter",
                                 label = T("Filter"),
                                 comment = DIV(_class="stickytip",
@@ -3013,6 +3139,9 @@ class GISFeatureLayerModel(DataModel):
                        super_entity = "gis_layer_entity",
                        )
 
+        # Invalidate cached map configurations on writes
+        MapConfigCache.watch(current.db.gis_layer_feature)
+
         # Pass names back to global scope (s3.*)
         return None
 
@@ -4065,6 +4194,11 @@ class GISMapModel(DataModel):
                            ),
                      )
 
+        # Invalidate cached map configurations on writes
+        db = current.db
+        MapConfigCache.watch(*[db[tn] for tn in self.names
+                                      if tn.startswith("gis_layer_")])
+
         # Pass names back to global scope (s3.*)
         return None
 
@@ -4536,6 +4670,9 @@ class GISThemeModel(DataModel):
             msg_list_empty = T("No Data currently defined for this Theme Layer")
         )
 
+        # Invalidate cached map configurations on writes
+        MapConfigCache.watch(current.db.gis_layer_theme)
+
         # Pass names back to global scope (s3.*)
         return {"gis_layer_theme_id": layer_theme_id,
                 }
@@ -26,6 +26,7 @@
 """
 
 __all__ = ("S3HierarchyModel",
+           "S3SummaryModel",
            "S3DashboardModel",
            "S3ImportJobModel",
            "S3DynamicTablesModel",
@@ -43,6 +44,7 @@ class S3HierarchyModel(DataModel):
     """ Model for stored object hierarchies """
 
     names = ("s3_hierarchy",
+             "s3_hierarchy_index",
              )
 
     def model(self):
@@ -57,10 +59,93 @@ class S3HierarchyModel(DataModel):
                                 default = False,
                                 ),
                           Field("hierarchy", "json"),
+                          # Fingerprint of the hierarchical table at the
+                          # time the subtree index was built (None = no index)
+                          Field("index_version", length=128),
                           *MetaFields.timestamps(),
                           meta = False,
                           )
 
+        # ---------------------------------------------------------------------
+        # Subtree Index (nested set numbers)
+        #
+        tablename = "s3_hierarchy_index"
+        self.define_table(tablename,
+                          Field("tablename", length=64),
+                          Field("node_id", "integer"),
+                          Field("lft", "integer"),
+                          Field("rgt", "integer"),
+                          meta = False,
+                          )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return None
+
+    # -------------------------------------------------------------------------
+    def defaults(self):
+        """ Safe defaults if module is disabled """
+
+        return None
+
+# =============================================================================
+class S3SummaryModel(DataModel):
+    """ Model for materialized summary tables (see SummaryTable) """
+
+    names = ("s3_summary",
+             "s3_summary_data",
+             )
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Summary Table
+        #
+        tablename = "s3_summary"
+        self.define_table(tablename,
+                          Field("tablename", length=64),
+                          Field("name", length=64),
+                          # Unique key "tablename.name"
+                          Field("summary_key", length=160,
+                                notnull = True,
+                                unique = True,
+                                ),
+                          # The definition the summary data have been built with
+                          Field("definition", "json"),
+                          # Summary must be rebuilt
+                          Field("dirty", "boolean",
+                                default = False,
+                                ),
+                          # Time of the last refresh (for delta refreshes)
+                          Field("refreshed_on", "datetime"),
+                          # Time of the first write not yet included in the
+                          # summary (None = no refresh pending)
+                          Field("pending", "datetime"),
+                          *MetaFields.timestamps(),
+                          meta = False,
+                          )
+
+        # ---------------------------------------------------------------------
+        # Summary Data
+        #
+        tablename = "s3_summary_data"
+        self.define_table(tablename,
+                          Field("summary_id", "reference s3_summary",
+                                ondelete = "CASCADE",
+                                ),
+                          # Start of the period (None = no time axis)
+                          Field("period", "datetime"),
+                          # Values of the dimension fields
+                          Field("dimensions", "json"),
+                          # Number of records
+                          Field("records", "integer"),
+                          # Partial aggregates of the measure fields,
+                          # {fieldname: [count, sum, min, max]}
+                          Field("measures", "json"),
+                          meta = False,
+                          )
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
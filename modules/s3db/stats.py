@@ -31,6 +31,7 @@ __all__ = ("StatsParameterModel",
            "StatsDemographicModel",
            "StatsImpactModel",
            "StatsPeopleModel",
+           "stats_Rollup",
            "stats_demographic_data_controller",
            "stats_quantile",
            "stats_year",
@@ -43,6 +44,7 @@ import json
 
 from gluon import *
 from gluon.storage import Storage
+from s3dal import Row
 
 from ..core import *
 from core.ui.layouts import PopupLink
@@ -278,7 +280,6 @@ class StatsDemographicModel(DataModel):
              "stats_demographic_id",
              "stats_demographic_rebuild_all_aggregates",
              "stats_demographic_update_aggregates",
-             "stats_demographic_update_location_aggregate",
              )
 
     def model(self):
@@ -456,6 +457,7 @@ class StatsDemographicModel(DataModel):
                                                     )
                                  )
 
+        rollup = stats_Rollup(tablename)
         configure(tablename,
                   deduplicate = S3Duplicate(primary = ("parameter_id",
                                                        "location_id",
@@ -464,14 +466,17 @@ class StatsDemographicModel(DataModel):
                                             ),
                   filter_widgets = filter_widgets,
                   list_fields = list_fields,
-                  # @ToDo: Wrapper function to call this for the record linked
-                  # to the relevant place depending on whether approval is
-                  # required or not. Disable when auth.override is True.
-                  #onaccept = self.stats_demographic_update_aggregates,
-                  #onapprove = self.stats_demographic_update_aggregates,
+                  onaccept = rollup.onaccept,
+                  onapprove = rollup.onaccept,
+                  ondelete = rollup.ondelete,
                   report_options = report_options,
                   # @ToDo: deployment_setting
                   requires_approval = True,
+                  rollup = {"aggregate": "stats_demographic_aggregate",
+                            "period": "year",
+                            "method": "latest",
+                            "total": "stats_demographic.total_id",
+                            },
                   super_entity = "stats_data",
                   # If using dis-aggregated data
                   #timeplot_options = {"defaults": {"event_start": "date",
@@ -573,7 +578,6 @@ class StatsDemographicModel(DataModel):
         return {"stats_demographic_id": demographic_id,
                 "stats_demographic_rebuild_all_aggregates": self.stats_demographic_rebuild_all_aggregates,
                 "stats_demographic_update_aggregates": self.stats_demographic_update_aggregates,
-                "stats_demographic_update_location_aggregate": self.stats_demographic_update_location_aggregate,
                 }
 
     # -------------------------------------------------------------------------
@@ -588,611 +592,49 @@ class StatsDemographicModel(DataModel):
     def stats_demographic_rebuild_all_aggregates():
         """
             This will delete all the stats_demographic_aggregate records and
-            then rebuild them by triggering off a request for each
-            stats_demographic_data record.
+            then rebuild them from the stats_demographic_data (async).
 
             This function is normally only run during prepop or postpop so we
             don't need to worry about the aggregate data being unavailable for
             any length of time
         """
 
-        # Check to see whether an existing task is running and if it is then kill it
-        db = current.db
-        ttable = db.scheduler_task
-        rtable = db.scheduler_run
-        wtable = db.scheduler_worker
-        query = (ttable.task_name == "stats_demographic_update_aggregates") & \
-                (rtable.task_id == ttable.id) & \
-                (rtable.status == "RUNNING")
-        rows = db(query).select(rtable.id,
-                                rtable.task_id,
-                                rtable.worker_name)
-        now = current.request.utcnow
-        for row in rows:
-            db(wtable.worker_name == row.worker_name).update(status="KILL")
-            db(rtable.id == row.id).update(stop_time=now,
-                                           status="STOPPED")
-            db(ttable.id == row.task_id).update(stop_time=now,
-                                                status="STOPPED")
-
-        # Delete the existing aggregates
-        current.s3db.stats_demographic_aggregate.truncate()
-
-        # Read all the approved stats_demographic_data records
-        dtable = db.stats_demographic
-        ddtable = db.stats_demographic_data
-        query = (ddtable.deleted != True) & \
-                (ddtable.parameter_id == dtable.parameter_id) & \
-                (ddtable.approved_by != None)
-        # @ToDo: deployment_setting for whether records need to be approved
-        #   query &= (ddtable.approved_by != None)
-        records = db(query).select(ddtable.data_id,
-                                   ddtable.parameter_id,
-                                   ddtable.date,
-                                   ddtable.location_id,
-                                   ddtable.value,
-                                   dtable.total_id,
-                                   )
-
-        # Fire off a rebuild task
-        current.s3task.run_async("stats_demographic_update_aggregates",
-                                 vars = {"records": records.json()},
-                                 timeout = 21600 # 6 hours
-                                 )
-
-    # -------------------------------------------------------------------------
-    @staticmethod
-    def stats_demographic_aggregated_period(data_date=None):
-        """
-            This will return the start and end dates of the aggregated time
-            period.
-
-            Currently the time period is annually so it will return the start
-            and end of the current year.
-        """
-
-        date = datetime.date
-        if data_date is None:
-            data_date = date.today()
-        year = data_date.year
-        soap = date(year, 1, 1)
-        eoap = date(year, 12, 31)
-        return (soap, eoap)
+        stats_Rollup("stats_demographic_data").rebuild_async()
 
     # -------------------------------------------------------------------------
     @staticmethod
     def stats_demographic_update_aggregates(records=None):
         """
-            This will calculate the stats_demographic_aggregates for the
-            specified records. Either all (when rebuild_all is invoked) or for
-            the individual parameter(s) at the specified location(s) when run
-            onapprove - which currently happens inside the vulnerability
-            approve_report() controller.
-            @ToDo: onapprove/onaccept wrapper function for other workflows.
-
-            This will get the raw data from stats_demographic_data and generate
-            a stats_demographic_aggregate record for the given time period.
-
-            The reason for doing this is so that all aggregated data can be
-            obtained from a single table. So when displaying data for a
-            particular location it will not be necessary to try the aggregate
-            table, and if it's not there then try the data table. Rather just
-            look at the aggregate table.
+            This will update the stats_demographic_aggregates for the
+            specified records, i.e. for the parameter(s) at the specified
+            location(s) and all their ancestors, from the time period of
+            the record onwards; called onapprove - which currently happens
+            inside the vulnerability approve_report() controller.
 
             Once this has run then a complete set of aggregate records should
             exists for this parameter_id and location for every time period from
             the first data item until the current time period.
 
-            @ToDo: Add test cases to modules/unit_tests/s3db/stats.py
+            Args:
+                records: the stats_demographic_data records (Rows, or
+                         Rows as JSON)
         """
 
         if not records:
             return
 
-        from dateutil.rrule import rrule, YEARLY
-
-        db = current.db
-        s3db = current.s3db
-        dtable = s3db.stats_demographic_data
-        atable = db.stats_demographic_aggregate
-        gtable = db.gis_location
-
-        # Data Structures used for the OPTIMISATION
-        param_total_dict = {} # the total_id for each parameter
-        param_location_dict = {} # a list of locations for each parameter
-        location_dict = {} # a list of locations
-        loc_level_list = {} # a list of levels for each location
-
-        aggregated_period = StatsDemographicModel.stats_demographic_aggregated_period
-        (last_period, year_end) = aggregated_period(None)
-
-        # Test to see which date format we have based on how we were called
         if isinstance(records, str):
-            from_json = True
-            from dateutil.parser import parse
             records = json.loads(records)
-        elif isinstance(records[0]["stats_demographic_data"]["date"],
-                        (datetime.date, datetime.datetime)):
-            from_json = False
-        else:
-            from_json = True
-            from dateutil.parser import parse
 
+        items = []
         for record in records:
-            total_id = record["stats_demographic"]["total_id"]
-            record = record["stats_demographic_data"]
-            data_id = record["data_id"]
-            location_id = record["location_id"]
-            parameter_id = record["parameter_id"]
-            # Skip if either the location or the parameter is not valid
-            if not location_id or not parameter_id:
-                current.log.warning("Skipping bad stats_demographic_data record with data_id %s " % data_id)
-                continue
-            if total_id and parameter_id not in param_total_dict:
-                param_total_dict[parameter_id] = total_id
-            if from_json:
-                date = parse(record["date"]) # produces a datetime
-                date = date.date()
-            else:
-                date = record["date"]
-            (start_date, end_date) = aggregated_period(date)
-
-            # Get all the approved stats_demographic_data records for this location and parameter
-            query = (dtable.location_id == location_id) & \
-                    (dtable.deleted != True) & \
-                    (dtable.approved_by != None)
-            # @ToDo: deployment_setting for whether records need to be approved
-            #   query &= (dtable.approved_by != None)
-            fields = [dtable.data_id,
-                      dtable.date,
-                      dtable.value,
-                      ]
-            if total_id:
-                # Also get the records for the Total to use to calculate the percentage
-                query &= (dtable.parameter_id.belongs([parameter_id, total_id]))
-                fields.append(dtable.parameter_id)
-            else:
-                percentage = None
-                query &= (dtable.parameter_id == parameter_id)
-            data_rows = db(query).select(*fields)
-
-            if total_id:
-                # Separate out the rows relating to the Totals
-                total_rows = data_rows.exclude(lambda row: row.parameter_id == total_id)
-                # Get each record and store them in a dict keyed on the start date
-                # of the aggregated period. If a record already exists for the
-                # reporting period then the most recent value will be stored.
-                earliest_period = current.request.utcnow.date()
-                end_date = year_end
-                totals = {}
-                for row in total_rows:
-                    row_date = row.date
-                    (start_date, end_date) = aggregated_period(row_date)
-                    if start_date in totals:
-                        if row_date <= totals[start_date]["date"]:
-                            # The indicator in the row is of the same time period as
-                            # another which is already stored in totals but it is earlier
-                            # so ignore this particular record
-                            continue
-                    elif start_date < earliest_period:
-                        earliest_period = start_date
-                    # Store the record from the db in the totals storage
-                    totals[start_date] = Storage(date = row_date,
-                                                 id = row.data_id,
-                                                 value = row.value)
-
-            # Get each record and store them in a dict keyed on the start date
-            # of the aggregated period. If a record already exists for the
-            # reporting period then the most recent value will be stored.
-            earliest_period = start_date
-            end_date = year_end
-            data = {}
-            data[start_date] = Storage(date = date,
-                                       id = data_id,
-                                       value = record["value"])
-            for row in data_rows:
-                if row.data_id == data_id:
-                    # This is the record we started with, so skip
-                    continue
-                row_date = row.date
-                (start_date, end_date) = aggregated_period(row_date)
-                if start_date in data:
-                    if row_date <= data[start_date]["date"]:
-                        # The indicator in the row is of the same time period as
-                        # another which is already stored in data but it is earlier
-                        # so ignore this particular record
-                        continue
-                elif start_date < earliest_period:
-                    earliest_period = start_date
-                # Store the record from the db in the data storage
-                data[start_date] = Storage(date = row_date,
-                                           id = row.data_id,
-                                           value = row.value)
-
-            # Get all the aggregate records for this parameter and location
-            query = (atable.location_id == location_id) & \
-                    (atable.parameter_id == parameter_id)
-            aggr_rows = db(query).select(atable.id,
-                                         atable.agg_type,
-                                         atable.date,
-                                         atable.end_date,
-                                         atable.sum,
-                                         )
-
-            aggr = {}
-            for row in aggr_rows:
-                (start_date, end_date) = aggregated_period(row.date)
-                aggr[start_date] = Storage(id = row.id,
-                                           type = row.agg_type,
-                                           end_date = row.end_date,
-                                           sum = row.sum,
-                                           )
-
-            # Step through each period and check that aggr is correct
-            last_type_agg = False # Whether the type of previous non-copy record was aggr
-            last_data_value = None # The value of the previous aggr record
-            last_total = None # The value of the previous aggr record for the totals param
-            # Keep track of which periods the aggr record has been changed in
-            # the database
-            changed_periods = []
-            for dt in rrule(YEARLY, dtstart=earliest_period, until=last_period):
-                # Calculate the end of the dt period.
-                # - it will be None if this is the last period
-                dt = dt.date()
-                if dt != last_period:
-                    (start_date, end_date) = aggregated_period(dt)
-                else:
-                    start_date = dt
-                    end_date = None
-                if dt in aggr:
-                    # Check that the stored aggr data is correct
-                    agg_type = aggr[dt]["type"]
-                    if agg_type == 2:
-                        # This is built using other location aggregates
-                        # so it can be ignored because only time or copy aggregates
-                        # are being calculated in this function
-                        last_type_agg = True
-                        last_data_value = aggr[dt]["sum"]
-                        continue
-                    # Query to use to update aggr records
-                    query = (atable.id == aggr[dt]["id"])
-                    if agg_type == 3:
-                        # This is a copy aggregate
-                        if dt in data:
-                            # There is data in the data dictionary for this period
-                            # so aggregate record needs to be changed
-                            value = data[dt]["value"]
-                            last_data_value = value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 1, # time
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                        elif last_type_agg:
-                            # No data in the data dictionary and the last type was aggr
-                            continue
-                        # Check that the data currently stored is correct
-                        elif aggr[dt]["sum"] != last_data_value:
-                            value = last_data_value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 3, # copy
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                    elif agg_type == 1:
-                        # The value in the aggr should match the value in data
-                        if dt in data:
-                            value = data[dt]["value"]
-                            last_data_value = value
-                            if total_id and dt in totals:
-                                last_total = totals[dt]["value"]
-                            if aggr[dt]["sum"] != value:
-                                if total_id and last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                                db(query).update(agg_type = 1, # time
-                                                 #reported_count = 1, # one record
-                                                 #ward_count = 1, # one ward
-                                                 end_date = end_date,
-                                                 percentage = percentage,
-                                                 sum = value,
-                                                 #min = value,
-                                                 #max = value,
-                                                 #mean = value,
-                                                 #median = value,
-                                                 )
-                                changed_periods.append((start_date, end_date))
-                        else:
-                            # The data is not there so it must have been deleted
-                            # Copy the value from the previous record
-                            value = last_data_value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 3, # copy
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                # No aggregate record for this time period exists
-                # So one needs to be inserted
-                else:
-                    if dt in data:
-                        value = data[dt]["value"]
-                        agg_type = 1 # time
-                        last_data_value = value
-                    else:
-                        value = last_data_value
-                        agg_type = 3 # copy
-                    if total_id:
-                        if dt in totals:
-                            last_total = totals[dt]["value"]
-                        if last_total:
-                            percentage = 100 * value / last_total
-                            percentage = round(percentage, 3)
-                    atable.insert(parameter_id = parameter_id,
-                                  location_id = location_id,
-                                  agg_type = agg_type,
-                                  #reported_count = 1, # one record
-                                  #ward_count = 1, # one ward
-                                  date = start_date,
-                                  end_date = end_date,
-                                  percentage = percentage,
-                                  sum = value,
-                                  #min = value,
-                                  #max = value,
-                                  #mean = value,
-                                  #median = value,
-                                  )
-                    changed_periods.append((start_date, end_date))
-            # End of loop through each time period
-
-            if changed_periods == []:
-                continue
-            # The following structures are used in the OPTIMISATION step later
-            location = db(gtable.id == location_id).select(gtable.level,
-                                                           limitby=(0, 1)
-                                                           ).first()
-            loc_level_list[location_id] = location.level
-            if parameter_id not in param_location_dict:
-                param_location_dict[parameter_id] = {location_id : changed_periods}
-            elif location_id not in param_location_dict[parameter_id]:
-                param_location_dict[parameter_id][location_id] = changed_periods
-            else:
-                # Store the older of the changed periods (the end will always be None)
-                # Only need to check the start date of the first period
-                if changed_periods[0][0] < param_location_dict[parameter_id][location_id][0][0]:
-                    param_location_dict[parameter_id][location_id] = changed_periods
-            if location_id not in location_dict:
-                location_dict[location_id] = changed_periods
-            else:
-                # Store the older of the changed periods (the end will always be None)
-                # Only need to check the start date of the first period
-                if changed_periods[0][0] < location_dict[location_id][0][0]:
-                    location_dict[location_id] = changed_periods
-
-        # End of loop through each stats_demographic_data record
-
-        # OPTIMISATION
-        # The following code will get all the locations for which a parameter
-        # has been changed. This will remove duplicates which will occur when
-        # items are being imported for many communes in the same district.
-        # Take an import of 12 communes in the same district, without this the
-        # district will be updated 12 times, the province will be updated 12
-        # times and the country will be updated 12 times that is 33 unnecessary
-        # updates (for each time period) (i.e. 15 updates rather than 48)
-
-        # Get all the parents
-        # @ToDo: Optimise by rewriting as custom routine rather than using this wrapper
-        # - we only need immediate children not descendants, so can use parent not path
-        # - look at disease_stats_update_aggregates()
-        parents = {}
-        get_parents = current.gis.get_parents
-        for loc_id in location_dict.keys():
-            _parents = get_parents(loc_id)
-            if parents:
-                parents[loc_id] = _parents
-        # Expand the list of locations for each parameter
-        parents_data = {}
-        for (param_id, loc_dict) in param_location_dict.items():
-            for (loc_id, periods) in loc_dict.items():
-                if loc_id in parents: # There won't be a parent if this is a L0
-                    for p_loc_row in parents[loc_id]:
-                        p_loc_id = p_loc_row.id
-                        if param_id in parents_data:
-                            if p_loc_id in parents_data[param_id]:
-                                # Store the older of the changed periods (the end will always be None)
-                                # Only need to check the start date of the first period
-                                if periods[0][0] < parents_data[param_id][p_loc_id][0][0][0]:
-                                    parents_data[param_id][p_loc_id][0] = periods
-                            else:
-                                parents_data[param_id][p_loc_id] = [periods,
-                                                                    loc_level_list[loc_id]
-                                                                    ]
-                        else:
-                            parents_data[param_id] = {p_loc_id : [periods,
-                                                                  loc_level_list[loc_id]
-                                                                  ]
-                                                      }
-
-        # Now that the time aggregate types have been set up correctly,
-        # fire off requests for the location aggregates to be calculated
-        run_async = current.s3task.run_async
-        for (param_id, loc_dict) in parents_data.items():
-            total_id = param_total_dict[param_id]
-            for (loc_id, (changed_periods, loc_level)) in loc_dict.items():
-                for (start_date, end_date) in changed_periods:
-                    s, e = str(start_date), str(end_date)
-                    run_async("stats_demographic_update_aggregate_location",
-                              args = [loc_level, loc_id, param_id, total_id, s, e],
-                              timeout = 1800 # 30m
-                              )
-
-    # -------------------------------------------------------------------------
-    @staticmethod
-    def stats_demographic_update_location_aggregate(location_level,
-                                                    location_id,
-                                                    parameter_id,
-                                                    total_id,
-                                                    start_date,
-                                                    end_date
-                                                    ):
-        """
-            Calculates the stats_demographic_aggregate for a specific parameter at a
-            specific location.
-
-            Args:
-                location_id: the location record ID
-                parameter_id: the parameter record ID
-                total_id: the parameter record ID for the percentage calculation
-                start_date: the start date of the time period (as string)
-                end_date: the end date of the time period (as string)
-        """
-
-        db = current.db
-        dtable = current.s3db.stats_demographic_data
-        atable = db.stats_demographic_aggregate
-
-        # Get all the child locations (immediate children only, not all descendants)
-        child_locations = current.gis.get_children(location_id, location_level)
-        child_ids = [row.id for row in child_locations]
-
-        # Get the most recent stats_demographic_data record for all child locations
-        query = (dtable.parameter_id == parameter_id) & \
-                (dtable.deleted != True) & \
-                (dtable.location_id.belongs(child_ids)) & \
-                (dtable.approved_by != None)
-        # @ToDo: deployment_setting for whether records need to be approved
-        #   query &= (dtable.approved_by != None)
-        if end_date == "None": # converted to string as async parameter
-            end_date = None
-        else:
-            query &= (dtable.date <= end_date)
-        rows = db(query).select(dtable.value,
-                                dtable.date,
-                                dtable.location_id,
-                                orderby=(dtable.location_id, ~dtable.date),
-                                # groupby avoids duplicate records for the same
-                                # location, but is slightly slower than just
-                                # skipping the duplicates in the loop below
-                                #groupby=(dtable.location_id)
-                                )
-
-        # Get the most recent aggregate for this location for the total parameter
-        #if total_id == "None": # converted to string as async parameter
-        #    total_id = None
-        values_total = None
-        if total_id != "None":
-            query = (dtable.parameter_id == total_id)
-            if end_date:
-                query &= (dtable.date <= end_date)
-            total_row = db(query).select(dtable.value,
-                                         limitby = (0, 1),
-                                         orderby = ~dtable.date,
-                                         ).first()
-            if total_row:
-                values_total = total_row.value
-
-        # Collect the values, skip duplicate records for the
-        # same location => use the most recent one, which is
-        # the first row for each location as per the orderby
-        # in the query above
-        last_location = None
-        values = []
-        append = values.append
-        for row in rows:
-            new_location_id = row.location_id
-            if new_location_id != last_location:
-                last_location = new_location_id
-                append(row.value)
-
-        # Aggregate the values
-        values_len = len(values)
-        if not values_len:
-            return
+            record = record.get("stats_demographic_data", record)
+            items.append((record["parameter_id"],
+                          record["location_id"],
+                          record["date"],
+                          ))
 
-        values_sum = sum(values)
-        #values_min = min(values)
-        #values_max = max(values)
-        #values_avg = float(values_sum) / values_len
-
-        if values_total:
-            percentage = 100 * values_sum / values_total
-            values_percentage = round(percentage, 3)
-        else:
-            values_percentage = None
-
-        #from numpy import median
-        #values_med = median(values)
-        #values_mad = median([abs(v - values_med) for v in values])
-
-        # Add or update the aggregated values in the database
-
-        # Do we already have a record?
-        query = (atable.location_id == location_id) & \
-                (atable.parameter_id == parameter_id) & \
-                (atable.date == start_date) & \
-                (atable.end_date == end_date)
-        exists = db(query).select(atable.id, limitby=(0, 1)).first()
-
-        attr = {"agg_type": 2, # Location
-                #"reported_count": values_len,
-                #"ward_count": len(child_ids),
-                #"min": values_min,
-                #"max": values_max,
-                #"mean": values_avg,
-                #"median": values_med,
-                #"mad": values_mad,
-                "sum": values_sum,
-                "percentage": values_percentage,
-                }
-        if exists:
-            # Update
-            db(query).update(**attr)
-        else:
-            # Insert new
-            atable.insert(parameter_id = parameter_id,
-                          location_id = location_id,
-                          date = start_date,
-                          end_date = end_date,
-                          **attr
-                          )
+        stats_Rollup("stats_demographic_data").update(items)
 
 # =============================================================================
 def stats_demographic_data_controller():
@@ -1677,6 +1119,941 @@ def stats_year_options(tablename):
         years[year] = year
     return years
 
+# =============================================================================
+class stats_Rollup:
+    """
+        Pre-aggregated rollup of stats data per parameter, location and
+        period, configured for the stats data table like:
+
+            configure("stats_demographic_data",
+                      rollup = {"aggregate": "stats_demographic_aggregate",
+                                "period": "year",
+                                "method": "latest",
+                                "total": "stats_demographic.total_id",
+                                },
+                      )
+
+            - aggregate: the aggregate table, with the fields parameter_id,
+                         location_id, agg_type, date and sum, and optionally
+                         end_date and percentage
+            - period: the aggregation period ("year"|"month"|"day")
+            - method: "latest" to use the most recent value in each period,
+                      carried forward into subsequent periods without data,
+                      or "cumulative" to use the sum of all values up to
+                      the end of each period
+            - total: the field linking a parameter to the parameter that
+                     represents its total, to compute percentages
+                     (tablename.fieldname)
+
+        The aggregates of a location are computed from its own data, or -
+        if it has no data of its own - by summing up the aggregates of its
+        immediate children. Data changes are applied incrementally: the
+        aggregates of the location are recomputed from the changed period
+        on, and the differences (deltas) added to all its ancestors at once.
+        A full rebuild computes the aggregates of all locations with data,
+        and then level by level up the location hierarchy.
+    """
+
+    # Aggregate types
+    TIME = 1        # from the location's own data
+    LOCATION = 2    # sum of the immediate child locations
+    COPY = 3        # carried forward from the previous period
+
+    def __init__(self, tablename):
+        """
+            Args:
+                tablename: the name of the stats data table
+        """
+
+        self.tablename = tablename
+
+        self._config = None
+        self._table = None
+        self._atable = None
+
+    # -------------------------------------------------------------------------
+    @property
+    def config(self):
+        """
+            The rollup configuration of the data table (with defaults)
+        """
+
+        config = self._config
+        if config is None:
+            config = {"period": "year",
+                      "method": "latest",
+                      }
+            custom = current.s3db.get_config(self.tablename, "rollup")
+            if custom:
+                config.update(custom)
+            self._config = config
+
+        return config
+
+    # -------------------------------------------------------------------------
+    @property
+    def table(self):
+        """
+            The stats data table
+        """
+
+        table = self._table
+        if table is None:
+            table = self._table = current.s3db.table(self.tablename)
+        return table
+
+    # -------------------------------------------------------------------------
+    @property
+    def atable(self):
+        """
+            The aggregate table
+        """
+
+        atable = self._atable
+        if atable is None:
+            aggregate = self.config.get("aggregate")
+            atable = self._atable = current.s3db.table(aggregate)
+        return atable
+
+    # -------------------------------------------------------------------------
+    # Periods
+    # -------------------------------------------------------------------------
+    def period(self, date):
+        """
+            Determines the aggregation period of a date
+
+            Args:
+                date: the date
+
+            Returns:
+                tuple (start, end) of the period
+        """
+
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+
+        unit = self.config["period"]
+        if unit == "year":
+            start = datetime.date(date.year, 1, 1)
+            end = datetime.date(date.year, 12, 31)
+        elif unit == "month":
+            start = date.replace(day=1)
+            end = self.next_period(start) - datetime.timedelta(days=1)
+        else:
+            start = end = date
+
+        return start, end
+
+    # -------------------------------------------------------------------------
+    def next_period(self, start):
+        """
+            Determines the start of the period following a period
+
+            Args:
+                start: the start date of the period
+
+            Returns:
+                the start date of the next period
+        """
+
+        unit = self.config["period"]
+        if unit == "year":
+            start = datetime.date(start.year + 1, 1, 1)
+        elif unit == "month":
+            if start.month == 12:
+                start = datetime.date(start.year + 1, 1, 1)
+            else:
+                start = datetime.date(start.year, start.month + 1, 1)
+        else:
+            start = start + datetime.timedelta(days=1)
+
+        return start
+
+    # -------------------------------------------------------------------------
+    # Aggregation
+    # -------------------------------------------------------------------------
+    def series(self, values, start=None, base=None):
+        """
+            Computes the aggregates of a location from its own data
+
+            Args:
+                values: list of tuples (date, value), ordered by date
+                start: the first period to compute (start date),
+                       defaults to the period of the first value
+                base: the aggregate value of the period before start,
+                      if the location has data before start
+
+            Returns:
+                dict {start date of period: (agg_type, value)} for all
+                periods from start until the current period
+        """
+
+        period = self.period
+
+        # Group the values by period
+        grouped = {}
+        for date, value in values:
+            if date is None or value is None:
+                continue
+            grouped.setdefault(period(date)[0], []).append(value)
+
+        if start is None:
+            if not grouped:
+                return {}
+            start = min(grouped)
+
+        until = period(current.request.utcnow.date())[0]
+        if grouped:
+            until = max(until, max(grouped))
+
+        cumulative = self.config["method"] == "cumulative"
+        TIME, COPY = self.TIME, self.COPY
+
+        series = {}
+        carry = base
+        next_period = self.next_period
+        while start <= until:
+            items = grouped.get(start)
+            if cumulative:
+                if items:
+                    carry = (carry or 0) + sum(items)
+                if carry is not None:
+                    series[start] = (TIME, carry)
+            elif items:
+                # Most recent value (values are ordered by date)
+                carry = items[-1]
+                series[start] = (TIME, carry)
+            elif carry is not None:
+                series[start] = (COPY, carry)
+            start = next_period(start)
+
+        return series
+
+    # -------------------------------------------------------------------------
+    def rollup(self, children):
+        """
+            Computes the aggregates of a location from the aggregates
+            of its immediate children
+
+            Args:
+                children: iterable of dicts {date: (agg_type, value)}
+
+            Returns:
+                dict {start date of period: (agg_type, value)}
+        """
+
+        totals = {}
+        for series in children:
+            for date, (_, value) in series.items():
+                totals[date] = totals.get(date, 0) + (value or 0)
+
+        LOCATION = self.LOCATION
+        return {date: (LOCATION, value) for date, value in totals.items()}
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def percentage(value, total):
+        """
+            Computes the percentage of a value in a total
+
+            Args:
+                value: the value
+                total: the total
+
+            Returns:
+                the percentage (rounded to 3 decimal places), or None
+                if there is no total
+        """
+
+        if value is None or not total:
+            return None
+        return round(100.0 * value / total, 3)
+
+    # -------------------------------------------------------------------------
+    # Full Rebuild
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """
+            Rebuilds all aggregates from scratch: per parameter, computes
+            the aggregates of all locations with data in a single pass over
+            the data, then those of their ancestors level by level (lowest
+            level first), and writes them in bulk
+        """
+
+        db = current.db
+
+        table = self.table
+        atable = self.atable
+        if not table or not atable:
+            return
+
+        # Delete the existing aggregates
+        atable.truncate()
+
+        # Parameters with data
+        query = self.data_query()
+        rows = db(query).select(table.parameter_id, distinct=True)
+        parameter_ids = [row.parameter_id for row in rows]
+        if not parameter_ids:
+            return
+
+        # Totals first, so they are available for percentages
+        totals = self.totals()
+        is_total = set(totals.values())
+        parameter_ids.sort(key=lambda p: 0 if p in is_total else 1)
+
+        # All locations with data, and their ancestors
+        rows = db(query).select(table.location_id, distinct=True)
+        tree = self.tree([row.location_id for row in rows])
+
+        cumulative = self.config["method"] == "cumulative"
+        if cumulative:
+            value = table.value.sum()
+            groupby = (table.location_id, table.date)
+        else:
+            value = table.value
+            groupby = None
+
+        total_series = {}
+        for parameter_id in parameter_ids:
+
+            # Single pass over the data of this parameter
+            rows = db(self.data_query(parameter_id)).select(table.location_id,
+                                                            table.date,
+                                                            value,
+                                                            groupby = groupby,
+                                                            orderby = (table.location_id,
+                                                                       table.date,
+                                                                       ),
+                                                            )
+            data = {}
+            for row in rows:
+                location_id = row[table.location_id]
+                data.setdefault(location_id, []).append((row[table.date],
+                                                         row[value],
+                                                         ))
+            own = {location_id: self.series(values)
+                   for location_id, values in data.items()}
+
+            # Roll up the location tree
+            series = self.rollup_tree(own, tree)
+
+            if parameter_id in is_total:
+                total_series[parameter_id] = series
+            total = total_series.get(totals.get(parameter_id), {})
+
+            # Write the aggregates
+            items = []
+            for location_id, aggregates in series.items():
+                ltotal = total.get(location_id, {})
+                for date, (agg_type, value_) in aggregates.items():
+                    ptotal = ltotal.get(date)
+                    percentage = self.percentage(value_, ptotal[1]) if ptotal else None
+                    items.append(self.record(parameter_id,
+                                             location_id,
+                                             date,
+                                             agg_type,
+                                             value_,
+                                             percentage = percentage,
+                                             ))
+            self.insert(items)
+
+    # -------------------------------------------------------------------------
+    def rollup_tree(self, own, tree):
+        """
+            Adds the aggregates of all ancestors of the locations with data,
+            level by level (lowest level first)
+
+            Args:
+                own: dict {location_id: series} of the locations with data
+                tree: the location tree, dict {location_id: parent}, as
+                      returned from tree()
+
+            Returns:
+                dict {location_id: series} for all locations
+        """
+
+        # Immediate children of each location
+        children = {}
+        for location_id, parent in tree.items():
+            if parent:
+                children.setdefault(parent, []).append(location_id)
+
+        # Depth of each location in the tree
+        depth = {}
+        for location_id in tree:
+            path = []
+            node = location_id
+            while node is not None and node not in depth and node not in path:
+                path.append(node)
+                node = tree.get(node)
+            level = depth.get(node, -1)
+            for node in reversed(path):
+                level += 1
+                depth[node] = level
+
+        # Locations to roll up, grouped by level
+        levels = {}
+        for location_id in children:
+            if location_id not in own:
+                levels.setdefault(depth.get(location_id, 0), []).append(location_id)
+
+        series = dict(own)
+        rollup = self.rollup
+        for level in sorted(levels, reverse=True):
+            for location_id in levels[level]:
+                aggregates = rollup(series[c] for c in children[location_id]
+                                              if c in series)
+                if aggregates:
+                    series[location_id] = aggregates
+
+        return series
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def tree(location_ids):
+        """
+            Looks up the ancestors of locations, level by level
+
+            Args:
+                location_ids: the location record IDs
+
+            Returns:
+                dict {location_id: parent} for the locations and all
+                their ancestors
+        """
+
+        db = current.db
+        gtable = current.s3db.gis_location
+
+        tree = {}
+        pending = set(location_ids)
+        while pending:
+            query = (gtable.id.belongs(pending))
+            rows = db(query).select(gtable.id, gtable.parent)
+            pending = set()
+            for row in rows:
+                tree[row.id] = parent = row.parent
+                if parent and parent not in tree:
+                    pending.add(parent)
+
+        return tree
+
+    # -------------------------------------------------------------------------
+    # Incremental Update
+    # -------------------------------------------------------------------------
+    def update(self, records):
+        """
+            Updates the aggregates after data changes
+
+            Args:
+                records: iterable of tuples (parameter_id, location_id, date)
+                         of the changed data records (dates can be ISO
+                         format strings)
+        """
+
+        if not self.table or not self.atable:
+            return
+
+        # Earliest changed period for each parameter and location
+        changes = {}
+        for parameter_id, location_id, date in records:
+            if not parameter_id or not location_id or not date:
+                continue
+            if isinstance(date, str):
+                date = datetime.datetime.strptime(date[:10], "%Y-%m-%d")
+            start = self.period(date)[0]
+            key = (int(parameter_id), int(location_id))
+            if key not in changes or start < changes[key]:
+                changes[key] = start
+
+        for (parameter_id, location_id), start in changes.items():
+            self.update_location(parameter_id, location_id, start)
+
+    # -------------------------------------------------------------------------
+    def update_location(self, parameter_id, location_id, start):
+        """
+            Recomputes the aggregates of a location from a period on, and
+            propagates the differences to its ancestors
+
+            Args:
+                parameter_id: the parameter ID
+                location_id: the location ID
+                start: the start date of the first changed period
+        """
+
+        db = current.db
+
+        table = self.table
+        atable = self.atable
+
+        query = self.data_query(parameter_id) & \
+                (table.location_id == location_id)
+        own = bool(db(query).select(table.id, limitby=(0, 1)).first())
+
+        # The aggregate of the previous period
+        aquery = (atable.parameter_id == parameter_id) & \
+                 (atable.location_id == location_id)
+        previous = db(aquery & (atable.date < start)).select(atable.agg_type,
+                                                             atable.sum,
+                                                             limitby = (0, 1),
+                                                             orderby = ~atable.date,
+                                                             ).first()
+        if previous and (previous.agg_type == self.LOCATION) == own:
+            # Location switched between own data and rollup => recompute all
+            first = db(aquery).select(atable.date,
+                                      limitby = (0, 1),
+                                      orderby = atable.date,
+                                      ).first()
+            start = first.date
+            previous = None
+
+        old = self.stored(parameter_id, [location_id], start).get(location_id, {})
+
+        if own:
+            rows = db(query & (table.date >= start)).select(table.date,
+                                                            table.value,
+                                                            orderby = table.date,
+                                                            )
+            base = previous.sum if previous else None
+            new = self.series([(row.date, row.value) for row in rows],
+                              start = start,
+                              base = base,
+                              )
+        else:
+            gtable = current.s3db.gis_location
+            rows = db(gtable.parent == location_id).select(gtable.id)
+            stored = self.stored(parameter_id, [row.id for row in rows], start)
+            new = self.rollup({date: (agg_type, value)
+                               for date, (_, agg_type, value) in aggregates.items()
+                               }
+                              for aggregates in stored.values())
+
+        deltas = self.write(parameter_id, location_id, old, new)
+
+        # Propagate the differences to all ancestors that have no data
+        # of their own
+        ancestors = current.gis.get_parents(location_id, ids_only=True) or []
+        if ancestors:
+            query = self.data_query(parameter_id) & \
+                    (table.location_id.belongs(ancestors))
+            rows = db(query).select(table.location_id, distinct=True)
+            with_data = {row.location_id for row in rows}
+            chain = []
+            for ancestor in ancestors:
+                if ancestor in with_data:
+                    break
+                chain.append(ancestor)
+            ancestors = chain
+        if deltas and ancestors:
+            self.propagate(parameter_id, ancestors, deltas)
+
+        self.update_percentages(parameter_id, [location_id] + ancestors, start)
+
+    # -------------------------------------------------------------------------
+    def write(self, parameter_id, location_id, old, new):
+        """
+            Writes the recomputed aggregates of a location
+
+            Args:
+                parameter_id: the parameter ID
+                location_id: the location ID
+                old: the stored aggregates, {date: (record_id, agg_type, value)}
+                new: the new aggregates, {date: (agg_type, value)}
+
+            Returns:
+                the changes of the aggregate values, {date: delta}
+        """
+
+        db = current.db
+        atable = self.atable
+
+        deltas = {}
+        updates = {}
+        remove = []
+        for date, (record_id, agg_type, value) in old.items():
+            if date not in new:
+                remove.append(record_id)
+                delta = -(value or 0)
+            else:
+                new_type, new_value = new[date]
+                delta = (new_value or 0) - (value or 0)
+                if delta or new_type != agg_type:
+                    updates.setdefault((new_type, delta), []).append(record_id)
+            if delta:
+                deltas[date] = delta
+
+        items = []
+        for date, (agg_type, value) in new.items():
+            if date not in old:
+                items.append(self.record(parameter_id,
+                                         location_id,
+                                         date,
+                                         agg_type,
+                                         value,
+                                         ))
+                if value:
+                    deltas[date] = value
+
+        if remove:
+            db(atable.id.belongs(remove)).delete()
+        for (agg_type, delta), record_ids in updates.items():
+            db(atable.id.belongs(record_ids)).update(agg_type = agg_type,
+                                                     sum = atable.sum + delta,
+                                                     )
+        self.insert(items)
+
+        return deltas
+
+    # -------------------------------------------------------------------------
+    def propagate(self, parameter_id, location_ids, deltas):
+        """
+            Adds the changes of the aggregate values of a location to
+            the aggregates of its ancestors
+
+            Args:
+                parameter_id: the parameter ID
+                location_ids: the IDs of the ancestors
+                deltas: the changes of the aggregate values, {date: delta}
+        """
+
+        db = current.db
+        atable = self.atable
+
+        query = (atable.parameter_id == parameter_id) & \
+                (atable.location_id.belongs(location_ids))
+
+        # Add missing aggregates
+        rows = db(query & (atable.date.belongs(list(deltas)))).select(atable.location_id,
+                                                                     atable.date,
+                                                                     )
+        existing = {(row.location_id, row.date) for row in rows}
+        self.insert([self.record(parameter_id, location_id, date, self.LOCATION, 0)
+                     for location_id in location_ids
+                     for date in deltas
+                     if (location_id, date) not in existing
+                     ])
+
+        # Apply the deltas, one update per distinct delta
+        dates = {}
+        for date, delta in deltas.items():
+            dates.setdefault(delta, []).append(date)
+        for delta, items in dates.items():
+            db(query & (atable.date.belongs(items))).update(sum = atable.sum + delta)
+
+    # -------------------------------------------------------------------------
+    def update_percentages(self, parameter_id, location_ids, start):
+        """
+            Updates the percentages of the aggregates of a parameter, and
+            of all parameters that have it as total
+
+            Args:
+                parameter_id: the parameter ID
+                location_ids: the location IDs
+                start: the start date of the first changed period
+        """
+
+        atable = self.atable
+        if "percentage" not in atable.fields:
+            return
+
+        pairs = [(p, t) for p, t in self.totals().items()
+                        if p != t and parameter_id in (p, t)]
+        if not pairs:
+            return
+
+        db = current.db
+        for p, t in pairs:
+            query = (atable.parameter_id.belongs((p, t))) & \
+                    (atable.location_id.belongs(location_ids)) & \
+                    (atable.date >= start)
+            rows = db(query).select(atable.id,
+                                    atable.parameter_id,
+                                    atable.location_id,
+                                    atable.date,
+                                    atable.sum,
+                                    atable.percentage,
+                                    )
+            totals = {(row.location_id, row.date): row.sum
+                      for row in rows if row.parameter_id == t}
+
+            updates = {}
+            for row in rows:
+                if row.parameter_id != p:
+                    continue
+                percentage = self.percentage(row.sum,
+                                             totals.get((row.location_id, row.date)),
+                                             )
+                if percentage != row.percentage:
+                    updates.setdefault(percentage, []).append(row.id)
+
+            for percentage, record_ids in updates.items():
+                db(atable.id.belongs(record_ids)).update(percentage = percentage)
+
+    # -------------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------------
+    def data_query(self, parameter_id=None):
+        """
+            The query for the data records to aggregate
+
+            Args:
+                parameter_id: limit to this parameter
+
+            Returns:
+                Query
+        """
+
+        table = self.table
+
+        query = (table.deleted == False)
+        if current.s3db.get_config(self.tablename, "requires_approval") and \
+           "approved_by" in table.fields:
+            query &= (table.approved_by != None)
+        if parameter_id:
+            query &= (table.parameter_id == parameter_id)
+
+        return query
+
+    # -------------------------------------------------------------------------
+    def totals(self):
+        """
+            Looks up the total parameters for percentages
+
+            Returns:
+                dict {parameter_id: total parameter_id}
+        """
+
+        total = self.config.get("total")
+        if not total:
+            return {}
+
+        tablename, fieldname = total.split(".", 1)
+        table = current.s3db.table(tablename)
+        if not table or fieldname not in table.fields:
+            return {}
+
+        field = table[fieldname]
+        query = (field != None) & (table.deleted == False)
+        rows = current.db(query).select(table.parameter_id, field)
+
+        return {row.parameter_id: row[field] for row in rows}
+
+    # -------------------------------------------------------------------------
+    def stored(self, parameter_id, location_ids, start):
+        """
+            Looks up stored aggregates
+
+            Args:
+                parameter_id: the parameter ID
+                location_ids: the location IDs
+                start: the start date of the first period
+
+            Returns:
+                dict {location_id: {date: (record_id, agg_type, value)}}
+        """
+
+        stored = {}
+        if not location_ids:
+            return stored
+
+        atable = self.atable
+        query = (atable.parameter_id == parameter_id) & \
+                (atable.location_id.belongs(location_ids)) & \
+                (atable.date >= start)
+        rows = current.db(query).select(atable.id,
+                                        atable.location_id,
+                                        atable.agg_type,
+                                        atable.date,
+                                        atable.sum,
+                                        )
+        for row in rows:
+            aggregates = stored.setdefault(row.location_id, {})
+            aggregates[row.date] = (row.id, row.agg_type, row.sum)
+
+        return stored
+
+    # -------------------------------------------------------------------------
+    def record(self, parameter_id, location_id, date, agg_type, value, percentage=None):
+        """
+            Produces an aggregate record
+
+            Args:
+                parameter_id: the parameter ID
+                location_id: the location ID
+                date: the start date of the period
+                agg_type: the aggregate type
+                value: the aggregate value
+                percentage: the percentage of the total
+
+            Returns:
+                the record as dict
+        """
+
+        fields = self.atable.fields
+
+        record = {"parameter_id": parameter_id,
+                  "location_id": location_id,
+                  "agg_type": agg_type,
+                  "date": date,
+                  "sum": value,
+                  }
+        if "end_date" in fields:
+            record["end_date"] = self.period(date)[1]
+        if "percentage" in fields:
+            record["percentage"] = percentage
+
+        return record
+
+    # -------------------------------------------------------------------------
+    def insert(self, items, chunk=1000):
+        """
+            Inserts aggregate records in bulk
+
+            Args:
+                items: list of records (dicts)
+                chunk: the number of records to insert at a time
+        """
+
+        atable = self.atable
+        for i in range(0, len(items), chunk):
+            atable.bulk_insert(items[i:i+chunk])
+
+    # -------------------------------------------------------------------------
+    # Scheduling
+    # -------------------------------------------------------------------------
+    def rebuild_async(self):
+        """
+            Schedules a full rebuild, stopping any rebuild of the same
+            aggregates that is still running
+        """
+
+        db = current.db
+        ttable = db.scheduler_task
+        rtable = db.scheduler_run
+        wtable = db.scheduler_worker
+
+        args = [self.tablename]
+
+        query = (ttable.task_name == "stats_rollup_rebuild") & \
+                (ttable.args == json.dumps(args)) & \
+                (rtable.task_id == ttable.id) & \
+                (rtable.status == "RUNNING")
+        rows = db(query).select(rtable.id,
+                                rtable.task_id,
+                                rtable.worker_name,
+                                )
+        now = current.request.utcnow
+        for row in rows:
+            db(wtable.worker_name == row.worker_name).update(status="KILL")
+            db(rtable.id == row.id).update(stop_time=now,
+                                           status="STOPPED")
+            db(ttable.id == row.task_id).update(stop_time=now,
+                                                status="STOPPED")
+
+        current.s3task.run_async("stats_rollup_rebuild",
+                                 args = args,
+                                 timeout = 21600 # 6 hours
+                                 )
+
+    # -------------------------------------------------------------------------
+    def onaccept(self, form):
+        """
+            Onaccept/onapprove of data records: schedules the update of
+            the aggregates (after commit)
+
+            Args:
+                form: the FORM (onaccept), or the Row (onapprove)
+        """
+
+        if current.auth.override:
+            # Bulk updates (e.g. prepop) are followed by a rebuild
+            return
+
+        if isinstance(form, Row):
+            record_id = form.id
+        else:
+            record_id = get_form_record_id(form)
+        if not record_id:
+            return
+
+        table = self.table
+        record = current.db(table.id == record_id).select(table.parameter_id,
+                                                          table.location_id,
+                                                          table.date,
+                                                          limitby = (0, 1),
+                                                          ).first()
+        if not record:
+            return
+        records = [record]
+
+        # Also update the aggregates for the previous values
+        original = getattr(form, "record", None)
+        if original and any(fn in original for fn in ("parameter_id", "location_id", "date")):
+            records.append(original)
+
+        self.schedule(records)
+
+    # -------------------------------------------------------------------------
+    def ondelete(self, row):
+        """
+            Ondelete of data records: schedules the update of the aggregates
+            (after commit)
+
+            Args:
+                row: the deleted Row
+        """
+
+        if current.auth.override:
+            return
+
+        # Nullable foreign keys have been removed from the record when
+        # it was archived => use the values from the row passed in, or
+        # fall back to the archived foreign keys
+        table = self.table
+        record = current.db(table.id == row.id).select(table.date,
+                                                       table.deleted_fk,
+                                                       limitby = (0, 1),
+                                                       ).first()
+        if not record:
+            return
+        if record.deleted_fk:
+            try:
+                deleted_fk = json.loads(record.deleted_fk)
+            except ValueError:
+                deleted_fk = {}
+        else:
+            deleted_fk = {}
+
+        data = {"date": record.date}
+        for fn in ("parameter_id", "location_id"):
+            value = row.get(fn)
+            data[fn] = value if value else deleted_fk.get(fn)
+
+        self.schedule([data])
+
+    # -------------------------------------------------------------------------
+    def schedule(self, records):
+        """
+            Schedules the update of the aggregates for data records
+
+            Args:
+                records: the data records (Rows or dicts)
+        """
+
+        defer = current.s3task.defer
+        for record in records:
+            parameter_id = record.get("parameter_id")
+            location_id = record.get("location_id")
+            date = record.get("date")
+            if not parameter_id or not location_id or not date:
+                continue
+            defer("stats_rollup_update",
+                  args = [self.tablename,
+                          [[parameter_id, location_id, date.isoformat()]],
+                          ],
+                  )
+
 # =============================================================================
 class stats_SourceRepresent(S3Represent):
     """ Representation of Stats Sources """
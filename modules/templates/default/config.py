@@ -257,6 +257,12 @@ def config(settings):
     #settings.gis.countries = ("US",)
     # Uncomment to pass Addresses imported from CSV to a Geocoder to try and automate Lat/Lon
     #settings.gis.geocode_imported_addresses = "google"
+    # Uncomment to geocode imported addresses in a background task (rate-limited) instead
+    #settings.gis.geocode_deferred = True
+    # Number of days to cache Geocoder results (0 to disable)
+    #settings.gis.geocode_cache_ttl = 30
+    # Maximum number of requests per second to the Geocoder Service in batch geocoding
+    #settings.gis.geocode_rate_limit = 1
     # Hide the Map-based selection tool in the Location Selector
     #settings.gis.map_selector = False
     # Show LatLon boxes in the Location Selector
@@ -337,6 +343,11 @@ def config(settings):
     #settings.gis.print_button = True
     # Uncomment to save a screenshot whenever a saved map is saved
     #settings.gis.config_screenshot = (820, 410)
+    # Number of seconds to reuse rendered map screenshots for identical requests (default 0 = disabled)
+    # - cached screenshots do not reflect changes of the layer data
+    #settings.gis.screenshot_cache = 3600
+    # Sizes of map screenshots to pre-render for all saved maps (gis_screenshot_seed task)
+    #settings.gis.screenshot_seed = [(3508, 2480)]
     # Uncomment to hide the Save control, or set to "float"
     #settings.gis.save = False
     # Uncomment to hide the ScaleLine control
@@ -345,8 +356,14 @@ def config(settings):
     #settings.gis.search_geonames = False
     # Uncomment to modify the Simplify Tolerance
     #settings.gis.simplify_tolerance = 0.001
+    # Uncomment to pre-compute simplified Polygons for these Tolerances
+    #settings.gis.simplify_tolerances = (0.1, 0.01, 0.001)
+    # Uncomment to use an in-process Spatial Index for bbox/radius/polygon queries (databases without spatial extensions)
+    #settings.gis.spatial_index = True
     # Uncomment this for highly-zoomed maps showing buildings
     #settings.gis.precision = 5
+    # Uncomment to advertise Mapbox Vector Tiles for Feature & Theme Layers (gis/tiles)
+    #settings.gis.vector_tiles = True
     # Uncomment to Hide the Toolbar from the main Map
     #settings.gis.toolbar = False
     # Uncomment to show Catalogue Layers in Map Widgets (e.g. Profile & Summary pages)
@@ -417,6 +434,18 @@ def config(settings):
     #settings.ui.autocomplete_min_chars = 2
     #settings.ui.filter_auto_submit = 800
     #settings.ui.report_auto_submit = 800
+    # Minimum number of records for pivot table reports to aggregate in the database
+    # (None to always aggregate in Python, retaining the cell records for exploration)
+    #settings.ui.report_aggregate_threshold = 10000
+    # Cache pivot table report data between requests (True, or expiry in seconds)
+    #settings.ui.report_cache = 300
+    # Compute only the top rows/columns of pivot table reports, collapsing all others
+    #settings.ui.report_collapse_tail = True
+    # Minimum number of records for pivot table reports to be computed in parallel
+    # worker processes (None to always compute them in the request process)
+    # NB forks the server process - use only with single-threaded server processes
+    #settings.ui.report_parallel_threshold = 200000
+    #settings.ui.report_workers = 4
     # Enable this for a UN-style deployment
     #settings.ui.cluster = True
     # Enable this to use the label 'Camp' instead of 'Shelter'
@@ -290,6 +290,67 @@ class SetRolesTests(unittest.TestCase):
             auth.s3_delete_role("TESTROLE")
             current.db.rollback()
 
+    # -------------------------------------------------------------------------
+    def testLazyRealmExpansion(self):
+        """ Test lazy expansion of realms with subsidiaries """
+
+        auth = current.auth
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        settings.security.policy = 7
+        auth.permission = S3Permission(auth)
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        try:
+            role = auth.s3_create_role("Example Role", uid="TESTROLE")
+
+            org1 = self.org1
+            org2 = self.org2
+            s3db.pr_add_affiliation(org1, org2, role="TestRole")
+
+            user_id = auth.s3_get_user_id("normaluser@example.com")
+            auth.s3_assign_role(user_id, role, for_pe=org1)
+
+            auth.s3_impersonate("normaluser@example.com")
+            realms = auth.user.realms
+
+            # Not expanded before first access
+            assertFalse(realms.expanded)
+            assertTrue(role in realms)
+            assertFalse(realms.expanded)
+
+            # Expanded on first access
+            assertTrue(org2 in realms[role])
+            assertTrue(realms.expanded)
+
+            # Only the role assignments are pickled
+            import pickle
+            restored = pickle.loads(pickle.dumps(realms))
+            assertFalse(restored.expanded)
+            assertEqual(restored.assignments[role], [org1])
+            assertEqual(restored, realms)
+
+            # Copies contain the expanded realms
+            import copy
+            for method in (dict, lambda r: {**r}, lambda r: r.copy(), copy.copy):
+                restored = pickle.loads(pickle.dumps(realms))
+                copied = method(restored)
+                assertTrue(org2 in copied[role])
+
+            # Time spent for role/realm computation is recorded
+            timings = current.response.s3.realm_timings
+            assertTrue("set_roles" in timings)
+            assertTrue("expand_realms" in timings)
+
+        finally:
+            auth.s3_impersonate(None)
+            auth.s3_delete_role("TESTROLE")
+            current.db.rollback()
+
 # =============================================================================
 class RoleAssignmentTests(unittest.TestCase):
     """ Test role assignments """
@@ -2038,6 +2099,92 @@ class RealmEntityTests(unittest.TestCase):
         record = otable[self.org_id]
         assertEqual(record.realm_entity, None)
 
+    # -------------------------------------------------------------------------
+    def testSetRealmEntityBulk(self):
+        """ Test bulk update of realm entities, incl. realm components """
+
+        s3db = current.s3db
+        auth = current.auth
+        settings = current.deployment_settings
+
+        realm_components = s3db.get_config("org_organisation",
+                                           "realm_components", "none")
+        s3db.configure("org_organisation",
+                       realm_components = ["office"])
+
+        assertEqual = self.assertEqual
+
+        try:
+            otable = s3db.org_organisation
+            ftable = s3db.org_office
+
+            settings.auth.realm_entity = self.realm_entity
+
+            reported = []
+            def progress(processed, last_id):
+                reported.append((processed, last_id))
+
+            query = (otable.id == self.org_id)
+            processed, last_id = auth.set_realm_entity_bulk(otable,
+                                                            query,
+                                                            force_update = True,
+                                                            progress = progress,
+                                                            )
+            assertEqual(processed, 1)
+            assertEqual(last_id, self.org_id)
+            assertEqual(reported, [(1, self.org_id)])
+
+            record = otable[self.org_id]
+            assertEqual(record.realm_entity, 5)
+            record = ftable[self.office_id]
+            assertEqual(record.realm_entity, 5)
+
+            # Resume after the last processed record
+            processed, last_id = auth.set_realm_entity_bulk(otable,
+                                                            query,
+                                                            force_update = True,
+                                                            start = last_id,
+                                                            )
+            assertEqual(processed, 0)
+        finally:
+            if realm_components != "none":
+                s3db.configure("org_organisation",
+                               realm_components=realm_components)
+            else:
+                s3db.clear_config("org_organisation", "realm_components")
+
+    # -------------------------------------------------------------------------
+    def testGetRealmEntitiesBulkHook(self):
+        """ Test bulk-capable realm_entity hooks """
+
+        s3db = current.s3db
+        auth = current.auth
+        settings = current.deployment_settings
+
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+
+        assertEqual = self.assertEqual
+
+        def realm_entity(table, row):
+            return 7
+        def bulk(table, rows):
+            return {row.id: 8 if row.id == self.office_id else 0 for row in rows}
+        realm_entity.bulk = bulk
+        settings.auth.realm_entity = realm_entity
+
+        rows = current.db(ftable.id == self.office_id).select(ftable.id,
+                                                              ftable.organisation_id,
+                                                              )
+        realms = auth.get_realm_entities(ftable, rows)
+        assertEqual(realms, {self.office_id: 8})
+
+        # Without hook, fall back to the default cascade
+        settings.auth.realm_entity = None
+        org = otable[self.org_id]
+        realms = auth.get_realm_entities(ftable, rows)
+        assertEqual(realms, {self.office_id: org.pe_id})
+
     # -------------------------------------------------------------------------
     def testUpdateSharedFields(self):
         """ Test that realm entity gets set in super-entity """
@@ -284,6 +284,186 @@ class S3PerformanceTests(unittest.TestCase):
 
         current.auth.override = False
 
+    def testGeoJSONExport(self):
+
+        import os
+        from core import GeoJSONWriter
+
+        info("")
+        current.auth.override = True
+        permission = current.auth.permission
+        fmt, permission.format = permission.format, "geojson"
+
+        s3db = current.s3db
+        n = s3db.resource("org_office").count()
+        if n:
+            stylesheet = os.path.join(current.request.folder,
+                                      "static", "formats", "geojson", "export.xsl",
+                                      )
+            x = lambda: s3db.resource("org_office").export_xml(stylesheet = stylesheet,
+                                                               as_json = True,
+                                                               )
+            mlt = timeit.Timer(x).timeit(number=10) * 100
+            info("GeoJSON export (S3XML+XSLT) = %s ms (=%s rec/sec)" % (mlt, int(n * 1000/mlt)))
+
+            x = lambda: GeoJSONWriter().encode(s3db.resource("org_office"))
+            mlt_native = timeit.Timer(x).timeit(number=10) * 100
+            info("GeoJSON export (native) = %s ms (=%s rec/sec)" % (mlt_native, int(n * 1000/mlt_native)))
+            info("GeoJSON export (native) speedup = %.1fx" % (mlt / mlt_native))
+            # Generous threshold to tolerate timing noise
+            self.assertTrue(mlt_native < mlt * 2)
+
+        permission.format = fmt
+        current.auth.override = False
+
+    def testSpatialIndex(self):
+
+        import random
+        from core.gis.spatialindex import STRTree
+
+        info("")
+        rnd = random.Random(1)
+        n = 1000000
+        items = []
+        for i in range(n):
+            x = rnd.uniform(-180, 180)
+            y = rnd.uniform(-90, 90)
+            items.append((i, x, y, x, y))
+
+        x = lambda: STRTree(items)
+        mlt = timeit.Timer(x).timeit(number=1)
+        info("STRTree build (1M points) = %s sec" % mlt)
+
+        tree = STRTree(items)
+        bboxes = []
+        for i in range(100):
+            x0 = rnd.uniform(-180, 179)
+            y0 = rnd.uniform(-90, 89)
+            bboxes.append((x0, y0, x0 + 1, y0 + 1))
+
+        x = lambda: [tree.query(*bbox) for bbox in bboxes]
+        mlt = timeit.Timer(x).timeit(number=1) * 10
+        info("STRTree.query (1M points, 1x1 deg bbox) = %s ms/query" % mlt)
+
+        def scan(xmin, ymin, xmax, ymax):
+            return [i for i, x0, y0, x1, y1 in items
+                      if x0 <= xmax and x1 >= xmin and y0 <= ymax and y1 >= ymin]
+        bbox = bboxes[0]
+        x = lambda: scan(*bbox)
+        mlt_scan = timeit.Timer(x).timeit(number=1) * 1000
+        info("Full scan (1M points, 1x1 deg bbox) = %s ms/query" % mlt_scan)
+        self.assertTrue(mlt < mlt_scan)
+
+    def testPivotTableLayers(self):
+
+        import random
+        from gluon import Field
+        from core.methods.report import S3PivotTable, S3PivotTableFact
+
+        info("")
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        db.define_table("pt_benchmark",
+                        Field("category", "integer"),
+                        Field("group_id", "integer"),
+                        Field("value", "integer"),
+                        Field("amount", "double"),
+                        Field("size", "integer"),
+                        Field("tag"),
+                        )
+        rnd = random.Random(1)
+        n = 100000
+        db.pt_benchmark.bulk_insert([{"category": rnd.randint(0, 50),
+                                      "group_id": rnd.randint(0, 20),
+                                      "value": rnd.randint(0, 100),
+                                      "amount": rnd.random(),
+                                      "size": rnd.randint(1, 9),
+                                      "tag": rnd.choice("abcdef"),
+                                      } for i in range(n)])
+
+        current.auth.override = True
+        threshold = settings.get_ui_report_parallel_threshold()
+        workers = settings.get_ui_report_workers()
+
+        def pivottable(fact):
+            resource = s3db.resource("pt_benchmark")
+            facts = S3PivotTableFact.parse(fact)
+            return S3PivotTable(resource, "category", "group_id", facts, aggregate=False)
+
+        try:
+            for fact in ("count(id)",
+                         "count(id),sum(amount),avg(size)",
+                         "count(id),sum(amount),avg(size),min(value),max(value),count(tag)",
+                         ):
+                numfacts = fact.count("(")
+                x = lambda: pivottable(fact)
+                mlt = timeit.Timer(x).timeit(number=1)
+                info("S3PivotTable (100k records, %s facts) = %s sec" % (numfacts, mlt))
+
+                settings.ui.report_parallel_threshold = 1
+                settings.ui.report_workers = 4
+                mlt = timeit.Timer(x).timeit(number=1)
+                info("S3PivotTable (100k records, %s facts, 4 workers) = %s sec" % (numfacts, mlt))
+
+                settings.ui.report_parallel_threshold = threshold
+                settings.ui.report_workers = workers
+        finally:
+            settings.ui.report_parallel_threshold = threshold
+            settings.ui.report_workers = workers
+            current.auth.override = False
+            db.rollback()
+            db.pt_benchmark.drop()
+
+    # -------------------------------------------------------------------------
+    def testPivotTableExport(self):
+
+        import random
+        from gluon import Field
+        from core.formats.xls import XLSWriter
+        from core.methods.report import S3PivotTable, S3PivotTableFact
+
+        info("")
+        db = current.db
+        s3db = current.s3db
+
+        db.define_table("pt_benchmark_export",
+                        Field("category", "integer"),
+                        Field("group_id", "integer"),
+                        Field("value", "integer"),
+                        )
+        rnd = random.Random(1)
+        n = 100000
+        db.pt_benchmark_export.bulk_insert([{"category": i % 2000,
+                                             "group_id": rnd.randint(0, 199),
+                                             "value": rnd.randint(0, 100),
+                                             } for i in range(n)])
+
+        current.auth.override = True
+        try:
+            resource = s3db.resource("pt_benchmark_export")
+            facts = S3PivotTableFact.parse("sum(value)")
+            pt = S3PivotTable(resource, "category", "group_id", facts)
+            info("S3PivotTable %s rows x %s columns" % (pt.numrows, pt.numcols))
+
+            x = lambda: pt.xlsx("Benchmark")
+            mlt = timeit.Timer(x).timeit(number=1)
+            info("XLSX export = %s sec" % mlt)
+
+            try:
+                import xlwt
+            except ImportError:
+                xlwt = None
+            if xlwt is not None:
+                x = lambda: XLSWriter.encode_pt(pt, "Benchmark")
+                mlt = timeit.Timer(x).timeit(number=1)
+                info("XLS export = %s sec" % mlt)
+        finally:
+            current.auth.override = False
+            db.rollback()
+            db.pt_benchmark_export.drop()
+
 # =============================================================================
 if __name__ == "__main__":
 
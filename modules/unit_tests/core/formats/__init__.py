@@ -1 +1,2 @@
+from .geojson import *
 from .xml import *
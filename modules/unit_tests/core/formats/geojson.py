@@ -0,0 +1,161 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/formats/geojson.py
+#
+import json
+import os
+import unittest
+
+from gluon import *
+
+from core import FS, GeoJSONWriter
+
+from unit_tests import run_suite
+
+# =============================================================================
+class GeoJSONWriterTests(unittest.TestCase):
+    """ Tests for native GeoJSON encoding of feature layers """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        current.auth.override = True
+
+        ltable = s3db.gis_location
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+
+        organisation_id = otable.insert(name = "GeoJSONWriterTestOrg")
+
+        office_ids = []
+        for i in range(3):
+            location = {"name": "GeoJSONWriterTestLocation%s" % i,
+                        "lat": 10.0 + i,
+                        "lon": 20.0 + i,
+                        }
+            location_id = ltable.insert(**location)
+            location["id"] = location_id
+            current.gis.update_location_tree(location)
+
+            office = {"name": "GeoJSONWriterTestOffice%s" % i,
+                      "organisation_id": organisation_id,
+                      "location_id": location_id,
+                      }
+            office_id = ftable.insert(**office)
+            office["id"] = office_id
+            s3db.update_super(ftable, office)
+            office_ids.append(office_id)
+
+        cls.office_ids = office_ids
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        permission = current.auth.permission
+        self.format = permission.format
+        permission.format = "geojson"
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.permission.format = self.format
+
+    # -------------------------------------------------------------------------
+    def export_xslt(self, resource):
+        """ Export the resource through S3XML+XSLT for comparison """
+
+        request = current.request
+        stylesheet = os.path.join(request.folder,
+                                  "static", "formats", "geojson", "export.xsl",
+                                  )
+        output = resource.export_xml(stylesheet = stylesheet,
+                                     as_json = True,
+                                     )
+        return json.loads(output)
+
+    # -------------------------------------------------------------------------
+    def testSupports(self):
+        """ Test that special tables are left to the XSLT stylesheet """
+
+        s3db = current.s3db
+
+        self.assertTrue(GeoJSONWriter.supports(s3db.resource("org_office")))
+        self.assertFalse(GeoJSONWriter.supports(s3db.resource("gis_location")))
+        self.assertFalse(GeoJSONWriter.supports(s3db.resource("gis_theme_data")))
+
+    # -------------------------------------------------------------------------
+    def testFeatureCollection(self):
+        """ Test that native output matches the XSLT output """
+
+        assertEqual = self.assertEqual
+
+        query = FS("id").belongs(self.office_ids)
+
+        resource = current.s3db.resource("org_office", filter=query)
+        output = GeoJSONWriter().encode(resource)
+        self.assertNotEqual(output, None)
+        native = json.loads(output)
+
+        resource = current.s3db.resource("org_office", filter=query)
+        xslt = self.export_xslt(resource)
+
+        assertEqual(native["type"], "FeatureCollection")
+        assertEqual(native["type"], xslt["type"])
+
+        features = native["features"]
+        assertEqual(len(features), len(xslt["features"]))
+        assertEqual(len(features), 3)
+
+        expected = {f["properties"]["id"]: f for f in xslt["features"]}
+        for feature in features:
+            properties = feature["properties"]
+            record_id = properties["id"]
+            self.assertIn(record_id, expected)
+
+            other = expected[record_id]
+            geometry = feature["geometry"]
+            assertEqual(geometry["type"], other["geometry"]["type"])
+            for a, b in zip(geometry["coordinates"], other["geometry"]["coordinates"]):
+                self.assertAlmostEqual(float(a), float(b), places=4)
+            assertEqual(set(properties), set(other["properties"]))
+
+    # -------------------------------------------------------------------------
+    def testSingleFeature(self):
+        """ Test that a single record is encoded as single Feature """
+
+        record_id = self.office_ids[0]
+
+        resource = current.s3db.resource("org_office", id=record_id)
+        output = json.loads(GeoJSONWriter().encode(resource))
+
+        self.assertEqual(output["type"], "Feature")
+        self.assertEqual(output["properties"]["id"], record_id)
+
+    # -------------------------------------------------------------------------
+    def testEmpty(self):
+        """ Test encoding of an empty resource """
+
+        resource = current.s3db.resource("org_office", id=0)
+        output = GeoJSONWriter().encode(resource)
+
+        self.assertEqual(output, "{}")
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        GeoJSONWriterTests,
+    )
+
+# END ========================================================================
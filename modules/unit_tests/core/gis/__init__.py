@@ -1 +1,7 @@
 from .base import *
+from .tiles import *
+from .cluster import *
+from .spatialindex import *
+from .geocoder import *
+from .configcache import *
+from .geodesy import *
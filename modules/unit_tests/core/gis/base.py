@@ -362,6 +362,171 @@ class LocationTreeTests(unittest.TestCase):
         # We should have seen all the expected parents.
         self.assertEqual(len(expected_parents), 0)
 
+    # -------------------------------------------------------------------------
+    def testULT5_rebuild_location_tree(self):
+        """ Test the set-based rebuild of the location tree """
+
+        from core import GIS
+
+        table = self.table
+        db = current.db
+
+        GIS.disable_update_location_tree = True
+
+        L0_id = table.insert(level = "L0",
+                             name = "s3gis.testULT5.L0",
+                             lat = 10.0,
+                             lon = -10.0,
+                             )
+        L1_id = table.insert(level = "L1",
+                             name = "s3gis.testULT5.L1",
+                             parent = L0_id,
+                             lat = 12.0,
+                             lon = -12.0,
+                             inherited = False,
+                             )
+        # Skipping over L2 to L3
+        L3_id = table.insert(level = "L3",
+                             name = "s3gis.testULT5.L3",
+                             parent = L1_id,
+                             path = "wrong",
+                             )
+        specific_id = table.insert(name = "s3gis.testULT5.specific",
+                                   parent = L3_id,
+                                   )
+
+        GIS.disable_update_location_tree = False
+        updated = GIS.rebuild_location_tree()
+        self.assertTrue(updated >= 4)
+
+        assertEqual = self.assertEqual
+
+        L3_record = db(table.id == L3_id).select(*self.fields,
+                                                 limitby=(0, 1)
+                                                 ).first()
+        assertEqual(L3_record.path, "%s/%s/%s" % (L0_id, L1_id, L3_id))
+        assertEqual(L3_record.L0, "s3gis.testULT5.L0")
+        assertEqual(L3_record.L1, "s3gis.testULT5.L1")
+        assertEqual(L3_record.L2, None)
+        assertEqual(L3_record.L3, "s3gis.testULT5.L3")
+        assertEqual(L3_record.inherited, True)
+        assertEqual(L3_record.lat, 12.0)
+        assertEqual(L3_record.lon, -12.0)
+        assertEqual(L3_record.lat_min, 12.0)
+
+        specific_record = db(table.id == specific_id).select(*self.fields,
+                                                             limitby=(0, 1)
+                                                             ).first()
+        assertEqual(specific_record.path, "%s/%s/%s/%s" % (L0_id, L1_id, L3_id, specific_id))
+        assertEqual(specific_record.L3, "s3gis.testULT5.L3")
+        assertEqual(specific_record.L4, None)
+        assertEqual(specific_record.inherited, True)
+        assertEqual(specific_record.lat, 12.0)
+
+        # Nothing to do if the tree is up-to-date
+        assertEqual(GIS.rebuild_location_tree([L1_id]), 0)
+
+        # Incremental update of a subtree
+        db(table.id == L1_id).update(name = "s3gis.testULT5.L1.renamed",
+                                     lat = 14.0,
+                                     lon = -14.0,
+                                     )
+        past = datetime.datetime(2000, 1, 1)
+        db(table.id == specific_id).update(modified_on = past)
+        updated = GIS.rebuild_location_tree([L1_id])
+        assertEqual(updated, 3)
+
+        specific_record = db(table.id == specific_id).select(table.modified_on,
+                                                             *self.fields,
+                                                             limitby=(0, 1)
+                                                             ).first()
+        self.assertTrue(specific_record.modified_on > past)
+        assertEqual(specific_record.L1, "s3gis.testULT5.L1.renamed")
+        assertEqual(specific_record.lat, 14.0)
+        assertEqual(specific_record.lon, -14.0)
+        assertEqual(specific_record.wkt, "POINT (-14.0 14.0)")
+
+    # -------------------------------------------------------------------------
+    def testULT6_rebuild_location_tree_geometries(self):
+        """ Test the set-based rebuild over a multi-level tree with polygons and points """
+
+        from core import GIS
+
+        table = self.table
+        db = current.db
+
+        POLYGON = "POLYGON ((30 10, 40 40, 20 40, 10 20, 30 10))"
+
+        GIS.disable_update_location_tree = True
+
+        L0_id = table.insert(level = "L0",
+                             name = "s3gis.testULT6.L0",
+                             wkt = POLYGON,
+                             lat = 25.0,
+                             lon = 25.0,
+                             )
+        L1_id = table.insert(level = "L1",
+                             name = "s3gis.testULT6.L1",
+                             parent = L0_id,
+                             wkt = POLYGON,
+                             lat = 30.0,
+                             lon = 30.0,
+                             )
+        L2_id = table.insert(level = "L2",
+                             name = "s3gis.testULT6.L2",
+                             parent = L1_id,
+                             )
+        inherited_id = table.insert(name = "s3gis.testULT6.inherited",
+                                    parent = L2_id,
+                                    )
+        point_id = table.insert(name = "s3gis.testULT6.point",
+                                parent = L2_id,
+                                lat = 5.0,
+                                lon = 6.0,
+                                wkt = "POINT (6.0 5.0)",
+                                )
+        GIS.disable_update_location_tree = False
+
+        updated = GIS.rebuild_location_tree([L0_id])
+        self.assertEqual(updated, 5)
+
+        assertEqual = self.assertEqual
+
+        rows = db(table.id.belongs((L0_id, L1_id, L2_id, inherited_id, point_id))).select(table.id, *self.fields)
+        records = {row.id: row for row in rows}
+
+        # Polygons keep their own centroid
+        record = records[L1_id]
+        assertEqual(record.path, "%s/%s" % (L0_id, L1_id))
+        assertEqual(record.inherited, False)
+        assertEqual(record.lat, 30.0)
+        assertEqual(record.wkt, POLYGON)
+
+        # Locations without geometry inherit from their parent
+        for location_id in (L2_id, inherited_id):
+            record = records[location_id]
+            assertEqual(record.L0, "s3gis.testULT6.L0")
+            assertEqual(record.L1, "s3gis.testULT6.L1")
+            assertEqual(record.L2, "s3gis.testULT6.L2")
+            assertEqual(record.inherited, True)
+            assertEqual(record.lat, 30.0)
+            assertEqual(record.lon, 30.0)
+            assertEqual(record.wkt, "POINT (30.0 30.0)")
+        assertEqual(records[inherited_id].path,
+                    "%s/%s/%s/%s" % (L0_id, L1_id, L2_id, inherited_id))
+
+        # Points keep their own coordinates
+        record = records[point_id]
+        assertEqual(record.inherited, False)
+        assertEqual(record.lat, 5.0)
+        assertEqual(record.lon, 6.0)
+        assertEqual(record.L2, "s3gis.testULT6.L2")
+
+        # Full rebuild leaves the (now up-to-date) subtree alone
+        GIS.rebuild_location_tree()
+        record = db(table.id == point_id).select(*self.fields, limitby=(0, 1)).first()
+        assertEqual(record.path, "%s/%s/%s/%s" % (L0_id, L1_id, L2_id, point_id))
+
     # -------------------------------------------------------------------------
     def _testL0(self, with_level):
         """ Test updating a Country with Polygon """
@@ -783,6 +948,151 @@ class LocationTreeTests(unittest.TestCase):
         if self.spatialdb:
             self.assertTrue(record.the_geom is not None)
 
+# =============================================================================
+class SimplifyToleranceTests(unittest.TestCase):
+    """ Tests for the selection of pre-computed simplification tolerances """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        settings = current.deployment_settings
+
+        self.tolerance = settings.get_gis_simplify_tolerance()
+        self.tolerances = settings.get_gis_simplify_tolerances()
+        settings.gis.simplify_tolerance = 0.01
+        settings.gis.simplify_tolerances = (0.1, 0.01, 0.001)
+
+        get_vars = current.request.get_vars
+        self.get_vars = Storage(get_vars)
+        get_vars.pop("zoom", None)
+        get_vars.pop("bbox", None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+
+        settings.gis.simplify_tolerance = self.tolerance
+        settings.gis.simplify_tolerances = self.tolerances
+
+        get_vars = current.request.get_vars
+        get_vars.clear()
+        get_vars.update(self.get_vars)
+
+    # -------------------------------------------------------------------------
+    def testDefault(self):
+        """ Test fallback to the global tolerance """
+
+        self.assertEqual(GIS.get_simplify_tolerance(), 0.01)
+
+    # -------------------------------------------------------------------------
+    def testZoom(self):
+        """ Test tolerance selection by zoom level """
+
+        assertEqual = self.assertEqual
+        get_vars = current.request.get_vars
+
+        # World map => coarsest tolerance
+        get_vars["zoom"] = "2"
+        assertEqual(GIS.get_simplify_tolerance(), 0.1)
+
+        # Regional map
+        get_vars["zoom"] = "9"
+        assertEqual(GIS.get_simplify_tolerance(), 0.001)
+
+        # Beyond the finest tolerance => raw geometry
+        get_vars["zoom"] = "12"
+        assertEqual(GIS.get_simplify_tolerance(), None)
+
+    # -------------------------------------------------------------------------
+    def testBBox(self):
+        """ Test tolerance selection by bounding box """
+
+        get_vars = current.request.get_vars
+
+        get_vars["bbox"] = "-180,-85,180,85"
+        self.assertEqual(GIS.get_simplify_tolerance(), 0.1)
+
+        get_vars["bbox"] = "10,10,20,20"
+        self.assertEqual(GIS.get_simplify_tolerance(), 0.01)
+
+# =============================================================================
+class ScreenshotCacheTests(unittest.TestCase):
+    """ Tests for the reuse of rendered map screenshots """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def config(self, temp=True, **view):
+
+        return current.s3db.gis_config.insert(name = "ScreenshotCacheTest",
+                                              temp = temp,
+                                              **view)
+
+    # -------------------------------------------------------------------------
+    def testKey(self):
+        """ Test cache keys for identical and different requests """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        key = GIS.screenshot_key
+
+        # Identical temporary configs produce the same key
+        view = {"lat": 10.0, "lon": 20.0, "zoom": 5}
+        a, b = self.config(**view), self.config(**view)
+        assertEqual(key(a, 400, 800), key(b, 400, 800))
+
+        # ...but not for different sizes or views
+        assertNotEqual(key(a, 400, 800), key(a, 800, 1600))
+        c = self.config(lat=10.0, lon=20.0, zoom=6)
+        assertNotEqual(key(a, 400, 800), key(c, 400, 800))
+
+        # Saved configs are distinguished by ID
+        d, e = self.config(temp=False, **view), self.config(temp=False, **view)
+        assertNotEqual(key(d, 400, 800), key(e, 400, 800))
+
+    # -------------------------------------------------------------------------
+    def testReuse(self):
+        """ Test that cached screenshots are reused without rendering """
+
+        import os
+
+        ctable = current.s3db.gis_config
+
+        config_id = self.config(lat=-10.0, lon=-20.0, zoom=4)
+
+        cachepath = os.path.join(current.request.folder, "static", "cache", "jpg")
+        if not os.path.exists(cachepath):
+            os.makedirs(cachepath)
+        filename = "map_%s.jpg" % GIS.screenshot_key(config_id, 300, 600)
+        path = os.path.join(cachepath, filename)
+        with open(path, "wb") as f:
+            f.write(b"")
+
+        try:
+            result = GIS.get_screenshot(config_id, height=300, width=600)
+            self.assertEqual(result, filename)
+
+            # Temporary config has been deleted
+            row = current.db(ctable.id == config_id).select(ctable.id,
+                                                            limitby = (0, 1),
+                                                            ).first()
+            self.assertIsNone(row)
+        finally:
+            os.remove(path)
+
 # =============================================================================
 class NoGisConfigTests(unittest.TestCase):
     """
@@ -823,6 +1133,8 @@ if __name__ == "__main__":
 
     run_suite(
         LocationTreeTests,
+        SimplifyToleranceTests,
+        ScreenshotCacheTests,
         NoGisConfigTests,
         )
 
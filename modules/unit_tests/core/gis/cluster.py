@@ -0,0 +1,177 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/cluster.py
+
+import datetime
+import unittest
+
+from gluon import current
+
+from core import FS
+from core.gis.cluster import PointClusters
+
+from unit_tests import run_suite
+
+# =============================================================================
+class PointClustersTests(unittest.TestCase):
+    """ Tests for server-side point clustering """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        current.auth.override = True
+
+        ltable = s3db.gis_location
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+
+        organisation_id = otable.insert(name = "PointClustersTestOrg")
+
+        # Two offices close to each other, one far away
+        office_ids = []
+        for i, (lat, lon) in enumerate(((10.0, 20.0), (10.001, 20.001), (-30.0, 100.0))):
+            location = {"name": "PointClustersTestLocation%s" % i,
+                        "lat": lat,
+                        "lon": lon,
+                        }
+            location_id = ltable.insert(**location)
+            location["id"] = location_id
+            current.gis.update_location_tree(location)
+
+            office = {"name": "PointClustersTestOffice%s" % i,
+                      "organisation_id": organisation_id,
+                      "location_id": location_id,
+                      }
+            office_id = ftable.insert(**office)
+            office["id"] = office_id
+            s3db.update_super(ftable, office)
+            office_ids.append(office_id)
+
+        cls.office_ids = office_ids
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def resource(self, vars=None):
+
+        query = FS("id").belongs(self.office_ids)
+        return current.s3db.resource("org_office", filter=query, vars=vars)
+
+    # -------------------------------------------------------------------------
+    def testProjection(self):
+        """ Test projection to normalized mercator and back """
+
+        import numpy as np
+
+        lat = np.array([0.0, 51.5, -33.9])
+        lon = np.array([0.0, -0.12, 151.2])
+
+        x, y = PointClusters.project(lat, lon)
+        self.assertAlmostEqual(x[0], 0.5)
+        self.assertAlmostEqual(y[0], 0.5)
+        self.assertTrue(y[1] < 0.5 < y[2])
+
+        lat_, lon_ = PointClusters.unproject(x, y)
+        for a, b in zip(lat, lat_):
+            self.assertAlmostEqual(a, b, places=6)
+        for a, b in zip(lon, lon_):
+            self.assertAlmostEqual(a, b, places=6)
+
+    # -------------------------------------------------------------------------
+    def testClusters(self):
+        """ Test clustering at different zoom levels """
+
+        assertEqual = self.assertEqual
+
+        office_ids = self.office_ids
+
+        # Low zoom level: the nearby offices form a cluster
+        clusters = PointClusters(self.resource()).clusters(4)
+        assertEqual(len(clusters), 2)
+        counts = sorted(c[0] for c in clusters.values())
+        assertEqual(counts, [1, 2])
+        self.assertIn(office_ids[2], clusters)
+        assertEqual(clusters[office_ids[2]][0], 1)
+
+        # Cluster centroid lies between the clustered offices
+        for record_id, (count, lat, lon) in clusters.items():
+            if count == 2:
+                self.assertIn(record_id, office_ids[:2])
+                self.assertTrue(10.0 < lat < 10.001)
+                self.assertTrue(20.0 < lon < 20.001)
+
+        # High zoom level: all offices separate
+        clusters = PointClusters(self.resource()).clusters(18)
+        assertEqual(set(clusters), set(office_ids))
+        for count, lat, lon in clusters.values():
+            assertEqual(count, 1)
+
+    # -------------------------------------------------------------------------
+    def testBBox(self):
+        """ Test that the index is shared between bboxes and filtered by bbox """
+
+        assertEqual = self.assertEqual
+
+        office_ids = self.office_ids
+
+        clusters = PointClusters(self.resource())
+        index = clusters.index()
+
+        # Same index for a request with bbox
+        clusters = PointClusters(self.resource(vars={"bbox": "0,0,30,30"}))
+        self.assertIs(clusters.index(), index)
+        assertEqual(len(index["ids"]), 3)
+
+        # ...but only the features inside the bbox are clustered
+        result = clusters.clusters(4)
+        assertEqual(len(result), 1)
+        record_id, (count, lat, lon) = list(result.items())[0]
+        self.assertIn(record_id, office_ids[:2])
+        assertEqual(count, 2)
+
+        clusters = PointClusters(self.resource(vars={"bbox": "90,-40,110,-20"}))
+        assertEqual(set(clusters.clusters(4)), {office_ids[2]})
+
+    # -------------------------------------------------------------------------
+    def testIndexInvalidation(self):
+        """ Test that the cached index is rebuilt when locations change """
+
+        db = current.db
+        s3db = current.s3db
+
+        clusters = PointClusters(self.resource())
+        index = clusters.index()
+        self.assertIs(clusters.index(), index)
+
+        # Move a location
+        ftable = s3db.org_office
+        ltable = s3db.gis_location
+        office = db(ftable.id == self.office_ids[2]).select(ftable.location_id,
+                                                           limitby = (0, 1),
+                                                           ).first()
+        db(ltable.id == office.location_id).update(lat = 10.0005,
+                                                   lon = 20.0005,
+                                                   modified_on = current.request.utcnow + \
+                                                                 datetime.timedelta(seconds=1),
+                                                   )
+        clusters = PointClusters(self.resource())
+        self.assertIsNot(clusters.index(), index)
+        self.assertEqual(len(clusters.clusters(4)), 1)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        PointClustersTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,151 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/configcache.py
+
+import unittest
+
+from gluon import current
+
+from core import GIS
+from core.gis.configcache import MapConfigCache
+
+from unit_tests import run_suite
+
+# =============================================================================
+class MapConfigCacheTests(unittest.TestCase):
+    """ Tests for the map configuration cache """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.response.s3.gis.config = None
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test that writes to map configuration tables change the version """
+
+        s3db = current.s3db
+
+        version = MapConfigCache.version()
+
+        # Writes to unrelated tables do not invalidate the cache
+        s3db.gis_location.insert(name = "MapConfigCacheTestLocation")
+        self.assertEqual(MapConfigCache.version(), version)
+
+        # Writes to map configuration tables do
+        s3db.gis_marker.insert(name = "MapConfigCacheTestMarker")
+        self.assertNotEqual(MapConfigCache.version(), version)
+
+    # -------------------------------------------------------------------------
+    def testTemporaryConfig(self):
+        """ Test that writes to temporary configs do not invalidate the cache """
+
+        db = current.db
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        ctable = s3db.gis_config
+        ltable = s3db.gis_layer_config
+
+        version = MapConfigCache.version()
+
+        # Temporary config, with a layer config
+        config_id = ctable.insert(name = "MapConfigCacheTestConfig",
+                                  temp = True,
+                                  )
+        layer = db(s3db.gis_layer_entity.id > 0).select(s3db.gis_layer_entity.layer_id,
+                                                        limitby = (0, 1),
+                                                        ).first()
+        if layer:
+            ltable.insert(config_id = config_id,
+                          layer_id = layer.layer_id,
+                          )
+            db(ltable.config_id == config_id).update(visible = False)
+            db(ltable.config_id == config_id).delete()
+        db(ctable.id == config_id).update(zoom = 5)
+        db(ctable.id == config_id).delete()
+        assertEqual(MapConfigCache.version(), version)
+
+        # Permanent config
+        config_id = ctable.insert(name = "MapConfigCacheTestConfig2")
+        version = MapConfigCache.version()
+        db(ctable.id == config_id).update(zoom = 5)
+        self.assertNotEqual(MapConfigCache.version(), version)
+
+    # -------------------------------------------------------------------------
+    def testConfig(self):
+        """ Test that merged configs are cached, and returned as copies """
+
+        assertEqual = self.assertEqual
+
+        config = GIS.set_config(0)
+        if not config:
+            self.skipTest("no site default config")
+
+        calls = []
+        def build():
+            calls.append(1)
+            return GIS._read_config(0)
+
+        a = MapConfigCache.config(0, build)
+        b = MapConfigCache.config(0, build)
+        self.assertLessEqual(len(calls), 1)
+        assertEqual(a, b)
+
+        # Modifying the returned config must not affect the cache
+        a.zoom = -1
+        assertEqual(MapConfigCache.config(0, build).zoom, b.zoom)
+        if isinstance(a.ids, list):
+            a.ids.append(-1)
+            assertEqual(MapConfigCache.config(0, build).ids, b.ids)
+
+    # -------------------------------------------------------------------------
+    def testLayers(self):
+        """ Test that layer definitions are cached """
+
+        assertEqual = self.assertEqual
+
+        config = GIS.set_config(0)
+        if not config:
+            self.skipTest("no site default config")
+
+        a, b = {}, {}
+        MapConfigCache.layers(config, a, catalogue_layers=True)
+        MapConfigCache.layers(config, b, catalogue_layers=True)
+        assertEqual(a, b)
+
+        # Modifying the options must not affect the cache
+        for value in a.values():
+            if isinstance(value, list):
+                value.append(None)
+        c = {}
+        MapConfigCache.layers(config, c, catalogue_layers=True)
+        assertEqual(b, c)
+
+        key = MapConfigCache.layers_key(config, True, 6)
+        self.assertIsNotNone(key)
+        self.assertNotEqual(key, MapConfigCache.layers_key(config, False, 6))
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        MapConfigCacheTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,186 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/geocoder.py
+
+import unittest
+
+from gluon import current
+
+from core.gis.geocoder import GazetteerGeocoder
+
+from unit_tests import run_suite
+
+# =============================================================================
+class GeocoderTests(unittest.TestCase):
+    """ Tests for the geocoder cache, batch geocoding and local gazetteer """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        current.auth.override = True
+
+        ltable = current.s3db.gis_location
+
+        # Two places with the same name in different regions
+        region_a = ltable.insert(name = "GeocoderTestRegionA",
+                                 level = "L1",
+                                 )
+        region_b = ltable.insert(name = "GeocoderTestRegionB",
+                                 level = "L1",
+                                 )
+        cls.place_a = ltable.insert(name = "GeocoderTestPlace",
+                                    lat = 10.0,
+                                    lon = 20.0,
+                                    parent = region_a,
+                                    L1 = "GeocoderTestRegionA",
+                                    )
+        cls.place_b = ltable.insert(name = "GeocoderTestPlace",
+                                    lat = -10.0,
+                                    lon = -20.0,
+                                    parent = region_b,
+                                    L1 = "GeocoderTestRegionB",
+                                    )
+        cls.street = ltable.insert(name = "GeocoderTestStreetAddress",
+                                   addr_street = "1 Geocoder Test Street",
+                                   lat = 5.0,
+                                   lon = 6.0,
+                                   )
+        cls.region_a = region_a
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        settings = current.deployment_settings
+
+        self.gis_settings = dict(settings.gis)
+        settings.gis.geocode_cache_ttl = 30
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        settings.gis.clear()
+        settings.gis.update(self.gis_settings)
+
+    # -------------------------------------------------------------------------
+    def testGazetteer(self):
+        """ Test lookups in the local gazetteer """
+
+        assertEqual = self.assertEqual
+
+        g = GazetteerGeocoder()
+
+        # Ambiguous name
+        results = g.geocode("GeocoderTestPlace", exactly_one=False)
+        assertEqual(len(results), 2)
+
+        # Disambiguated by Lx
+        results = g.geocode("geocodertestplace, GeocoderTestRegionB", exactly_one=False)
+        assertEqual(len(results), 1)
+        place, (lat, lon) = results[0]
+        assertEqual((lat, lon), (-10.0, -20.0))
+        self.assertIn("GeocoderTestRegionB", place)
+
+        # Matches street addresses too
+        place, (lat, lon) = g.geocode("1 geocoder test street")
+        assertEqual((lat, lon), (5.0, 6.0))
+
+        # No match
+        self.assertIsNone(g.geocode("GeocoderTestNowhere"))
+
+    # -------------------------------------------------------------------------
+    def testCache(self):
+        """ Test that geocoder results are cached """
+
+        assertEqual = self.assertEqual
+
+        gis = current.gis
+        calls = []
+
+        class TestGeocoder(GazetteerGeocoder):
+            def geocode(self, query, exactly_one=True, **kwargs):
+                calls.append(query)
+                return super().geocode(query, exactly_one=exactly_one, **kwargs)
+
+        result = gis.geocode("1 Geocoder Test Street", geocoder=TestGeocoder)
+        assertEqual(result, {"lat": 5.0, "lon": 6.0})
+        assertEqual(len(calls), 1)
+
+        # Normalized address => cache hit
+        result = gis.geocode(" 1 geocoder  TEST street ", geocoder=TestGeocoder)
+        assertEqual(result, {"lat": 5.0, "lon": 6.0})
+        assertEqual(len(calls), 1)
+
+        # Negative results are cached too
+        result = gis.geocode("GeocoderTestNowhere", geocoder=TestGeocoder)
+        assertEqual(result, "No results found")
+        result = gis.geocode("GeocoderTestNowhere", geocoder=TestGeocoder)
+        assertEqual(result, "No results found")
+        assertEqual(len(calls), 2)
+
+        # Cache disabled
+        current.deployment_settings.gis.geocode_cache_ttl = 0
+        gis.geocode("1 Geocoder Test Street", geocoder=TestGeocoder)
+        assertEqual(len(calls), 3)
+
+    # -------------------------------------------------------------------------
+    def testBatch(self):
+        """ Test batch geocoding with duplicate addresses """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        ltable = current.s3db.gis_location
+
+        location_ids = [ltable.insert(name = "GeocoderTestAddress%s" % i,
+                                      addr_street = "1 Geocoder Test Street",
+                                      )
+                        for i in range(3)]
+
+        # Lat/Lon inherited by the tree update => geocoded too
+        location_ids.append(ltable.insert(name = "GeocoderTestAddress3",
+                                          addr_street = "1 Geocoder Test Street",
+                                          inherited = True,
+                                          lat = 1.0,
+                                          lon = 2.0,
+                                          ))
+
+        current.deployment_settings.gis.geocode_cache_ttl = 0
+        calls = []
+
+        class TestGeocoder(GazetteerGeocoder):
+            def geocode(self, query, exactly_one=True, **kwargs):
+                calls.append(query)
+                return super().geocode(query, exactly_one=exactly_one, **kwargs)
+
+        updated = current.gis.geocode_batch(location_ids, geocoder=TestGeocoder)
+        assertEqual(updated, 4)
+        assertEqual(len(calls), 1)
+
+        rows = db(ltable.id.belongs(location_ids)).select(ltable.lat,
+                                                          ltable.lon,
+                                                          ltable.wkt,
+                                                          ltable.inherited,
+                                                          )
+        for row in rows:
+            assertEqual((row.lat, row.lon), (5.0, 6.0))
+            self.assertFalse(row.inherited)
+            self.assertTrue(row.wkt.startswith("POINT"))
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        GeocoderTests,
+    )
+
+# END ========================================================================
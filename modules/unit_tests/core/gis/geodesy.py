@@ -0,0 +1,108 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/geodesy.py
+
+import unittest
+
+from core.gis.geodesy import Geodesy
+
+from unit_tests import run_suite
+
+# =============================================================================
+class GeodesyTests(unittest.TestCase):
+    """ Tests for vectorized geodesic calculations """
+
+    # -------------------------------------------------------------------------
+    def testDistance(self):
+        """ Test great-circle distances for scalars and sequences """
+
+        assertAlmostEqual = self.assertAlmostEqual
+
+        # London - Paris
+        distance = Geodesy.distance(51.5074, -0.1278, 48.8566, 2.3522)
+        assertAlmostEqual(distance, 343.5, delta=1.0)
+        assertAlmostEqual(Geodesy.distance(51.5074, -0.1278, 48.8566, 2.3522, quick=False),
+                          distance,
+                          places = 3,
+                          )
+
+        # Distances from one point to many
+        distances = Geodesy.distance(0, 0, [0, 0, 10], [0, 1, 0])
+        assertAlmostEqual(distances[0], 0.0)
+        assertAlmostEqual(distances[1], 111.19, places=1)
+        assertAlmostEqual(distances[2], 1111.95, places=1)
+
+    # -------------------------------------------------------------------------
+    def testBearing(self):
+        """ Test bearings """
+
+        assertAlmostEqual = self.assertAlmostEqual
+
+        assertAlmostEqual(Geodesy.bearing(0, 0, 1, 0), 0.0)
+        assertAlmostEqual(Geodesy.bearing(0, 0, 0, 1), 90.0)
+        assertAlmostEqual(Geodesy.bearing(0, 0, -1, 0), 180.0)
+        assertAlmostEqual(Geodesy.bearing(0, 0, 0, -1), 270.0)
+
+    # -------------------------------------------------------------------------
+    def testBounds(self):
+        """ Test bounds of point sets, skipping missing coordinates """
+
+        assertEqual = self.assertEqual
+
+        bounds = Geodesy.bounds([10, None, -5, 3], [20, 7, 40, None])
+        assertEqual(bounds, {"lat_min": -5.0,
+                             "lon_min": 20.0,
+                             "lat_max": 10.0,
+                             "lon_max": 40.0,
+                             })
+
+        assertEqual(Geodesy.bounds([], []), None)
+        assertEqual(Geodesy.bounds([None], [None]), None)
+
+    # -------------------------------------------------------------------------
+    def testBoundsFromRadius(self):
+        """ Test bounding boxes from a radius """
+
+        assertAlmostEqual = self.assertAlmostEqual
+
+        bounds = Geodesy.bounds_from_radius(0, 0, 111.19)
+        assertAlmostEqual(bounds["lat_min"], -1.0, places=2)
+        assertAlmostEqual(bounds["lat_max"], 1.0, places=2)
+        assertAlmostEqual(bounds["lon_min"], -1.0, places=2)
+        assertAlmostEqual(bounds["lon_max"], 1.0, places=2)
+
+        # Radius including the pole covers all longitudes
+        bounds = Geodesy.bounds_from_radius(89.5, 0, 200)
+        self.assertEqual(bounds["lat_max"], 90.0)
+        self.assertEqual(bounds["lon_min"], -180.0)
+        self.assertEqual(bounds["lon_max"], 180.0)
+
+    # -------------------------------------------------------------------------
+    def testNearest(self):
+        """ Test ranking of points by distance """
+
+        assertEqual = self.assertEqual
+
+        lats = [0, 5, None, 1, 3]
+        lons = [2, 0, 0, 0, 0]
+
+        ranking = [i for i, _ in Geodesy.nearest(0, 0, lats, lons)]
+        assertEqual(ranking, [3, 0, 4, 1])
+
+        ranking = [i for i, _ in Geodesy.nearest(0, 0, lats, lons, limit=2)]
+        assertEqual(ranking, [3, 0])
+
+        ranking = [i for i, _ in Geodesy.nearest(0, 0, lats, lons, radius=300)]
+        assertEqual(ranking, [3, 0])
+
+        assertEqual(Geodesy.nearest(0, 0, [], []), [])
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        GeodesyTests,
+    )
+
+# END ========================================================================
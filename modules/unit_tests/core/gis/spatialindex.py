@@ -0,0 +1,231 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/spatialindex.py
+
+import random
+import shutil
+import tempfile
+import unittest
+
+from gluon import current
+
+from core.gis.spatialindex import STRTree, SpatialIndex
+
+from unit_tests import run_suite
+
+# =============================================================================
+class STRTreeTests(unittest.TestCase):
+    """ Tests for the packed R-tree """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        rnd = random.Random(42)
+
+        items = []
+        for i in range(5000):
+            x = rnd.uniform(-180, 179)
+            y = rnd.uniform(-90, 89)
+            items.append((i, x, y, x + rnd.random(), y + rnd.random()))
+
+        cls.items = items
+        cls.tree = STRTree(items)
+
+    # -------------------------------------------------------------------------
+    def scan(self, xmin, ymin, xmax, ymax):
+        """ Brute-force lookup for comparison """
+
+        return sorted(i for i, x0, y0, x1, y1 in self.items
+                        if x0 <= xmax and x1 >= xmin and y0 <= ymax and y1 >= ymin)
+
+    # -------------------------------------------------------------------------
+    def testQuery(self):
+        """ Test that query results match a full scan """
+
+        rnd = random.Random(7)
+        tree = self.tree
+
+        for _ in range(100):
+            x = rnd.uniform(-180, 170)
+            y = rnd.uniform(-90, 80)
+            w = rnd.uniform(0, 20)
+            bbox = (x, y, x + w, y + w)
+            self.assertEqual(sorted(tree.query(*bbox)), self.scan(*bbox))
+
+    # -------------------------------------------------------------------------
+    def testLimit(self):
+        """ Test that query returns None when exceeding the limit """
+
+        tree = self.tree
+
+        self.assertEqual(len(tree), len(self.items))
+        self.assertEqual(tree.query(-180, -90, 180, 90, limit=10), None)
+        self.assertEqual(len(tree.query(-180, -90, 180, 90, limit=len(self.items))),
+                         len(self.items))
+
+    # -------------------------------------------------------------------------
+    def testEmpty(self):
+        """ Test queries against an empty tree """
+
+        self.assertEqual(STRTree([]).query(-180, -90, 180, 90), [])
+
+# =============================================================================
+class SpatialIndexTests(unittest.TestCase):
+    """ Tests for the persistent spatial index of locations """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        current.auth.override = True
+
+        ltable = current.s3db.gis_location
+
+        cls.point_id = ltable.insert(name = "SpatialIndexTestPoint",
+                                     lat = 10.5,
+                                     lon = 20.5,
+                                     )
+        cls.polygon_id = ltable.insert(name = "SpatialIndexTestPolygon",
+                                       wkt = "POLYGON ((30 10, 32 10, 32 12, 30 12, 30 10))",
+                                       lat = 11.0,
+                                       lon = 31.0,
+                                       lat_min = 10.0,
+                                       lat_max = 12.0,
+                                       lon_min = 30.0,
+                                       lon_max = 32.0,
+                                       )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        SpatialIndex(self.path).build()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    # -------------------------------------------------------------------------
+    def testQuery(self):
+        """ Test bbox queries against the index """
+
+        index = SpatialIndex(self.path)
+
+        result = index.query(20, 10, 21, 11)
+        self.assertIn(self.point_id, result)
+        self.assertNotIn(self.polygon_id, result)
+
+        # Polygon bounds intersect the bbox
+        result = index.query(31.5, 11.5, 33, 13)
+        self.assertIn(self.polygon_id, result)
+        self.assertNotIn(self.point_id, result)
+
+    # -------------------------------------------------------------------------
+    def testNoSnapshot(self):
+        """ Test that queries fall back while no snapshot is available """
+
+        path = tempfile.mkdtemp()
+        try:
+            index = SpatialIndex(path)
+            self.assertIsNone(index.query(20, 10, 21, 11))
+            self.assertIsNone(index.intersects("POLYGON ((20 10, 21 10, 21 11, 20 11, 20 10))"))
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    # -------------------------------------------------------------------------
+    def testIntersects(self):
+        """ Test intersects-queries against the index """
+
+        index = SpatialIndex(self.path)
+
+        result = index.intersects("POLYGON ((20 10, 21 10, 21 11, 20 11, 20 10))")
+        self.assertIn(self.point_id, result)
+        self.assertNotIn(self.polygon_id, result)
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test that updates are applied from the journal """
+
+        db = current.db
+        ltable = current.s3db.gis_location
+
+        index = SpatialIndex(self.path)
+        self.assertIn(self.point_id, index.query(20, 10, 21, 11))
+
+        # Move the point
+        db(ltable.id == self.point_id).update(lat = -10.5, lon = -20.5)
+        index.update([self.point_id])
+
+        self.assertNotIn(self.point_id, index.query(20, 10, 21, 11))
+        self.assertIn(self.point_id, index.query(-21, -11, -20, -10))
+
+        # Another process reads the journal
+        other = SpatialIndex(self.path)
+        self.assertIn(self.point_id, other.query(-21, -11, -20, -10))
+
+        # Rebuild consolidates the journal into the snapshot
+        index.build()
+        self.assertIn(self.point_id, other.query(-21, -11, -20, -10))
+        self.assertEqual(other.updates, {})
+
+        # Delete the point
+        db(ltable.id == self.point_id).update(deleted = True)
+        index.update([self.point_id])
+        self.assertNotIn(self.point_id, other.query(-21, -11, -20, -10))
+
+    # -------------------------------------------------------------------------
+    def testWatch(self):
+        """ Test that location writes are journaled by table callbacks """
+
+        db = current.db
+        gis = current.gis
+        request = current.request
+        ltable = current.s3db.gis_location
+
+        index = SpatialIndex(self.path)
+        SpatialIndex.watch(ltable)
+
+        is_shell = request.is_shell
+        request.is_shell = True
+        gis.get_spatial_index = lambda: index
+        try:
+            other = SpatialIndex(self.path)
+
+            # Insert
+            location_id = ltable.insert(name = "SpatialIndexTestWatch",
+                                        lat = 40.5,
+                                        lon = 50.5,
+                                        )
+            self.assertIn(location_id, other.query(50, 40, 51, 41))
+
+            # Update
+            db(ltable.id == location_id).update(lat = 41.5, lon = 51.5)
+            self.assertNotIn(location_id, other.query(50, 40, 51, 41))
+            self.assertIn(location_id, other.query(51, 41, 52, 42))
+
+            # Delete
+            db(ltable.id == location_id).delete()
+            self.assertNotIn(location_id, other.query(51, 41, 52, 42))
+        finally:
+            del gis.get_spatial_index
+            request.is_shell = is_shell
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        STRTreeTests,
+        SpatialIndexTests,
+    )
+
+# END ========================================================================
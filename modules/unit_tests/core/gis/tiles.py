@@ -0,0 +1,123 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/gis/tiles.py
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.gis.tiles import MVTEncoder, VectorTiles
+
+from unit_tests import run_suite
+
+# =============================================================================
+class MVTEncoderTests(unittest.TestCase):
+    """ Tests for the built-in vector tile encoder """
+
+    # -------------------------------------------------------------------------
+    def testVarint(self):
+        """ Test varint encoding """
+
+        varint = MVTEncoder.varint
+
+        self.assertEqual(varint(1), b"\x01")
+        self.assertEqual(varint(300), b"\xac\x02")
+
+    # -------------------------------------------------------------------------
+    def testPointGeometry(self):
+        """ Test encoding of a point (example from the MVT specification) """
+
+        from shapely.geometry import Point
+
+        geometry_type, commands = MVTEncoder().geometry(Point(25, 17))
+
+        self.assertEqual(geometry_type, MVTEncoder.POINT)
+        self.assertEqual(commands, [9, 50, 34])
+
+    # -------------------------------------------------------------------------
+    def testPolygonGeometry(self):
+        """ Test encoding of a polygon (example from the MVT specification) """
+
+        from shapely.geometry import Polygon
+
+        polygon = Polygon([(3, 6), (8, 12), (20, 34), (3, 6)])
+        geometry_type, commands = MVTEncoder().geometry(polygon)
+
+        self.assertEqual(geometry_type, MVTEncoder.POLYGON)
+        self.assertEqual(commands, [9, 6, 12, 18, 10, 12, 24, 44, 15])
+
+    # -------------------------------------------------------------------------
+    def testEmptyLayer(self):
+        """ Test that layers without features are omitted """
+
+        encoder = MVTEncoder()
+        encoder.add_layer("test", [])
+
+        self.assertEqual(encoder.encode(), b"")
+
+# =============================================================================
+class TileMathTests(unittest.TestCase):
+    """ Tests for tile coordinate calculations """
+
+    # -------------------------------------------------------------------------
+    def testBounds(self):
+        """ Test tile bounds in spherical mercator and WGS84 """
+
+        assertAlmostEqual = self.assertAlmostEqual
+
+        minx, miny, maxx, maxy = VectorTiles.bounds(0, 0, 0)
+        assertAlmostEqual(minx, -20037508.342789244)
+        assertAlmostEqual(maxy, 20037508.342789244)
+
+        west, south, east, north = VectorTiles.lonlat_bounds(1, 1, 0)
+        assertAlmostEqual(west, 0)
+        assertAlmostEqual(east, 180)
+        assertAlmostEqual(south, 0)
+        assertAlmostEqual(north, 85.0511287798, places=6)
+
+# =============================================================================
+class TileCacheTests(unittest.TestCase):
+    """ Tests for the tile cache """
+
+    # -------------------------------------------------------------------------
+    def testPrune(self):
+        """ Test removal of cached tiles of older versions """
+
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        root = tempfile.mkdtemp()
+        try:
+            layer = os.path.join(root, "4")
+            old = os.path.join(layer, "v1", "q1", "0", "0")
+            other = os.path.join(root, "5", "v1", "q1", "0", "0")
+            for folder in (old, other):
+                os.makedirs(folder)
+
+            path = os.path.join(layer, "v2", "q2", "1", "0", "0.mvt")
+            VectorTiles.prune(path)
+
+            # Older version of the same layer is removed...
+            assertFalse(os.path.exists(os.path.join(layer, "v1")))
+            # ...but not the tiles of other layers
+            assertTrue(os.path.exists(other))
+
+            # Current version is retained
+            os.makedirs(os.path.dirname(path))
+            VectorTiles.prune(path)
+            assertTrue(os.path.exists(os.path.dirname(path)))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        MVTEncoderTests,
+        TileMathTests,
+        TileCacheTests,
+        )
+
+# END ========================================================================
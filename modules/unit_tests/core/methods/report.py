@@ -0,0 +1,447 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/methods/report.py
+
+import unittest
+
+from gluon import current, Field
+
+from core import FS
+from core.methods.report import S3PivotTable, S3PivotTableCache, S3PivotTableFact
+
+from unit_tests import run_suite
+
+# =============================================================================
+class PivotTableAggregateTests(unittest.TestCase):
+    """ Tests for aggregation of pivot tables in the database """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        db = current.db
+
+        db.define_table("pt_test_group",
+                        Field("name"),
+                        )
+        db.define_table("pt_test_record",
+                        Field("group_id", "reference pt_test_group"),
+                        Field("category"),
+                        Field("value", "integer"),
+                        Field("amount", "double"),
+                        Field("tags", "list:string"),
+                        )
+
+        gtable = db.pt_test_group
+        group_ids = [gtable.insert(name="Group%s" % i) for i in range(3)]
+
+        table = db.pt_test_record
+        records = (("A", 0, 3, 1.5, ["x"]),
+                   ("A", 0, 3, 2.25, ["x", "y"]),
+                   ("A", 1, None, 0.5, []),
+                   ("B", 1, 7, None, ["y"]),
+                   ("B", 2, -2, 4.0, ["z"]),
+                   ("C", 2, 5, 1.0, ["x"]),
+                   (None, 0, 1, 3.0, None),
+                   ("C", None, 4, 2.5, ["z"]),
+                   )
+        for category, group, value, amount, tags in records:
+            table.insert(category = category,
+                         group_id = group_ids[group] if group is not None else None,
+                         value = value,
+                         amount = amount,
+                         tags = tags,
+                         )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        db.pt_test_record.drop()
+        db.pt_test_group.drop()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def pivottable(self, rows, cols, fact, aggregate, query=None):
+        """ Generate a pivot table """
+
+        resource = current.s3db.resource("pt_test_record", filter=query)
+        facts = S3PivotTableFact.parse(fact)
+
+        return S3PivotTable(resource, rows, cols, facts, aggregate=aggregate)
+
+    # -------------------------------------------------------------------------
+    def assertParity(self, rows, cols, fact, query=None):
+        """ Assert that both engines produce the same results """
+
+        pt = self.pivottable(rows, cols, fact, True, query=query)
+        self.assertIsNone(pt.records)
+
+        ref = self.pivottable(rows, cols, fact, False, query=query)
+        self.assertIsNotNone(ref.records)
+
+        self.assertSameResults(pt, ref)
+
+    # -------------------------------------------------------------------------
+    def assertSameResults(self, pt, ref):
+        """ Assert that two pivot tables have the same results """
+
+        assertEqual = self.assertEqual
+
+        assertEqual(len(pt), len(ref))
+        assertEqual(pt.empty, ref.empty)
+        if ref.empty:
+            return
+
+        layers = [f.layer for f in ref.facts]
+
+        def headers(items):
+            return {item.value: [item[layer] for layer in layers] for item in items}
+
+        assertEqual(headers(pt.row), headers(ref.row))
+        assertEqual(headers(pt.col), headers(ref.col))
+
+        def cells(pt):
+            return {(pt.row[r].value, pt.col[c].value): [pt.cell[r][c][layer] for layer in layers]
+                    for r in range(pt.numrows) for c in range(pt.numcols)}
+
+        assertEqual(cells(pt), cells(ref))
+        for layer in layers:
+            assertEqual(pt.totals[layer], ref.totals[layer])
+
+    # -------------------------------------------------------------------------
+    def testParity(self):
+        """ Test result parity of database and Python aggregation """
+
+        assertParity = self.assertParity
+
+        fact = "count(id),count(category),sum(value),min(value),max(amount),avg(amount)"
+
+        assertParity("category", "group_id", fact)
+        assertParity("group_id$name", None, fact)
+        assertParity(None, "category", fact)
+        assertParity("category", "group_id", "avg(value)", query=FS("value") > 2)
+        assertParity("category", None, "sum(amount)", query=FS("value") > 100)
+
+    # -------------------------------------------------------------------------
+    def testColumnar(self):
+        """ Test result parity of columnar and item-wise aggregation """
+
+        from core.methods import report
+        np = report.np
+        if np is None:
+            self.skipTest("numpy not installed")
+
+        fact = "count(id),count(tags),sum(value),min(amount),avg(value),list(category)"
+
+        for rows, cols in (("tags", "category"),
+                           ("category", "tags"),
+                           ("group_id$name", None),
+                           ("tags", "tags"),
+                           ):
+            pt = self.pivottable(rows, cols, fact, False)
+            report.np = None
+            try:
+                ref = self.pivottable(rows, cols, fact, False)
+            finally:
+                report.np = np
+            self.assertSameResults(pt, ref)
+
+    # -------------------------------------------------------------------------
+    def testParallel(self):
+        """ Test result parity of parallel and single-process aggregation """
+
+        import multiprocessing
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("fork start method not available")
+
+        settings = current.deployment_settings
+        threshold = settings.get_ui_report_parallel_threshold()
+        workers = settings.get_ui_report_workers()
+
+        fact = "count(id),count(tags),sum(value),min(amount),avg(value)"
+
+        for rows, cols in (("tags", "category"),
+                           ("group_id$name", None),
+                           ):
+            ref = self.pivottable(rows, cols, fact, False)
+
+            settings.ui.report_parallel_threshold = 1
+            settings.ui.report_workers = 3
+            try:
+                pt = self.pivottable(rows, cols, fact, False)
+            finally:
+                settings.ui.report_parallel_threshold = threshold
+                settings.ui.report_workers = workers
+            self.assertSameResults(pt, ref)
+
+    # -------------------------------------------------------------------------
+    def testCollapse(self):
+        """ Test collapsing of rows beyond the top n into "Others" """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        facts = S3PivotTableFact.parse("count(id),sum(value)")
+
+        for aggregate in (True, False):
+
+            resource = current.s3db.resource("pt_test_record")
+            pt = S3PivotTable(resource, "category", "group_id", facts,
+                              aggregate = aggregate,
+                              maxrows = 2,
+                              )
+            ref = self.pivottable("category", "group_id", "count(id),sum(value)", aggregate)
+
+            # Top row retained, all others collapsed
+            assertEqual(pt.numrows, 2)
+            assertEqual(pt.rother, 1)
+            assertEqual(pt.row[0].value, "A")
+
+            other = pt.row[pt.rother]
+            assertTrue(other.other)
+            assertEqual(set(other.value), {"B", "C", None})
+            assertEqual(other[("id", "count")], 5)
+            assertEqual(other[("value", "sum")], 15)
+
+            # Columns unaffected
+            assertEqual(pt.numcols, ref.numcols)
+            self.assertIsNone(pt.cother)
+
+            # Same totals
+            for fact in facts:
+                assertEqual(pt.totals[fact.layer], ref.totals[fact.layer])
+
+    # -------------------------------------------------------------------------
+    def testCollapseParity(self):
+        """ Test result parity of database and Python aggregation with "Others" """
+
+        assertEqual = self.assertEqual
+
+        facts = S3PivotTableFact.parse("count(id),count(category),sum(value),max(amount)")
+        layers = [fact.layer for fact in facts]
+
+        def results(pt):
+            def key(item):
+                return tuple(sorted(item.value, key=repr)) if item.other else item.value
+            cells = {(key(pt.row[r]), key(pt.col[c])): [pt.cell[r][c][layer] for layer in layers]
+                     for r in range(pt.numrows) for c in range(pt.numcols)}
+            rows = {key(item): [item[layer] for layer in layers] for item in pt.row}
+            cols = {key(item): [item[layer] for layer in layers] for item in pt.col}
+            return cells, rows, cols, [pt.totals[layer] for layer in layers]
+
+        output = []
+        for aggregate in (True, False):
+            resource = current.s3db.resource("pt_test_record")
+            pt = S3PivotTable(resource, "category", "group_id", facts,
+                              aggregate = aggregate,
+                              maxrows = 2,
+                              maxcols = 2,
+                              )
+            assertEqual(pt.records is None, aggregate)
+            output.append(results(pt))
+
+        assertEqual(output[0], output[1])
+
+        # Counts in "Others" are the sums of the merged cells
+        cells = output[0][0]
+        other = [v for k, v in cells.items()
+                 if isinstance(k[0], tuple) and isinstance(k[1], tuple)]
+        assertEqual(other[0][1], 4)
+
+    # -------------------------------------------------------------------------
+    def testFallback(self):
+        """ Test fallback to Python aggregation for unsupported facts/axes """
+
+        assertIsNotNone = self.assertIsNotNone
+
+        # List aggregation
+        pt = self.pivottable("category", None, "list(value)", True)
+        assertIsNotNone(pt.records)
+
+        # Numeric aggregation of non-numeric field
+        pt = self.pivottable("category", None, "max(category)", True)
+        assertIsNotNone(pt.records)
+
+        # List:type axis
+        pt = self.pivottable("tags", None, "count(id)", True)
+        assertIsNotNone(pt.records)
+
+    # -------------------------------------------------------------------------
+    def testMerge(self):
+        """ Test merging of partial aggregates """
+
+        assertEqual = self.assertEqual
+
+        fact = S3PivotTableFact("count", "id")
+        assertEqual(fact.result(fact.merge([2, None, 3])), 5)
+
+        partials = [(4, 2, 1, 3), None, (None, 0, None, None), (2.5, 1, 2.5, 2.5)]
+
+        fact = S3PivotTableFact("sum", "value")
+        assertEqual(fact.result(fact.merge(partials)), 6.5)
+        assertEqual(fact.result(None), 0)
+
+        fact = S3PivotTableFact("min", "value")
+        assertEqual(fact.result(fact.merge(partials)), 1)
+
+        fact = S3PivotTableFact("max", "value")
+        assertEqual(fact.result(fact.merge(partials)), 3)
+
+        fact = S3PivotTableFact("avg", "value")
+        assertEqual(fact.result(fact.merge(partials), precision=2), 2.17)
+        assertEqual(fact.result(None), 0.0)
+
+# =============================================================================
+class PivotTableCacheTests(unittest.TestCase):
+    """ Tests for the pivot table report cache """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        db = current.db
+
+        db.define_table("pt_cache_group",
+                        Field("name"),
+                        )
+        db.define_table("pt_cache_record",
+                        Field("group_id", "reference pt_cache_group"),
+                        Field("category"),
+                        Field("value", "integer"),
+                        )
+
+        group_id = db.pt_cache_group.insert(name="Group")
+
+        table = db.pt_cache_record
+        for category, value in (("A", 1), ("A", 2), ("B", 3)):
+            table.insert(group_id=group_id, category=category, value=value)
+
+        S3PivotTableCache.watch(db.pt_cache_record)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        db.pt_cache_record.drop()
+        db.pt_cache_group.drop()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.report_cache = settings.ui.get("report_cache")
+        settings.ui.report_cache = True
+
+        current.response.s3.report_cache_touched = None
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.ui.report_cache = self.report_cache
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def key(rows, cols, fact, query=None):
+        """ Get the cache key for a report """
+
+        resource = current.s3db.resource("pt_cache_record", filter=query)
+        facts = S3PivotTableFact.parse(fact)
+
+        return S3PivotTableCache.key(resource, rows, cols, facts)
+
+    # -------------------------------------------------------------------------
+    def testKey(self):
+        """ Test that the cache key reflects the report parameters """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        key = self.key("category", None, "count(id)")
+        assertEqual(key, self.key("category", None, "count(id)"))
+
+        assertNotEqual(key, self.key("group_id", None, "count(id)"))
+        assertNotEqual(key, self.key("category", "group_id", "count(id)"))
+        assertNotEqual(key, self.key("category", None, "sum(value)"))
+        assertNotEqual(key, self.key("category", None, "count(id)",
+                                     query = FS("value") > 1,
+                                     ))
+
+        # Depends on the realms of the user
+        current.auth.override = False
+        try:
+            assertNotEqual(key, self.key("category", None, "count(id)"))
+        finally:
+            current.auth.override = True
+
+        # Stable when the data of any involved table change...
+        key = self.key("group_id", None, "count(id)")
+        resource = current.s3db.resource("pt_cache_record")
+        facts = S3PivotTableFact.parse("count(id)")
+        versions = S3PivotTableCache.versions(resource, "group_id", None, facts)
+        S3PivotTableCache.touch("pt_cache_group")
+        assertEqual(key, self.key("group_id", None, "count(id)"))
+
+        # ...but the versions change
+        assertNotEqual(versions, S3PivotTableCache.versions(resource, "group_id", None, facts))
+
+    # -------------------------------------------------------------------------
+    def testLookup(self):
+        """ Test lookup and invalidation of cached reports """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        resource = current.s3db.resource("pt_cache_record")
+        facts = S3PivotTableFact.parse("sum(value)")
+
+        built = []
+        def build():
+            pivottable = S3PivotTable(resource, "category", None, facts)
+            data = pivottable.json()
+            built.append(data)
+            return data
+
+        lookup = lambda: S3PivotTableCache.lookup(resource, "category", None, facts, build)
+
+        data = lookup()
+        assertEqual(len(built), 1)
+
+        # Looked up from cache
+        self.assertIs(lookup(), data)
+        assertEqual(len(built), 1)
+
+        # Writes to the table invalidate the cache
+        db.pt_cache_record.insert(category="B", value=4)
+        self.assertIsNot(lookup(), data)
+        assertEqual(len(built), 2)
+
+        # Not cached if disabled
+        current.deployment_settings.ui.report_cache = False
+        lookup()
+        assertEqual(len(built), 3)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        PivotTableAggregateTests,
+        PivotTableCacheTests,
+    )
+
+# END ========================================================================
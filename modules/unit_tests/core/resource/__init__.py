@@ -1,3 +1,4 @@
 from .importer import *
 from .query import *
 from .resource import *
+from .summary import *
@@ -0,0 +1,298 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/resource/summary.py
+#
+import datetime
+import unittest
+
+from gluon import *
+
+from core import *
+from core.methods.report import S3PivotTableFact
+
+from unit_tests import run_suite
+
+# =============================================================================
+class SummaryTableTests(unittest.TestCase):
+    """ Tests for materialized summary tables """
+
+    @classmethod
+    def setUpClass(cls):
+
+        s3db = current.s3db
+
+        s3db.define_table("test_summary",
+                          Field("date", "datetime"),
+                          Field("type_id", "integer"),
+                          Field("site"),
+                          Field("quantity", "integer"),
+                          )
+        current.db.commit()
+
+        s3db.configure("test_summary",
+                       summary_tables = {"daily": {"timestamp": "date",
+                                                   "grain": "day",
+                                                   "dimensions": ["type_id", "site"],
+                                                   "measures": ["quantity"],
+                                                   },
+                                         },
+                       )
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        current.s3db.clear_config("test_summary")
+
+        db = current.db
+        db.rollback()
+        db.test_summary.drop()
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        current.response.s3.summary_periods = {}
+
+        table = current.s3db.test_summary
+
+        day = lambda d, h: datetime.datetime(2022, 3, d, h, 0, 0)
+        records = {}
+        for name, date, type_id, site, quantity in (("A", day(1, 8), 1, "X", 3),
+                                                    ("B", day(1, 17), 1, "X", 4),
+                                                    ("C", day(1, 9), 2, "X", None),
+                                                    ("D", day(2, 10), 1, "Y", 5),
+                                                    ("E", day(3, 11), 2, "Y", 7),
+                                                    ("F", None, 1, "Y", 1),
+                                                    ):
+            records[name] = table.insert(date = date,
+                                         type_id = type_id,
+                                         site = site,
+                                         quantity = quantity,
+                                         )
+        self.records = records
+
+        self.summary = SummaryTable.configured("test_summary")[0]
+        self.summary.rebuild()
+        current.response.s3.summary_pending = None
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def lookup(self, query=None, dimensions=None, timestamp=None, grain=None):
+        """ Look up groups from the summary, as dict for comparison """
+
+        resource = current.s3db.resource("test_summary", filter=query)
+        groups = SummaryTable.lookup(resource,
+                                     dimensions or ["site"],
+                                     ["id", "quantity"],
+                                     timestamp = timestamp,
+                                     grain = grain,
+                                     )
+        if groups is None:
+            return None
+
+        return {(period, values): (records, partials["quantity"])
+                for period, values, records, partials in groups}
+
+    # -------------------------------------------------------------------------
+    def testPeriod(self):
+        """ Test the computation of periods """
+
+        assertEqual = self.assertEqual
+
+        summary = self.summary
+
+        dt = datetime.datetime(2022, 3, 1, 17, 30)
+        assertEqual(summary.period(dt), datetime.datetime(2022, 3, 1))
+        assertEqual(summary.period(None), None)
+        assertEqual(summary.next_period(datetime.datetime(2022, 2, 28)),
+                    datetime.datetime(2022, 3, 1))
+
+    # -------------------------------------------------------------------------
+    def testLookup(self):
+        """ Test lookup of aggregates from the summary """
+
+        assertEqual = self.assertEqual
+
+        # All records, grouped by site
+        groups = self.lookup()
+        assertEqual(groups, {(None, ("X",)): (3, (2, 7, 3, 4)),
+                             (None, ("Y",)): (3, (3, 13, 1, 7)),
+                             })
+
+        # Filtered by dimension
+        groups = self.lookup(FS("type_id") == 1)
+        assertEqual(groups, {(None, ("X",)): (2, (2, 7, 3, 4)),
+                             (None, ("Y",)): (2, (2, 6, 1, 5)),
+                             })
+
+        # Filtered by timestamp at period boundaries
+        groups = self.lookup(FS("date") >= datetime.datetime(2022, 3, 2))
+        assertEqual(groups, {(None, ("Y",)): (2, (2, 12, 5, 7)),
+                             })
+
+        # Time axis
+        groups = self.lookup(FS("site") == "X",
+                             dimensions = ["type_id"],
+                             timestamp = "date",
+                             grain = "month",
+                             )
+        assertEqual(groups, {(datetime.datetime(2022, 3, 1), (1,)): (2, (2, 7, 3, 4)),
+                             (datetime.datetime(2022, 3, 1), (2,)): (1, (0, None, None, None)),
+                             })
+
+    # -------------------------------------------------------------------------
+    def testNoMatch(self):
+        """ Test that reports are not answered from non-matching summaries """
+
+        assertEqual = self.assertEqual
+
+        # Timestamp filter not at period boundaries
+        assertEqual(self.lookup(FS("date") >= datetime.datetime(2022, 3, 2, 6)), None)
+
+        # Filter by measure
+        assertEqual(self.lookup(FS("quantity") > 3), None)
+
+        # Axis not a dimension
+        assertEqual(self.lookup(dimensions=["quantity"]), None)
+
+        # Time axis with periods shorter than the summary grain
+        assertEqual(self.lookup(timestamp="date", grain="hour"), None)
+
+        stable = current.s3db.s3_summary
+        query = (stable.tablename == "test_summary")
+
+        # Summary outdated
+        self.summary.max_age = 60
+        outdated = current.request.utcnow - datetime.timedelta(seconds=120)
+        current.db(query).update(refreshed_on=outdated)
+        self.assertIsNone(self.summary.answer(current.s3db.resource("test_summary"),
+                                              ["site"],
+                                              ["id"],
+                                              ))
+
+        # Refresh pending
+        current.db(query).update(pending=current.request.utcnow)
+        assertEqual(self.lookup(), None)
+
+        # Summary marked dirty
+        current.db(query).update(dirty=True, pending=None)
+        assertEqual(self.lookup(), None)
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test incremental updates after writes """
+
+        db = current.db
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        table = s3db.test_summary
+        records = self.records
+
+        # Move a record to another period, archive another
+        db(table.id == records["A"]).update(date = datetime.datetime(2022, 3, 3, 8))
+        db(table.id == records["D"]).update(deleted = True)
+        # Irrelevant update
+        db(table.id == records["E"]).update(modified_on = current.request.utcnow)
+
+        # Affected periods collected by write hooks
+        periods = current.response.s3.summary_periods[("test_summary", "daily")]
+        assertEqual(periods, {datetime.datetime(2022, 3, 1),
+                              datetime.datetime(2022, 3, 2),
+                              datetime.datetime(2022, 3, 3),
+                              })
+
+        # Not used for reports until refreshed
+        assertEqual(self.lookup(), None)
+
+        # Incremental update produces the same result as a rebuild
+        summary = self.summary
+        summary.refresh(periods)
+        groups = self.lookup(timestamp="date", grain="day")
+
+        summary.rebuild()
+        assertEqual(self.lookup(timestamp="date", grain="day"), groups)
+        assertEqual(groups[(datetime.datetime(2022, 3, 3), ("X",))], (1, (1, 3, 3, 3)))
+
+    # -------------------------------------------------------------------------
+    def testFlush(self):
+        """ Test that writes outside of web requests are refreshed by flush """
+
+        db = current.db
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        table = s3db.test_summary
+        records = self.records
+
+        request = current.request
+        is_shell = request.is_shell
+        request.is_shell = True
+
+        deferred = []
+        s3task = current.s3task
+        defer = s3task.defer
+        s3task.defer = lambda task, *args, **kwargs: deferred.append(task)
+        try:
+            # Hard delete, and insert into another period
+            db(table.id == records["B"]).delete()
+            table.insert(date = datetime.datetime(2022, 3, 2, 12),
+                         type_id = 2,
+                         site = "X",
+                         quantity = 2,
+                         )
+        finally:
+            s3task.defer = defer
+            request.is_shell = is_shell
+
+        # Nothing run from inside the write hooks, only marked pending
+        assertEqual(deferred, [])
+        assertEqual(self.lookup(), None)
+
+        # Flush refreshes the collected periods
+        assertEqual(SummaryTable.flush(), 1)
+        groups = self.lookup(timestamp="date", grain="day")
+        self.assertIsNotNone(groups)
+
+        self.summary.rebuild()
+        assertEqual(self.lookup(timestamp="date", grain="day"), groups)
+
+    # -------------------------------------------------------------------------
+    def testPivotTable(self):
+        """ Test pivot table computed from the summary """
+
+        resource = current.s3db.resource("test_summary")
+        facts = [S3PivotTableFact("sum", "quantity"),
+                 S3PivotTableFact("count", "id"),
+                 ]
+
+        summarized = S3PivotTable(resource, "site", "type_id", facts)
+        self.assertEqual(summarized.records, None)
+
+        resource = current.s3db.resource("test_summary")
+        selected = S3PivotTable(resource, "site", "type_id", facts, aggregate=False)
+
+        self.assertEqual(len(summarized), len(selected))
+        self.assertEqual(summarized.totals, selected.totals)
+        self.assertEqual(sorted(row.value for row in summarized.row),
+                         sorted(row.value for row in selected.row))
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        SummaryTableTests,
+    )
+
+# END ========================================================================
@@ -2,6 +2,7 @@ from .calendar import *
 from .convert import *
 from .hierarchy import *
 from .represent import *
+from .tasks import *
 from .timeseries import *
 from .utils import *
 from .validators import *
@@ -569,6 +569,46 @@ class SimpleHierarchyTests(unittest.TestCase):
         nodes = h.findall(root, category="Cat 4")
         assertEqual(nodes, set())
 
+    # -------------------------------------------------------------------------
+    def testSubtreeIndex(self):
+        """ Test subtree lookup via the hierarchy index """
+
+        uids = self.uids
+
+        db = current.db
+        table = db.test_hierarchy
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        h = S3Hierarchy("test_hierarchy")
+        count = h.build_index()
+        assertEqual(count, len(uids))
+        assertTrue(h.indexed)
+
+        roots = [uids["HIERARCHY1-1"], uids["HIERARCHY2"]]
+        for inclusive in (True, False):
+            query = h.subtree_query(table.id, roots, inclusive=inclusive)
+            rows = db(query).select(table.id)
+            expected = h.findall(roots, inclusive=inclusive)
+            assertEqual({row.id for row in rows}, expected)
+
+        # Index becomes stale when the hierarchy is marked dirty,
+        # and gets rebuilt asynchronously
+        s3task = current.s3task
+        deferred = []
+        defer = s3task.defer
+        s3task.defer = lambda task, args=None, **attr: deferred.append((task, args))
+        try:
+            S3Hierarchy.dirty("test_hierarchy")
+        finally:
+            s3task.defer = defer
+        assertEqual(deferred, [("s3_hierarchy_index", ["test_hierarchy"])])
+
+        h = S3Hierarchy("test_hierarchy")
+        self.assertFalse(h.indexed)
+        self.assertEqual(h.subtree_query(table.id, roots), None)
+
     # -------------------------------------------------------------------------
     def testExportNode(self):
         """ Test export of nodes """
@@ -0,0 +1,189 @@
+# Eden Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/core/tools/tasks.py
+#
+import unittest
+
+from gluon import current
+
+from core import S3Task
+
+from unit_tests import run_suite
+
+# =============================================================================
+class DeferredTaskTests(unittest.TestCase):
+    """ Tests for deferred tasks """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3 = current.response.s3
+
+        self.calls = calls = []
+        def test_deferred(*args, **kwargs):
+            calls.append((args, kwargs))
+
+        self.tasks = s3.tasks
+        s3.tasks = dict(self.tasks or {})
+        s3.tasks["test_deferred"] = test_deferred
+
+        request = current.request
+        self.is_shell = request.is_shell
+        self.is_scheduler = request.is_scheduler
+        request.is_shell = request.is_scheduler = False
+
+        self.queue = s3.deferred_tasks
+        s3.deferred_tasks = {}
+
+        self.is_alive = S3Task._is_alive
+        S3Task._is_alive = staticmethod(lambda: False)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        s3 = current.response.s3
+        s3.tasks = self.tasks
+        s3.deferred_tasks = self.queue
+
+        request = current.request
+        request.is_shell = self.is_shell
+        request.is_scheduler = self.is_scheduler
+
+        S3Task._is_alive = self.is_alive
+
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testCoalescing(self):
+        """ Test that deferred tasks are coalesced by key """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        s3task = current.s3task
+
+        assertTrue(s3task.defer("test_deferred", args=[1], key=1))
+        assertTrue(s3task.defer("test_deferred", args=[2], key=2))
+        assertFalse(s3task.defer("test_deferred", args=[3], key=1))
+
+        # Default key is task name + args + vars
+        assertTrue(s3task.defer("test_deferred", vars={"a": 1}))
+        assertFalse(s3task.defer("test_deferred", vars={"a": 1}))
+
+        # Nothing is run before flush
+        assertEqual(self.calls, [])
+        assertEqual(s3task.deferred_metrics()["depth"], 3)
+
+        processed = s3task.flush()
+        assertEqual(processed, 3)
+        assertEqual(self.calls, [((3,), {}),
+                                 ((2,), {}),
+                                 ((), {"a": 1}),
+                                 ])
+        assertEqual(s3task.deferred_metrics()["depth"], 0)
+
+    # -------------------------------------------------------------------------
+    def testBatchVariant(self):
+        """ Test that deferred tasks with batch variant are run as batch """
+
+        assertEqual = self.assertEqual
+
+        s3task = current.s3task
+
+        batches = []
+        def test_batched_batch(items):
+            batches.append(items)
+        tasks = current.response.s3.tasks
+        tasks["test_batched"] = lambda item: None
+        tasks["test_batched_batch"] = test_batched_batch
+
+        s3task.defer("test_batched", args=[1], key=1)
+        s3task.defer("test_batched", args=[2], key=2)
+        s3task.defer("test_batched", args=[3], key=1)
+        s3task.defer("test_deferred", args=[4])
+
+        processed = s3task.flush()
+        assertEqual(processed, 3)
+        assertEqual(batches, [[3, 2]])
+        assertEqual(self.calls, [((4,), {})])
+
+    # -------------------------------------------------------------------------
+    def testLocal(self):
+        """ Test that local tasks are run locally even if a worker is alive """
+
+        assertEqual = self.assertEqual
+
+        s3task = current.s3task
+
+        queued = []
+        class Scheduler:
+            def queue_task(self, task, **kwargs):
+                queued.append(task)
+
+        def test_nested():
+            # Deferred while flushing => processed in the same flush
+            s3task.defer("test_deferred", args=[2], local=True)
+        current.response.s3.tasks["test_nested"] = test_nested
+
+        S3Task._is_alive = staticmethod(lambda: True)
+        scheduler = s3task.scheduler
+        s3task.scheduler = Scheduler()
+        try:
+            s3task.defer("test_deferred", args=[1], local=True)
+            s3task.defer("test_nested", local=True)
+            s3task.defer("test_deferred", args=[3])
+
+            processed = s3task.flush()
+        finally:
+            s3task.scheduler = scheduler
+
+        assertEqual(processed, 4)
+        assertEqual(queued, ["test_deferred"])
+        assertEqual(self.calls, [((1,), {}), ((2,), {})])
+
+    # -------------------------------------------------------------------------
+    def testCommitHook(self):
+        """ Test that the commit hook chains to a previously installed hook """
+
+        assertEqual = self.assertEqual
+
+        response = current.response
+        s3task = current.s3task
+
+        commits = []
+        def custom_commit(adapter):
+            commits.append(adapter)
+
+        custom_commit_ = response.custom_commit
+        response.custom_commit = custom_commit
+        response.s3.deferred_tasks = None
+        try:
+            s3task.defer("test_deferred", args=[1])
+
+            adapter = current.db._adapter
+            response.custom_commit(adapter)
+        finally:
+            response.custom_commit = custom_commit_
+
+        assertEqual(commits, [adapter])
+        assertEqual(self.calls, [((1,), {})])
+
+    # -------------------------------------------------------------------------
+    def testUndefinedTask(self):
+        """ Test that undefined tasks are rejected """
+
+        s3task = current.s3task
+
+        self.assertFalse(s3task.defer("test_undefined"))
+        self.assertEqual(s3task.flush(), 0)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        DeferredTaskTests,
+    )
+
+# END ========================================================================
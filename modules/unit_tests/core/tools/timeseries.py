@@ -1124,6 +1124,79 @@ class EventFrameTests(unittest.TestCase):
                                        ])
             assertEqual(result, expected_result)
 
+    # -------------------------------------------------------------------------
+    def testExtendCumulative(self):
+        """ Test running totals of previous events across periods """
+
+        assertEqual = self.assertEqual
+
+        rnd = random.Random(42)
+
+        # Random events with random grouping
+        events = []
+        for event_id in range(60):
+            start = tp_datetime(2012, 1, 1) + datetime.timedelta(days=rnd.randint(-60, 400))
+            if rnd.random() < 0.2:
+                end = None
+            elif rnd.random() < 0.2:
+                # Zero-length event at the start of a period
+                start = end = tp_datetime(2012, rnd.randint(1, 12), 1)
+            else:
+                end = start + datetime.timedelta(days=rnd.randint(0, 120))
+            events.append(TimeSeriesEvent(event_id,
+                                          start = start,
+                                          end = end,
+                                          values = {"base": rnd.randint(0, 10),
+                                                    "slope": rnd.randint(0, 3),
+                                                    },
+                                          row = rnd.choice(["A", "B", ["A", "C"]]),
+                                          col = rnd.choice([1, 2]),
+                                          ))
+
+        ef = TimeSeriesEventFrame(tp_datetime(2012, 1, 1),
+                                  tp_datetime(2012, 12, 31),
+                                  slots = "months",
+                                  )
+        ef.extend(events)
+
+        facts = [TimeSeriesFact("sum", "base"),
+                 TimeSeriesFact("cumulate", "base", slope="slope", interval="weeks"),
+                 ]
+
+        stored = set()
+        for period in ef:
+
+            # Each previous event is stored in only one period
+            pevents = set(period._pevents)
+            self.assertFalse(pevents & stored)
+            stored |= pevents
+
+            # Events are either current or previous
+            current = period.cevents
+            previous = period.pevents
+            self.assertFalse(set(current) & set(previous))
+            for event in previous.values():
+                self.assertTrue(event.end <= period.start)
+
+            # Events are current in the period they start
+            for event in events:
+                if period.start <= event.start < period.end:
+                    self.assertIn(event.event_id, current)
+
+            # Compare with aggregation over all events in a single period
+            expected = TimeSeriesPeriod(period.start, end=period.end)
+            for event in current.values():
+                expected.add_current(event)
+            for event in previous.values():
+                expected.add_previous(event)
+            expected.aggregate(facts)
+
+            period.aggregate(facts)
+            assertEqual(period.totals, expected.totals)
+            assertEqual(period.rows, expected.rows)
+            assertEqual(period.cols, expected.cols)
+            assertEqual(period.matrix, expected.matrix)
+
     # -------------------------------------------------------------------------
     def testPeriodsDays(self):
         """ Test iteration over periods (days) """
@@ -1767,6 +1840,63 @@ class TimeSeriesTests(unittest.TestCase):
                         msg="Period %s cumulative sum should be %s, but is %s" %
                         (i, expected_value, value))
 
+    # -------------------------------------------------------------------------
+    def testEventDataAggregationInDB(self):
+        """ Test aggregation of point events in the database """
+
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        facts = [TimeSeriesFact("count", "id"),
+                 TimeSeriesFact("sum", "parameter1"),
+                 TimeSeriesFact("avg", "parameter2"),
+                 TimeSeriesFact("max", "parameter1"),
+                 ]
+
+        for event_end in (None, "event_start"):
+            for slots in ("months", "weeks", "2 days"):
+
+                result = {}
+                for aggregate in (True, False):
+                    resource = s3db.resource("tp_test_events")
+                    ts = TimeSeries(resource,
+                                    event_start = "event_start",
+                                    event_end = event_end,
+                                    start = "2011-01-01",
+                                    end = "2013-03-01",
+                                    slots = slots,
+                                    rows = "event_type",
+                                    facts = facts,
+                                    aggregate = aggregate,
+                                    )
+                    assertEqual(ts._aggregate_in_db(), True)
+                    result[aggregate] = ts.as_dict()
+
+                assertEqual(result[True], result[False],
+                            msg="Aggregation in DB differs (%s, %s)" %
+                            (event_end, slots))
+
+    # -------------------------------------------------------------------------
+    def testFactMerge(self):
+        """ Test merging of pre-aggregated fact values """
+
+        assertEqual = self.assertEqual
+
+        values = [3, 5]
+        partials = [(2, 9, 4, 5), (0, None, None, None), (1, 1, 1, 1)]
+
+        expected = {"count": 5,
+                    "sum": 18,
+                    "avg": 3.6,
+                    "min": 1,
+                    "max": 5,
+                    }
+        for method, value in expected.items():
+            fact = TimeSeriesFact(method, "parameter1")
+            assertEqual(fact.merge(values, partials), value)
+            assertEqual(fact.merge([], []), 0 if method in ("count", "sum") else None)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def is_now(dt):
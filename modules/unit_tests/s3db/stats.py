@@ -0,0 +1,318 @@
+# Stats Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/stats.py
+#
+import datetime
+import unittest
+
+from gluon import *
+
+from unit_tests import run_suite
+
+# =============================================================================
+class StatsRollupTests(unittest.TestCase):
+    """ Tests for the computation of stats rollup aggregates """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3db = current.s3db
+
+        s3db.configure("stats_rollup_latest",
+                       rollup = {"period": "year",
+                                 "method": "latest",
+                                 },
+                       )
+        s3db.configure("stats_rollup_cumulative",
+                       rollup = {"period": "day",
+                                 "method": "cumulative",
+                                 },
+                       )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        s3db = current.s3db
+
+        s3db.clear_config("stats_rollup_latest")
+        s3db.clear_config("stats_rollup_cumulative")
+
+    # -------------------------------------------------------------------------
+    def testPeriod(self):
+        """ Test the computation of aggregation periods """
+
+        assertEqual = self.assertEqual
+
+        rollup = current.s3db.stats_Rollup("stats_rollup_latest")
+        assertEqual(rollup.period(datetime.date(2020, 5, 17)),
+                    (datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)))
+        assertEqual(rollup.next_period(datetime.date(2020, 1, 1)),
+                    datetime.date(2021, 1, 1))
+
+        rollup = current.s3db.stats_Rollup("stats_rollup_cumulative")
+        assertEqual(rollup.period(datetime.datetime(2020, 5, 17, 8, 0, 0)),
+                    (datetime.date(2020, 5, 17), datetime.date(2020, 5, 17)))
+        assertEqual(rollup.next_period(datetime.date(2020, 12, 31)),
+                    datetime.date(2021, 1, 1))
+
+    # -------------------------------------------------------------------------
+    def testSeriesLatest(self):
+        """ Test the aggregation of the most recent values """
+
+        assertEqual = self.assertEqual
+
+        rollup = current.s3db.stats_Rollup("stats_rollup_latest")
+        TIME, COPY = rollup.TIME, rollup.COPY
+
+        date = datetime.date
+        series = rollup.series([(date(2018, 3, 1), 5),
+                                (date(2018, 7, 1), 7),
+                                (date(2020, 1, 1), 9),
+                                ])
+
+        this_year = current.request.utcnow.year
+        assertEqual(len(series), this_year - 2017)
+        assertEqual(series[date(2018, 1, 1)], (TIME, 7))
+        assertEqual(series[date(2019, 1, 1)], (COPY, 7))
+        assertEqual(series[date(2020, 1, 1)], (TIME, 9))
+        assertEqual(series[date(this_year, 1, 1)], (COPY, 9))
+
+        # Continue from a base value
+        series = rollup.series([], start=date(2020, 1, 1), base=3)
+        assertEqual(series[date(2020, 1, 1)], (COPY, 3))
+
+        # No data
+        assertEqual(rollup.series([]), {})
+
+    # -------------------------------------------------------------------------
+    def testSeriesCumulative(self):
+        """ Test the aggregation of cumulative values """
+
+        assertEqual = self.assertEqual
+
+        rollup = current.s3db.stats_Rollup("stats_rollup_cumulative")
+        TIME = rollup.TIME
+
+        today = current.request.utcnow.date()
+        first = today - datetime.timedelta(days=4)
+        third = today - datetime.timedelta(days=2)
+
+        series = rollup.series([(first, 2),
+                                (third, 1),
+                                (third, 4),
+                                ])
+        assertEqual(len(series), 5)
+        assertEqual(series[first], (TIME, 2))
+        assertEqual(series[first + datetime.timedelta(days=1)], (TIME, 2))
+        assertEqual(series[third], (TIME, 7))
+        assertEqual(series[today], (TIME, 7))
+
+        # Continue from a base value
+        series = rollup.series([(today, 1)], start=third, base=10)
+        assertEqual(series[third], (TIME, 10))
+        assertEqual(series[today], (TIME, 11))
+
+    # -------------------------------------------------------------------------
+    def testRollupTree(self):
+        """ Test the rollup of aggregates over the location tree """
+
+        assertEqual = self.assertEqual
+
+        rollup = current.s3db.stats_Rollup("stats_rollup_cumulative")
+        TIME, LOCATION = rollup.TIME, rollup.LOCATION
+
+        d1 = datetime.date(2020, 1, 1)
+        d2 = datetime.date(2020, 1, 2)
+
+        # 1 => (2 => (4, 5), 3 => 6)
+        tree = {1: None, 2: 1, 3: 1, 4: 2, 5: 2, 6: 3}
+        own = {4: {d1: (TIME, 2), d2: (TIME, 2)},
+               5: {d2: (TIME, 3)},
+               6: {d1: (TIME, 100), d2: (TIME, 100)},
+               # Location with data of its own is not rolled up
+               3: {d1: (TIME, 10), d2: (TIME, 10)},
+               }
+
+        series = rollup.rollup_tree(own, tree)
+        assertEqual(series[2], {d1: (LOCATION, 2), d2: (LOCATION, 5)})
+        assertEqual(series[3], own[3])
+        assertEqual(series[1], {d1: (LOCATION, 12), d2: (LOCATION, 15)})
+
+# =============================================================================
+class StatsRollupUpdateTests(unittest.TestCase):
+    """ Tests for incremental updates of stats rollup aggregates """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        if not current.deployment_settings.has_module("stats"):
+            self.skipTest("stats module not enabled")
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        gis = current.gis
+
+        # Location hierarchy L1 => L2 => (L3, L3)
+        ltable = s3db.gis_location
+        parent = None
+        locations = []
+        for name, level in (("StatsRollupL1", "L1"),
+                            ("StatsRollupL2", "L2"),
+                            ("StatsRollupL3A", "L3"),
+                            ("StatsRollupL3B", "L3"),
+                            ):
+            location = {"name": name,
+                        "level": level,
+                        "parent": parent,
+                        }
+            location["id"] = ltable.insert(**location)
+            gis.update_location_tree(location)
+            locations.append(location["id"])
+            if level != "L3":
+                parent = location["id"]
+        self.locations = locations
+
+        # Demographic
+        table = s3db.stats_demographic
+        demographic = {"name": "StatsRollupTestDemographic"}
+        demographic["id"] = table.insert(**demographic)
+        s3db.update_super(table, demographic)
+        self.parameter_id = demographic["parameter_id"]
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def aggregates(self):
+        """ Extract the aggregates for the test parameter """
+
+        atable = current.s3db.stats_demographic_aggregate
+        query = (atable.parameter_id == self.parameter_id)
+        rows = current.db(query).select(atable.location_id,
+                                        atable.agg_type,
+                                        atable.date,
+                                        atable.sum,
+                                        )
+        return {(row.location_id, row.date): (row.agg_type, row.sum)
+                for row in rows}
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test that incremental updates match a full rebuild """
+
+        db = current.db
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        rollup = s3db.stats_Rollup("stats_demographic_data")
+        table = s3db.stats_demographic_data
+
+        l1, l2, l3a, l3b = self.locations
+        parameter_id = self.parameter_id
+
+        this_year = current.request.utcnow.year
+        date = lambda y: datetime.date(this_year - y, 6, 1)
+
+        records = []
+        for location_id, year, value in ((l3a, 3, 10.0),
+                                         (l3a, 1, 20.0),
+                                         (l3b, 2, 5.0),
+                                         ):
+            record = {"parameter_id": parameter_id,
+                      "location_id": location_id,
+                      "date": date(year),
+                      "value": value,
+                      "approved_by": 0,
+                      }
+            record["id"] = table.insert(**record)
+            records.append(record)
+            rollup.update([(parameter_id, location_id, record["date"])])
+
+        aggregates = self.aggregates()
+
+        # Rolled up to all ancestors
+        start = lambda y: datetime.date(this_year - y, 1, 1)
+        assertEqual(aggregates[(l2, start(3))], (rollup.LOCATION, 10.0))
+        assertEqual(aggregates[(l2, start(2))], (rollup.LOCATION, 15.0))
+        assertEqual(aggregates[(l1, start(1))], (rollup.LOCATION, 25.0))
+        assertEqual(aggregates[(l3b, start(0))], (rollup.COPY, 5.0))
+
+        # Update and delete records
+        record = records[0]
+        db(table.id == record["id"]).update(value = 12.0)
+        rollup.update([(parameter_id, l3a, record["date"])])
+
+        record = records[2]
+        db(table.id == record["id"]).update(deleted = True)
+        rollup.update([(parameter_id, l3b, record["date"])])
+
+        aggregates = self.aggregates()
+        assertEqual(aggregates[(l1, start(2))], (rollup.LOCATION, 12.0))
+        assertEqual(aggregates[(l1, start(0))], (rollup.LOCATION, 20.0))
+        self.assertNotIn((l3b, start(0)), aggregates)
+
+        # Incremental updates produce the same result as a rebuild
+        rollup.rebuild()
+        assertEqual(self.aggregates(), aggregates)
+
+    # -------------------------------------------------------------------------
+    def testDelete(self):
+        """ Test that deleting a record schedules the update of its aggregates """
+
+        auth = current.auth
+        s3db = current.s3db
+        s3task = current.s3task
+
+        table = s3db.stats_demographic_data
+
+        l3a = self.locations[2]
+        date = datetime.date(current.request.utcnow.year, 6, 1)
+
+        record_id = table.insert(parameter_id = self.parameter_id,
+                                 location_id = l3a,
+                                 date = date,
+                                 value = 10.0,
+                                 approved_by = 0,
+                                 )
+
+        deferred = []
+        def defer(task, args=None, vars=None, key=None, timeout=300):
+            deferred.append((task, args))
+            return True
+
+        defer_ = s3task.defer
+        s3task.defer = defer
+        auth.override = False
+        auth.s3_impersonate("admin@example.com")
+        try:
+            resource = s3db.resource("stats_demographic_data", id=record_id)
+            numrows = resource.delete()
+        finally:
+            auth.s3_impersonate(None)
+            auth.override = True
+            s3task.defer = defer_
+
+        self.assertEqual(numrows, 1)
+        self.assertEqual(deferred,
+                         [("stats_rollup_update",
+                           ["stats_demographic_data",
+                            [[self.parameter_id, l3a, date.isoformat()]],
+                            ],
+                           ),
+                          ])
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        StatsRollupTests,
+        StatsRollupUpdateTests,
+    )
+
+# END ========================================================================
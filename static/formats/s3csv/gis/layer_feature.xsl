@@ -13,6 +13,7 @@
          GPS Marker...........string..........Style GPS Marker
          Controller...........string..........Layer Controller
          Function.............string..........Layer Function
+         Table................string..........Layer Table (the database table holding the features)
          Filter...............string..........Layer Filter
          Aggregate............string..........Layer/Style Aggregate (define the non-aggregate style as a row in a separate style.csv)
          Popup Format.........string..........Style Popup Format
@@ -116,6 +117,9 @@
             </xsl:if>
             <data field="controller"><xsl:value-of select="col[@field='Controller']"/></data>
             <data field="function"><xsl:value-of select="col[@field='Function']"/></data>
+            <xsl:if test="col[@field='Table']!=''">
+                <data field="tablename"><xsl:value-of select="col[@field='Table']"/></data>
+            </xsl:if>
             <xsl:if test="col[@field='Filter']!=''">
                 <data field="filter"><xsl:value-of select="col[@field='Filter']"/></data>
             </xsl:if>